@@ -0,0 +1,26 @@
+cimport numpy
+
+cdef class BlockCache:
+    cdef numpy.int64_t[:,:] tag_cache
+    cdef numpy.int64_t[:,:] last_used
+    cdef numpy.int8_t[:,:] cache_dirty
+    cdef int n_sets
+    cdef int n_ways
+    cdef int block_col_size
+    cdef int block_row_size
+    cdef int n_rows
+    cdef int n_cols
+    cdef int n_global_block_cols
+    cdef numpy.int64_t access_count
+    cdef readonly numpy.int64_t hits
+    cdef readonly numpy.int64_t misses
+    cdef readonly numpy.int64_t write_backs
+    cdef public object band_list
+    cdef public object block_list
+    cdef public object update_list
+
+    cdef void update_cache(
+        self, int global_row, int global_col, int *set_index,
+        int *way_index, int *row_block_offset, int *col_block_offset)
+    cdef void write_back(self, int set_index, int way_index)
+    cdef void flush_cache(self)
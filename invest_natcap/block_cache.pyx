@@ -0,0 +1,274 @@
+# cython: profile=False
+"""A set associative, least recently used cache of raster blocks shared by
+the Cython routing cores (ndr_core and seasonal_water_yield_core).
+
+The cache holds `n_sets * n_ways` slots.  A raster block can only live in
+the `n_ways` slots of the set its block index hashes to, and on a miss the
+least recently used slot of that set is written back (if dirty) and
+replaced.  Callers address the cached data with the (set, way) slot and
+the in-block offsets returned by `update_cache`, so each cached raster is a
+4D numpy array shaped (n_sets, n_ways, block_row_size, block_col_size).
+
+The number of slots is either the default a core asks for or, if a memory
+budget is set with `set_memory_budget` or the INVEST_BLOCK_CACHE_BYTES
+environment variable, as many as fit in that budget."""
+
+import logging
+import os
+
+import numpy
+cimport numpy
+cimport cython
+
+LOGGER = logging.getLogger('invest_natcap.block_cache')
+
+#Routing kernels hold up to 4 distinct blocks (a pixel's and the blocks of
+#the neighbors it's looking at) at once.  With at least this many ways LRU
+#replacement never evicts one of them while it's in use.
+MIN_WAYS = 4
+
+#The memory budget in bytes for a single cache, or None to use the slot
+#count each core asks for.
+_MEMORY_BUDGET = None
+if 'INVEST_BLOCK_CACHE_BYTES' in os.environ:
+    _MEMORY_BUDGET = int(os.environ['INVEST_BLOCK_CACHE_BYTES'])
+
+
+def set_memory_budget(n_bytes):
+    """Sets the memory budget of each block cache created afterwards.
+
+        n_bytes - the number of bytes a cache may use for its blocks, or
+            None to go back to each core's default slot count
+
+        returns nothing"""
+    global _MEMORY_BUDGET
+    _MEMORY_BUDGET = n_bytes
+
+
+def get_memory_budget():
+    """Returns the current memory budget in bytes or None if unset."""
+    return _MEMORY_BUDGET
+
+
+def cache_geometry(
+        int default_n_slots, int block_row_size, int block_col_size,
+        dtype_list, int n_ways=MIN_WAYS):
+    """Calculates how many sets and ways a cache should have.
+
+        default_n_slots - the number of slots to use if no memory budget is
+            set
+        block_row_size, block_col_size - the dimensions of a raster block
+        dtype_list - the numpy dtypes of every cached raster, a slot holds
+            one block of each
+        n_ways - the associativity of the cache, raised to MIN_WAYS if lower
+
+        returns a tuple (n_sets, n_ways)"""
+
+    n_ways = max(n_ways, MIN_WAYS)
+    n_slots = default_n_slots
+    if _MEMORY_BUDGET is not None:
+        slot_bytes = block_row_size * block_col_size * sum(
+            [numpy.dtype(dtype).itemsize for dtype in dtype_list])
+        n_slots = _MEMORY_BUDGET // slot_bytes
+        if n_slots < n_ways:
+            LOGGER.warn(
+                'a memory budget of %d bytes fits %d blocks, using the '
+                'minimum of %d', _MEMORY_BUDGET, n_slots, n_ways)
+    n_sets = max(n_slots // n_ways, 1)
+    return n_sets, n_ways
+
+
+cdef class BlockCache:
+    def __cinit__(
+            self, int n_sets, int n_ways, int n_rows, int n_cols,
+            int block_row_size, int block_col_size, band_list, block_list,
+            update_list, numpy.int8_t[:,:] cache_dirty):
+        """Creates a cache over the bands in `band_list`.
+
+            n_sets, n_ways - the cache geometry, see cache_geometry
+            n_rows, n_cols - the dimensions of every band
+            block_row_size, block_col_size - the dimensions of a block
+            band_list - the gdal bands to cache
+            block_list - a 4D numpy array per band shaped (n_sets, n_ways,
+                block_row_size, block_col_size) that holds its cached blocks
+            update_list - a boolean per band, True if dirty blocks of that
+                band should be written back
+            cache_dirty - a (n_sets, n_ways) int8 array the caller sets to 1
+                when it modifies a slot"""
+        self.n_sets = n_sets
+        self.n_ways = n_ways
+        self.block_col_size = block_col_size
+        self.block_row_size = block_row_size
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.n_global_block_cols = (
+            (n_cols + block_col_size - 1) // block_col_size)
+        self.tag_cache = numpy.empty((n_sets, n_ways), dtype=numpy.int64)
+        self.tag_cache[:] = -1
+        self.last_used = numpy.zeros((n_sets, n_ways), dtype=numpy.int64)
+        self.cache_dirty = cache_dirty
+        self.access_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.write_backs = 0
+        self.band_list = list(band_list)
+        self.block_list = list(block_list)
+        self.update_list = list(update_list)
+        list_lengths = [len(x) for x in [band_list, block_list, update_list]]
+        if len(set(list_lengths)) > 1:
+            raise ValueError(
+                "lengths of band_list, block_list, update_list should be equal."
+                " instead they are %s", list_lengths)
+        raster_dimensions_list = [(b.YSize, b.XSize) for b in band_list]
+        for raster_n_rows, raster_n_cols in raster_dimensions_list:
+            if raster_n_rows != n_rows or raster_n_cols != n_cols:
+                raise ValueError(
+                    "a band was passed in that has a different dimension than"
+                    "the memory block was specified as")
+        for block in block_list:
+            if block.shape[0:2] != (n_sets, n_ways):
+                raise ValueError(
+                    "a block array of shape %s doesn't match the cache "
+                    "geometry of %d sets and %d ways" % (
+                        block.shape, n_sets, n_ways))
+
+        for band in band_list:
+            band_block_col_size, band_block_row_size = band.GetBlockSize()
+            if band_block_col_size == 1 or band_block_row_size == 1:
+                LOGGER.warn(
+                    'a band in BlockCache is not memory blocked, this might '
+                    'make the runtime slow for other algorithms. %s',
+                    band.GetDescription())
+
+    def __dealloc__(self):
+        self.band_list = []
+        self.block_list = []
+        self.update_list = []
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void update_cache(
+            self, int global_row, int global_col, int *set_index,
+            int *way_index, int *row_block_offset, int *col_block_offset):
+        """Makes sure the block holding (global_row, global_col) is cached
+            and sets the slot and in-block offsets that address it."""
+        cdef int global_block_row = global_row // self.block_row_size
+        cdef int global_block_col = global_col // self.block_col_size
+        cdef numpy.int64_t block_tag = (
+            <numpy.int64_t>global_block_row * self.n_global_block_cols +
+            global_block_col)
+        cdef int way, replace_way
+        cdef int global_row_offset, global_col_offset
+        cdef int cache_row_size, cache_col_size
+
+        row_block_offset[0] = global_row % self.block_row_size
+        col_block_offset[0] = global_col % self.block_col_size
+        set_index[0] = block_tag % self.n_sets
+        self.access_count += 1
+
+        for way in xrange(self.n_ways):
+            if self.tag_cache[set_index[0], way] == block_tag:
+                self.hits += 1
+                self.last_used[set_index[0], way] = self.access_count
+                way_index[0] = way
+                return
+
+        #miss: fill an empty way if there is one, otherwise replace the
+        #least recently used one
+        self.misses += 1
+        replace_way = 0
+        for way in xrange(self.n_ways):
+            if self.tag_cache[set_index[0], way] == -1:
+                replace_way = way
+                break
+            if (self.last_used[set_index[0], way] <
+                    self.last_used[set_index[0], replace_way]):
+                replace_way = way
+        way_index[0] = replace_way
+
+        if self.tag_cache[set_index[0], replace_way] != -1:
+            self.write_back(set_index[0], replace_way)
+
+        self.tag_cache[set_index[0], replace_way] = block_tag
+        self.last_used[set_index[0], replace_way] = self.access_count
+
+        global_row_offset = global_block_row * self.block_row_size
+        global_col_offset = global_block_col * self.block_col_size
+        cache_row_size = self.n_rows - global_row_offset
+        if cache_row_size > self.block_row_size:
+            cache_row_size = self.block_row_size
+        cache_col_size = self.n_cols - global_col_offset
+        if cache_col_size > self.block_col_size:
+            cache_col_size = self.block_col_size
+
+        for band, block in zip(self.band_list, self.block_list):
+            band.ReadAsArray(
+                xoff=global_col_offset, yoff=global_row_offset,
+                win_xsize=cache_col_size, win_ysize=cache_row_size,
+                buf_obj=block[set_index[0], replace_way, 0:cache_row_size,
+                              0:cache_col_size])
+
+    @cython.cdivision(True)
+    cdef void write_back(self, int set_index, int way_index):
+        """Writes the slot back to the updated bands if it's dirty."""
+        if not self.cache_dirty[set_index, way_index]:
+            return
+        cdef numpy.int64_t block_tag = self.tag_cache[set_index, way_index]
+        cdef int global_row_offset = (
+            block_tag // self.n_global_block_cols) * self.block_row_size
+        cdef int global_col_offset = (
+            block_tag % self.n_global_block_cols) * self.block_col_size
+        cdef int cache_row_size = self.n_rows - global_row_offset
+        if cache_row_size > self.block_row_size:
+            cache_row_size = self.block_row_size
+        cdef int cache_col_size = self.n_cols - global_col_offset
+        if cache_col_size > self.block_col_size:
+            cache_col_size = self.block_col_size
+
+        for band, block, update in zip(
+                self.band_list, self.block_list, self.update_list):
+            if update:
+                band.WriteArray(
+                    block[set_index, way_index, 0:cache_row_size,
+                          0:cache_col_size],
+                    yoff=global_row_offset, xoff=global_col_offset)
+        self.cache_dirty[set_index, way_index] = 0
+        self.write_backs += 1
+
+    cdef void flush_cache(self):
+        """Writes back every dirty slot and flushes the bands."""
+        cdef int set_index, way_index
+        for set_index in xrange(self.n_sets):
+            for way_index in xrange(self.n_ways):
+                if self.tag_cache[set_index, way_index] != -1:
+                    self.write_back(set_index, way_index)
+        for band in self.band_list:
+            band.FlushCache()
+        LOGGER.info(
+            'block cache of %d sets x %d ways: %d hits, %d misses, %d write '
+            'backs', self.n_sets, self.n_ways, self.hits, self.misses,
+            self.write_backs)
+
+    def lookup(self, int global_row, int global_col):
+        """Python access to update_cache for scripts and tests.
+
+            returns a tuple (set index, way index, row offset in block, col
+                offset in block) that addresses the pixel in block_list"""
+        cdef int set_index, way_index, row_block_offset, col_block_offset
+        self.update_cache(
+            global_row, global_col, &set_index, &way_index,
+            &row_block_offset, &col_block_offset)
+        return set_index, way_index, row_block_offset, col_block_offset
+
+    def flush(self):
+        """Python access to flush_cache."""
+        self.flush_cache()
+
+    def stats(self):
+        """Returns a dictionary of the hit, miss and write back counts."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'write_backs': self.write_backs,
+        }
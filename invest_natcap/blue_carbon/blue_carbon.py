@@ -21,6 +21,9 @@ logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 
 LOGGER = logging.getLogger('invest_natcap.blue_carbon.blue_carbon')
 
+# The number of pixels of each raster read at once when summing rasters
+ZONAL_BLOCK_PIXELS = 2**20
+
 
 def transition_soil_carbon(area_final, carbon_final, depth_final,
                            transition_rate, year, area_initial,
@@ -152,24 +155,102 @@ def sum_uri(dataset_uri, datasource_uri):
 
 
 def sum_by_category_uri(category_uri, value_uri,categories=None):
-    if categories == None:
-        categories = raster_utils.unique_raster_values_count(category_uri).keys()
+    """Sums the values of a raster within each category of another raster.
 
-    category_src = gdal.Open(category_uri)
-    category_band = category_src.GetRasterBand(1)
+    Args:
+        category_uri (str): The uri for the category raster.
+        value_uri (str): The uri for the value raster, aligned with
+            category_uri.
+        categories (list): The categories to sum, all of the categories of
+            category_uri other than nodata if None.
 
-    values_src = gdal.Open(value_uri)
-    values_band = values_src.GetRasterBand(1)
+    Returns:
+        dict: The total of the values not nodata in each category
+    """
+    return zonal_sums_uri([value_uri], category_uri, categories)[0]
 
-    category_sum = dict(zip(categories,[0]*len(categories)))
-    for category in categories:
-        for row_index in range(category_band.YSize):
-            category_array = category_band.ReadAsArray(0, row_index, category_band.XSize, 1)[0]
-            values_array = values_band.ReadAsArray(0, row_index, values_band.XSize, 1)[0]
 
-            category_sum[category]+=numpy.sum(values_array[category_array == category])
+def zonal_sums_uri(value_uri_list, category_uri=None, categories=None):
+    """Sums several aligned value rasters, by category if a category raster
+    is given, in a single block-wise pass over the rasters.  Nodata values
+    are left out of the sums.
 
-    return category_sum
+    Args:
+        value_uri_list (list): The uris for the value rasters.
+        category_uri (str): The uri for a category raster aligned with the
+            value rasters, or None to sum each raster in full.
+        categories (list): The categories to sum, all of the categories of
+            category_uri other than nodata if None.
+
+    Returns:
+        list: A dictionary of the total in each category per value raster,
+            or if category_uri is None, the total of each value raster
+    """
+    value_band_list = []
+    for value_uri in value_uri_list:
+        value_src = gdal.Open(value_uri)
+        value_band_list.append((value_src, value_src.GetRasterBand(1)))
+    value_nodata_list = [
+        raster_utils.get_nodata_from_uri(value_uri)
+        for value_uri in value_uri_list]
+
+    if category_uri is not None:
+        category_src = gdal.Open(category_uri)
+        category_band = category_src.GetRasterBand(1)
+        category_nodata = raster_utils.get_nodata_from_uri(category_uri)
+        n_rows, n_cols = category_band.YSize, category_band.XSize
+    else:
+        category_band = None
+        n_rows, n_cols = value_band_list[0][1].YSize, value_band_list[0][1].XSize
+
+    sum_list = [{} for _ in value_uri_list]
+    if categories is not None:
+        sum_list = [
+            dict([(category, 0) for category in categories])
+            for _ in value_uri_list]
+
+    strip_rows = max(1, ZONAL_BLOCK_PIXELS / n_cols)
+    for row_index in range(0, n_rows, strip_rows):
+        n_strip_rows = min(strip_rows, n_rows - row_index)
+        if category_band is not None:
+            category_array = category_band.ReadAsArray(
+                0, row_index, n_cols, n_strip_rows).ravel()
+            if categories is not None:
+                category_mask = numpy.in1d(category_array, categories)
+            elif category_nodata is not None:
+                category_mask = category_array != category_nodata
+            else:
+                category_mask = numpy.ones(category_array.shape, dtype=bool)
+            category_array = category_array[category_mask]
+            # number the categories in this block for bincount
+            block_categories, category_index = numpy.unique(
+                category_array, return_inverse=True)
+
+        for value_sum, (_, value_band), value_nodata in zip(
+                sum_list, value_band_list, value_nodata_list):
+            value_array = value_band.ReadAsArray(
+                0, row_index, n_cols, n_strip_rows).ravel()
+            if category_band is None:
+                if value_nodata is not None:
+                    value_array = value_array[value_array != value_nodata]
+                value_sum[None] = value_sum.get(None, 0) + numpy.sum(
+                    value_array, dtype=numpy.float64)
+                continue
+
+            value_array = value_array[category_mask]
+            if value_nodata is not None:
+                value_array = numpy.where(
+                    value_array != value_nodata, value_array, 0)
+            category_totals = numpy.bincount(
+                category_index, weights=value_array,
+                minlength=block_categories.size)
+            for category, total in zip(
+                    block_categories.tolist(), category_totals.tolist()):
+                value_sum[category] = value_sum.get(category, 0) + total
+
+    if category_band is None:
+        return [value_sum.get(None, 0) for value_sum in sum_list]
+    return sum_list
 
 
 def alignment_check_uri(dataset_uri_list):
@@ -920,7 +1001,7 @@ def execute(args):
             veg_dis_bio_uri_list.append(this_veg_dis_bio_uri)
             veg_dis_soil_uri_list.append(this_veg_dis_soil_uri)
 
-            for name, uri in [(veg_acc_bio_name, this_veg_acc_bio_uri),
+            name_uri_list = [(veg_acc_bio_name, this_veg_acc_bio_uri),
                               (veg_acc_soil_name, this_veg_acc_soil_uri),
                               (veg_dis_bio_name, this_veg_dis_bio_uri),
                               (veg_dis_soil_name, this_veg_dis_soil_uri),
@@ -931,8 +1012,11 @@ def execute(args):
                               (veg_em_bio_name, this_veg_em_bio_uri),
                               (veg_em_soil_name, this_veg_em_soil_uri),
                               (veg_adj_em_dis_bio_name, this_veg_adj_em_dis_bio_uri),
-                              (veg_adj_em_dis_soil_name, this_veg_adj_em_dis_soil_uri)]:
-                totals[this_year][veg_type][name] = sum_uri(uri, extent_uri)
+                              (veg_adj_em_dis_soil_name, this_veg_adj_em_dis_soil_uri)]
+            for (name, _), total in zip(
+                    name_uri_list,
+                    zonal_sums_uri([uri for _, uri in name_uri_list])):
+                totals[this_year][veg_type][name] = total
 
             ##switch base carbon rasters
             this_total_carbon_uri_list.append(veg_base_uri_dict[veg_type][base_veg_acc_bio])
@@ -1260,9 +1344,8 @@ def execute(args):
         gain_uri = os.path.join(workspace_dir, gain_name % (this_year, next_year))
         loss_uri = os.path.join(workspace_dir, loss_name % (this_year, next_year))
 
-        gain = sum_uri(gain_uri, extent_uri)
-        loss = sum_uri(loss_uri, extent_uri)
-        total_seq = sum_uri(total_seq_uri, extent_uri)
+        gain, loss, total_seq = zonal_sums_uri(
+            [gain_uri, loss_uri, total_seq_uri])
 
         row.append(str(int(gain)))
         row.append(str(int(loss)))
@@ -1331,12 +1414,12 @@ def execute(args):
             em_soil_value_uri = os.path.join(workspace_dir, em_soil_value_name  % (this_year, next_year))
             value_uri = os.path.join(workspace_dir, value_name  % (this_year, next_year))
 
-            for uri in [acc_value_uri,
-                        em_bio_value_uri,
-                        em_soil_value_uri,
-                        value_uri]:
+            for total in zonal_sums_uri([acc_value_uri,
+                                         em_bio_value_uri,
+                                         em_soil_value_uri,
+                                         value_uri]):
 
-                row.append(str(int(sum_uri(uri, extent_uri))))
+                row.append(str(int(total)))
 
             report.write("<TR><TD ALIGN=\"RIGHT\">" + "</TD><TD ALIGN=\"RIGHT\">".join(row) + "</TR></TD>")
 
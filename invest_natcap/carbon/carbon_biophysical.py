@@ -21,6 +21,9 @@ LOGGER = logging.getLogger('invest_natcap.carbon.biophysical')
 
 NUM_MONTE_CARLO_RUNS = 10000
 
+#The number of Monte Carlo runs sampled in memory at once
+MONTE_CARLO_BLOCK_RUNS = 2**14
+
 class MapCarbonPoolError(Exception):
     """A custom error for catching lulc codes from a raster that do not
         match the carbon pools data file"""
@@ -51,6 +54,15 @@ def execute_30(**args):
         args['confidence_threshold'] - a number between 0 and 100 that indicates
             the minimum threshold for which we should highlight regions in the output
             raster. (required if 'do_uncertainty' is True)
+        args['monte_carlo_runs'] - the number of Monte Carlo runs of the
+            uncertainty analysis (optional, defaults to NUM_MONTE_CARLO_RUNS)
+        args['monte_carlo_seed'] - an integer seed that makes the Monte Carlo
+            runs reproducible (optional)
+        args['uncertainty_percentiles'] - a list of numbers between 0 and 100.
+            For each one a raster is made of that percentile of the carbon
+            stored per grid cell over the Monte Carlo runs, and of the
+            carbon sequestered if there's a future or REDD scenario.
+            (optional, only used if 'do_uncertainty' is True)
         args['lulc_fut_uri'] - is a uri to a GDAL raster dataset (optional
          if calculating sequestration)
         args['lulc_cur_year'] - An integer representing the year of lulc_cur
@@ -286,7 +298,27 @@ def execute_30(**args):
     if (do_uncertainty and
         'hwp_cur_shape_uri' not in args and
         'hwp_fut_shape_uri' not in args):
-        outputs['uncertainty'] = _compute_uncertainty_data(args, pools)
+        percentile_uris = {}
+        for percentile in args.get('uncertainty_percentiles', []):
+            for scenario_type in ['cur', 'fut', 'redd']:
+                if 'lulc_%s_uri' % scenario_type not in args:
+                    continue
+                percentile_uris[(scenario_type, percentile)] = outfile_uri(
+                    'tot_C_p%g' % percentile, scenario_type)
+                if scenario_type != 'cur':
+                    percentile_uris[
+                        ('sequest_%s' % scenario_type, percentile)] = (
+                            outfile_uri('sequest_p%g' % percentile,
+                                        scenario_type))
+        outputs['uncertainty'] = _compute_uncertainty_data(
+            args, pools, percentile_uris)
+        for (scenario, percentile), percentile_uri in percentile_uris.items():
+            if scenario.startswith('sequest_'):
+                output_key = 'sequest_p%g_%s' % (
+                    percentile, scenario.split('_')[1])
+            else:
+                output_key = 'tot_C_p%g_%s' % (percentile, scenario)
+            outputs[output_key] = percentile_uri
 
     return outputs
 
@@ -352,8 +384,22 @@ def _compute_cell_area_ha(args):
     return cell_area_cur / 10000.0
 
 
-def _compute_uncertainty_data(args, pools):
-    """Computes the mean and std dev for carbon storage and sequestration."""
+def _compute_uncertainty_data(args, pools, percentile_uris=None):
+    """Computes the mean and std dev for carbon storage and sequestration.
+
+        args - the model's args, may also have
+            args['monte_carlo_runs'] - the number of Monte Carlo runs,
+                defaults to NUM_MONTE_CARLO_RUNS
+            args['monte_carlo_seed'] - an integer seed that makes the runs
+                reproducible, otherwise numpy's global random state is used
+        pools - the dict returned by _compute_carbon_pools
+        percentile_uris - (optional) a dict mapping (scenario, percentile)
+            tuples to uris of rasters to create with that percentile of the
+            carbon per grid cell over the runs.  scenario is 'cur', 'fut',
+            'redd', 'sequest_fut' or 'sequest_redd'.
+
+        returns a dict mapping each scenario and sequestration to a
+            (mean, std dev) tuple of its total carbon"""
 
     LOGGER.info("Computing uncertainty data.")
 
@@ -368,65 +414,181 @@ def _compute_uncertainty_data(args, pools):
         lulc_counts[scenario] = pygeoprocessing.geoprocessing.unique_raster_values_count(
             lulc_uri)
 
-    # Do a Monte Carlo simulation for carbon storage.
-    monte_carlo_results = {}
-    LOGGER.info("Beginning Monte Carlo simulation.")
-    for _ in range(NUM_MONTE_CARLO_RUNS):
-        run_results = _do_monte_carlo_run(pools, lulc_counts)
-
-        # Note that in this context, 'scenario' could be an actual scenario
-        # (e.g. current, future, REDD) or it could be a sequestration
-        # (e.g. sequestration under future or sequestration under REDD).
-        for scenario, carbon_amount in run_results.items():
-            try:
-                monte_carlo_results[scenario].append(carbon_amount)
-            except KeyError:
-                monte_carlo_results[scenario] = [carbon_amount]
-
+    if 'monte_carlo_seed' in args:
+        random_state = numpy.random.RandomState(int(args['monte_carlo_seed']))
+    else:
+        random_state = numpy.random
+    n_runs = int(args.get('monte_carlo_runs', NUM_MONTE_CARLO_RUNS))
+    keep_samples = bool(percentile_uris)
+
+    # The counts form a (lulc types x scenarios) matrix so that the carbon
+    # in every scenario of a block of runs is a single matrix product.
+    lulc_ids = pools.keys()
+    lulc_index = dict(
+        (lulc_id, index) for index, lulc_id in enumerate(lulc_ids))
+    scenarios = lulc_counts.keys()
+    count_matrix = numpy.zeros((len(lulc_ids), len(scenarios)))
+    for scenario_index, scenario in enumerate(scenarios):
+        for lulc_id, count in lulc_counts[scenario].items():
+            count_matrix[lulc_index[lulc_id], scenario_index] = count
+
+    LOGGER.info("Beginning Monte Carlo simulation of %d runs.", n_runs)
+    carbon_totals = numpy.empty((n_runs, len(scenarios)))
+    if keep_samples:
+        samples = numpy.empty((n_runs, len(lulc_ids)))
+    for run_offset in xrange(0, n_runs, MONTE_CARLO_BLOCK_RUNS):
+        block_runs = min(MONTE_CARLO_BLOCK_RUNS, n_runs - run_offset)
+        sample_block = _draw_carbon_samples(
+            pools, lulc_ids, block_runs, random_state)
+        carbon_totals[run_offset:run_offset + block_runs] = numpy.dot(
+            sample_block, count_matrix)
+        if keep_samples:
+            samples[run_offset:run_offset + block_runs] = sample_block
     LOGGER.info("Done with Monte Carlo simulation.")
 
+    # Note that in this context, 'scenario' could be an actual scenario
+    # (e.g. current, future, REDD) or it could be a sequestration
+    # (e.g. sequestration under future or sequestration under REDD).
+    monte_carlo_results = {}
+    for scenario_index, scenario in enumerate(scenarios):
+        monte_carlo_results[scenario] = carbon_totals[:, scenario_index]
+    for scenario in ['fut', 'redd']:
+        if scenario not in monte_carlo_results:
+            continue
+        monte_carlo_results['sequest_%s' % scenario] = (
+            monte_carlo_results[scenario] - monte_carlo_results['cur'])
+
     # Compute the mean and standard deviation for each scenario.
     results = {}
     for scenario in monte_carlo_results:
         results[scenario] = norm.fit(monte_carlo_results[scenario])
 
+    if keep_samples:
+        _make_percentile_rasters(args, lulc_ids, samples, percentile_uris)
+
     return results
 
 
-def _do_monte_carlo_run(pools, lulc_counts):
-    """Do a single Monte Carlo run for carbon storage.
+def _draw_carbon_samples(pools, lulc_ids, n_runs, random_state):
+    """Samples carbon-per-grid-cell for a block of Monte Carlo runs.
+
+    Each lulc type is sampled independently from its normal distribution,
+    the types without variance are set to their total.  The draws are made
+    run by run in the order of lulc_ids, so a seeded random state gives the
+    same samples however the runs are split into blocks.
 
-    Returns a dict with the results, keyed by scenario, and
-    # including results for sequestration.
+    Returns a (n_runs x len(lulc_ids)) array.
     """
+    totals = numpy.array([pools[lulc_id]['total'] for lulc_id in lulc_ids])
+    variable_index = numpy.array([
+        index for index, lulc_id in enumerate(lulc_ids)
+        if pools[lulc_id]['variance']], dtype=int)
+    std_devs = numpy.sqrt(numpy.array([
+        pools[lulc_ids[index]]['variance'] for index in variable_index]))
+
+    sample_block = numpy.tile(totals, (n_runs, 1))
+    if variable_index.size > 0:
+        sample_block[:, variable_index] = random_state.normal(
+            totals[variable_index], std_devs,
+            size=(n_runs, variable_index.size))
+    return sample_block
+
+
+def _make_percentile_rasters(args, lulc_ids, samples, percentile_uris):
+    """Maps percentiles of the Monte Carlo carbon per grid cell to rasters.
+
+    The storage percentile of a grid cell depends only on its lulc type and
+    the sequestration percentile only on its current and future lulc types,
+    so they're computed once per type, or pair of types, that occurs and
+    looked up a block at a time.  As in the sequestration rasters, a nodata
+    cell in only one of the scenarios holds no carbon.
+
+    Returns nothing.
+    """
+    nodata_out = -5.0
+    n_types = len(lulc_ids)
+    sorted_order = numpy.argsort(lulc_ids)
+    sorted_ids = numpy.array(lulc_ids)[sorted_order]
+    percentile_list = sorted(set(
+        percentile for _, percentile in percentile_uris))
+    percentile_position = dict(
+        (percentile, index) for index, percentile in enumerate(percentile_list))
+
+    # (percentiles x lulc types) storage percentiles, the last column is for
+    # nodata cells
+    storage_percentiles = numpy.empty((len(percentile_list), n_types + 1))
+    storage_percentiles[:, :n_types] = numpy.percentile(
+        samples, percentile_list, axis=0)
+    storage_percentiles[:, n_types] = nodata_out
+
+    # (current type, future type) -> percentiles of their difference, with
+    # n_types standing for nodata
+    sequest_percentiles = {}
+
+    def type_index(lulc_array, lulc_nodata):
+        """Returns the position in lulc_ids of each cell's type, or n_types
+            where the cell is nodata"""
+        position = numpy.searchsorted(sorted_ids, lulc_array).clip(
+            0, n_types - 1)
+        index = sorted_order[position]
+        return numpy.where(lulc_array == lulc_nodata, n_types, index)
+
+    pixel_size_out = pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+        args['lulc_cur_uri'])
+    for (scenario, percentile), percentile_uri in percentile_uris.items():
+        LOGGER.info(
+            'Mapping the %s percentile of carbon for %s.', percentile,
+            scenario)
+        row = percentile_position[percentile]
+        if not scenario.startswith('sequest_'):
+            lulc_uri = args['lulc_%s_uri' % scenario]
+            lulc_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+                lulc_uri)
 
-    # Sample carbon-per-grid-cell from the given normal distribution.
-    # We sample this independently for each LULC type.
-    lulc_carbon_samples = {}
-    for lulc_id, distribution in pools.items():
-        if not distribution['variance']:
-            lulc_carbon_samples[lulc_id] = distribution['total']
-        else:
-            lulc_carbon_samples[lulc_id] = numpy.random.normal(
-                distribution['total'],
-                math.sqrt(distribution['variance']))
-
-    # Compute the amount of carbon in each scenario.
-    results = {}
-    for scenario, counts in lulc_counts.items():
-        # Amount of carbon is the sum across all lulc types of:
-        # (number of grid cells) x (carbon per grid cell)
-        results[scenario] = sum(
-            count * lulc_carbon_samples[lulc_id]
-            for lulc_id, count in counts.items())
-
-    # Compute sequestration.
-    for scenario in ['fut', 'redd']:
-        if scenario not in results:
+            def storage_op(lulc):
+                return storage_percentiles[row][type_index(lulc, lulc_nodata)]
+
+            pygeoprocessing.geoprocessing.vectorize_datasets(
+                [lulc_uri], storage_op, percentile_uri, gdal.GDT_Float32,
+                nodata_out, pixel_size_out, "intersection",
+                dataset_to_align_index=0, vectorize_op=False)
             continue
-        results['sequest_%s' % scenario] = results[scenario] - results['cur']
 
-    return results
+        fut_type = scenario.split('_')[1]
+        lulc_uri_list = [
+            args['lulc_cur_uri'], args['lulc_%s_uri' % fut_type]]
+        cur_nodata, fut_nodata = [
+            pygeoprocessing.geoprocessing.get_nodata_from_uri(lulc_uri)
+            for lulc_uri in lulc_uri_list]
+
+        def sequest_op(lulc_cur, lulc_fut):
+            pair_code = (
+                type_index(lulc_cur, cur_nodata) * (n_types + 1) +
+                type_index(lulc_fut, fut_nodata))
+            unique_codes, code_index = numpy.unique(
+                pair_code.ravel(), return_inverse=True)
+            unique_values = numpy.empty(unique_codes.size)
+            for code_position, code in enumerate(unique_codes):
+                pair = divmod(int(code), n_types + 1)
+                if pair not in sequest_percentiles:
+                    if pair == (n_types, n_types):
+                        sequest_percentiles[pair] = numpy.repeat(
+                            nodata_out, len(percentile_list))
+                    else:
+                        difference = numpy.zeros(samples.shape[0])
+                        if pair[1] != n_types:
+                            difference += samples[:, pair[1]]
+                        if pair[0] != n_types:
+                            difference -= samples[:, pair[0]]
+                        sequest_percentiles[pair] = numpy.percentile(
+                            difference, percentile_list)
+                unique_values[code_position] = sequest_percentiles[pair][row]
+            return unique_values[code_index].reshape(pair_code.shape)
+
+        pygeoprocessing.geoprocessing.vectorize_datasets(
+            lulc_uri_list, sequest_op, percentile_uri, gdal.GDT_Float32,
+            nodata_out, pixel_size_out, "intersection",
+            dataset_to_align_index=0, vectorize_op=False)
 
 
 def _calculate_hwp_storage_cur(
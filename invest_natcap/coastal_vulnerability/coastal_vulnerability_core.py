@@ -28,6 +28,7 @@ logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s \
 
 SECTOR_COUNT = 16 # Number of equi-angular sectors
 MAX_FETCH = 60000 # Longest fetch ray
+FETCH_BATCH_PIXELS = 2**20 # Ray pixels compute_fetch casts at once
 SHELTERED_SHORE = 0
 EXPOSED_SHORE = 1
 
@@ -3404,7 +3405,6 @@ def compute_fetch(land_array, rays_per_sector, d_max, cell_size, \
     direction_step = 2.0 * math.pi / direction_count
     directions_rad = [a * direction_step for a in direction_range]
     direction_vectors = fetch_vectors(directions_rad)
-    unit_step_length = np.empty(direction_vectors.shape[0])
     # Perform a bunch of tests to ensure the assumptions in the fetch algorithm
     # are valid
     # Check that bathy and landmass rasters are size-compatible
@@ -3439,162 +3439,119 @@ def compute_fetch(land_array, rays_per_sector, d_max, cell_size, \
     message = 'There are ' + str(shore_points_on_land) + \
     ' shore points on land. There should be none.'
     assert shore_points_on_land == 0, message
-    # Compute the ray paths in each direction to their full length (d_max).
-    # We'll clip them for each point in two steps (raster boundaries & land)
-    # The points returned by the cast function are relative to the origin (0,0)
-    ray_path = {}
-    valid_depths = 0 # used to determine if there are non-nodata depths
+    # Cast the rays one direction at a time, each one from a batch of shore
+    # points at once. The ray path relative to the origin (0,0) is computed
+    # to its full length (MAX_FETCH) and _cast_fetch_rays clips it for every
+    # point in the batch at the raster boundaries and the first landmass.
+    shore_rows = np.asarray(shore_points[0])
+    shore_cols = np.asarray(shore_points[1])
+    point_count = shore_rows.size
+    ray_distances = np.empty((point_count, direction_count))
+    ray_depths = np.empty((point_count, direction_count))
     for d in direction_range:
-        result = \
-        cast_ray_fast(direction_vectors[d], MAX_FETCH/cell_size)
-        ray_path[directions_rad[d]] = result[0]
-        unit_step_length[d] = result[1]
-    # For each point, we use the rays in ray_path, and clip them in 2 steps:
-    # 1)- clip the ray paths that go beyond the raster boundaries
-    # 2)- If a ray passes over a landmass, remove that section till the end
-    # All this computation has to be done on a per-point basis.
-    point_list = np.array(zip(shore_points[0], shore_points[1]))
-    #print('shore_geo', GT)
-    x_points = shore_points[1] * GT[1] + GT[0] + shore_points[0] * GT[2]
-    y_points = shore_points[1] * GT[4] + GT[3] + shore_points[0] * GT[5]
+        (ray_i, ray_j), unit_step_length = \
+            cast_ray_fast(direction_vectors[d], MAX_FETCH/cell_size)
+        batch_size = max(1, FETCH_BATCH_PIXELS / ray_i.size)
+        for batch_start in range(0, point_count, batch_size):
+            batch = slice(batch_start, batch_start + batch_size)
+            ray_distances[batch, d], ray_depths[batch, d] = \
+                _cast_fetch_rays(shore_rows[batch], shore_cols[batch], \
+                ray_i, ray_j, unit_step_length, cell_size, land_array, \
+                bathymetry, bathymetry_nodata)
+    # We have the distances for all the directions, now we combine them
+    # Shift the arrays so that each sector has an equal number of rays on
+    # each side of its center, and reshape them so that a sector is a row
+    sector_shape = (point_count, SECTOR_COUNT, rays_per_sector)
+    ray_distances = np.reshape( \
+        np.roll(ray_distances, rays_per_sector / 2, axis = 1), sector_shape)
+    ray_depths = np.reshape( \
+        np.roll(ray_depths, rays_per_sector / 2, axis = 1), sector_shape)
+    # Compute the weights by taking the cos of the appropriately shifted
+    # angles
+    angles = np.array(directions_rad[:rays_per_sector])
+    angles -= directions_rad[rays_per_sector / 2]
+    cos = np.cos(angles)
+    # Take the weighted rows average column-wise
+    sector_distances = \
+        np.minimum(np.average(ray_distances * cos, axis = 2), d_max)
+    sector_depths = np.average(ray_depths, axis = 2)
+    pos_depth = np.where(sector_depths >= 0)
+    if pos_depth[0].size:
+        message = str(pos_depth[0].size) + \
+        ' points have positive depth, set to -1.'
+        LOGGER.warning(message)
+        sector_depths[pos_depth] = -1
+
     x_points, y_points = \
     rowcol_to_xy(shore_points[0], shore_points[1], shore_raster)
     key_list = np.array(zip(x_points, y_points))
     distance = {}
     avg_depth = {}
-    positive_depth_points = 0
-    point_count = point_list.shape[0]
     for p in range(point_count):
-        point = point_list[p]
         key = (key_list[p][0], key_list[p][1])
-        #print(key)
-        distance[key] = np.empty(direction_count)
-        avg_depth[key] = np.empty(direction_count)
-        for d in range(direction_count):
-            direction = directions_rad[d]
-            # Anchor the ray path to the current point
-            I = ray_path[direction][0]+point[0]
-            J = ray_path[direction][1]+point[1]
-            # We need integer indices to index arrays: round I and J
-            I = np.around(I).astype(int)
-            J = np.around(J).astype(int)
-            # Find valid indices for I and J separately
-            valid_i = np.where((I>=0) & (I<i_count))
-            valid_j = np.where((J>=0) & (J<j_count))
-            # Find points for which both I and J are valid
-            valid_i_and_j = set(valid_i[0]) & set(valid_j[0])
-            # Put the indices back into a tuple as if it came from np.where()
-            valid_i_and_j = (np.array([pt for pt in valid_i_and_j]),)
-            # Isolate indices from points within the raster
-            I = I[valid_i_and_j]
-            J = J[valid_i_and_j]
-            # At this point, all indices are within bounds
-            # Extract only those ray indices that are not over land
-            sea_indices = np.where(land_array[(I, J)] < 1)[0]
-            # If not all indices over water -> keep first section over water
-            if sea_indices[-1] != len(sea_indices) - 1:
-                # Find the index after the first section over water:
-                # Since ray indices over land don't show up in sea_indices, do
-                # 1- Subtract each index from its predecessor (D_i=i_n - i_n-1)
-                # 2- Continuous indices over water have a D_i == 1, otherwise
-                #   the indices are separated by land (D_i > 1). We extract
-                #   all indices that have a discontinuity, I=np.where(D_i > 1)
-                non_consecutive = \
-                    np.where(sea_indices[1:] - sea_indices[0:-1] > 1)[0]
-                # 3- The index at I[0] is the end of the ray we want to keep
-                #   (before the first time the ray hits land). We use I[0]+1
-                #   for slicing ray.
-                sea_indices = (sea_indices[:non_consecutive[0]+1],)
-            # At this point, the ray stops before the first landmass
-            # We use sea_indices to extract the accurate portion of the ray to
-            # compute the distance
-            I = I[sea_indices]
-            J = J[sea_indices]
-            # We now compute the distance traversed by the ray, which we almost
-            # have already: we know the length of the ray when moving 1 cell
-            # (by taking 1 step). The number of steps to get the ray is the
-            # biggest of its coordinates:
-            step_count = max(math.fabs(I[-1]-I[0]), math.fabs(J[-1]-J[0]))
-            D = step_count * unit_step_length[d]
-            # We want to return the maximum fetch distance: it's max_fetch if
-            # the ray is not stopped by land before, else it's the maximum
-            # distance the ray traversed over water. D is not this maximum
-            # length: the marching algorithm makes 1 pixel jumps in either the
-            # x or y direction starting at the center of the first pixel. So,
-            # 1/2 of the last pixel is not accounted for in D. We have to take
-            # this into account.
-            to_last_pixel_edge = unit_step_length[d] / 2.
-            # Fetch distance is distance from pixel center to edge of water
-            distance[key][d] = min(MAX_FETCH, (D+to_last_pixel_edge)*cell_size)
-            # reset invalid depth values from segments outside the bathymetry
-            # layer
-            depths = bathymetry[(I, J)]
-            #print(bathymetry_nodata, depths.shape, depths)
-
-            if depths[0] == bathymetry_nodata:
-                average_depth = np.array([-100.0])
-            # Valid depths, compute the average
-            else:
-                # Remove nodata from depth values
-                valid_data = np.where(depths != bathymetry_nodata)
-                if valid_data[0].size > 0:
-                    depths = depths[valid_data]
-                else:
-                    print('Warning: point',point,'surrounded by nodata depths')
-                # Remove positive values
-                negative = np.where(depths <= 0.)[0]
-                if negative.size > 0:
-                    depths = depths[negative]
-                # If depths are all positive, set to zero
-                else:
-                    depths = np.array([0.])
-                # Average depth is mean bathymetry along the ray
-                average_depth = np.average(depths)
-                # Testing for Inf or NaN
-                message = 'Detected NaN in average_depth.' + \
-                    ' individual depths ' + str(depths) + \
-                    ', valid depth indices: ' + str(negative)
-                assert not np.isnan(average_depth), message
-                message = 'Detected Inf in average_depth.' + \
-                    ' individual depths ' + str(depths) + \
-                    ', valid depth indices: ' + str(negative) + \
-                    ', valid - no_data: ' + str(negative-bathymetry_nodata)
-                assert not np.isinf(average_depth), message
-
-            message = 'depth == nodata (' + str(bathymetry_nodata) + \
-            '). bathymetry = ' + str(depths)
-            assert average_depth != bathymetry_nodata, message
-            avg_depth[key][d] = average_depth
-        # We have the distances for all the directions, now we combine them
-        # Shift the arrays so that each sector has an equal number of rays on
-        # each side of its center
-        distance[key] = np.roll(distance[key], (rays_per_sector / 2))
-        avg_depth[key] = np.roll(avg_depth[key], (rays_per_sector / 2))
-        # Reshape the fetch arrays so that a row corresponds to a sector
-        distance[key] = \
-            np.reshape(distance[key], (SECTOR_COUNT, rays_per_sector))
-        avg_depth[key] = \
-            np.reshape(avg_depth[key], (SECTOR_COUNT, rays_per_sector))
-        # Compute the weights by taking the cos of the appropriately shifted
-        # angles
-        angles = np.array(directions_rad[:rays_per_sector])
-        angles -= directions_rad[rays_per_sector / 2]
-        cos = np.cos(angles)
-        # Take the weighted rows average column-wise
-        distance[key] = \
-            np.minimum(np.average(distance[key] * cos, axis = 1), d_max)
-        avg_depth[key] = np.average(avg_depth[key], axis = 1)
-        pos_depth = np.where(avg_depth[key] >= 0)
-        positive_depth_points += pos_depth[0].size
-
-    if pos_depth[0].size:
-        message = str(pos_depth[0].size) + \
-        ' points have positive depth, set to -1.'
-        LOGGER.warning(message)
-        avg_depth[key][pos_depth] = -1
+        distance[key] = sector_distances[p]
+        avg_depth[key] = sector_depths[p]
 
     return (distance, avg_depth)
 
+def _cast_fetch_rays(rows, cols, ray_i, ray_j, unit_step_length, cell_size, \
+    land_array, bathymetry, bathymetry_nodata):
+    """ Cast the same fetch ray from a batch of shore points at once.
+
+        Inputs:
+        - rows, cols: 1D integer arrays of the shore points' coordinates
+        - ray_i, ray_j: the ray path relative to the origin from
+            cast_ray_fast
+        - unit_step_length: length of one step of the ray in pixels
+        - cell_size: size of a cell in meters
+        - land_array: land raster array, land is encoded as 1s
+        - bathymetry: bathymetry array the same size as land_array
+        - bathymetry_nodata: nodata value of bathymetry
+
+        Returns a tuple (distances, depths) of arrays holding each point's
+        fetch distance and the average depth along its ray."""
+    (i_count, j_count) = land_array.shape
+    # Anchor the ray path to every point. A row is a point, a column a step.
+    # We need integer indices to index arrays: round I and J
+    I = np.around(ray_i[np.newaxis, :] + rows[:, np.newaxis]).astype(int)
+    J = np.around(ray_j[np.newaxis, :] + cols[:, np.newaxis]).astype(int)
+    inside = (I >= 0) & (I < i_count) & (J >= 0) & (J < j_count)
+    # Clip the indices so they can be looked up, the steps outside the
+    # raster are masked out by 'inside'
+    I = np.clip(I, 0, i_count - 1)
+    J = np.clip(J, 0, j_count - 1)
+    # The ray keeps its first section over water: it ends at the first step
+    # that leaves the raster or hits land. Shore points are at sea, so every
+    # ray has at least one step.
+    stopped = ~(inside & (land_array[I, J] < 1))
+    step_index = np.arange(I.shape[1])
+    ray_length = np.where(np.any(stopped, axis = 1), \
+        np.argmax(stopped, axis = 1), I.shape[1])
+    # The number of steps to get to the end of the ray is the biggest of its
+    # coordinates. The marching algorithm makes 1 pixel jumps starting at the
+    # center of the first pixel, so 1/2 of the last pixel is added to get the
+    # distance from the pixel center to the edge of the water.
+    point_index = np.arange(I.shape[0])
+    step_count = np.maximum( \
+        np.absolute(I[point_index, ray_length - 1] - I[:, 0]), \
+        np.absolute(J[point_index, ray_length - 1] - J[:, 0]))
+    distances = np.minimum(MAX_FETCH, \
+        (step_count * unit_step_length + unit_step_length / 2.) * cell_size)
+    # Average depth is the mean of the valid non-positive depths along the
+    # ray, 0 if there are none, and -100 if the ray starts on nodata
+    depths = bathymetry[I, J]
+    valid = (step_index[np.newaxis, :] < ray_length[:, np.newaxis]) & \
+        (depths != bathymetry_nodata) & (depths <= 0.)
+    valid_count = np.sum(valid, axis = 1)
+    depth_sum = np.sum(np.where(valid, depths, 0.), axis = 1)
+    average_depths = \
+        np.where(valid_count > 0, depth_sum / np.maximum(valid_count, 1), 0.)
+    average_depths[depths[:, 0] == bathymetry_nodata] = -100.
+    message = 'Detected NaN or Inf in average depths.'
+    assert np.all(np.isfinite(average_depths)), message
+
+    return (distances, average_depths)
+
 
 def adjust_raster_to_aoi(in_dataset_uri, aoi_datasource_uri, cell_size, \
     out_dataset_uri):
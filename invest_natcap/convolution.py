@@ -0,0 +1,340 @@
+"""Distance decay convolutions shared by the habitat quality, pollination and
+GLOBIO models.  Kernels are built once per decay type and distance in pixels
+and the signal raster is convolved a block at a time by multiplying FFTs.
+Kernels are split into tiles the size of a signal block so every FFT has the
+same shape whatever the kernels.  Each signal block is transformed once per
+pass and multiplied by the spectra of every kernel of the pass, and the
+spectra of kernel tiles are kept in a least recently used cache so later
+passes with the same kernel don't transform it again."""
+
+import collections
+import logging
+
+from osgeo import gdal
+from osgeo import osr
+import numpy
+
+import pygeoprocessing.geoprocessing
+
+LOGGER = logging.getLogger('invest_natcap.convolution')
+
+#The number of rows and columns in a block of the signal raster
+BLOCK_SIZE = 512
+
+#The bytes of kernel tile spectra kept in memory between calls
+SPECTRUM_CACHE_BYTES = 2**28
+
+#The nodata value of convolved rasters, set where the signal is nodata
+OUTPUT_NODATA = -9999.0
+
+_KERNEL_CACHE = {}
+_SPECTRUM_CACHE = collections.OrderedDict()
+_SPECTRUM_CACHE_SIZE = [0]
+_CACHE_STATS = {'hits': 0, 'misses': 0, 'signal_transforms': 0}
+
+
+def linear_decay_kernel(max_distance):
+    """Makes a kernel that decays linearly to 0 at max_distance pixels from
+        its center, normalized to sum to 1.
+
+        returns a 2D float32 array"""
+    distance = _kernel_distance(max_distance)
+    return _normalize(numpy.where(
+        distance > max_distance, 0.0,
+        (max_distance - distance) / max_distance))
+
+
+def exponential_decay_kernel(expected_distance):
+    """Makes a kernel that decays as exp(-d / expected_distance) out to
+        5 * expected_distance pixels from its center, normalized to sum to 1.
+
+        returns a 2D float32 array"""
+    max_distance = expected_distance * 5
+    distance = _kernel_distance(max_distance)
+    return _normalize(numpy.where(
+        distance > max_distance, 0.0,
+        numpy.exp(-distance / expected_distance)))
+
+
+def gaussian_kernel(sigma):
+    """Makes a gaussian kernel with a standard deviation of sigma pixels out
+        to 5 * sigma pixels from its center, normalized to sum to 1.
+
+        returns a 2D float32 array"""
+    distance = _kernel_distance(sigma * 5)
+    return _normalize(numpy.exp(-distance ** 2 / (2.0 * sigma ** 2)))
+
+
+#decay type -> function of the decay distance in pixels that makes a kernel
+KERNEL_FUNCTIONS = {
+    'linear': linear_decay_kernel,
+    'exponential': exponential_decay_kernel,
+    'gaussian': gaussian_kernel,
+}
+
+
+def get_kernel(decay_type, distance, pixel_size=1.0):
+    """Returns the kernel of a decay type, building it the first time.
+
+        decay_type - a key of KERNEL_FUNCTIONS
+        distance - the decay distance in the same units as pixel_size
+        pixel_size - the size of a pixel, defaults to 1.0 so distance is in
+            pixels
+
+        returns a 2D float32 array that the caller shouldn't modify"""
+    if decay_type not in KERNEL_FUNCTIONS:
+        raise ValueError(
+            'Unknown decay type %s, expected one of %s' % (
+                decay_type, sorted(KERNEL_FUNCTIONS.keys())))
+    kernel_key = _kernel_key(decay_type, distance, pixel_size)
+    if kernel_key not in _KERNEL_CACHE:
+        _KERNEL_CACHE[kernel_key] = KERNEL_FUNCTIONS[decay_type](
+            kernel_key[1])
+    return _KERNEL_CACHE[kernel_key]
+
+
+def write_kernel_uri(kernel, kernel_uri):
+    """Writes a kernel array to a GeoTIFF.
+
+        kernel - a 2D array, for example from get_kernel
+        kernel_uri - the uri of the GeoTIFF to create
+
+        returns nothing"""
+    driver = gdal.GetDriverByName('GTiff')
+    kernel_dataset = driver.Create(
+        kernel_uri.encode('utf-8'), kernel.shape[1], kernel.shape[0], 1,
+        gdal.GDT_Float32, options=['BIGTIFF=IF_SAFER'])
+
+    #Make some kind of geotransform, it doesn't matter what but
+    #will make GIS libraries behave better if it's all defined
+    kernel_dataset.SetGeoTransform([444720, 30, 0, 3751320, 0, -30])
+    srs = osr.SpatialReference()
+    srs.SetUTM(11, 1)
+    srs.SetWellKnownGeogCS('NAD27')
+    kernel_dataset.SetProjection(srs.ExportToWkt())
+
+    kernel_band = kernel_dataset.GetRasterBand(1)
+    kernel_band.SetNoDataValue(-9999)
+    kernel_band.WriteArray(kernel)
+    kernel_band = None
+    kernel_dataset = None
+
+
+def convolve_uri(signal_uri, decay_type, distance, pixel_size, output_uri):
+    """Convolves a raster with the kernel of a decay type, see
+        convolve_kernels_uri."""
+    convolve_kernels_uri(
+        signal_uri, [(decay_type, distance, pixel_size)], [output_uri])
+
+
+def convolve_kernels_uri(signal_uri, kernel_key_list, output_uri_list):
+    """Convolves a raster with several kernels in one pass over it.  Each
+        block of the raster is transformed once and the transform is reused
+        for every kernel.  Nodata values in the signal are treated as 0.0 and
+        are nodata in the outputs.
+
+        signal_uri - a uri to a single band raster
+        kernel_key_list - a list of (decay type, distance, pixel size) tuples
+            of the kernels, see get_kernel
+        output_uri_list - a list of uris to the float32 rasters to create,
+            parallel to kernel_key_list
+
+        returns nothing"""
+    kernel_list = [get_kernel(*kernel_key) for kernel_key in kernel_key_list]
+    signal_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        signal_uri)
+    signal_dataset = gdal.Open(signal_uri)
+    signal_band = signal_dataset.GetRasterBand(1)
+    n_rows, n_cols = signal_band.YSize, signal_band.XSize
+    block_rows = min(BLOCK_SIZE, n_rows)
+    block_cols = min(BLOCK_SIZE, n_cols)
+
+    #a block and a kernel tile are both at most block_rows by block_cols so
+    #their full convolution fits in this shape, whatever the kernel
+    fft_shape = (
+        _next_power_of_2(2 * block_rows - 1),
+        _next_power_of_2(2 * block_cols - 1))
+    #the tile spectra are held for the whole pass, they're needed by every
+    #block
+    tile_spectra_list = [
+        _kernel_tile_spectra(kernel_key, block_rows, block_cols, fft_shape)
+        for kernel_key in kernel_key_list]
+
+    output_dataset_list = []
+    output_band_list = []
+    for output_uri in output_uri_list:
+        pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+            signal_uri, output_uri, 'GTiff', OUTPUT_NODATA, gdal.GDT_Float32,
+            fill_value=0)
+        output_dataset = gdal.Open(output_uri, gdal.GA_Update)
+        output_dataset_list.append(output_dataset)
+        output_band_list.append(output_dataset.GetRasterBand(1))
+
+    for row_offset, col_offset, win_rows, win_cols in _block_windows(
+            n_rows, n_cols, block_rows, block_cols):
+        signal_block = signal_band.ReadAsArray(
+            col_offset, row_offset, win_cols, win_rows).astype(numpy.float64)
+        if signal_nodata is not None:
+            signal_block[signal_block == signal_nodata] = 0.0
+        signal_spectrum = numpy.fft.rfft2(signal_block, fft_shape)
+        _CACHE_STATS['signal_transforms'] += 1
+
+        for kernel, tile_spectra, output_band in zip(
+                kernel_list, tile_spectra_list, output_band_list):
+            #the full convolution of the block starts half a kernel up and
+            #left of the block, clip it to the raster
+            kernel_rows, kernel_cols = kernel.shape
+            out_row = row_offset - kernel_rows / 2
+            out_col = col_offset - kernel_cols / 2
+            clip_top = max(0, -out_row)
+            clip_left = max(0, -out_col)
+            clip_bottom = min(win_rows + kernel_rows - 1, n_rows - out_row)
+            clip_right = min(win_cols + kernel_cols - 1, n_cols - out_col)
+            result = numpy.zeros(
+                (clip_bottom - clip_top, clip_right - clip_left))
+
+            #each tile adds its part of the full convolution, tiles whose
+            #part lands outside of the raster are skipped
+            for (tile_row, tile_col, tile_rows, tile_cols,
+                 tile_spectrum) in tile_spectra:
+                top = max(clip_top, tile_row)
+                bottom = min(clip_bottom, tile_row + win_rows + tile_rows - 1)
+                left = max(clip_left, tile_col)
+                right = min(clip_right, tile_col + win_cols + tile_cols - 1)
+                if top >= bottom or left >= right:
+                    continue
+                tile_result = numpy.fft.irfft2(
+                    signal_spectrum * tile_spectrum, fft_shape)
+                result[top - clip_top:bottom - clip_top,
+                       left - clip_left:right - clip_left] += tile_result[
+                           top - tile_row:bottom - tile_row,
+                           left - tile_col:right - tile_col]
+
+            out_row += clip_top
+            out_col += clip_left
+            output_array = output_band.ReadAsArray(
+                out_col, out_row, result.shape[1], result.shape[0])
+            output_band.WriteArray(output_array + result, out_col, out_row)
+
+    #mask the outputs to nodata where the signal is nodata
+    if signal_nodata is not None:
+        for row_offset, col_offset, win_rows, win_cols in _block_windows(
+                n_rows, n_cols, block_rows, block_cols):
+            nodata_mask = signal_band.ReadAsArray(
+                col_offset, row_offset, win_cols, win_rows) == signal_nodata
+            if not nodata_mask.any():
+                continue
+            for output_band in output_band_list:
+                output_array = output_band.ReadAsArray(
+                    col_offset, row_offset, win_cols, win_rows)
+                output_array[nodata_mask] = OUTPUT_NODATA
+                output_band.WriteArray(output_array, col_offset, row_offset)
+
+    for output_band in output_band_list:
+        output_band.FlushCache()
+    output_band_list = None
+    output_dataset_list = None
+    signal_band = None
+    signal_dataset = None
+
+
+def cache_stats():
+    """Returns a dictionary of the spectrum cache 'hits' and 'misses' and
+        the number of signal blocks transformed, 'signal_transforms', since
+        the cache was last cleared."""
+    return dict(_CACHE_STATS)
+
+
+def clear_cache():
+    """Empties the kernel and spectrum caches."""
+    _KERNEL_CACHE.clear()
+    _SPECTRUM_CACHE.clear()
+    _SPECTRUM_CACHE_SIZE[0] = 0
+    for stat in _CACHE_STATS:
+        _CACHE_STATS[stat] = 0
+
+
+def _kernel_key(decay_type, distance, pixel_size):
+    """Returns the key of a kernel, which only depends on the decay type and
+        the distance in pixels."""
+    return (decay_type, float(distance) / float(pixel_size))
+
+
+def _kernel_tile_spectra(kernel_key, block_rows, block_cols, fft_shape):
+    """Splits a kernel into tiles of at most block_rows by block_cols and
+        returns the spectra of the tiles that aren't all 0.
+
+        kernel_key - a (decay type, distance, pixel size) tuple
+        block_rows, block_cols - the size of the signal blocks
+        fft_shape - the shape to zero pad the tiles to
+
+        returns a list of (tile row, tile col, tile rows, tile cols,
+            spectrum) tuples"""
+    kernel = get_kernel(*kernel_key)
+    tile_spectra = []
+    for tile_row, tile_col, tile_rows, tile_cols in _block_windows(
+            kernel.shape[0], kernel.shape[1], block_rows, block_cols):
+        tile = kernel[
+            tile_row:tile_row + tile_rows, tile_col:tile_col + tile_cols]
+        if not tile.any():
+            continue
+        spectrum_key = (
+            _kernel_key(*kernel_key) +
+            (block_rows, block_cols, tile_row, tile_col))
+        tile_spectra.append((
+            tile_row, tile_col, tile_rows, tile_cols,
+            _cached_spectrum(spectrum_key, lambda: tile, fft_shape)))
+    return tile_spectra
+
+
+def _kernel_distance(max_distance):
+    """Returns the distance in pixels of each pixel of a square kernel from
+        its center, the kernel reaching max_distance pixels out."""
+    kernel_size = int(numpy.round(max_distance * 2 + 1))
+    index = numpy.arange(kernel_size)
+    return numpy.sqrt(
+        (index[:, numpy.newaxis] - max_distance) ** 2 +
+        (index[numpy.newaxis, :] - max_distance) ** 2)
+
+
+def _normalize(kernel):
+    """Divides a kernel by its sum and casts it to float32."""
+    return (kernel / numpy.sum(kernel)).astype(numpy.float32)
+
+
+def _next_power_of_2(value):
+    """Returns the smallest power of 2 at least value."""
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+
+def _block_windows(n_rows, n_cols, block_rows, block_cols):
+    """Yields (row offset, col offset, rows, cols) of the blocks of a
+        raster."""
+    for row_offset in xrange(0, n_rows, block_rows):
+        for col_offset in xrange(0, n_cols, block_cols):
+            yield (
+                row_offset, col_offset, min(block_rows, n_rows - row_offset),
+                min(block_cols, n_cols - col_offset))
+
+
+def _cached_spectrum(spectrum_key, read_array, fft_shape):
+    """Returns the real FFT of `read_array()` zero padded to fft_shape,
+        computing it only if it's not in the cache."""
+    if spectrum_key in _SPECTRUM_CACHE:
+        _CACHE_STATS['hits'] += 1
+        spectrum = _SPECTRUM_CACHE.pop(spectrum_key)
+        _SPECTRUM_CACHE[spectrum_key] = spectrum
+        return spectrum
+
+    _CACHE_STATS['misses'] += 1
+    spectrum = numpy.fft.rfft2(read_array(), fft_shape)
+    if spectrum.nbytes <= SPECTRUM_CACHE_BYTES:
+        _SPECTRUM_CACHE[spectrum_key] = spectrum
+        _SPECTRUM_CACHE_SIZE[0] += spectrum.nbytes
+        while _SPECTRUM_CACHE_SIZE[0] > SPECTRUM_CACHE_BYTES:
+            _, evicted_spectrum = _SPECTRUM_CACHE.popitem(last=False)
+            _SPECTRUM_CACHE_SIZE[0] -= evicted_spectrum.nbytes
+    return spectrum
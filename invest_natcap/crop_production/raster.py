@@ -27,14 +27,46 @@ LOGGER = logging.getLogger('Raster Class')
 logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s \
     %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H/%M/%S')
 
+# Local operations are deferred and evaluated together, an expression is
+# computed early once it is this many operations deep or reads this many
+# rasters so the recursion and the blocks held in memory stay bounded
+MAX_EXPRESSION_DEPTH = 64
+MAX_EXPRESSION_LEAVES = 16
+
+# GDAL datatype -> numpy dtype that intermediate results are stored as
+GDAL_TO_NUMPY_TYPE = {
+    gdal.GDT_Byte: np.uint8,
+    gdal.GDT_UInt16: np.uint16,
+    gdal.GDT_Int16: np.int16,
+    gdal.GDT_UInt32: np.uint32,
+    gdal.GDT_Int32: np.int32,
+    gdal.GDT_Float32: np.float32,
+    gdal.GDT_Float64: np.float64,
+}
+
 
 class Raster(object):
     # any global variables here
     def __init__(self, uri, driver):
-        self.uri = uri
+        self._uri = uri
         self.driver = driver
         self.dataset = None
 
+        # (pixel_op, operand_list) while the raster is an unevaluated
+        # expression, the raster whose grid it shares and its band 1 type
+        self._expression = None
+        self._template = None
+        self._datatype = None
+        self._nodata = None
+        self._depth = 0
+        self._leaf_count = 1
+
+    @property
+    def uri(self):
+        if self._expression is not None:
+            self._materialize()
+        return self._uri
+
     @classmethod
     def from_array(self, array, affine, proj, datatype, nodata_val, driver='GTiff', filepath=None):
         if len(array.shape) is 2:
@@ -101,7 +133,8 @@ class Raster(object):
         self._delete()
 
     def _delete(self):
-        os.remove(self.uri)
+        if self._uri is not None:
+            os.remove(self._uri)
 
     def __str__(self):
         string = '\nRASTER'
@@ -452,6 +485,9 @@ class Raster(object):
         return a
 
     def get_nodata(self, band_num):
+        if self._expression is not None:
+            return self._nodata if band_num == 1 else None
+
         nodata_val = None
         self._open_dataset()
 
@@ -463,6 +499,9 @@ class Raster(object):
         return nodata_val
 
     def get_datatype(self, band_num):
+        if self._expression is not None:
+            return self._datatype if band_num == 1 else None
+
         datatype = None
         self._open_dataset()
 
@@ -475,7 +514,7 @@ class Raster(object):
 
     def get_rows(self):
         rows = None
-        self._open_dataset()
+        self._open_dataset(metadata_only=True)
 
         rows = self.dataset.RasterYSize
 
@@ -484,7 +523,7 @@ class Raster(object):
 
     def get_cols(self):
         cols = None
-        self._open_dataset()
+        self._open_dataset(metadata_only=True)
 
         cols = self.dataset.RasterXSize
 
@@ -549,7 +588,7 @@ class Raster(object):
         return (rows, cols)
 
     def get_projection(self):
-        self._open_dataset()
+        self._open_dataset(metadata_only=True)
         RasterSRS = osr.SpatialReference()
         RasterSRS.ImportFromWkt(self.dataset.GetProjectionRef())
         proj = int(RasterSRS.GetAttrValue("AUTHORITY", 1))
@@ -560,14 +599,14 @@ class Raster(object):
         return proj
 
     def get_projection_wkt(self):
-        self._open_dataset()
+        self._open_dataset(metadata_only=True)
         wkt = self.dataset.GetProjectionRef()
         self._close_dataset()
         return wkt
 
     def get_geotransform(self):
         geotransform = None
-        self._open_dataset()
+        self._open_dataset(metadata_only=True)
 
         geotransform = self.dataset.GetGeoTransform()
 
@@ -579,7 +618,7 @@ class Raster(object):
         return Affine.from_gdal(*geotransform)
 
     def get_bounding_box(self):
-        return pygeo.geoprocessing.get_bounding_box(self.uri)
+        return pygeo.geoprocessing.get_bounding_box(self._grid_uri())
 
     def get_aoi(self):
         '''May only be suited for non-rotated rasters'''
@@ -621,106 +660,29 @@ class Raster(object):
                 return np.where(x == x, x, nodata)
             return copy
 
-        bounding_box_mode = "dataset"
-        resample_method = "nearest"
-
-        dataset_uri_list = [self.uri]
-        resample_list = [resample_method]
-
-        nodata = self.get_nodata(1)
-        pixel_op = pixel_op_closure(nodata)
-        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
-        datatype_out = datatype
-        nodata_out = nodata
-        pixel_size_out = pygeo.geoprocessing.get_cell_size_from_uri(self.uri)
-
-        pygeo.geoprocessing.vectorize_datasets(
-            dataset_uri_list,
-            pixel_op,
-            dataset_out_uri,
-            datatype_out,
-            nodata_out,
-            pixel_size_out,
-            bounding_box_mode,
-            resample_method_list=resample_list,
-            dataset_to_align_index=0,
-            dataset_to_bound_index=0,
-            assert_datasets_projected=False,
-            vectorize_op=False)
-
-        return Raster.from_tempfile(dataset_out_uri)
+        return self.local_op(
+            None, pixel_op_closure, broadcast=True, datatype_out=datatype)
 
     def set_nodata(self, nodata_val):
 
-        def pixel_op_closure(old_nodata, new_nodata):
+        def pixel_op_closure(old_nodata):
             def copy(x):
-                return np.where(x == old_nodata, new_nodata, x)
+                return np.where(x == old_nodata, nodata_val, x)
             return copy
 
-        bounding_box_mode = "dataset"
-        resample_method = "nearest"
-
-        dataset_uri_list = [self.uri]
-        resample_list = [resample_method]
-
-        old_nodata = self.get_nodata(1)
-        pixel_op = pixel_op_closure(old_nodata, nodata_val)
-        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
-        datatype_out = pygeo.geoprocessing.get_datatype_from_uri(self.uri)
-        nodata_out = nodata_val
-        pixel_size_out = pygeo.geoprocessing.get_cell_size_from_uri(self.uri)
-
-        pygeo.geoprocessing.vectorize_datasets(
-            dataset_uri_list,
-            pixel_op,
-            dataset_out_uri,
-            datatype_out,
-            nodata_out,
-            pixel_size_out,
-            bounding_box_mode,
-            resample_method_list=resample_list,
-            dataset_to_align_index=0,
-            dataset_to_bound_index=0,
-            assert_datasets_projected=False,
-            vectorize_op=False)
-
-        return Raster.from_tempfile(dataset_out_uri)
+        return self.local_op(
+            None, pixel_op_closure, broadcast=True, nodata_out=nodata_val)
 
     def set_datatype_and_nodata(self, datatype, nodata_val):
 
-        def pixel_op_closure(old_nodata, new_nodata):
+        def pixel_op_closure(old_nodata):
             def copy(x):
-                return np.where(x == old_nodata, new_nodata, x)
+                return np.where(x == old_nodata, nodata_val, x)
             return copy
 
-        bounding_box_mode = "dataset"
-        resample_method = "nearest"
-
-        dataset_uri_list = [self.uri]
-        resample_list = [resample_method]
-
-        old_nodata = self.get_nodata(1)
-        pixel_op = pixel_op_closure(old_nodata, nodata_val)
-        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
-        datatype_out = datatype
-        nodata_out = nodata_val
-        pixel_size_out = pygeo.geoprocessing.get_cell_size_from_uri(self.uri)
-
-        pygeo.geoprocessing.vectorize_datasets(
-            dataset_uri_list,
-            pixel_op,
-            dataset_out_uri,
-            datatype_out,
-            nodata_out,
-            pixel_size_out,
-            bounding_box_mode,
-            resample_method_list=resample_list,
-            dataset_to_align_index=0,
-            dataset_to_bound_index=0,
-            assert_datasets_projected=False,
-            vectorize_op=False)
-
-        return Raster.from_tempfile(dataset_out_uri)
+        return self.local_op(
+            None, pixel_op_closure, broadcast=True, datatype_out=datatype,
+            nodata_out=nodata_val)
 
     def copy(self, uri=None):
         if not uri:
@@ -935,20 +897,32 @@ class Raster(object):
 
     def reclass(self, reclass_table, out_nodata=None, out_datatype=None):
         if out_nodata is None:
-            out_nodata = pygeo.geoprocessing.get_nodata_from_uri(self.uri)
+            out_nodata = self.get_nodata(1)
         if out_datatype is None:
-            out_datatype = pygeo.geoprocessing.get_datatype_from_uri(self.uri)
-        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
-
-        pygeo.geoprocessing.reclassify_dataset_uri(
-            self.uri,
-            reclass_table,
-            dataset_out_uri,
-            out_datatype,
-            out_nodata,
-            assert_dataset_projected=False)
+            out_datatype = self.get_datatype(1)
+
+        def reclass_closure(nodata):
+            value_map = dict(reclass_table)
+            if nodata is not None:
+                value_map[nodata] = out_nodata
+            keys = np.array(sorted(value_map.keys()))
+            values = np.array([value_map[key] for key in keys])
+
+            def reclass(x):
+                unique = np.unique(x)
+                has_map = np.in1d(unique, keys)
+                if not has_map.all():
+                    raise ValueError(
+                        'There was not a value for at least the following '
+                        'codes %s for this raster.\nNodata value is: %s' % (
+                            str(unique[~has_map]), str(nodata)))
+                index = np.digitize(x.ravel(), keys, right=True)
+                return values[index].reshape(x.shape)
+            return reclass
 
-        return Raster.from_tempfile(dataset_out_uri)
+        return self.local_op(
+            None, reclass_closure, broadcast=True, datatype_out=out_datatype,
+            nodata_out=out_nodata)
 
     def overlay(self, raster):
         raise NotImplementedError
@@ -958,10 +932,14 @@ class Raster(object):
         proj = self.get_projection()
         return Vector.from_shapely(aoi_shapely, proj)
 
-    def local_op(self, raster, pixel_op_closure, broadcast=False):
-        bounding_box_mode = "dataset"
-        resample_method = "nearest"
-
+    def local_op(self, raster, pixel_op_closure, broadcast=False,
+                 datatype_out=None, nodata_out=None):
+        '''
+        Returns a raster of pixel_op_closure(nodata) applied to the pixels of
+        this raster, and of raster too unless broadcast is set.  The result
+        is an expression that isn't computed until its file is needed, see
+        _materialize.  The datatype and nodata default to this raster's.
+        '''
         if not broadcast:
             assert(self.is_aligned(raster))
             try:
@@ -970,41 +948,167 @@ class Raster(object):
                 LOGGER.error("Rasters have different nodata values: %f, %f" % (
                     self.get_nodata(1), raster.get_nodata(1)))
                 raise AssertionError
-            dataset_uri_list = [self.uri, raster.uri]
-            resample_list = [resample_method]*2
+            operand_list = [self, raster]
         else:
-            dataset_uri_list = [self.uri]
-            resample_list = [resample_method]
+            operand_list = [self]
 
         nodata = self.get_nodata(1)
-        pixel_op = pixel_op_closure(nodata)
-        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
-        datatype_out = pygeo.geoprocessing.get_datatype_from_uri(self.uri)
-        nodata_out = pygeo.geoprocessing.get_nodata_from_uri(self.uri)
-        pixel_size_out = pygeo.geoprocessing.get_cell_size_from_uri(self.uri)
+        if datatype_out is None:
+            datatype_out = self.get_datatype(1)
+        if nodata_out is None:
+            nodata_out = nodata
+
+        result = Raster(None, self.driver)
+        result._expression = (pixel_op_closure(nodata), operand_list)
+        result._template = self._grid_raster()
+        result._datatype = datatype_out
+        result._nodata = nodata_out
+        result._depth = 1 + max(
+            [operand._depth for operand in operand_list])
+        result._leaf_count = sum(
+            [operand._leaf_count for operand in operand_list])
+        if (result._depth > MAX_EXPRESSION_DEPTH or
+                result._leaf_count > MAX_EXPRESSION_LEAVES):
+            result._materialize()
+        return result
+
+    def _grid_raster(self):
+        '''The evaluated raster whose grid this raster shares'''
+        if self._expression is not None:
+            return self._template
+        return self
+
+    def _grid_uri(self):
+        return self._grid_raster().uri
+
+    def _materialize(self):
+        '''
+        Computes the expression into a temporary GeoTIFF with one
+        vectorize_datasets call over the rasters it reads.  Subexpressions
+        that occur more than once are computed once per block.
+        '''
+        template = self._template
+        leaf_uri_list = [template.uri]
+        leaf_slots = {os.path.abspath(template.uri): 0}
+        visited = {}
+
+        def collect_leaves(raster):
+            if id(raster) in visited:
+                return
+            visited[id(raster)] = True
+            if raster._expression is None:
+                leaf_key = os.path.abspath(raster.uri)
+                if leaf_key not in leaf_slots:
+                    leaf_slots[leaf_key] = len(leaf_uri_list)
+                    leaf_uri_list.append(raster.uri)
+                return
+            for operand in raster._expression[1]:
+                collect_leaves(operand)
+        collect_leaves(self)
+
+        # operations in the order they're evaluated as (pixel_op, slots of
+        # the operands, dtype), slot i is leaf i and then the results
+        program = []
+        op_slots = {}
+        raster_slots = {}
+
+        def compile_raster(raster):
+            if id(raster) in raster_slots:
+                return raster_slots[id(raster)]
+            if raster._expression is None:
+                slot = leaf_slots[os.path.abspath(raster.uri)]
+            else:
+                pixel_op, operand_list = raster._expression
+                operand_slots = tuple(
+                    [compile_raster(operand) for operand in operand_list])
+                op_key = (
+                    _pixel_op_key(pixel_op), raster._datatype,
+                    _hashable(raster._nodata), operand_slots)
+                if op_key not in op_slots:
+                    op_slots[op_key] = len(leaf_uri_list) + len(program)
+                    program.append((
+                        pixel_op, operand_slots,
+                        GDAL_TO_NUMPY_TYPE.get(raster._datatype)))
+                slot = op_slots[op_key]
+            raster_slots[id(raster)] = slot
+            return slot
+        result_slot = compile_raster(self)
+
+        def evaluate_program(*blocks):
+            values = list(blocks)
+            for pixel_op, operand_slots, dtype in program:
+                values.append(_cast_block(
+                    pixel_op(*[values[slot] for slot in operand_slots]),
+                    dtype))
+            return values[result_slot]
+
+        LOGGER.debug('Evaluating %d operations over %d rasters' % (
+            len(program), len(leaf_uri_list)))
 
+        dataset_out_uri = pygeo.geoprocessing.temporary_filename()
         pygeo.geoprocessing.vectorize_datasets(
-            dataset_uri_list,
-            pixel_op,
+            leaf_uri_list,
+            evaluate_program,
             dataset_out_uri,
-            datatype_out,
-            nodata_out,
-            pixel_size_out,
-            bounding_box_mode,
-            resample_method_list=resample_list,
+            self._datatype,
+            self._nodata,
+            pygeo.geoprocessing.get_cell_size_from_uri(template.uri),
+            "dataset",
+            resample_method_list=["nearest"] * len(leaf_uri_list),
             dataset_to_align_index=0,
             dataset_to_bound_index=0,
             assert_datasets_projected=False,
             vectorize_op=False)
 
-        return Raster.from_tempfile(dataset_out_uri)
+        # the operands can be freed now that the result is on disk
+        self._uri = dataset_out_uri
+        self._expression = None
+        self._template = None
+        self._depth = 0
+        self._leaf_count = 1
 
-    def _open_dataset(self):
-        self.dataset = gdal.Open(self.uri)
+    def _open_dataset(self, metadata_only=False):
+        if metadata_only:
+            self.dataset = gdal.Open(self._grid_uri())
+        else:
+            self.dataset = gdal.Open(self.uri)
 
     def _close_dataset(self):
         self.dataset = None
 
+
+def _hashable(value):
+    '''Returns value as a dictionary key, values that aren't plain scalars
+    are told apart by identity'''
+    if value is None or isinstance(value, (int, long, float, str)):
+        return (type(value), value)
+    return ('id', id(value))
+
+
+def _pixel_op_key(pixel_op):
+    '''
+    Two pixel ops with the same key compute the same thing: they come from
+    the same def and closed over equal values.
+    '''
+    cells = pixel_op.__closure__ or ()
+    return (pixel_op.__code__, tuple(
+        [_hashable(cell.cell_contents) for cell in cells]))
+
+
+def _cast_block(block, dtype):
+    '''
+    Casts an intermediate block to the type it would have been written to
+    disk as, rounding and clamping into integer types the way GDAL does.
+    '''
+    if dtype is None:
+        return block
+    block = np.asarray(block)
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(
+            block.dtype, np.integer):
+        info = np.iinfo(dtype)
+        block = np.clip(np.round(block), info.min, info.max)
+    return block.astype(dtype)
+
 '''
 RasterFactory Class
 '''
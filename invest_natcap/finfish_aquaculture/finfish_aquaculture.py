@@ -36,6 +36,10 @@ def execute(args):
         g_param_a_sd (float): (description)
         g_param_b_sd (float): (description)
         num_monte_carlo_runs (int):
+        monte_carlo_seed (int): (optional) seeds the random states of the
+            blocks of Monte Carlo runs so they're reproducible
+        n_workers (int): (optional) the number of processes the Monte Carlo
+            runs are split across, defaults to 1
         water_temp_tbl (string): URI to a CSV table where daily water
             temperature values are stored from one year
         farm_op_tbl (string): URI to CSV table of static variables for
@@ -100,6 +104,9 @@ def execute(args):
         LOGGER.debug('Adding uncertainty parameters')
         for key in ['g_param_a_sd', 'g_param_b_sd', 'num_monte_carlo_runs']:
             ff_aqua_args[key] = args[key]
+        for key in ['monte_carlo_seed', 'n_workers']:
+            if key in args:
+                ff_aqua_args[key] = args[key]
 
     #Both CSVs are being pulled in, but need to do some maintenance to remove
     #undesirable information before they can be passed into core
@@ -4,6 +4,8 @@ This will pull from data passed in by finfish_aquaculture.
 '''
 
 import collections
+import itertools
+import multiprocessing
 import os
 import math
 import datetime
@@ -24,6 +26,9 @@ logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s \
 
 NUM_HISTOGRAM_BINS = 30
 
+#The number of Monte Carlo runs simulated together
+MONTE_CARLO_BLOCK_RUNS = 1000
+
 
 def execute(args):
     ''''
@@ -429,6 +434,105 @@ def compute_uncertainty_data(args, output_dir):
 def do_monte_carlo_simulation(args):
     '''
     Performs a Monte Carlo simulation and returns the results.
+
+    The runs are split into blocks of MONTE_CARLO_BLOCK_RUNS that are
+    simulated together by simulate_farm_cycles, on args['n_workers']
+    processes (defaults to 1).  If args['monte_carlo_seed'] is given each
+    block samples its growth parameters from its own random state seeded
+    from it, otherwise they're all sampled up front from numpy's global
+    random state in the same order as one run at a time.  Either way the
+    results don't depend on the number of workers.
+
+    Returns an OrderedDict mapping 'total' and each farm ID to a dict mapping
+    result types ('cycles', 'weight' and, with valuation, 'value') to arrays
+    with a value per run.
+    '''
+    num_runs = int(args['num_monte_carlo_runs'])
+    farm_arrays = _make_farm_arrays(
+        args['outplant_buffer'], args['water_temp_dict'],
+        args['farm_op_dict'])
+    farms = farm_arrays['farm_ids']
+
+    if args['do_valuation']:
+        valuation_params = (args['p_per_kg'], args['frac_p'], args['discount'])
+    else:
+        valuation_params = None
+
+    block_offsets = range(0, num_runs, MONTE_CARLO_BLOCK_RUNS)
+    if 'monte_carlo_seed' in args:
+        block_samples = np.random.RandomState(
+            int(args['monte_carlo_seed'])).randint(
+                2**31 - 1, size=len(block_offsets))
+    else:
+        a_samples, b_samples = _sample_growth_params(args, num_runs)
+        block_samples = [
+            (a_samples[offset:offset + MONTE_CARLO_BLOCK_RUNS],
+             b_samples[offset:offset + MONTE_CARLO_BLOCK_RUNS])
+            for offset in block_offsets]
+    growth_args = dict(
+        (key, args[key]) for key in [
+            'g_param_a', 'g_param_a_sd', 'g_param_b', 'g_param_b_sd',
+            'g_param_tau', 'duration', 'frac_post_process',
+            'mort_rate_daily'])
+    block_list = [
+        (farm_arrays, growth_args, valuation_params, samples,
+         min(MONTE_CARLO_BLOCK_RUNS, num_runs - offset))
+        for offset, samples in zip(block_offsets, block_samples)]
+
+    # Preallocate the results for all the runs on all the farms.
+    cycles = np.empty((num_runs, len(farms)), dtype=np.int)
+    weight = np.empty((num_runs, len(farms)))
+    value = np.empty((num_runs, len(farms)))
+
+    n_workers = int(args.get('n_workers', 1))
+    LOGGER.info('Beginning Monte Carlo simulation. Doing %d runs on %d '
+                'workers.' % (num_runs, n_workers))
+    if n_workers > 1:
+        worker_pool = multiprocessing.Pool(n_workers)
+        block_iterator = worker_pool.imap(_monte_carlo_block, block_list)
+    else:
+        worker_pool = None
+        block_iterator = (
+            _monte_carlo_block(block) for block in block_list)
+
+    for offset, block_results in itertools.izip(
+            block_offsets, block_iterator):
+        block_cycles, block_weight, block_value = block_results
+        block_slice = slice(offset, offset + block_cycles.shape[0])
+        cycles[block_slice] = block_cycles
+        weight[block_slice] = block_weight
+        if valuation_params is not None:
+            value[block_slice] = block_value
+        LOGGER.info('Done with %d runs.' % block_slice.stop)
+
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+
+    # We don't log total cycles across all farms,
+    # since it's not particularly meaningful.
+    results = collections.OrderedDict()
+    results['total'] = {'weight': weight.sum(axis=1)}
+    if valuation_params is not None:
+        results['total']['value'] = value.sum(axis=1)
+    for farm_index, farm in enumerate(farms):
+        results[farm] = {
+            'cycles': cycles[:, farm_index],
+            'weight': weight[:, farm_index],
+        }
+        if valuation_params is not None:
+            results[farm]['value'] = value[:, farm_index]
+
+    LOGGER.info('Monte Carlo simulation complete.')
+    return results
+
+
+def _sample_growth_params(args, num_runs):
+    '''
+    Samples growth parameters a and b for each run from numpy's global
+    random state, a run at a time, discarding non-positive samples.
+
+    Returns a tuple of arrays (a, b).
     '''
     def sample_param(param):
         '''Samples the normal distribution for the given growth parameter.
@@ -440,63 +544,176 @@ def do_monte_carlo_simulation(args):
             if sample > 0:
                 return sample
 
-    # Set up a dict to contain the results of the simulation.
-    farms = sorted(int(f) for f in args['farm_op_dict'])
+    samples = np.empty((2, num_runs))
+    for i in xrange(num_runs):
+        samples[0, i] = sample_param('a')
+        samples[1, i] = sample_param('b')
+    return samples[0], samples[1]
 
-    # Add a placeholder for aggregate results.
-    farms.insert(0, 'total')
 
-    fields = ['cycles', 'weight']
-    if args['do_valuation']:
-        fields.append('value')
+def _monte_carlo_block(block):
+    '''
+    Simulates a block of Monte Carlo runs.  Takes a single tuple so it can
+    be mapped over a process pool.
 
-    results = collections.OrderedDict()
-    for farm in farms:
-        results[farm] = {}
-        for field in fields:
-            # We don't log total cycles across all farms,
-            # since it's not particularly meaningful.
-            if not (farm == 'total' and field == 'cycles'):
-                results[farm][field] = []
-
-    LOGGER.info('Beginning Monte Carlo simulation. Doing %d runs.'
-                % args['num_monte_carlo_runs'])
-
-    for i in range(args['num_monte_carlo_runs']):
-        if i > 0 and i % 100 == 0:
-            LOGGER.info('Done with %d runs.' % i)
-
-        # Compute the cycle history given samples for parameters a and b.
-        cycle_history = calc_farm_cycles(
-            args['outplant_buffer'], sample_param('a'), sample_param('b'),
-            args['g_param_tau'], args['water_temp_dict'], args['farm_op_dict'],
-            float(args['duration']))
-
-        # Compute the total harvested weight.
-        sum_hrv_weight, hrv_weight_per_cycle = calc_hrv_weight(
-            args['farm_op_dict'], args['frac_post_process'],
-            args['mort_rate_daily'], cycle_history)
-
-        # Compute valuation data.
-        if args['do_valuation']:
-            _, farms_npv = valuation(
-                args['p_per_kg'], args['frac_p'], args['discount'],
-                hrv_weight_per_cycle, cycle_history)
+    block: a tuple of (farm_arrays, growth_args, valuation_params, samples,
+        num_runs), where growth_args holds the growth parameter and
+        processing entries of the model's args, and samples is either a
+        tuple of arrays of growth parameters a and b or a seed to sample
+        them from
 
-        # Update our total results.
-        results['total']['weight'].append(sum(sum_hrv_weight.values()))
-        if args['do_valuation']:
-            results['total']['value'].append(sum(farms_npv.values()))
+    Returns the (cycles, weight, value) tuple of simulate_farm_cycles.
+    '''
+    farm_arrays, growth_args, valuation_params, samples, num_runs = block
+    if isinstance(samples, tuple):
+        a, b = samples
+    else:
+        random_state = np.random.RandomState(int(samples))
+
+        def sample_param(param):
+            '''Samples the normal distribution for the given growth
+            parameter.
+
+            Returns only positive values, resampling the rest.'''
+            param_samples = np.zeros(num_runs)
+            resample = param_samples <= 0
+            while resample.any():
+                param_samples[resample] = random_state.normal(
+                    growth_args['g_param_%s' % param],
+                    growth_args['g_param_%s_sd' % param],
+                    size=np.count_nonzero(resample))
+                resample = param_samples <= 0
+            return param_samples
+
+        a = sample_param('a')
+        b = sample_param('b')
+    return simulate_farm_cycles(
+        farm_arrays, a, b, growth_args['g_param_tau'],
+        float(growth_args['duration']), growth_args['frac_post_process'],
+        growth_args['mort_rate_daily'], valuation_params)
+
+
+def _make_farm_arrays(outplant_buffer, water_temp_dict, farm_op_dict):
+    '''
+    Gathers the per-farm inputs of calc_farm_cycles into arrays with a
+    column per farm, in order of farm ID.
 
-        # Update our per-farm results.
-        for farm, hrv_weight in sum_hrv_weight.items():
-            results[farm]['weight'].append(hrv_weight)
-            results[farm]['cycles'].append(len(cycle_history[farm]))
-            if args['do_valuation']:
-                results[farm]['value'].append(farms_npv[farm])
+    Returns a dict with the keys 'farm_ids', 'start_day', 'fallow_per',
+    'start_weight' and 'tar_weight' (grams), 'num_fish', 'water_temp' (a
+    365 x farms array) and 'outplant_window' (a 365 x farms boolean array
+    that's True on the days of the year a farm may start a cycle).
+    '''
+    farm_ids = sorted(int(f) for f in farm_op_dict)
+    farm_keys = [str(f) for f in farm_ids]
+
+    def farm_param(name, cast):
+        return np.array([cast(farm_op_dict[f][name]) for f in farm_keys])
+
+    start_day = farm_param('start day for growing', int) - 1
+    outplant_window = np.zeros((365, len(farm_ids)), dtype=np.bool)
+    for farm_index, farm_start_day in enumerate(start_day):
+        window_days = np.arange(
+            farm_start_day - outplant_buffer,
+            farm_start_day + outplant_buffer + 1) % 365
+        outplant_window[window_days, farm_index] = True
+
+    return {
+        'farm_ids': farm_ids,
+        'start_day': start_day,
+        'fallow_per': farm_param('Length of Fallowing period', int),
+        'start_weight': 1000 * farm_param(
+            'weight of fish at start (kg)', float),
+        'tar_weight': 1000 * farm_param(
+            'target weight of fish at harvest (kg)', float),
+        'num_fish': farm_param('number of fish in farm', int),
+        'water_temp': np.array([
+            [float(water_temp_dict[str(day)][f]) for f in farm_keys]
+            for day in range(365)]),
+        'outplant_window': outplant_window,
+    }
+
+
+def simulate_farm_cycles(farm_arrays, a, b, tau, dur, frac, mort,
+                         valuation_params=None):
+    '''
+    Simulates the growth cycles of every farm for many samples of the growth
+    parameters at once.  Follows the day by day rules of calc_farm_cycles,
+    and accumulates the processed weight of calc_hrv_weight and the net
+    present value of valuation at each harvest.
 
-    LOGGER.info('Monte Carlo simulation complete.')
-    return results
+    Inputs:
+        farm_arrays: the dict returned by _make_farm_arrays
+        a: array of samples of growth parameter alpha.
+        b: array of samples of growth parameter beta, parallel to a.
+        tau: Growth parameter tau.
+        dur: Float which describes the length for the growth simulation to run
+            in years.
+        frac: A float representing the fraction of the fish that remains after
+            processing.
+        mort: A float referring to the daily mortality rate of fishes on an
+            aquaculture farm.
+        valuation_params: (optional) a (price_per_kg, frac_mrkt_price,
+            discount) tuple, see valuation.
+
+    Returns a tuple (cycles, weight, value) of (samples x farms) arrays of
+    the number of completed cycles, total processed weight (kg) and total net
+    present value (thousands of dollars, None without valuation_params).
+    '''
+    num_runs = len(a)
+    a = np.asarray(a, dtype=np.float64).reshape(num_runs, 1)
+    b = np.asarray(b, dtype=np.float64).reshape(num_runs, 1)
+    tar_weight = farm_arrays['tar_weight']
+    start_weight = farm_arrays['start_weight']
+    frac = float(frac)
+    num_fish = farm_arrays['num_fish']
+    growth_factor = np.exp(farm_arrays['water_temp'] * tau)
+    mort = float(mort)
+    shape = (num_runs, len(farm_arrays['farm_ids']))
+
+    fallow_days_left = np.tile(farm_arrays['start_day'], (num_runs, 1))
+    fish_weight = np.zeros(shape)
+    outplant_date = np.zeros(shape, dtype=np.int)
+    cycles = np.zeros(shape, dtype=np.int)
+    weight = np.zeros(shape)
+    value = np.zeros(shape) if valuation_params is not None else None
+
+    for day in xrange(0, int((365*dur)) + 1):
+        # The cases are decided on the state at the start of the day, in the
+        # same order as in calc_farm_cycles.
+        fallowing = fallow_days_left > 0
+        harvesting = ~fallowing & (fish_weight >= tar_weight)
+        empty = ~fallowing & ~harvesting & (fish_weight == 0)
+        growing = ~fallowing & ~harvesting & ~empty
+        outplanting = empty & farm_arrays['outplant_window'][day % 365]
+
+        fallow_days_left -= fallowing
+
+        if harvesting.any():
+            cycle_tpw = (fish_weight / 1000) * frac * num_fish * np.exp(
+                -mort * (day - outplant_date))
+            cycle_tpw[~harvesting] = 0
+            weight += cycle_tpw
+            cycles += harvesting
+            if value is not None:
+                price_per_kg, frac_mrkt_price, discount = valuation_params
+                net_rev = cycle_tpw * (price_per_kg * (1 - frac_mrkt_price))
+                value += net_rev * (1 / (1 + discount) ** day) / 1000
+            fallow_days_left = np.where(
+                harvesting, farm_arrays['fallow_per'], fallow_days_left)
+            fish_weight[harvesting] = 0
+
+        if growing.any():
+            fish_weight = np.where(
+                growing,
+                (a * (fish_weight ** b) * growth_factor[(day-1) % 365]) +
+                fish_weight,
+                fish_weight)
+
+        if outplanting.any():
+            fish_weight = np.where(outplanting, start_weight, fish_weight)
+            outplant_date[outplanting] = day + 1
+
+    return cycles, weight, value
 
 
 def make_histograms(farm, results, output_dir, total_num_runs):
@@ -2,10 +2,15 @@
 The Fisheries Model module contains functions for running the model
 
 Variable Suffix Notation:
+k: ensemble member
 t: time
 x: area/region
 a: age/class
 s: sex
+
+The parameters listed in ENSEMBLE_PARAMS may carry a leading member axis (k),
+in which case the derived variables and the numbers passed to and returned by
+the model functions carry it too.
 '''
 
 import logging
@@ -50,12 +55,13 @@ def initialize_vars(vars_dict):
     if vars_dict['population_type'] == 'Stage-Based':
         G, P = _calc_p_g_survtotalfrac(vars_dict)
         # Swap axes for easier class-based math in model run
-        vars_dict['G_survtotalfrac'] = G.swapaxes(0, 2)
-        vars_dict['P_survtotalfrac'] = P.swapaxes(0, 2)
+        vars_dict['G_survtotalfrac'] = G.swapaxes(-3, -1)
+        vars_dict['P_survtotalfrac'] = P.swapaxes(-3, -1)
 
     # Swap axes for easier class-based math in model run
-    vars_dict['Survtotalfrac'] = vars_dict['Survtotalfrac'].swapaxes(0, 2)
-    vars_dict['Survnaturalfrac'] = vars_dict['Survnaturalfrac'].swapaxes(0, 2)
+    vars_dict['Survtotalfrac'] = vars_dict['Survtotalfrac'].swapaxes(-3, -1)
+    vars_dict['Survnaturalfrac'] = vars_dict['Survnaturalfrac'].swapaxes(
+        -3, -1)
 
     t = vars_dict['total_timesteps']
     x = len(vars_dict['Regions'])  # Region
@@ -85,10 +91,7 @@ def _calc_survtotalfrac(vars_dict):
     E = vars_dict['Exploitationfraction']
     V = vars_dict['Vulnfishing']
 
-    I = []
-    for x in E:
-        I.append(x * V)
-    I = np.array(I)
+    I = E[..., np.newaxis, np.newaxis] * V
 
     S_tot = S_nat * (1 - I)
 
@@ -160,25 +163,33 @@ def set_recru_func(vars_dict):
     Fec = vars_dict['Fecundity']
     fixed = vars_dict['total_recur_recruits']
 
+    def total(N_xsa):
+        # Sums over region, sex and class, leaving any member axis
+        return N_xsa.sum(axis=-1).sum(axis=-1).sum(axis=-1)
+
+    def by_region(recruits):
+        # Lines up total recruits with the regions of LarvDisp
+        return np.asarray(recruits)[..., np.newaxis]
+
     def spawners(N_prev):
-        return (N_prev * Matu * Weight).sum()
+        return total(N_prev * Matu * Weight)
 
     def rec_func_BH(N_prev):
-        N_0 = (LarvDisp * ((alpha * spawners(
-            N_prev) / (beta + spawners(N_prev)))) / sexsp)
+        N_0 = (LarvDisp * by_region(alpha * spawners(
+            N_prev) / (beta + spawners(N_prev))) / sexsp)
         return (N_0, spawners(N_prev))
 
     def rec_func_Ricker(N_prev):
-        N_0 = (LarvDisp * (alpha * spawners(N_prev) * (
+        N_0 = (LarvDisp * by_region(alpha * spawners(N_prev) * (
             np.e ** (-beta * spawners(N_prev)))) / sexsp)
         return (N_0, spawners(N_prev))
 
     def rec_func_Fecundity(N_prev):
-        N_0 = (LarvDisp * (N_prev * Matu * Fec).sum() / sexsp)
+        N_0 = (LarvDisp * by_region(total(N_prev * Matu * Fec)) / sexsp)
         return (N_0, spawners(N_prev))
 
     def rec_func_Fixed(N_prev):
-        N_0 = LarvDisp * fixed / sexsp
+        N_0 = LarvDisp * by_region(fixed) / sexsp
         return (N_0, None)
 
     # Create Recruitment Function
@@ -193,12 +204,20 @@ def set_recru_func(vars_dict):
             N_0, spawn = rec_func(N_prev)
             assert(type(spawn) is np.float64)
             assert(N_0.shape == (len(vars_dict['Regions']),))
-            return rec_func
 
         except Exception, e:
             LOGGER.error("User-defined recruitment function could not be validated.")
             raise ValueError
 
+        def rec_func_Other(N_prev):
+            # User-defined functions take one member's numbers at a time
+            if N_prev.ndim == 3:
+                return rec_func(N_prev)
+            results = [rec_func(N_xsa) for N_xsa in N_prev]
+            return (np.array([N_0 for N_0, _ in results]),
+                    np.array([spawn for _, spawn in results]))
+        return rec_func_Other
+
     elif vars_dict['recruitment_type'] == "Beverton-Holt":
         return rec_func_BH
     elif vars_dict['recruitment_type'] == "Ricker":
@@ -233,21 +252,30 @@ def set_init_cond_func(vars_dict):
     num_regions = len(vars_dict['Regions'])
     num_classes = len(vars_dict['Classes'])
 
+    def init_recruits():
+        '''
+        Returns:
+            N_0_asx (np.ndarray): initial numbers with only class 0 filled
+        '''
+        N_0_x = LarvDisp * np.asarray(total_init_recruits)[
+            ..., np.newaxis] / sexsp
+        N_0 = np.zeros(N_0_x.shape[:-1] + (num_classes, sexsp, num_regions))
+        N_0[..., 0, :, :] = N_0_x[..., np.newaxis, :]
+        return N_0
+
     def age_based_init_cond():
         '''
         Returns:
             N_0_asx (np.ndarray): initial numbers
         '''
-
-        N_0 = np.zeros([num_classes, sexsp, num_regions])
-
-        N_0[0] = LarvDisp * total_init_recruits / sexsp
+        N_0 = init_recruits()
 
         for i in range(1, num_classes-1):
-            N_0[i] = N_0[i-1] * S[i-1]
+            N_0[..., i, :, :] = N_0[..., i-1, :, :] * S[..., i-1, :, :]
 
-        if len(N_0) > 1:
-            N_0[-1] = (N_0[-2] * S[-2]) / (1 - S[-1])
+        if num_classes > 1:
+            N_0[..., -1, :, :] = (N_0[..., -2, :, :] * S[..., -2, :, :]) / (
+                1 - S[..., -1, :, :])
 
         return N_0
 
@@ -256,10 +284,8 @@ def set_init_cond_func(vars_dict):
         Returns:
             N_0_asx (np.ndarray): initial numbers
         '''
-        N_0 = np.zeros([num_classes, sexsp, num_regions])
-
-        N_0[0] = LarvDisp * total_init_recruits / sexsp
-        N_0[1:] = 1
+        N_0 = init_recruits()
+        N_0[..., 1:, :, :] = 1
 
         return N_0
 
@@ -293,7 +319,28 @@ def set_cycle_func(vars_dict, rec_func):
     P = vars_dict['P_survtotalfrac']  # P_asx
     G = vars_dict['G_survtotalfrac']  # G_asx
     num_classes = len(vars_dict['Classes'])
-    Migration = vars_dict['Migration']
+    # Index Order: class, destination region, source region
+    Migration = np.array(vars_dict['Migration'])
+
+    def migrate(N_prev):
+        '''
+        Moves each class and sex between regions
+
+        Returns:
+            N_asx (np.ndarray): numbers after migration
+        '''
+        return np.einsum('...ayx,...asx->...asy', Migration, N_prev)
+
+    def recruit(N_prev, N_next):
+        '''
+        Fills in class 0 of N_next with the recruits from N_prev
+
+        Returns:
+            Spawners (np.array): spawners
+        '''
+        N_next_0_x, spawners = rec_func(N_prev.swapaxes(-3, -1))
+        N_next[..., 0, :, :] = N_next_0_x[..., np.newaxis, :]
+        return spawners
 
     def age_based_cycle_func(N_prev):
         '''
@@ -305,21 +352,16 @@ def set_cycle_func(vars_dict, rec_func):
         Returns:
             N_next (np.ndarray): next cycle numbers
 
-            Spawners (np.array): spawners by region
+            Spawners (np.array): spawners
         '''
         N_next = np.ndarray(N_prev.shape)
+        spawners = recruit(N_prev, N_next)
+        M = migrate(N_prev)
 
-        N_prev_xsa = N_prev.swapaxes(0, 2)
-        N_next_0_xsa, spawners = rec_func(N_prev_xsa)
-        N_next[0] = N_next_0_xsa.swapaxes(0, 2)
-
-        for i in range(1, num_classes):
-            N_next[i] = np.array(map(lambda x: Migration[i-1].dot(
-                x), N_prev[i-1]))[:, 0, :] * S[i-1]
+        N_next[..., 1:, :, :] = M[..., :-1, :, :] * S[..., :-1, :, :]
 
-        if len(N_prev) > 1:
-            N_next[-1] = N_next[-1] + np.array(map(lambda x: Migration[-1].dot(
-                x), N_prev[-1]))[:, 0, :] * S[-1]
+        if num_classes > 1:
+            N_next[..., -1, :, :] += M[..., -1, :, :] * S[..., -1, :, :]
 
         return N_next, spawners
 
@@ -333,22 +375,17 @@ def set_cycle_func(vars_dict, rec_func):
         Returns:
             N_next (np.ndarray): next cycle numbers
 
-            Spawners (np.array): spawners by region
+            Spawners (np.array): spawners
         '''
         N_next = np.ndarray(N_prev.shape)
+        spawners = recruit(N_prev, N_next)
+        M = migrate(N_prev)
 
-        N_prev_xsa = N_prev.swapaxes(0, 2)
-        N_next_0_xsa, spawners = rec_func(N_prev_xsa)
-        N_next[0] = N_next_0_xsa.swapaxes(0, 2)
+        N_next[..., 0, :, :] += M[..., 0, :, :] * S[..., 0, :, :]
 
-        N_next[0] = N_next[0] + np.array(Migration[0].dot(N_prev[0])) * S[0]
-
-        for i in range(1, num_classes):
-            G_comp = np.array(map(lambda x: Migration[i-1].dot(
-                x), N_prev[i-1]))[:, 0, :] * G[i-1]
-            P_comp = np.array(map(lambda x: Migration[i].dot(
-                x), N_prev[i]))[:, 0, :] * P[i]
-            N_next[i] = G_comp + P_comp
+        G_comp = M[..., :-1, :, :] * G[..., :-1, :, :]
+        P_comp = M[..., 1:, :, :] * P[..., 1:, :, :]
+        N_next[..., 1:, :, :] = G_comp + P_comp
 
         return N_next, spawners
 
@@ -393,10 +430,7 @@ def set_harvest_func(vars_dict):
     E = vars_dict['Exploitationfraction']
     V = vars_dict['Vulnfishing']
 
-    I = []
-    for x in E:
-        I.append(x * V)
-    I = np.array(I)
+    I = E[..., np.newaxis, np.newaxis] * V
 
     def harv_func(N_asx):
         '''
@@ -410,9 +444,9 @@ def set_harvest_func(vars_dict):
 
             V_x (np.ndarray): Value by region
         '''
-        N_xsa = N_asx.swapaxes(0, 2)
+        N_xsa = N_asx.swapaxes(-3, -1)
         H_xsa = N_xsa * I * Weight
-        H_x = np.array(map(lambda x: x.sum(), H_xsa))
+        H_x = H_xsa.sum(axis=-1).sum(axis=-1)
         V_x = H_x * (frac_post_process * unit_price)
         return H_x, V_x
 
@@ -446,63 +480,217 @@ def run_population_model(vars_dict, init_cond_func, cycle_func, harvest_func):
             'equilibrate_timestep': <int>,
         }
     '''
+    # Run as an ensemble of one member, the functions broadcast over the
+    # member axis
     N_tasx = vars_dict['N_tasx']
     H_tx = vars_dict['H_tx']
     V_tx = vars_dict['V_tx']
     Spawners_t = vars_dict['Spawners_t']
-    equilibrate_timestep = False
-    subset_size = 10
-
-    # Set Initial Conditions for Population
-    N_tasx[0] = init_cond_func()
 
-    # Run Cycles
-    for i in range(0, len(N_tasx)-1):
-        # Run Harvest and Check Equilibrium for Current Population
-        # Consider Wrapping this into a function
-        if harvest_func:
-            H_x, V_x = harvest_func(N_tasx[i])
-            H_tx[i] = H_x
-            V_tx[i] = V_x
-        if not equilibrate_timestep and i >= subset_size and _is_equilibrated(H_tx, i, subset_size=subset_size):
-            equilibrate_timestep = i
-            LOGGER.info('Model Equilibrated at Timestep %i', equilibrate_timestep)
-        # Find Numbers for Next Population
-        N_next, Spawners_t[i+1] = cycle_func(N_tasx[i])
-        N_tasx[i+1] = N_next
-
-    # Run Harvest and Check Equilibrium for Final Population
-    if harvest_func:
-        H_x, V_x = harvest_func(N_tasx[-1])
-        H_tx[-1] = H_x
-        V_tx[-1] = V_x
-    if not equilibrate_timestep and len(N_tasx) >= subset_size and _is_equilibrated(H_tx, len(N_tasx)-1, subset_size=subset_size):
-        equilibrate_timestep = len(N_tasx)
-        LOGGER.info('Model Equilibrated at Timestep %i', equilibrate_timestep)
+    equilibrate_timestep_k = _run_members(
+        N_tasx[np.newaxis], H_tx[np.newaxis], V_tx[np.newaxis],
+        Spawners_t[np.newaxis],
+        lambda members: (init_cond_func, cycle_func, harvest_func))
 
     # Store Results in Variables Dictionary
     vars_dict['N_tasx'] = N_tasx
     vars_dict['H_tx'] = H_tx
     vars_dict['V_tx'] = V_tx
     vars_dict['Spawners_t'] = Spawners_t
-    vars_dict['equilibrate_timestep'] = equilibrate_timestep
+    vars_dict['equilibrate_timestep'] = int(equilibrate_timestep_k[0]) or False
 
     return vars_dict
 
 
 # Helper functions for run_population_model
+def _run_members(N_ktasx, H_ktx, V_ktx, Spawners_kt, member_funcs,
+                 stop_at_equilibrium=False):
+    '''Steps the members of an ensemble through time together, filling in
+    the arrays in place
+
+    Args:
+        N_ktasx, H_ktx, V_ktx, Spawners_kt (np.ndarray): numbers, harvest,
+            valuation and spawners with a leading member axis
+
+        member_funcs (function): takes an array of member indexes and returns
+            (init_cond_func, cycle_func, harvest_func) for those members.  It
+            is called again when members equilibrate and stop.
+
+        stop_at_equilibrium (boolean): if True a member stops being stepped
+            once it equilibrates, and its remaining time steps hold its
+            equilibrated values
+
+    Returns:
+        equilibrate_timestep_k (np.ndarray): 0 where the member didn't
+            equilibrate
+    '''
+    num_timesteps = N_ktasx.shape[1]
+    members = np.arange(len(N_ktasx))
+    equilibrate_timestep_k = np.zeros(len(members), dtype=int)
+    subset_size = 10
+
+    # Set Initial Conditions for Population
+    init_cond_func, cycle_func, harvest_func = member_funcs(members)
+    N_ktasx[:, 0] = init_cond_func()
+
+    for i in range(0, num_timesteps):
+        # Run Harvest and Check Equilibrium for Current Population
+        if harvest_func:
+            H_kx, V_kx = harvest_func(N_ktasx[members, i])
+            H_ktx[members, i] = H_kx
+            V_ktx[members, i] = V_kx
+        # The check after the final time step records one past it
+        if i >= subset_size or (
+                i == num_timesteps - 1 and num_timesteps >= subset_size):
+            H_window = H_ktx[members, i-(subset_size-1):i+1]
+            equilibrated = (
+                (equilibrate_timestep_k[members] == 0) & _is_equilibrated(
+                    H_window, subset_size-1, subset_size=subset_size))
+            if equilibrated.any():
+                equilibrate_timestep = (
+                    i if i < num_timesteps - 1 else num_timesteps)
+                equilibrate_timestep_k[members[equilibrated]] = (
+                    equilibrate_timestep)
+                LOGGER.info(
+                    'Model Equilibrated at Timestep %i for %d members',
+                    equilibrate_timestep, np.count_nonzero(equilibrated))
+                if stop_at_equilibrium:
+                    stopped = members[equilibrated]
+                    for array in [N_ktasx, H_ktx, V_ktx, Spawners_kt]:
+                        array[stopped, i+1:] = array[stopped, i][
+                            :, np.newaxis]
+                    members = members[~equilibrated]
+                    if len(members) == 0:
+                        break
+                    init_cond_func, cycle_func, harvest_func = member_funcs(
+                        members)
+        if i == num_timesteps - 1:
+            break
+
+        # Find Numbers for Next Population
+        N_next, spawners = cycle_func(N_ktasx[members, i])
+        N_ktasx[members, i+1] = N_next
+        Spawners_kt[members, i+1] = np.nan if spawners is None else spawners
+
+    return equilibrate_timestep_k
+
+
 def _calc_moving_average(H):
-    mov_avg = H.sum() / len(H)
+    mov_avg = H.sum(axis=-1).sum(axis=-1) / H.shape[-2]
     return mov_avg
 
 
 def _is_equilibrated(H_tx, i, tolerance=0.001, subset_size=10):
-    mov_avg = _calc_moving_average(H_tx[i-(subset_size-1): i+1])
-    cur = H_tx[i].sum()
+    mov_avg = _calc_moving_average(H_tx[..., i-(subset_size-1): i+1, :])
+    cur = H_tx[..., i, :].sum(axis=-1)
     frac = mov_avg / cur
     diff = np.abs(frac - 1)
 
-    if diff < tolerance:
-        return True
-    else:
-        return False
+    return diff < tolerance
+
+
+# Parameters that may vary across the members of an ensemble, and the shape
+# of one member's value
+ENSEMBLE_PARAMS = {
+    'alpha': 'scalar',
+    'beta': 'scalar',
+    'total_init_recruits': 'scalar',
+    'total_recur_recruits': 'scalar',
+    'Larvaldispersal': 'x',
+    'Exploitationfraction': 'x',
+    'Survnaturalfrac': 'xsa',
+    'Migration': 'a list of x by x matrices',
+}
+
+# Variables initialize_vars derives from the ensemble parameters
+_DERIVED_ENSEMBLE_VARS = [
+    'Survtotalfrac', 'G_survtotalfrac', 'P_survtotalfrac']
+
+
+def run_ensemble_model(vars_dict, ensemble_dict, stop_at_equilibrium=False):
+    '''Runs the model for K parameter sets at once
+
+    Every member of the ensemble shares the parameters in vars_dict except
+    those given in ensemble_dict, and all members are stepped through time
+    together by the functions of a single model run with a member axis
+    added to their parameters.  Recruitment functions of type 'Other' are
+    called once per member and time step.
+
+    Args:
+        vars_dict (dictionary): verified arguments and variables of a single
+            model, as returned by fisheries_io.fetch_args (before
+            initialize_vars)
+
+        ensemble_dict (dictionary): maps keys of ENSEMBLE_PARAMS to arrays
+            whose first axis has a value for each of the K members
+
+        stop_at_equilibrium (boolean): if True a member stops being stepped
+            once it equilibrates, and its remaining time steps hold its
+            equilibrated values.  The run ends once every member has.
+
+    Returns:
+        ensemble_vars (dictionary)
+
+    Example Returned Dictionary::
+
+        {
+            'N_ktasx': np.array([...]),  # Index Order: member, time, class,
+                                         # sex, region
+            'H_ktx': np.array([...]),  # Index Order: member, time, region
+            'V_ktx': np.array([...]),  # Index Order: member, time, region
+            'Spawners_kt': np.array([...]),  # Index Order: member, time
+            'equilibrate_timestep_k': np.array([...]),  # 0 where the member
+                                                        # didn't equilibrate
+        }
+    '''
+    for key in ensemble_dict:
+        if key not in ENSEMBLE_PARAMS:
+            LOGGER.error(
+                "%s can't vary across an ensemble, expected one of %s",
+                key, sorted(ENSEMBLE_PARAMS.keys()))
+            raise ValueError
+    num_members = len(ensemble_dict.values()[0]) if ensemble_dict else 1
+    if not all(len(value) == num_members for value in ensemble_dict.values()):
+        LOGGER.error("Ensemble parameters have different numbers of members")
+        raise ValueError
+
+    # Give every ensemble parameter a leading member axis
+    ensemble_vars = dict(vars_dict)
+    for key in ENSEMBLE_PARAMS:
+        if key in ensemble_dict:
+            ensemble_vars[key] = np.array(ensemble_dict[key], dtype=np.float64)
+        else:
+            ensemble_vars[key] = np.array(
+                [vars_dict[key]] * num_members, dtype=np.float64)
+    ensemble_vars = initialize_vars(ensemble_vars)
+
+    def member_funcs(members):
+        '''Returns the model functions of the given members'''
+        member_vars = dict(ensemble_vars)
+        for key in ENSEMBLE_PARAMS.keys() + _DERIVED_ENSEMBLE_VARS:
+            if member_vars[key] is not None:
+                member_vars[key] = member_vars[key][members]
+        rec_func = set_recru_func(member_vars)
+        return (set_init_cond_func(member_vars),
+                set_cycle_func(member_vars, rec_func),
+                set_harvest_func(member_vars))
+
+    num_timesteps = vars_dict['total_timesteps']
+    num_regions = len(vars_dict['Regions'])
+    N_ktasx = np.zeros(
+        (num_members,) + ensemble_vars['N_tasx'].shape)
+    H_ktx = np.zeros([num_members, num_timesteps, num_regions])
+    V_ktx = np.zeros([num_members, num_timesteps, num_regions])
+    Spawners_kt = np.zeros([num_members, num_timesteps])
+
+    equilibrate_timestep_k = _run_members(
+        N_ktasx, H_ktx, V_ktx, Spawners_kt, member_funcs,
+        stop_at_equilibrium=stop_at_equilibrium)
+
+    return {
+        'N_ktasx': N_ktasx,
+        'H_ktx': H_ktx,
+        'V_ktx': V_ktx,
+        'Spawners_kt': Spawners_kt,
+        'equilibrate_timestep_k': equilibrate_timestep_k,
+    }
@@ -4,10 +4,11 @@ import os
 import logging
 
 import gdal
-import osr
 import numpy
 import pygeoprocessing
 
+from invest_natcap import convolution
+
 logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 
@@ -77,13 +78,11 @@ def execute(args):
 
         LOGGER.info('gaussian filter natural areas')
         sigma = 9.0
-        gaussian_kernel_uri = os.path.join(
-            args['workspace_dir'], 'gaussian_kernel%s.tif' % file_suffix)
-        make_gaussian_kernel_uri(sigma, gaussian_kernel_uri)
         smoothed_natural_areas_uri = os.path.join(
             args['workspace_dir'], 'smoothed_natural_areas%s.tif' % file_suffix)
-        pygeoprocessing.geoprocessing.convolve_2d_uri(
-            natural_areas_uri, gaussian_kernel_uri, smoothed_natural_areas_uri)
+        convolution.convolve_uri(
+            natural_areas_uri, 'gaussian', sigma, 1.0,
+            smoothed_natural_areas_uri)
 
         ffqi_uri = os.path.join(
             args['workspace_dir'], 'ffqi%s.tif' % file_suffix)
@@ -305,13 +304,11 @@ def execute(args):
 
     LOGGER.info('gaussian filter primary veg')
     sigma = 9.0
-    gaussian_kernel_uri = os.path.join(
-        args['workspace_dir'], 'gaussian_kernel%s.tif' % file_suffix)
-    make_gaussian_kernel_uri(sigma, gaussian_kernel_uri)
     smoothed_primary_veg_mask_uri = os.path.join(
         args['workspace_dir'], 'smoothed_primary_veg_mask%s.tif' % file_suffix)
-    pygeoprocessing.geoprocessing.convolve_2d_uri(
-        primary_veg_mask_uri, gaussian_kernel_uri, smoothed_primary_veg_mask_uri)
+    convolution.convolve_uri(
+        primary_veg_mask_uri, 'gaussian', sigma, 1.0,
+        smoothed_primary_veg_mask_uri)
 
     primary_veg_smooth_uri = os.path.join(
         args['workspace_dir'], 'ffqi%s.tif' % file_suffix)
@@ -436,43 +433,3 @@ def execute(args):
         dataset_to_align_index=0, assert_datasets_projected=False,
         vectorize_op=False)
     #calc msa msa = msa_f[tail_type] * msa_lu[tail_type] * msa_i[tail_type]
-
-
-
-def make_gaussian_kernel_uri(sigma, kernel_uri):
-    """create a gaussian kernel raster"""
-    max_distance = sigma * 5
-    kernel_size = int(numpy.round(max_distance * 2 + 1))
-
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_dataset = driver.Create(
-        kernel_uri.encode('utf-8'), kernel_size, kernel_size, 1,
-        gdal.GDT_Float32, options=['BIGTIFF=IF_SAFER'])
-
-    #Make some kind of geotransform, it doesn't matter what but
-    #will make GIS libraries behave better if it's all defined
-    kernel_dataset.SetGeoTransform([444720, 30, 0, 3751320, 0, -30])
-    srs = osr.SpatialReference()
-    srs.SetUTM(11, 1)
-    srs.SetWellKnownGeogCS('NAD27')
-    kernel_dataset.SetProjection(srs.ExportToWkt())
-
-    kernel_band = kernel_dataset.GetRasterBand(1)
-    kernel_band.SetNoDataValue(-9999)
-
-    col_index = numpy.array(xrange(kernel_size))
-    integration = 0.0
-    for row_index in xrange(kernel_size):
-        kernel = numpy.exp(
-            -((row_index - max_distance)**2 +
-                (col_index - max_distance) ** 2)/(2.0*sigma**2)).reshape(
-                    1, kernel_size)
-
-        integration += numpy.sum(kernel)
-        kernel_band.WriteArray(kernel, xoff=0, yoff=row_index)
-
-    for row_index in xrange(kernel_size):
-        kernel_row = kernel_band.ReadAsArray(
-            xoff=0, yoff=row_index, win_xsize=kernel_size, win_ysize=1)
-        kernel_row /= integration
-        kernel_band.WriteArray(kernel_row, 0, row_index)
@@ -44,6 +44,11 @@ def execute(args):
             information about the E parameter
         args['adv_uv_points_uri'] (string): optional OGR point Datasource with
             spatial advection u and v vectors.
+        args['solver'] (string): optional name of the linear solver, one of
+            the keys of marine_water_quality_core.LINEAR_SOLVERS.  Defaults
+            to 'lgmres'.
+        args['solver_tolerance'] (float): optional relative residual the
+            iterative solvers stop at.  Defaults to 1e-5.
 
     Returns:
         nothing
@@ -228,7 +233,9 @@ def execute(args):
 
     concentration_array = marine_water_quality_core.diffusion_advection_solver(
         source_point_values, args['kps'], in_water_array, tide_e_array,
-        adv_u_array, adv_v_array, nodata_out, cell_size, args['layer_depth'])
+        adv_u_array, adv_v_array, nodata_out, cell_size, args['layer_depth'],
+        solver=args.get('solver', 'lgmres'),
+        tolerance=float(args.get('solver_tolerance', 1e-5)))
 
     raster_out = gdal.Open(raster_out_uri, gdal.GA_Update)
     raster_out_band = raster_out.GetRasterBand(1)
@@ -1,14 +1,24 @@
+"""Core routines for the marine water quality model.  The steady state
+advection diffusion equation is discretized on the model grid as a sparse
+banded linear system which is then solved with one of the solvers in
+LINEAR_SOLVERS."""
+
 import logging
 import time
 
 import scipy.sparse
+import scipy.sparse.linalg
 from scipy.sparse.linalg import spsolve
 import numpy as np
 import pyamg
 
+LOGGER = logging.getLogger('invest_natcap.marine_water_quality.core')
+
+
 def diffusion_advection_solver(source_point_data, kps, in_water_array,
                                tide_e_array, adv_u_array,
-                               adv_v_array, nodata, cell_size, layer_depth):
+                               adv_v_array, nodata, cell_size, layer_depth,
+                               solver='lgmres', tolerance=1e-5):
     """2D Water quality model to track a pollutant in the ocean.  Three input
        arrays must be of the same shape.  Returns the solution in an array of
        the same shape.
@@ -29,21 +39,87 @@ def diffusion_advection_solver(source_point_data, kps, in_water_array,
     cell_size - the length of the side of a cell in meters
     layer_depth - float indicating the depth of the grid cells in
             meters.
+    solver - (optional) the name of the linear solver in LINEAR_SOLVERS to
+        use, defaults to 'lgmres', LGMRES preconditioned by algebraic
+        multigrid.  'direct' is the most robust on small grids but runs out
+        of memory on grids of a few million cells.
+    tolerance - (optional) the relative residual the iterative solvers stop
+        at, defaults to 1e-5
     """
 
     n_rows = in_water_array.shape[0]
     n_cols = in_water_array.shape[1]
 
-    #Flatten arrays for use in the matrix building step
-    in_water = in_water_array.flatten()
-    e_array_flat = tide_e_array.flatten()
-    adv_u_flat = adv_u_array.flatten()
-    adv_v_flat = adv_v_array.flatten()
+    if n_cols <= 2 or n_rows <= 2:
+        raise ValueError(
+            'The number of inferred columns and rows in the output raster'
+            'are less than 2, probably because the Output Pixel size in the UI '
+            'is set too low for the projection of the AOI. '
+            'Try a smaller value. Current n_cols, n_rows (%d, %d)' % (
+                n_cols, n_rows))
+
+    if solver not in LINEAR_SOLVERS:
+        raise ValueError(
+            'Unknown solver %s, expected one of %s' % (
+                solver, sorted(LINEAR_SOLVERS.keys())))
 
-    LOGGER = logging.getLogger('invest_natcap.marine_water_quality.core')
     LOGGER.info('Calculating advection diffusion')
     t0 = time.clock()
 
+    LOGGER.info('Building diagonals for linear advection diffusion system.')
+    a_matrix, diagonal_offsets, b_vector = build_diffusion_advection_system(
+        source_point_data, kps, in_water_array, tide_e_array, adv_u_array,
+        adv_v_array, nodata, cell_size, layer_depth)
+    matrix = scipy.sparse.spdiags(
+        a_matrix, diagonal_offsets, n_rows * n_cols, n_rows * n_cols, "csr")
+    LOGGER.info('(' + str(time.clock() - t0) + 's elapsed)')
+
+    LOGGER.info('Solving via %s', solver)
+    solve_start = time.clock()
+    result, n_iterations = LINEAR_SOLVERS[solver](
+        matrix, b_vector, tolerance)
+    b_norm = np.linalg.norm(b_vector)
+    if b_norm == 0:
+        b_norm = 1.0
+    relative_residual = np.linalg.norm(b_vector - matrix * result) / b_norm
+    LOGGER.info(
+        '%s solver finished in %s iterations with a relative residual of '
+        '%g (%fs elapsed)', solver, n_iterations, relative_residual,
+        time.clock() - solve_start)
+    if relative_residual > tolerance:
+        LOGGER.warn(
+            'the %s solver did not converge to a relative residual of %g',
+            solver, tolerance)
+    LOGGER.info('(' + str(time.clock() - t0) + 's elapsed)')
+
+    #Result is a 1D array of all values, put it back to 2D
+    result.resize(n_rows,n_cols)
+    return result
+
+
+def build_diffusion_advection_system(
+        source_point_data, kps, in_water_array, tide_e_array, adv_u_array,
+        adv_v_array, nodata, cell_size, layer_depth):
+    """Builds the banded linear system of the advection diffusion equation,
+        see diffusion_advection_solver for the parameters.  The stencil of
+        every cell is built at once with whole array operations.
+
+        Cells at the edge of the grid treat their neighbor outside the grid
+        as valid if the last cell of the grid is valid, and their
+        coefficients for that neighbor end up in the last column of the
+        diagonal they belong to.  Cells next to the first cell of the grid
+        don't take the central difference towards it.  Both quirks are kept
+        so results match earlier versions of the model.
+
+        returns a tuple (a_matrix, diagonal_offsets, b_vector) where a_matrix
+            is a (5, n_rows * n_cols) array of the diagonals at
+            diagonal_offsets in the format scipy.sparse.spdiags takes and
+            b_vector is the right hand side"""
+
+    n_rows = in_water_array.shape[0]
+    n_cols = in_water_array.shape[1]
+    n_cells = n_rows * n_cols
+
     def calc_index(i, j):
         """used to abstract the 2D to 1D index calculation below"""
         if i >= 0 and i < n_rows and j >= 0 and j < n_cols:
@@ -51,15 +127,6 @@ def diffusion_advection_solver(source_point_data, kps, in_water_array,
         else:
             return -1
 
-    #set up variables to hold the sparse system of equations
-    #upper bound  n*m*5 elements
-    b_vector = np.zeros(n_rows * n_cols)
-
-    #holds the rows for diagonal sparse matrix creation later, row 4 is
-    #the diagonal
-    a_matrix = np.zeros((9, n_rows * n_cols))
-    diags = np.array([-2 * n_cols, -n_cols, -2, -1, 0, 1, 2, n_cols, 2 * n_cols])
-
     #Set up a data structure so we can index point source data based on 1D
     #indexes
     source_points = {}
@@ -71,164 +138,171 @@ def diffusion_advection_solver(source_point_data, kps, in_water_array,
             #There is another point at the same grid point, add the sources
             source_points[source_index]['WPS'] += source_data['WPS']
 
-
-    #Build up an array of valid indexes.  These are locations where there is
+    #Build up an array of valid cells.  These are locations where there is
     #water and well defined E and ADV points.
     LOGGER.info('Building valid index lookup table.')
-    valid_indexes = in_water
-    valid_indexes *= e_array_flat != nodata
-    valid_indexes *= adv_u_flat != nodata
-    valid_indexes *= adv_v_flat != nodata
-
-    LOGGER.info('Building diagonals for linear advection diffusion system.')
-    for i in range(n_rows):
-        for j in range(n_cols):
-            #diagonal element i,j always in bounds, calculate directly
-            a_diagonal_index = calc_index(i, j)
-            a_up_index = calc_index(i - 1, j)
-            a_down_index = calc_index(i + 1, j)
-            a_left_index = calc_index(i, j - 1)
-            a_right_index = calc_index(i, j + 1)
-
-            #if land then s = 0 and quit
-            if not valid_indexes[a_diagonal_index]:
-                a_matrix[4, a_diagonal_index] = 1
-                b_vector[a_diagonal_index] = nodata
-                continue
-
-            if  a_diagonal_index in source_points:
-                #Set wps to be daily loading the concentration, convert to / sec
-                #loading
-                wps = source_points[a_diagonal_index]['WPS'] / (cell_size ** 2 * \
-                    layer_depth)
-                b_vector[a_diagonal_index] = -wps
-
-            E = e_array_flat[a_diagonal_index]
-            adv_u = adv_u_flat[a_diagonal_index]
-            adv_v = adv_v_flat[a_diagonal_index]
-
-            #Build up terms
-            #Ey
-            if a_up_index > 0 and a_down_index > 0 and \
-                valid_indexes[a_up_index] and valid_indexes[a_down_index]:
-                #Ey
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[7, a_down_index] += E / cell_size ** 2
-                a_matrix[1, a_up_index] += E / cell_size ** 2
-
-                #Uy
-                a_matrix[7, a_down_index] += adv_v / (2.0 * cell_size)
-                a_matrix[1, a_up_index] += -adv_v / (2.0 * cell_size)
-            if a_up_index < 0 and valid_indexes[a_down_index]:
-                #we're at the top boundary, forward expansion down
-                #Ey
-                a_matrix[4, a_diagonal_index] += -E / cell_size ** 2
-                a_matrix[7, a_down_index] += E / cell_size ** 2
-
-                #Uy
-                a_matrix[7, a_down_index] += adv_v / (2.0 * cell_size)
-                a_matrix[4, a_diagonal_index] += -adv_v / (2.0 * cell_size)
-            if a_down_index < 0 and valid_indexes[a_up_index]:
-                #we're at the bottom boundary, forward expansion up
-                #Ey
-                a_matrix[4, a_diagonal_index] += -E / cell_size ** 2
-                a_matrix[1, a_up_index] += E / cell_size ** 2
-
-                #Uy
-                a_matrix[1, a_up_index] += adv_v / (2.0 * cell_size)
-                a_matrix[4, a_diagonal_index] += -adv_v / (2.0 * cell_size)
-            if not valid_indexes[a_up_index]:
-                #Ey
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[7, a_down_index] += E / cell_size ** 2
-
-                #Uy
-                a_matrix[7, a_down_index] += adv_v / (2.0 * cell_size)
-            if not valid_indexes[a_down_index]:
-                #Ey
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[1, a_up_index] += E / cell_size ** 2
-
-                #Uy
-                a_matrix[1, a_up_index] += -adv_v / (2.0 * cell_size)
-
-            if a_left_index > 0 and a_right_index > 0 and \
-                valid_indexes[a_left_index] and valid_indexes[a_right_index]:
-                #Ex
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[5, a_right_index] += E / cell_size ** 2
-                a_matrix[3, a_left_index] += E / cell_size ** 2
-
-                #Ux
-                a_matrix[5, a_right_index] += adv_u / (2.0 * cell_size)
-                a_matrix[3, a_left_index] += -adv_u / (2.0 * cell_size)
-            if a_left_index < 0 and valid_indexes[a_right_index]:
-                #we're on left boundary, expand right
-                #Ex
-                a_matrix[4, a_diagonal_index] += -E / cell_size ** 2
-                a_matrix[5, a_right_index] += E / cell_size ** 2
-
-                a_matrix[5, a_right_index] += adv_u / (2.0 * cell_size)
-                a_matrix[4, a_diagonal_index] += -adv_u / (2.0 * cell_size)
-                #Ux
-            if a_right_index < 0 and valid_indexes[a_left_index]:
-                #we're on right boundary, expand left
-                #Ex
-                a_matrix[4, a_diagonal_index] += -E / cell_size ** 2
-                a_matrix[3, a_left_index] += E / cell_size ** 2
-
-                #Ux
-                a_matrix[3, a_left_index] += adv_u / (2.0 * cell_size)
-                a_matrix[4, a_diagonal_index] += -adv_u / (2.0 * cell_size)
-
-            if not valid_indexes[a_right_index]:
-                #Ex
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[3, a_left_index] += E / cell_size ** 2
-
-                #Ux
-                a_matrix[3, a_left_index] += -adv_u / (2.0 * cell_size)
-
-            if not valid_indexes[a_left_index]:
-                #Ex
-                a_matrix[4, a_diagonal_index] += -2.0 * E / cell_size ** 2
-                a_matrix[5, a_right_index] += E / cell_size ** 2
-
-                #Ux
-                a_matrix[5, a_right_index] += adv_u / (2.0 * cell_size)
-
-            #K
-            a_matrix[4, a_diagonal_index] += -kps
-
-            if not valid_indexes[a_up_index]:
-                a_matrix[1, a_up_index] = 0
-            if not valid_indexes[a_down_index]:
-                a_matrix[7, a_down_index] = 0
-            if not valid_indexes[a_left_index]:
-                a_matrix[3, a_left_index] = 0
-            if not valid_indexes[a_right_index]:
-                a_matrix[5, a_right_index] = 0
-
-    if n_cols <= 2 or n_rows <= 2:
-        raise ValueError(
-            'The number of inferred columns and rows in the output raster'
-            'are less than 2, probably because the Output Pixel size in the UI '
-            'is set too low for the projection of the AOI. '
-            'Try a smaller value. Current n_cols, n_rows (%d, %d)',
-            n_cols, n_rows)
-
-    matrix = scipy.sparse.spdiags(
-        a_matrix, [-2 * n_cols, -n_cols, -2, -1, 0, 1, 2, n_cols, 2 * n_cols],
-        n_rows * n_cols, n_rows * n_cols, "csc")
-
-    LOGGER.info('generating preconditioner')
+    valid = np.asarray(in_water_array) != 0
+    valid &= tide_e_array != nodata
+    valid &= adv_u_array != nodata
+    valid &= adv_v_array != nodata
+
+    #the validity of each cell's neighbors, a neighbor off the grid looks up
+    #the last cell
+    outside_valid = valid[-1, -1]
+    valid_up = np.empty_like(valid)
+    valid_up[1:, :] = valid[:-1, :]
+    valid_up[0, :] = outside_valid
+    valid_down = np.empty_like(valid)
+    valid_down[:-1, :] = valid[1:, :]
+    valid_down[-1, :] = outside_valid
+    valid_left = np.empty_like(valid)
+    valid_left[:, 1:] = valid[:, :-1]
+    valid_left[:, 0] = outside_valid
+    valid_right = np.empty_like(valid)
+    valid_right[:, :-1] = valid[:, 1:]
+    valid_right[:, -1] = outside_valid
+
+    cell_index = np.arange(n_cells).reshape((n_rows, n_cols))
+    row_index, col_index = np.indices((n_rows, n_cols))
+    top_edge = row_index == 0
+    bottom_edge = row_index == n_rows - 1
+    left_edge = col_index == 0
+    right_edge = col_index == n_cols - 1
+
+    e_term = np.asarray(tide_e_array, dtype=np.float64) / cell_size ** 2
+    u_term = np.asarray(adv_u_array, dtype=np.float64) / (2.0 * cell_size)
+    v_term = np.asarray(adv_v_array, dtype=np.float64) / (2.0 * cell_size)
+
+    diagonal = np.zeros((n_rows, n_cols))
+    up_coef = np.zeros((n_rows, n_cols))
+    down_coef = np.zeros((n_rows, n_cols))
+    left_coef = np.zeros((n_rows, n_cols))
+    right_coef = np.zeros((n_rows, n_cols))
+
+    #Ey and Uy
+    central = (
+        ~top_edge & ~bottom_edge & (cell_index - n_cols > 0) & valid_up &
+        valid_down)
+    diagonal -= central * 2.0 * e_term
+    down_coef += central * (e_term + v_term)
+    up_coef += central * (e_term - v_term)
+    #we're at the top boundary, forward expansion down
+    boundary = top_edge & valid_down
+    diagonal -= boundary * (e_term + v_term)
+    down_coef += boundary * (e_term + v_term)
+    #we're at the bottom boundary, forward expansion up
+    boundary = bottom_edge & valid_up
+    diagonal -= boundary * (e_term + v_term)
+    up_coef += boundary * (e_term + v_term)
+    diagonal -= ~valid_up * 2.0 * e_term
+    down_coef += ~valid_up * (e_term + v_term)
+    diagonal -= ~valid_down * 2.0 * e_term
+    up_coef += ~valid_down * (e_term - v_term)
+
+    #Ex and Ux
+    central = (
+        ~left_edge & ~right_edge & (cell_index - 1 > 0) & valid_left &
+        valid_right)
+    diagonal -= central * 2.0 * e_term
+    right_coef += central * (e_term + u_term)
+    left_coef += central * (e_term - u_term)
+    #we're on left boundary, expand right
+    boundary = left_edge & valid_right
+    diagonal -= boundary * (e_term + u_term)
+    right_coef += boundary * (e_term + u_term)
+    #we're on right boundary, expand left
+    boundary = right_edge & valid_left
+    diagonal -= boundary * (e_term + u_term)
+    left_coef += boundary * (e_term + u_term)
+    diagonal -= ~valid_right * 2.0 * e_term
+    left_coef += ~valid_right * (e_term - u_term)
+    diagonal -= ~valid_left * 2.0 * e_term
+    right_coef += ~valid_left * (e_term + u_term)
+
+    #K
+    diagonal -= kps
+
+    #if land then s = 0
+    diagonal[~valid] = 1
+    b_vector = np.zeros(n_cells)
+    b_vector[~valid.ravel()] = nodata
+
+    for source_index, source_data in source_points.iteritems():
+        if source_index >= 0 and valid.flat[source_index]:
+            #Set wps to be daily loading the concentration, convert to / sec
+            #loading
+            b_vector[source_index] = -source_data['WPS'] / (
+                cell_size ** 2 * layer_depth)
+
+    #the rows of a_matrix are the diagonals at diagonal_offsets indexed by
+    #the column of the matrix, so a cell's coefficient for a neighbor goes in
+    #the neighbor's position.  Neighbors off the grid go in the last position
+    #which spdiags drops for the lower diagonals.
+    diagonal_offsets = np.array([-n_cols, -1, 0, 1, n_cols])
+    a_matrix = np.zeros((5, n_cells))
+    a_matrix[2] = diagonal.ravel()
+    for diagonal_row, coefficient, valid_neighbor, on_edge in [
+            (0, up_coef, valid_up, top_edge),
+            (1, left_coef, valid_left, left_edge),
+            (3, right_coef, valid_right, right_edge),
+            (4, down_coef, valid_down, bottom_edge)]:
+        offset = diagonal_offsets[diagonal_row]
+        neighbor_index = np.where(on_edge, n_cells - 1, cell_index + offset)
+        a_matrix[diagonal_row] = np.bincount(
+            neighbor_index.ravel(),
+            weights=(coefficient * (valid & valid_neighbor)).ravel(),
+            minlength=n_cells)
+
+    return a_matrix, diagonal_offsets, b_vector
+
+
+def _solve_direct(matrix, b_vector, tolerance):
+    """Solves the system with a sparse LU factorization, tolerance is
+        unused.  Returns a tuple (result, number of iterations)"""
+    return spsolve(matrix.tocsc(), b_vector), 1
+
+
+def _solve_amg(matrix, b_vector, tolerance):
+    """Solves the system with smoothed aggregation algebraic multigrid
+        cycles.  Returns a tuple (result, number of iterations)"""
+    LOGGER.info('generating multigrid hierarchy')
     ml = pyamg.smoothed_aggregation_solver(matrix)
-    M = ml.aspreconditioner()
-
-    LOGGER.info('Solving via gmres iteration')
-    result = scipy.sparse.linalg.lgmres(matrix, b_vector, tol=1e-5, M=M)[0]
-    LOGGER.info('(' + str(time.clock() - t0) + 's elapsed)')
-
-    #Result is a 1D array of all values, put it back to 2D
-    result.resize(n_rows,n_cols)
-    return result
+    LOGGER.debug('multigrid hierarchy:\n%s', ml)
+    residuals = []
+    result = ml.solve(b_vector, tol=tolerance, residuals=residuals)
+    return result, len(residuals) - 1
+
+
+def _krylov_solver(krylov_function):
+    """Makes a solver out of a scipy.sparse.linalg Krylov method that's
+        preconditioned by algebraic multigrid."""
+    def _solve_krylov(matrix, b_vector, tolerance):
+        """Returns a tuple (result, number of iterations)"""
+        LOGGER.info('generating preconditioner')
+        ml = pyamg.smoothed_aggregation_solver(matrix)
+        M = ml.aspreconditioner()
+
+        iteration_count = [0]
+        def _count_iteration(_):
+            """counts the iterations of the Krylov method"""
+            iteration_count[0] += 1
+
+        result, info = krylov_function(
+            matrix, b_vector, tol=tolerance, M=M, callback=_count_iteration)
+        if info < 0:
+            raise ValueError(
+                'the Krylov solver failed with an illegal input or breakdown '
+                '(info %d)' % info)
+        return result, iteration_count[0]
+    return _solve_krylov
+
+
+#solver name -> function(matrix, b_vector, tolerance) that returns a tuple
+#(result, number of iterations)
+LINEAR_SOLVERS = {
+    'direct': _solve_direct,
+    'amg': _solve_amg,
+    'lgmres': _krylov_solver(scipy.sparse.linalg.lgmres),
+    'gmres': _krylov_solver(scipy.sparse.linalg.gmres),
+    'bicgstab': _krylov_solver(scipy.sparse.linalg.bicgstab),
+}
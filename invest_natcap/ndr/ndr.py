@@ -14,6 +14,8 @@ import pygeoprocessing.geoprocessing
 import pygeoprocessing.routing
 import pygeoprocessing.routing.routing_core
 
+from invest_natcap import prepare_cache
+
 import ndr_core
 
 LOGGER = logging.getLogger('invest_natcap.ndr.ndr')
@@ -46,6 +48,17 @@ def execute(args):
                 ndr._prepare call.  This argument could be used in cases where the
                 call to this function is scripted and can save a significant amount
                 of runtime.
+            'n_workers' - (optional) if greater than 1 the effective
+                retention is routed on this many threads, one independent
+                drainage basin at a time.  The result is identical to the
+                serial routing.
+            'use_prepare_cache' - (optional) if False the prepared data is
+                recalculated in the workspace rather than loaded from or
+                saved to the cache in invest_natcap.prepare_cache.  Defaults
+                to True.
+            'prepare_cache_dir' - (optional) a uri to the directory holding
+                the prepared data cache.  Defaults to
+                prepare_cache.default_cache_dir().
 
         returns nothing.
     """
@@ -122,10 +135,15 @@ def execute(args):
 
     if '_prepare' in args:
         preprocessed_data = args['_prepare']
+    elif args.get('use_prepare_cache', True):
+        preprocessed_data = prepare_cache.cached_prepare(
+            'ndr', _prepare, args, ['dem_uri', 'watersheds_uri'],
+            cache_dir=args.get('prepare_cache_dir', None))
     else:
         preprocessed_data = _prepare(**args)
 
     aligned_dem_uri = preprocessed_data['aligned_dem_uri']
+    n_workers = int(args.get('n_workers', 1))
     thresholded_slope_uri = preprocessed_data['thresholded_slope_uri']
     flow_accumulation_uri = preprocessed_data['flow_accumulation_uri']
     flow_direction_uri = preprocessed_data['flow_direction_uri']
@@ -405,9 +423,9 @@ def execute(args):
             intermediate_dir, 'effective_retention_%s%s.tif' %
             (nutrient, file_suffix))
         LOGGER.info('calculate effective retention')
-        ndr_core.ndr_eff_calculation(
+        _ndr_eff_calculation(
             flow_direction_uri, stream_uri, eff_uri[nutrient],
-            crit_len_uri[nutrient], effective_retention_uri)
+            crit_len_uri[nutrient], effective_retention_uri, n_workers)
         effective_retention_nodata = (
             pygeoprocessing.geoprocessing.get_nodata_from_uri(
                 effective_retention_uri))
@@ -432,9 +450,10 @@ def execute(args):
             intermediate_dir, 'sub_effective_retention_%s%s.tif' %
             (nutrient, file_suffix))
         LOGGER.info('calculate subsurface effective retention')
-        ndr_core.ndr_eff_calculation(
+        _ndr_eff_calculation(
             flow_direction_uri, stream_uri, sub_eff_uri[nutrient],
-            sub_crit_len_uri[nutrient], sub_effective_retention_uri)
+            sub_crit_len_uri[nutrient], sub_effective_retention_uri,
+            n_workers)
         sub_effective_retention_nodata = (
             pygeoprocessing.geoprocessing.get_nodata_from_uri(
                 sub_effective_retention_uri))
@@ -495,6 +514,25 @@ def execute(args):
             current_l_lulc_uri, l_lulc_temp_uri, dem_uri, lulc_uri]:
         os.remove(uri)
 
+
+def _ndr_eff_calculation(
+        flow_direction_uri, stream_uri, retention_eff_lulc_uri, crit_len_uri,
+        effective_retention_uri, n_workers):
+    """Dispatches to the serial or basin parallel effective retention
+        routing in ndr_core depending on `n_workers`.  See
+        ndr_core.ndr_eff_calculation for the other arguments.
+
+        returns nothing"""
+    if n_workers > 1:
+        ndr_core.ndr_eff_calculation_parallel(
+            flow_direction_uri, stream_uri, retention_eff_lulc_uri,
+            crit_len_uri, effective_retention_uri, n_workers)
+    else:
+        ndr_core.ndr_eff_calculation(
+            flow_direction_uri, stream_uri, retention_eff_lulc_uri,
+            crit_len_uri, effective_retention_uri)
+
+
 def add_fields_to_shapefile(
         key_field, field_summaries, output_layer, field_header_order=None):
     """Adds fields and their values indexed by key fields to an OGR
@@ -558,7 +596,7 @@ def _prepare(**args):
         args['dem_uri'])
 
     #Align all the input rasters
-    aligned_dem_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    aligned_dem_uri = os.path.join(intermediate_dir, 'aligned_dem.tif')
     pygeoprocessing.geoprocessing.align_dataset_list(
         [args['dem_uri']], [aligned_dem_uri], ['nearest'], dem_pixel_size,
         'intersection', dataset_to_align_index=0,
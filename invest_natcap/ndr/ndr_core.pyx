@@ -20,6 +20,7 @@ from libc.math cimport tan
 from libc.math cimport sqrt
 from libc.math cimport ceil
 from libc.math cimport exp
+from cython.parallel cimport prange
 
 cdef extern from "time.h" nogil:
     ctypedef int time_t
@@ -28,149 +29,17 @@ cdef extern from "time.h" nogil:
 import pygeoprocessing
 import pygeoprocessing.routing.routing_core
 
+import invest_natcap.block_cache
+from invest_natcap.block_cache cimport BlockCache
+
 logging.basicConfig(format='%(asctime)s %(name)-18s %(levelname)-8s \
     %(message)s', lnevel=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 
 LOGGER = logging.getLogger('ndr core')
 
 cdef double PI = 3.141592653589793238462643383279502884
-cdef int N_BLOCK_ROWS = 16
-cdef int N_BLOCK_COLS = 16
-
-cdef class BlockCache:
-    cdef numpy.int32_t[:,:] row_tag_cache
-    cdef numpy.int32_t[:,:] col_tag_cache
-    cdef numpy.int8_t[:,:] cache_dirty
-    cdef int n_block_rows
-    cdef int n_block_cols
-    cdef int block_col_size
-    cdef int block_row_size
-    cdef int n_rows
-    cdef int n_cols
-    band_list = []
-    block_list = []
-    update_list = []
-
-    def __cinit__(
-            self, int n_block_rows, int n_block_cols, int n_rows, int n_cols,
-            int block_row_size, int block_col_size, band_list, block_list,
-            update_list, numpy.int8_t[:,:] cache_dirty):
-        self.n_block_rows = n_block_rows
-        self.n_block_cols = n_block_cols
-        self.block_col_size = block_col_size
-        self.block_row_size = block_row_size
-        self.n_rows = n_rows
-        self.n_cols = n_cols
-        self.row_tag_cache = numpy.zeros((n_block_rows, n_block_cols), dtype=numpy.int32)
-        self.col_tag_cache = numpy.zeros((n_block_rows, n_block_cols), dtype=numpy.int32)
-        self.cache_dirty = cache_dirty
-        self.row_tag_cache[:] = -1
-        self.col_tag_cache[:] = -1
-        self.band_list[:] = band_list
-        self.block_list[:] = block_list
-        self.update_list[:] = update_list
-        list_lengths = [len(x) for x in [band_list, block_list, update_list]]
-        if len(set(list_lengths)) > 1:
-            raise ValueError(
-                "lengths of band_list, block_list, update_list should be equal."
-                " instead they are %s", list_lengths)
-        raster_dimensions_list = [(b.YSize, b.XSize) for b in band_list]
-        for raster_n_rows, raster_n_cols in raster_dimensions_list:
-            if raster_n_rows != n_rows or raster_n_cols != n_cols:
-                raise ValueError(
-                    "a band was passed in that has a different dimension than"
-                    "the memory block was specified as")
-
-        for band in band_list:
-            block_col_size, block_row_size = band.GetBlockSize()
-            if block_col_size == 1 or block_row_size == 1:
-                LOGGER.warn(
-                    'a band in BlockCache is not memory blocked, this might '
-                    'make the runtime slow for other algorithms. %s',
-                    band.GetDescription())
-
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.cdivision(True)
-    cdef void update_cache(self, int global_row, int global_col, int *row_index, int *col_index, int *row_block_offset, int *col_block_offset):
-        cdef int cache_row_size, cache_col_size
-        cdef int global_row_offset, global_col_offset
-        cdef int row_tag, col_tag
-
-        row_block_offset[0] = global_row % self.block_row_size
-        row_index[0] = (global_row // self.block_row_size) % self.n_block_rows
-        row_tag = (global_row // self.block_row_size) // self.n_block_rows
-
-        col_block_offset[0] = global_col % self.block_col_size
-        col_index[0] = (global_col // self.block_col_size) % self.n_block_cols
-        col_tag = (global_col // self.block_col_size) // self.n_block_cols
-
-        cdef int current_row_tag = self.row_tag_cache[row_index[0], col_index[0]]
-        cdef int current_col_tag = self.col_tag_cache[row_index[0], col_index[0]]
-
-        if current_row_tag != row_tag or current_col_tag != col_tag:
-            if self.cache_dirty[row_index[0], col_index[0]]:
-                global_col_offset = (current_col_tag * self.n_block_cols + col_index[0]) * self.block_col_size
-                cache_col_size = self.n_cols - global_col_offset
-                if cache_col_size > self.block_col_size:
-                    cache_col_size = self.block_col_size
-
-                global_row_offset = (current_row_tag * self.n_block_rows + row_index[0]) * self.block_row_size
-                cache_row_size = self.n_rows - global_row_offset
-                if cache_row_size > self.block_row_size:
-                    cache_row_size = self.block_row_size
-
-                for band, block, update in zip(self.band_list, self.block_list, self.update_list):
-                    if update:
-                        band.WriteArray(block[row_index[0], col_index[0], 0:cache_row_size, 0:cache_col_size],
-                            yoff=global_row_offset, xoff=global_col_offset)
-                self.cache_dirty[row_index[0], col_index[0]] = 0
-            self.row_tag_cache[row_index[0], col_index[0]] = row_tag
-            self.col_tag_cache[row_index[0], col_index[0]] = col_tag
-
-            global_col_offset = (col_tag * self.n_block_cols + col_index[0]) * self.block_col_size
-            global_row_offset = (row_tag * self.n_block_rows + row_index[0]) * self.block_row_size
-
-            cache_col_size = self.n_cols - global_col_offset
-            if cache_col_size > self.block_col_size:
-                cache_col_size = self.block_col_size
-            cache_row_size = self.n_rows - global_row_offset
-            if cache_row_size > self.block_row_size:
-                cache_row_size = self.block_row_size
-
-            for band, block in zip(self.band_list, self.block_list):
-                band.ReadAsArray(
-                    xoff=global_col_offset, yoff=global_row_offset,
-                    win_xsize=cache_col_size, win_ysize=cache_row_size,
-                    buf_obj=block[row_index[0], col_index[0], 0:cache_row_size, 0:cache_col_size])
-
-    cdef void flush_cache(self):
-        cdef int global_row_offset, global_col_offset
-        cdef int cache_row_size, cache_col_size
-        cdef int row_index, col_index
-        for row_index in xrange(self.n_block_rows):
-            for col_index in xrange(self.n_block_cols):
-                row_tag = self.row_tag_cache[row_index, col_index]
-                col_tag = self.col_tag_cache[row_index, col_index]
-
-                if self.cache_dirty[row_index, col_index]:
-                    global_col_offset = (col_tag * self.n_block_cols + col_index) * self.block_col_size
-                    cache_col_size = self.n_cols - global_col_offset
-                    if cache_col_size > self.block_col_size:
-                        cache_col_size = self.block_col_size
-
-                    global_row_offset = (row_tag * self.n_block_rows + row_index) * self.block_row_size
-                    cache_row_size = self.n_rows - global_row_offset
-                    if cache_row_size > self.block_row_size:
-                        cache_row_size = self.block_row_size
-
-                    for band, block, update in zip(self.band_list, self.block_list, self.update_list):
-                        if update:
-                            band.WriteArray(block[row_index, col_index, 0:cache_row_size, 0:cache_col_size],
-                                yoff=global_row_offset, xoff=global_col_offset)
-        for band in self.band_list:
-            band.FlushCache()
-
+#number of blocks cached per raster unless a block_cache memory budget is set
+cdef int N_CACHE_SLOTS = 256
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -205,8 +74,9 @@ def ndr_eff_calculation(
         gdal.GDT_Float32, fill_value=effective_retention_nodata)
 
     cdef float processed_cell_nodata = 127
-    processed_cell_uri = (
-        os.path.join(os.path.dirname(flow_direction_uri), 'processed_cell.tif'))
+    #a temporary file since the flow direction may live in a prepared data
+    #cache shared by concurrent runs
+    processed_cell_uri = pygeoprocessing.temporary_filename()
     pygeoprocessing.new_raster_from_base_uri(
         flow_direction_uri, processed_cell_uri, 'GTiff', processed_cell_nodata,
         gdal.GDT_Byte, fill_value=0)
@@ -255,34 +125,39 @@ def ndr_eff_calculation(
     block_col_size, block_row_size = stream_band.GetBlockSize()
     cdef int n_global_block_rows = int(ceil(float(n_rows) / block_row_size))
     cdef int n_global_block_cols = int(ceil(float(n_cols) / block_col_size))
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.int8, numpy.float32, numpy.float32,
+         numpy.int8, numpy.float32, numpy.float32])
 
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] stream_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int8))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.float32))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] effective_retention_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.float32))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] retention_eff_lulc_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.float32))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] crit_len_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
 
 
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] processed_cell_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int8))
 
     band_list = [stream_band, outflow_direction_band, outflow_weights_band,
@@ -294,10 +169,10 @@ def ndr_eff_calculation(
     update_list = [False, False, False, True, True, False, False]
 
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = (
-        numpy.zeros((N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte))
+        numpy.zeros((n_cache_sets, n_cache_ways), dtype=numpy.byte))
 
     cdef BlockCache block_cache = BlockCache(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     #center point of global index
@@ -555,7 +430,703 @@ def ndr_eff_calculation(
 
     block_cache.flush_cache()
 
+    for dataset in [
+            outflow_weights_ds, outflow_direction_ds, processed_cell_ds]:
+        gdal.Dataset.__swig_destroy__(dataset)
+    for dataset_uri in [
+            outflow_weights_uri, outflow_direction_uri, processed_cell_uri]:
+        os.remove(dataset_uri)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline numpy.int64_t _find_root(
+        numpy.int64_t *parent, numpy.int64_t index) nogil:
+    """Returns the root of `index` in the union-find forest `parent`,
+        halving the path as it goes."""
+    while parent[index] != index:
+        parent[index] = parent[parent[index]]
+        index = parent[index]
+    return index
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _union_roots(
+        numpy.int64_t *parent, numpy.int64_t index_a,
+        numpy.int64_t index_b) nogil:
+    """Joins the sets of `index_a` and `index_b`, the smaller flat index
+        always becomes the root."""
+    index_a = _find_root(parent, index_a)
+    index_b = _find_root(parent, index_b)
+    if index_a < index_b:
+        parent[index_b] = index_a
+    elif index_b < index_a:
+        parent[index_a] = index_b
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _label_flow_basins(
+        outflow_direction_band, outflow_weights_band,
+        int outflow_direction_nodata, int n_rows, int n_cols, labels_uri,
+        int strip_rows):
+    """Labels the hydrologically independent basins of a d-infinity flow
+        graph, that is the connected components of the graph whose edges
+        join each pixel to the one or two neighbors it flows to with a
+        positive weight.  Two pixels with different labels never exchange
+        flow.
+
+        outflow_direction_band - band of outflow directions as written by
+            routing_core.calculate_flow_weights
+        outflow_weights_band - band of the matching outflow weights
+        outflow_direction_nodata - nodata value of outflow_direction_band
+        n_rows, n_cols - dimensions of the bands
+        labels_uri - path to a scratch file that backs the label array
+        strip_rows - the number of rows read from the bands at a time
+
+        returns a tuple (labels, n_basins) where labels is a memory mapped
+            int64 array of n_rows * n_cols basin ids numbered in raster
+            order from 0 to n_basins - 1"""
+
+    cdef int *row_offsets = [0, -1, -1, -1,  0,  1, 1, 1]
+    cdef int *col_offsets = [1,  1,  0, -1, -1, -1, 0, 1]
+
+    cdef numpy.int64_t n_pixels = <numpy.int64_t>n_rows * n_cols
+    labels = numpy.memmap(
+        labels_uri, dtype=numpy.int64, mode='w+', shape=(n_pixels,))
+    cdef numpy.int64_t[::1] parent = labels
+    cdef numpy.int64_t *parent_ptr = &parent[0]
+
+    cdef numpy.ndarray[numpy.npy_int8, ndim=2] outflow_direction_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.int8))
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] outflow_weights_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.float32))
+
+    cdef int row_offset, n_strip_rows, strip_row, global_row, global_col
+    cdef int outflow_direction, neighbor_index, neighbor_row, neighbor_col
+    cdef float outflow_weight
+    cdef numpy.int64_t flat_index, root_index, n_basins
+
+    for row_offset in xrange(0, n_rows, strip_rows):
+        n_strip_rows = min(strip_rows, n_rows - row_offset)
+        labels[row_offset * <numpy.int64_t>n_cols:
+               (row_offset + n_strip_rows) * <numpy.int64_t>n_cols] = (
+            numpy.arange(
+                row_offset * <numpy.int64_t>n_cols,
+                (row_offset + n_strip_rows) * <numpy.int64_t>n_cols,
+                dtype=numpy.int64))
+
+    for row_offset in xrange(0, n_rows, strip_rows):
+        n_strip_rows = min(strip_rows, n_rows - row_offset)
+        outflow_direction_band.ReadAsArray(
+            xoff=0, yoff=row_offset, win_xsize=n_cols, win_ysize=n_strip_rows,
+            buf_obj=outflow_direction_strip[0:n_strip_rows, :])
+        outflow_weights_band.ReadAsArray(
+            xoff=0, yoff=row_offset, win_xsize=n_cols, win_ysize=n_strip_rows,
+            buf_obj=outflow_weights_strip[0:n_strip_rows, :])
+        with nogil:
+            for strip_row in xrange(n_strip_rows):
+                global_row = row_offset + strip_row
+                for global_col in xrange(n_cols):
+                    outflow_direction = outflow_direction_strip[
+                        strip_row, global_col]
+                    if outflow_direction == outflow_direction_nodata:
+                        continue
+                    outflow_weight = outflow_weights_strip[
+                        strip_row, global_col]
+                    flat_index = <numpy.int64_t>global_row * n_cols + global_col
+                    #the same two edges, with the same float arithmetic, that
+                    #ndr_eff_calculation follows downstream
+                    for neighbor_index in xrange(2):
+                        if neighbor_index == 1:
+                            outflow_direction = (outflow_direction + 1) % 8
+                            outflow_weight = (1.0 - outflow_weight)
+                        if outflow_weight <= 0.0:
+                            continue
+                        neighbor_row = global_row + row_offsets[outflow_direction]
+                        neighbor_col = global_col + col_offsets[outflow_direction]
+                        if (neighbor_row < 0 or neighbor_row >= n_rows or
+                                neighbor_col < 0 or neighbor_col >= n_cols):
+                            continue
+                        _union_roots(
+                            parent_ptr, flat_index,
+                            <numpy.int64_t>neighbor_row * n_cols + neighbor_col)
+
+    #compress every path to its root, then renumber the roots in raster
+    #order; roots are the smallest index of their set so each root is
+    #numbered before any of its members are visited
+    n_basins = 0
+    with nogil:
+        for flat_index in xrange(n_pixels):
+            parent_ptr[flat_index] = _find_root(parent_ptr, flat_index)
+        for flat_index in xrange(n_pixels):
+            root_index = parent_ptr[flat_index]
+            if root_index == flat_index:
+                parent_ptr[flat_index] = -(n_basins + 1)
+                n_basins += 1
+            else:
+                parent_ptr[flat_index] = parent_ptr[root_index]
+        for flat_index in xrange(n_pixels):
+            parent_ptr[flat_index] = -parent_ptr[flat_index] - 1
+    labels.flush()
+    return labels, n_basins
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _basin_extents(labels, stream_band, numpy.int64_t n_basins, int n_rows,
+                   int n_cols, int strip_rows):
+    """Calculates the bounding box of each basin and whether it contains a
+        stream pixel.
+
+        labels - the flat label array returned by _label_flow_basins
+        stream_band - band where 1 indicates a stream pixel
+        n_basins - the number of basins in labels
+        n_rows, n_cols - dimensions of the raster
+        strip_rows - the number of rows read from stream_band at a time
+
+        returns a tuple of numpy arrays (min_row, max_row, min_col, max_col,
+            has_stream) indexed by basin id"""
+
+    min_row_array = numpy.empty(n_basins, dtype=numpy.int32)
+    min_row_array[:] = n_rows
+    max_row_array = numpy.empty(n_basins, dtype=numpy.int32)
+    max_row_array[:] = -1
+    min_col_array = numpy.empty(n_basins, dtype=numpy.int32)
+    min_col_array[:] = n_cols
+    max_col_array = numpy.empty(n_basins, dtype=numpy.int32)
+    max_col_array[:] = -1
+    has_stream_array = numpy.zeros(n_basins, dtype=numpy.int8)
+
+    cdef numpy.int32_t[::1] min_row = min_row_array
+    cdef numpy.int32_t[::1] max_row = max_row_array
+    cdef numpy.int32_t[::1] min_col = min_col_array
+    cdef numpy.int32_t[::1] max_col = max_col_array
+    cdef numpy.int8_t[::1] has_stream = has_stream_array
+    cdef numpy.int64_t[::1] label_view = labels
+
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] stream_strip = numpy.empty(
+        (strip_rows, n_cols), dtype=numpy.float32)
+
+    cdef int row_offset, n_strip_rows, strip_row, global_row, global_col
+    cdef numpy.int64_t basin_id
+
+    for row_offset in xrange(0, n_rows, strip_rows):
+        n_strip_rows = min(strip_rows, n_rows - row_offset)
+        stream_band.ReadAsArray(
+            xoff=0, yoff=row_offset, win_xsize=n_cols, win_ysize=n_strip_rows,
+            buf_obj=stream_strip[0:n_strip_rows, :])
+        with nogil:
+            for strip_row in xrange(n_strip_rows):
+                global_row = row_offset + strip_row
+                for global_col in xrange(n_cols):
+                    basin_id = label_view[
+                        <numpy.int64_t>global_row * n_cols + global_col]
+                    if global_row < min_row[basin_id]:
+                        min_row[basin_id] = global_row
+                    if global_row > max_row[basin_id]:
+                        max_row[basin_id] = global_row
+                    if global_col < min_col[basin_id]:
+                        min_col[basin_id] = global_col
+                    if global_col > max_col[basin_id]:
+                        max_col[basin_id] = global_col
+                    if stream_strip[strip_row, global_col] == 1:
+                        has_stream[basin_id] = 1
+
+    return (min_row_array, max_row_array, min_col_array, max_col_array,
+            has_stream_array)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _basin_effective_retention(
+        numpy.int64_t basin_id, int min_row, int max_row, int min_col,
+        int max_col, int n_rows, int n_cols, numpy.int64_t *labels,
+        float *stream, numpy.int8_t *outflow_direction_array,
+        float *outflow_weights, float *retention_eff_lulc_array,
+        float *crit_len_array, float *effective_retention,
+        numpy.int8_t *processed_cell, float stream_nodata,
+        int outflow_direction_nodata, float cell_size, int *row_offsets,
+        int *col_offsets, int *inflow_offsets) nogil:
+    """Routes effective retention through one basin held in memory.  This is
+        the visiting algorithm of ndr_eff_calculation on flat arrays of
+        n_rows * n_cols pixels instead of a BlockCache, seeded only with the
+        streams of `basin_id` inside its bounding box.  Every pixel it
+        reaches is in `basin_id`, so basins can run concurrently on the same
+        arrays.  Flat indexes are 64 bit since the arrays may be a window
+        onto a basin bigger than 2**31 pixels."""
+
+    cdef deque[numpy.int64_t] visit_stack
+    cdef c_set[numpy.int64_t] cells_in_queue
+
+    cdef int global_row, global_col
+    cdef numpy.int64_t flat_index, neighbor_flat_index
+    cdef int neighbor_row, neighbor_col
+    cdef int neighbor_outflow_direction, neighbor_index, outflow_direction
+    cdef float neighbor_outflow_weight, current_effective_retention
+    cdef float outflow_weight, neighbor_effective_retention, step_size
+    cdef float current_stream
+    cdef float retention_eff_lulc, crit_len, intermediate_retention
+    cdef float current_step_factor
+    cdef int it_flows_here, update_downstream
+
+    for global_row in xrange(min_row, max_row + 1):
+        for global_col in xrange(min_col, max_col + 1):
+            flat_index = <numpy.int64_t>global_row * n_cols + global_col
+            if labels[flat_index] == basin_id and stream[flat_index] == 1:
+                visit_stack.push_front(flat_index)
+                cells_in_queue.insert(flat_index)
+                effective_retention[flat_index] = 0
+                processed_cell[flat_index] = 1
+
+    while visit_stack.size() > 0:
+        flat_index = visit_stack.front()
+        visit_stack.pop_front()
+        cells_in_queue.erase(flat_index)
+        global_row = <int>(flat_index / n_cols)
+        global_col = <int>(flat_index % n_cols)
+
+        update_downstream = False
+        current_effective_retention = 0.0
+
+        current_stream = stream[flat_index]
+        outflow_direction = outflow_direction_array[flat_index]
+        if current_stream == 1:
+            effective_retention[flat_index] = 0
+            processed_cell[flat_index] = 1
+        elif outflow_direction == outflow_direction_nodata:
+            current_effective_retention = 1.0
+        elif processed_cell[flat_index] == 0:
+            outflow_weight = outflow_weights[flat_index]
+            retention_eff_lulc = retention_eff_lulc_array[flat_index]
+            crit_len = crit_len_array[flat_index]
+
+            for neighbor_index in xrange(2):
+                if neighbor_index == 1:
+                    outflow_direction = (outflow_direction + 1) % 8
+                    outflow_weight = (1.0 - outflow_weight)
+
+                if outflow_weight <= 0.0:
+                    continue
+
+                neighbor_row = global_row + row_offsets[outflow_direction]
+                neighbor_col = global_col + col_offsets[outflow_direction]
+                if (neighbor_row < 0 or neighbor_row >= n_rows or
+                        neighbor_col < 0 or neighbor_col >= n_cols):
+                    continue
+                neighbor_flat_index = (
+                    <numpy.int64_t>neighbor_row * n_cols + neighbor_col)
+
+                if stream[neighbor_flat_index] == stream_nodata:
+                    continue
+
+                neighbor_effective_retention = effective_retention[
+                    neighbor_flat_index]
+
+                if processed_cell[neighbor_flat_index] == 0:
+                    if (cells_in_queue.find(flat_index) ==
+                            cells_in_queue.end()):
+                        visit_stack.push_back(flat_index)
+                        cells_in_queue.insert(flat_index)
+
+                    if (cells_in_queue.find(neighbor_flat_index) ==
+                            cells_in_queue.end()):
+                        visit_stack.push_front(neighbor_flat_index)
+                        cells_in_queue.insert(neighbor_flat_index)
+
+                    update_downstream = True
+                    neighbor_effective_retention = 0.0
+
+                if outflow_direction % 2 == 1:
+                    step_size = cell_size * 1.41421356237
+                else:
+                    step_size = cell_size
+
+                current_step_factor = exp(-5 * step_size / crit_len)
+                if neighbor_effective_retention >= retention_eff_lulc:
+                    current_effective_retention += (
+                        neighbor_effective_retention) * outflow_weight
+                else:
+                    intermediate_retention = (
+                        neighbor_effective_retention * current_step_factor +
+                        retention_eff_lulc * (1 - current_step_factor))
+                    if intermediate_retention > retention_eff_lulc:
+                        intermediate_retention = retention_eff_lulc
+                    current_effective_retention += (
+                        intermediate_retention * outflow_weight)
+
+        if not update_downstream:
+            processed_cell[flat_index] = 1
+            effective_retention[flat_index] = current_effective_retention
+
+            for neighbor_index in xrange(8):
+                neighbor_row = global_row + row_offsets[neighbor_index]
+                neighbor_col = global_col + col_offsets[neighbor_index]
+                if (neighbor_row < 0 or neighbor_row >= n_rows or
+                        neighbor_col < 0 or neighbor_col >= n_cols):
+                    continue
+                neighbor_flat_index = (
+                    <numpy.int64_t>neighbor_row * n_cols + neighbor_col)
+
+                if (stream[neighbor_flat_index] == 1 or
+                        stream[neighbor_flat_index] == stream_nodata):
+                    continue
+
+                if processed_cell[neighbor_flat_index] == 1:
+                    continue
+
+                neighbor_outflow_direction = outflow_direction_array[
+                    neighbor_flat_index]
+                if neighbor_outflow_direction == outflow_direction_nodata:
+                    continue
+
+                neighbor_outflow_weight = outflow_weights[neighbor_flat_index]
+
+                it_flows_here = False
+                if (neighbor_outflow_direction ==
+                        inflow_offsets[neighbor_index]):
+                    it_flows_here = True
+                elif ((neighbor_outflow_direction + 1) % 8 ==
+                        inflow_offsets[neighbor_index]):
+                    it_flows_here = True
+                    neighbor_outflow_weight = 1.0 - neighbor_outflow_weight
+
+                if (it_flows_here and neighbor_outflow_weight > 0.0 and
+                        cells_in_queue.find(neighbor_flat_index) ==
+                        cells_in_queue.end()):
+                    visit_stack.push_back(neighbor_flat_index)
+                    cells_in_queue.insert(neighbor_flat_index)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def ndr_eff_calculation_parallel(
+        flow_direction_uri, stream_uri, retention_eff_lulc_uri, crit_len_uri,
+        effective_retention_uri, int n_workers, int max_strip_pixels=2**24):
+    """Calculates the same effective retention raster as ndr_eff_calculation
+        but splits the landscape into drainage basins that share no flow and
+        routes the basins on `n_workers` threads.
+
+        Basins are processed in full width strips of rows that are read into
+        memory once; every basin whose bounding box fits in a strip is
+        routed there in a nogil section while the strip is resident.  Basins
+        taller than a strip are then routed one at a time on a window of
+        their bounding box, backed by scratch files if the window holds more
+        than `max_strip_pixels`.  Each basin only reads and writes its own
+        pixels and the per-pixel arithmetic is that of ndr_eff_calculation,
+        so the result is bit-identical to the serial path regardless of
+        `n_workers`.
+
+        Args:
+            flow_direction_uri (string) - (input) a path to a raster with
+                d-infinity flow directions.
+            stream_uri (string) - (input) a raster where 1 indicates a stream
+                all other values ignored must be same dimensions and projection
+                as flow_direction_uri.
+            retention_eff_lulc_uri (string) - (input) a raster indicating the
+                maximum retention efficiency that the landcover on that pixel
+                can accumulate.
+            crit_len_uri (string) - (input) a raster indicating the critical length
+                of the retention efficiency that the landcover on this pixel.
+            effective_retention_uri (string) - (output) a raster showing
+                the effective retention on that pixel to the stream.
+            n_workers (int) - the number of threads to route basins on.
+            max_strip_pixels (int) - the most pixels to hold in memory in a
+                strip or a basin window, about 30 bytes each.
+
+        Returns:
+            nothing"""
+
+    cdef int *row_offsets = [0, -1, -1, -1,  0,  1, 1, 1]
+    cdef int *col_offsets = [1,  1,  0, -1, -1, -1, 0, 1]
+    cdef int *inflow_offsets = [4, 5, 6, 7, 0, 1, 2, 3]
+
+    cdef int n_rows, n_cols
+    n_rows, n_cols = pygeoprocessing.get_row_col_from_uri(
+        flow_direction_uri)
+    cdef int strip_rows = max(max_strip_pixels // n_cols, 1)
+
+    cdef float stream_nodata = pygeoprocessing.get_nodata_from_uri(
+        stream_uri)
+    cdef float cell_size = pygeoprocessing.get_cell_size_from_uri(stream_uri)
+
+    outflow_weights_uri = pygeoprocessing.temporary_filename()
+    outflow_direction_uri = pygeoprocessing.temporary_filename()
+    pygeoprocessing.routing.routing_core.calculate_flow_weights(
+        flow_direction_uri, outflow_weights_uri, outflow_direction_uri)
+    outflow_weights_ds = gdal.Open(outflow_weights_uri)
+    outflow_weights_band = outflow_weights_ds.GetRasterBand(1)
+    outflow_direction_ds = gdal.Open(outflow_direction_uri)
+    outflow_direction_band = outflow_direction_ds.GetRasterBand(1)
+    cdef int outflow_direction_nodata = pygeoprocessing.get_nodata_from_uri(
+        outflow_direction_uri)
+
+    stream_ds = gdal.Open(stream_uri)
+    stream_band = stream_ds.GetRasterBand(1)
+
+    LOGGER.info('labeling independent drainage basins')
+    labels_uri = pygeoprocessing.temporary_filename()
+    labels, n_basins = _label_flow_basins(
+        outflow_direction_band, outflow_weights_band, outflow_direction_nodata,
+        n_rows, n_cols, labels_uri, strip_rows)
+    min_row, max_row, min_col, max_col, has_stream = _basin_extents(
+        labels, stream_band, n_basins, n_rows, n_cols, strip_rows)
+
+    #basins without a stream are never reached by the routing
+    stream_basin_ids = numpy.nonzero(has_stream)[0]
+    oversize_mask = (
+        max_row[stream_basin_ids] - min_row[stream_basin_ids] + 1 >
+        strip_rows)
+    oversize_basin_ids = stream_basin_ids[oversize_mask]
+    stream_basin_ids = stream_basin_ids[~oversize_mask]
+    LOGGER.info(
+        '%d drainage basins, %d with streams, %d taller than a strip',
+        n_basins, stream_basin_ids.size + oversize_basin_ids.size,
+        oversize_basin_ids.size)
+
+    cdef float effective_retention_nodata = -9999
+    pygeoprocessing.new_raster_from_base_uri(
+        flow_direction_uri, effective_retention_uri, 'GTiff',
+        effective_retention_nodata, gdal.GDT_Float32,
+        fill_value=effective_retention_nodata)
+    effective_retention_ds = gdal.Open(effective_retention_uri, gdal.GA_Update)
+    effective_retention_band = effective_retention_ds.GetRasterBand(1)
+
+    retention_eff_lulc_ds = gdal.Open(retention_eff_lulc_uri)
+    retention_eff_lulc_band = retention_eff_lulc_ds.GetRasterBand(1)
+    crit_len_ds = gdal.Open(crit_len_uri)
+    crit_len_band = crit_len_ds.GetRasterBand(1)
+
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] stream_strip = numpy.empty(
+        (strip_rows, n_cols), dtype=numpy.float32)
+    cdef numpy.ndarray[numpy.npy_int8, ndim=2] outflow_direction_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.int8))
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] outflow_weights_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.float32))
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] retention_eff_lulc_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.float32))
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] crit_len_strip = numpy.empty(
+        (strip_rows, n_cols), dtype=numpy.float32)
+    cdef numpy.ndarray[numpy.npy_float32, ndim=2] effective_retention_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.float32))
+    cdef numpy.ndarray[numpy.npy_int8, ndim=2] processed_cell_strip = (
+        numpy.empty((strip_rows, n_cols), dtype=numpy.int8))
+    cdef numpy.int64_t[::1] label_strip
+
+    cdef numpy.int64_t[::1] batch_ids
+    cdef numpy.int32_t[::1] batch_min_row, batch_max_row
+    cdef numpy.int32_t[::1] batch_min_col, batch_max_col
+    cdef int batch_index, n_batch, row_offset, n_strip_rows
+
+    #visit basins by their top row, each strip starts at the top of the
+    #first basin that hasn't been routed yet
+    pending_ids = stream_basin_ids[
+        numpy.argsort(min_row[stream_basin_ids], kind='mergesort')]
+    while pending_ids.size > 0:
+        row_offset = min_row[pending_ids[0]]
+        n_strip_rows = min(strip_rows, n_rows - row_offset)
+        in_strip_mask = max_row[pending_ids] < row_offset + n_strip_rows
+        batch_id_array = pending_ids[in_strip_mask].astype(numpy.int64)
+        pending_ids = pending_ids[~in_strip_mask]
+        n_batch = batch_id_array.size
+        LOGGER.info(
+            'routing %d basins in rows %d to %d, %d basins left', n_batch,
+            row_offset, row_offset + n_strip_rows, pending_ids.size)
+
+        for band, strip in [
+                (stream_band, stream_strip),
+                (outflow_direction_band, outflow_direction_strip),
+                (outflow_weights_band, outflow_weights_strip),
+                (retention_eff_lulc_band, retention_eff_lulc_strip),
+                (crit_len_band, crit_len_strip),
+                (effective_retention_band, effective_retention_strip)]:
+            band.ReadAsArray(
+                xoff=0, yoff=row_offset, win_xsize=n_cols,
+                win_ysize=n_strip_rows, buf_obj=strip[0:n_strip_rows, :])
+        processed_cell_strip[:] = 0
+        label_strip = numpy.ascontiguousarray(
+            labels[row_offset * <numpy.int64_t>n_cols:
+                   (row_offset + n_strip_rows) * <numpy.int64_t>n_cols])
+
+        batch_ids = batch_id_array
+        batch_min_row = min_row[batch_id_array] - row_offset
+        batch_max_row = max_row[batch_id_array] - row_offset
+        batch_min_col = min_col[batch_id_array]
+        batch_max_col = max_col[batch_id_array]
+
+        with nogil:
+            for batch_index in prange(
+                    n_batch, num_threads=n_workers, schedule='dynamic'):
+                _basin_effective_retention(
+                    batch_ids[batch_index], batch_min_row[batch_index],
+                    batch_max_row[batch_index], batch_min_col[batch_index],
+                    batch_max_col[batch_index], n_strip_rows, n_cols,
+                    &label_strip[0], &stream_strip[0, 0],
+                    <numpy.int8_t*>&outflow_direction_strip[0, 0],
+                    &outflow_weights_strip[0, 0],
+                    &retention_eff_lulc_strip[0, 0], &crit_len_strip[0, 0],
+                    &effective_retention_strip[0, 0],
+                    <numpy.int8_t*>&processed_cell_strip[0, 0],
+                    stream_nodata, outflow_direction_nodata, cell_size,
+                    row_offsets, col_offsets, inflow_offsets)
+
+        effective_retention_band.WriteArray(
+            effective_retention_strip[0:n_strip_rows, :], xoff=0,
+            yoff=row_offset)
+
+    for basin_id in oversize_basin_ids:
+        LOGGER.info(
+            'routing basin %d in rows %d to %d on its own', basin_id,
+            min_row[basin_id], max_row[basin_id] + 1)
+        _route_basin_window(
+            basin_id, min_row[basin_id], max_row[basin_id],
+            min_col[basin_id], max_col[basin_id], labels, n_rows, n_cols,
+            [stream_band, outflow_direction_band, outflow_weights_band,
+             retention_eff_lulc_band, crit_len_band],
+            effective_retention_band, stream_nodata,
+            outflow_direction_nodata, cell_size, strip_rows,
+            max_strip_pixels)
+
+    effective_retention_band.FlushCache()
+    labels = None
+    label_strip = None
     for dataset in [outflow_weights_ds, outflow_direction_ds]:
         gdal.Dataset.__swig_destroy__(dataset)
-    for dataset_uri in [outflow_weights_uri, outflow_direction_uri]:
+    for dataset_uri in [
+            outflow_weights_uri, outflow_direction_uri, labels_uri]:
         os.remove(dataset_uri)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _route_basin_window(
+        numpy.int64_t basin_id, int min_row, int max_row, int min_col,
+        int max_col, labels, int n_rows, int n_cols, band_list,
+        effective_retention_band, float stream_nodata,
+        int outflow_direction_nodata, float cell_size, int strip_rows,
+        numpy.int64_t max_strip_pixels):
+    """Routes effective retention through one basin on a window of its
+        bounding box and writes the basin's pixels to
+        effective_retention_band.  A basin's pixels only flow to and from
+        each other, so the window edges behave like the raster edges for
+        it.
+
+        basin_id - the label of the basin in `labels`
+        min_row, max_row, min_col, max_col - the basin's bounding box
+        labels - the flat label array returned by _label_flow_basins
+        n_rows, n_cols - dimensions of the raster
+        band_list - the stream, outflow direction, outflow weights,
+            retention efficiency and critical length bands in that order
+        effective_retention_band - the band to write the result to
+        stream_nodata, outflow_direction_nodata, cell_size - as in
+            ndr_eff_calculation_parallel
+        strip_rows - the number of rows read from the bands at a time
+        max_strip_pixels - windows with more pixels than this are held in
+            scratch files rather than in memory
+
+        returns nothing"""
+
+    cdef int *row_offsets = [0, -1, -1, -1,  0,  1, 1, 1]
+    cdef int *col_offsets = [1,  1,  0, -1, -1, -1, 0, 1]
+    cdef int *inflow_offsets = [4, 5, 6, 7, 0, 1, 2, 3]
+
+    cdef int window_rows = max_row - min_row + 1
+    cdef int window_cols = max_col - min_col + 1
+    scratch_uri_list = []
+
+    def _window_array(dtype):
+        """a zeroed window sized array, memory mapped if it's too big"""
+        if <numpy.int64_t>window_rows * window_cols <= max_strip_pixels:
+            return numpy.zeros((window_rows, window_cols), dtype=dtype)
+        scratch_uri = pygeoprocessing.temporary_filename()
+        scratch_uri_list.append(scratch_uri)
+        return numpy.memmap(
+            scratch_uri, dtype=dtype, mode='w+',
+            shape=(window_rows, window_cols))
+
+    stream_window = _window_array(numpy.float32)
+    outflow_direction_window = _window_array(numpy.int8)
+    outflow_weights_window = _window_array(numpy.float32)
+    retention_eff_lulc_window = _window_array(numpy.float32)
+    crit_len_window = _window_array(numpy.float32)
+    effective_retention_window = _window_array(numpy.float32)
+    processed_cell_window = _window_array(numpy.int8)
+    label_window = _window_array(numpy.int64)
+
+    label_grid = labels.reshape((n_rows, n_cols))
+    cdef int row_offset, n_strip_rows
+    for row_offset in xrange(0, window_rows, strip_rows):
+        n_strip_rows = min(strip_rows, window_rows - row_offset)
+        for band, window in zip(band_list, [
+                stream_window, outflow_direction_window,
+                outflow_weights_window, retention_eff_lulc_window,
+                crit_len_window]):
+            band.ReadAsArray(
+                xoff=min_col, yoff=min_row + row_offset,
+                win_xsize=window_cols, win_ysize=n_strip_rows,
+                buf_obj=window[row_offset:row_offset + n_strip_rows, :])
+        label_window[row_offset:row_offset + n_strip_rows, :] = label_grid[
+            min_row + row_offset:min_row + row_offset + n_strip_rows,
+            min_col:max_col + 1]
+
+    cdef numpy.int64_t[:, ::1] label_view = label_window
+    cdef numpy.float32_t[:, ::1] stream_view = stream_window
+    cdef numpy.int8_t[:, ::1] outflow_direction_view = (
+        outflow_direction_window)
+    cdef numpy.float32_t[:, ::1] outflow_weights_view = outflow_weights_window
+    cdef numpy.float32_t[:, ::1] retention_eff_lulc_view = (
+        retention_eff_lulc_window)
+    cdef numpy.float32_t[:, ::1] crit_len_view = crit_len_window
+    cdef numpy.float32_t[:, ::1] effective_retention_view = (
+        effective_retention_window)
+    cdef numpy.int8_t[:, ::1] processed_cell_view = processed_cell_window
+
+    with nogil:
+        _basin_effective_retention(
+            basin_id, 0, window_rows - 1, 0, window_cols - 1, window_rows,
+            window_cols, &label_view[0, 0], &stream_view[0, 0],
+            &outflow_direction_view[0, 0], &outflow_weights_view[0, 0],
+            &retention_eff_lulc_view[0, 0], &crit_len_view[0, 0],
+            &effective_retention_view[0, 0], &processed_cell_view[0, 0],
+            stream_nodata, outflow_direction_nodata, cell_size, row_offsets,
+            col_offsets, inflow_offsets)
+
+    #the window overlaps other basins that are already written, so only
+    #this basin's pixels are replaced
+    for row_offset in xrange(0, window_rows, strip_rows):
+        n_strip_rows = min(strip_rows, window_rows - row_offset)
+        effective_retention_strip = effective_retention_band.ReadAsArray(
+            xoff=min_col, yoff=min_row + row_offset, win_xsize=window_cols,
+            win_ysize=n_strip_rows)
+        basin_mask = (
+            label_window[row_offset:row_offset + n_strip_rows, :] == basin_id)
+        effective_retention_strip[basin_mask] = effective_retention_window[
+            row_offset:row_offset + n_strip_rows, :][basin_mask]
+        effective_retention_band.WriteArray(
+            effective_retention_strip, xoff=min_col,
+            yoff=min_row + row_offset)
+
+    label_view = None
+    stream_view = None
+    outflow_direction_view = None
+    outflow_weights_view = None
+    retention_eff_lulc_view = None
+    crit_len_view = None
+    effective_retention_view = None
+    processed_cell_view = None
+    stream_window = None
+    outflow_direction_window = None
+    outflow_weights_window = None
+    retention_eff_lulc_window = None
+    crit_len_window = None
+    effective_retention_window = None
+    processed_cell_window = None
+    label_window = None
+    for scratch_uri in scratch_uri_list:
+        os.remove(scratch_uri)
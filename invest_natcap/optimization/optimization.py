@@ -1,8 +1,17 @@
+import os
+import logging
+import tempfile
+
 from osgeo import gdal
+from osgeo import ogr
 import numpy
-import bisect
 import scipy.ndimage.filters
 
+LOGGER = logging.getLogger('invest_natcap.optimization.optimization')
+
+#The number of pixels of the score raster that are held in memory at once
+BLOCK_PIXELS = 2**20
+
 def new_raster_from_base(base, output_uri, gdal_format, nodata, datatype, fill_value=None, ):
     """Create a new, empty GDAL raster dataset with the spatial references,
         dimensions and geotranforms of the base GDAL raster dataset.
@@ -45,81 +54,188 @@ def new_raster_from_base(base, output_uri, gdal_format, nodata, datatype, fill_v
 def static_max_marginal_gain(
     score_dataset_uri, budget, output_datset_uri, sigma=0.0, aoi_uri=None):
     """This funciton calculates the maximum marginal gain by selecting pixels
-        in a greedy fashion until the entire budget is spent.
+        in a greedy fashion until the entire budget is spent.  The score
+        raster is streamed in strips of rows and only the best `budget`
+        pixels seen so far are kept in memory, so it can be larger than RAM.
+        Pixels with equal scores are selected in row major order.
         
         score_dataset_uri - gdal dataset to a float raster
-        budget - number of pixels to select
+        budget - number of pixels to select, or a list of budgets to select
+            for in one pass over the score raster
         output_dataset_uri - the uri to an output gdal dataset of type gdal.Byte
             values are 0 if not selected, 1 if selected, and nodata if the original
-            was nodata.
+            was nodata.  A list of uris parallel to budget if budget is a list.
         sigma - a "clumping factor" parameter that biases the selection of maximum
             pixels to be close to other selected pixels.  The higher the value
             the higher the clumps.  Formally this is the sigma paramter on
             a gaussian filter that operates on the original score_dataset_uri
             the default is 0.0 which does not bias selection toward clumping.
-        aoi_uri - an area to consider selection
+        aoi_uri - (optional) an OGR polygon datasource in the projection of
+            score_dataset_uri, pixels outside of it are treated as nodata
     
     returns nothing"""
-    
-    #TODO: mask aoi_uri here
-    
+
+    if isinstance(budget, (list, tuple)):
+        budget_list = list(budget)
+        output_uri_list = list(output_datset_uri)
+    else:
+        budget_list = [budget]
+        output_uri_list = [output_datset_uri]
+    if len(budget_list) != len(output_uri_list):
+        raise ValueError(
+            'Expected one output uri per budget, got %d budgets and %d uris' %
+            (len(budget_list), len(output_uri_list)))
+
     dataset = gdal.Open(score_dataset_uri)
     band = dataset.GetRasterBand(1)
-    
-    #TODO: use memmapped or hd5 arrays here
-    array = band.ReadAsArray()
     in_nodata = band.GetNoDataValue()
-    array[numpy.isnan(array)] = in_nodata
-    nodata_mask = array == in_nodata
-    
-    #Gaussian smooth the array but treating nodata as 0.0
+    n_rows, n_cols = band.YSize, band.XSize
+
+    aoi_mask_dataset = None
+    aoi_mask_band = None
+    if aoi_uri is not None:
+        aoi_mask_file, aoi_mask_uri = tempfile.mkstemp(suffix='.tif')
+        os.close(aoi_mask_file)
+        aoi_mask_dataset = new_raster_from_base(
+            dataset, aoi_mask_uri, 'GTiff', 255, gdal.GDT_Byte)
+        aoi_mask_band = aoi_mask_dataset.GetRasterBand(1)
+        aoi_mask_band.Fill(0)
+        aoi_datasource = ogr.Open(aoi_uri)
+        gdal.RasterizeLayer(
+            aoi_mask_dataset, [1], aoi_datasource.GetLayer(), burn_values=[1])
+        aoi_datasource = None
+
+    #The gaussian filter of a pixel only reaches this many rows away, it's
+    #how far scipy truncates the kernel
+    halo_rows = 0
     if sigma != 0.0:
-        array[array==in_nodata] = 0.0
-        array = scipy.ndimage.filters.gaussian_filter(array, sigma, mode='constant', cval=0.0)
-        #put the nodata values back
-        array[nodata_mask] = in_nodata
-        nodata_mask = None
-        
-    #This sets any nans to nodata values, an issue with the MN data
-    flat_array = array.flat
-    ordered_indexes = numpy.argsort(flat_array)
-    ordered_array = flat_array[ordered_indexes]
-    
-    #TODO: use memmapped or hd5 arrays here
-    #This is the array that will record what features are selected
+        halo_rows = int(4.0 * sigma + 0.5)
+    strip_rows = max(1, BLOCK_PIXELS / n_cols)
+
+    #The values and flat indexes of the best pixels seen so far, in flat
+    #index order.  Once they've been trimmed to max_budget pixels a later
+    #pixel has to beat the worst of them, and since it comes after all of
+    #them in row major order it has to be strictly greater.
+    max_budget = max(budget_list)
+    best_values = numpy.empty(0)
+    best_indexes = numpy.empty(0, dtype=numpy.int64)
+    threshold = None
+    n_valid = 0
+    for row_start in xrange(0, n_rows, strip_rows):
+        row_end = min(row_start + strip_rows, n_rows)
+        scores, valid_mask = _read_score_strip(
+            band, aoi_mask_band, in_nodata, row_start, row_end, sigma,
+            halo_rows)
+        valid_indexes = numpy.flatnonzero(valid_mask)
+        n_valid += valid_indexes.size
+        if max_budget == 0:
+            continue
+        strip_values = scores.flat[valid_indexes]
+        if threshold is not None:
+            above_threshold = strip_values > threshold
+            strip_values = strip_values[above_threshold]
+            valid_indexes = valid_indexes[above_threshold]
+        best_values = numpy.concatenate([best_values, strip_values])
+        best_indexes = numpy.concatenate(
+            [best_indexes, valid_indexes + row_start * n_cols])
+        if best_values.size > 2 * max_budget:
+            best_values, best_indexes, threshold = _trim_best(
+                best_values, best_indexes, max_budget)
+    if best_values.size > max_budget:
+        best_values, best_indexes, _ = _trim_best(
+            best_values, best_indexes, max_budget)
+
+    #rank 0 is the best pixel, a budget selects the pixels ranked below it
+    best_ranks = numpy.empty(best_values.size, dtype=numpy.int64)
+    best_ranks[numpy.lexsort((best_indexes, -best_values))] = numpy.arange(
+        best_values.size)
+    flat_order = numpy.argsort(best_indexes)
+    best_indexes = best_indexes[flat_order]
+    best_ranks = best_ranks[flat_order]
+    for budget_value in budget_list:
+        LOGGER.info(
+            'remaining budget %d', max(budget_value - n_valid, 0))
+
+    #Write output results
     out_nodata = 255
-    selection_array = numpy.empty_like(flat_array, dtype=numpy.ubyte)
-    selection_array[:] = out_nodata
-    
-    #This finds the range of nodata values in the sorted array
-    left_nodata_index = bisect.bisect_left(ordered_array, in_nodata)
-    right_nodata_index = bisect.bisect_right(ordered_array, in_nodata)
-    
-    n_elements = len(ordered_indexes)
-    right_length = n_elements-right_nodata_index
-    
-    if budget < right_length:
-        #We can spend it all on the right side of the array
-        selection_array[ordered_indexes[(n_elements-budget):n_elements]] = 1
-        budget = 0
-    else:
-        #Spend what we can on the right and figure out the left
-        selection_array[ordered_indexes[right_nodata_index:n_elements]] = 1
-        budget -= right_length
-        if budget < left_nodata_index:
-            #we can spend the remaining on the left side of the array
-            selection_array[ordered_indexes[(left_nodata_index-budget):left_nodata_index]] = 1
-            budget = 0
-        else:
-            #Otherwise select the rest of the array and have some remaining budget
-            selection_array[ordered_indexes[0:left_nodata_index]] = 1
-            budget -= left_nodata_index
-    
-    print 'remaining budget', budget
-    
-    #Write output result
-    out_dataset = new_raster_from_base(dataset, output_datset_uri, 'GTiff', out_nodata, gdal.GDT_Byte)
-    out_band = out_dataset.GetRasterBand(1)
-    selection_array.shape = array.shape
-    out_band.WriteArray(selection_array)
-    
+    out_band_list = []
+    out_dataset_list = []
+    for output_uri in output_uri_list:
+        out_dataset = new_raster_from_base(
+            dataset, output_uri, 'GTiff', out_nodata, gdal.GDT_Byte)
+        out_dataset_list.append(out_dataset)
+        out_band_list.append(out_dataset.GetRasterBand(1))
+    for row_start in xrange(0, n_rows, strip_rows):
+        row_end = min(row_start + strip_rows, n_rows)
+        _, valid_mask = _read_score_strip(
+            band, aoi_mask_band, in_nodata, row_start, row_end, 0.0, 0)
+        strip_slice = slice(*numpy.searchsorted(
+            best_indexes, [row_start * n_cols, row_end * n_cols]))
+        strip_indexes = best_indexes[strip_slice] - row_start * n_cols
+        strip_ranks = best_ranks[strip_slice]
+        for budget_value, out_band in zip(budget_list, out_band_list):
+            selection_array = numpy.where(
+                valid_mask, 0, out_nodata).astype(numpy.ubyte)
+            selection_array.flat[
+                strip_indexes[strip_ranks < budget_value]] = 1
+            out_band.WriteArray(selection_array, 0, row_start)
+
+    out_band_list = None
+    out_dataset_list = None
+    if aoi_mask_dataset is not None:
+        aoi_mask_band = None
+        aoi_mask_dataset = None
+        os.remove(aoi_mask_uri)
+
+
+def _trim_best(best_values, best_indexes, max_budget):
+    """Keeps the max_budget greatest values, breaking ties at the smallest
+        kept value toward the lower flat index so the selection doesn't
+        depend on how the raster is split into strips.
+
+        best_values - a 1D array of scores
+        best_indexes - a 1D array of the flat indexes of best_values in
+            increasing order
+        max_budget - the number of values to keep, less than the size of
+            best_values
+
+        returns a tuple (best_values, best_indexes, threshold) of the kept
+            values and indexes, still in flat index order, and the smallest
+            kept value"""
+    threshold = best_values[
+        numpy.argpartition(-best_values, max_budget - 1)[max_budget - 1]]
+    keep_mask = best_values > threshold
+    tie_indexes = numpy.flatnonzero(best_values == threshold)
+    keep_mask[tie_indexes[:max_budget - numpy.count_nonzero(keep_mask)]] = True
+    return best_values[keep_mask], best_indexes[keep_mask], threshold
+
+
+def _read_score_strip(
+        band, aoi_mask_band, in_nodata, row_start, row_end, sigma,
+        halo_rows):
+    """Reads the rows [row_start, row_end) of the score band, gaussian
+        smoothed with nodata treated as 0.0 if sigma is not 0.0.  The strip is
+        read with `halo_rows` extra rows on either side so the smoothing is
+        the same as smoothing the whole raster.
+
+        returns a tuple (scores, valid_mask) of 2D arrays of the strip"""
+
+    read_start = max(0, row_start - halo_rows)
+    read_end = min(band.YSize, row_end + halo_rows)
+    array = band.ReadAsArray(0, read_start, band.XSize, read_end - read_start)
+    #This sets any nans to nodata values, an issue with the MN data
+    valid_mask = ~numpy.isnan(array)
+    if in_nodata is not None:
+        valid_mask &= array != in_nodata
+    if aoi_mask_band is not None:
+        valid_mask &= aoi_mask_band.ReadAsArray(
+            0, read_start, band.XSize, read_end - read_start) == 1
+
+    #Gaussian smooth the array but treating nodata as 0.0
+    if sigma != 0.0:
+        array[~valid_mask] = 0.0
+        array = scipy.ndimage.filters.gaussian_filter(
+            array, sigma, mode='constant', cval=0.0)
+
+    strip_slice = slice(row_start - read_start, row_end - read_start)
+    return array[strip_slice], valid_mask[strip_slice]
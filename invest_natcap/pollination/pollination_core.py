@@ -5,11 +5,12 @@ import os
 import logging
 
 import gdal
-import osr
 import numpy
 
 import pygeoprocessing.geoprocessing
 
+from invest_natcap import convolution
+
 LOGGER = logging.getLogger('invest_natcap.pollination.core')
 
 def execute_model(args):
@@ -91,6 +92,24 @@ def execute_model(args):
             [args['ag_map']], mask_op, out_uri, gdal.GDT_Float32, nodata,
             pixel_size_out, 'intersection', vectorize_op=False)
 
+    # Species that weigh the floral seasons the same way have the same floral
+    # resources before they're blurred, so each group's floral raster is
+    # mapped once and blurred with all of their foraging distances at once.
+    floral_groups = {}
+    for species in args['species']:
+        guild_dict = args['guilds'].get_table_row('species', species)
+        floral_weights = tuple(
+            guild_dict[field] for field in args['floral_fields'])
+        floral_groups.setdefault(floral_weights, []).append(species)
+    for species_list in floral_groups.itervalues():
+        LOGGER.info('Calculating floral resources of %s', species_list)
+        calculate_floral_resources(args['landuse'],
+            args['landuse_attributes'],
+            [args['guilds'].get_table_row('species', species)
+             for species in species_list],
+            args['floral_fields'],
+            [args['species'][species]['floral'] for species in species_list])
+
     # Loop through all species and perform the necessary calculations.
     for species, species_dict in args['species'].iteritems():
         LOGGER.debug('Starting %s species', species)
@@ -105,7 +124,7 @@ def execute_model(args):
         LOGGER.info('Calculating %s abundance on the landscape', species)
         calculate_abundance(args['landuse'],
             args['landuse_attributes'], guild_dict, args['nesting_fields'],
-            args['floral_fields'], uris={
+            uris={
                 'nesting': species_dict['nesting'],
                 'floral': species_dict['floral'],
                 'species_abundance': species_dict['species_abundance'],
@@ -195,8 +214,44 @@ def execute_model(args):
     LOGGER.debug('Finished pollination biophysical calculations')
 
 
-def calculate_abundance(landuse, lu_attr, guild, nesting_fields,
-    floral_fields, uris):
+def calculate_floral_resources(landuse, lu_attr, guild_list, floral_fields,
+    floral_uri_list):
+    """Calculate the floral resources of pollinators that weigh the floral
+    seasons the same way, blurred by each pollinator's foraging distance.  The
+    floral raster is mapped once and convolved with every pollinator's kernel
+    in a single pass over it.
+
+        landuse - a URI to a GDAL dataset of the LULC.
+        lu_attr - a TableHandler
+        guild_list - a list of guild dictionaries as in calculate_abundance,
+            all with the same value in each of floral_fields.
+        floral_fields - a list of string fieldnames.  Used to extract floral
+            season fields from the guild dictionaries.
+        floral_uri_list - a list of URIs to where the floral resource raster
+            of each guild will be saved, parallel to guild_list.
+
+        Returns nothing."""
+    floral_raster_temp_uri = pygeoprocessing.geoprocessing.temporary_filename()
+
+    LOGGER.debug('Mapping floral attributes to landcover, writing to %s',
+        floral_raster_temp_uri)
+    map_attribute(landuse, lu_attr, guild_list[0], floral_fields,
+        floral_raster_temp_uri, sum)
+
+    lulc_ds = gdal.Open(landuse)
+    pixel_size = abs(lulc_ds.GetGeoTransform()[1])
+    lulc_ds = None
+
+    # Apply an exponential convolution filter per foraging distance to the
+    # floral resources raster and save each result.
+    LOGGER.debug('Applying neighborhood mappings to floral resources')
+    convolution.convolve_kernels_uri(
+        floral_raster_temp_uri,
+        [('exponential', guild['alpha'], pixel_size) for guild in guild_list],
+        floral_uri_list)
+
+
+def calculate_abundance(landuse, lu_attr, guild, nesting_fields, uris):
     """Calculate pollinator abundance on the landscape.  The calculated
     pollinator abundance raster will be created at uris['species_abundance'].
 
@@ -210,19 +265,17 @@ def calculate_abundance(landuse, lu_attr, guild, nesting_fields,
                 denoted in nesting_fields.  This value must be either 0 and 1,
                 indicating whether the pollinator uses this nesting resource for
                 nesting sites.
-            resource_f - One entry for each floral field denoted in
-                floral_fields.  This value must be between 0 and 1,
-                representing the liklihood that this species will forage during
-                this season.
+            resource_f - One entry for each floral field, used by
+                calculate_floral_resources.  This value must be between 0 and
+                1, representing the liklihood that this species will forage
+                during this season.
         nesting_fields - a list of string fieldnames.  Used to extract nesting
             fields from the guild dictionary, so fieldnames here must exist in
             guild.
-        floral_fields - a list of string fieldnames.  Used to extract floral
-            season fields from the guild dictionary.  Fieldnames here must exist
-            in guild.
         uris - a dictionary with these entries:
             'nesting' - a URI to where the nesting raster will be saved.
-            'floral' - a URI to where the floral resource raster will be saved.
+            'floral' - a URI to the floral resource raster made by
+                calculate_floral_resources.
             'species_abundance' - a URI to where the species abundance raster
                 will be saved.
             'temp' - a URI to a folder where temp files will be saved
@@ -230,32 +283,12 @@ def calculate_abundance(landuse, lu_attr, guild, nesting_fields,
         Returns nothing."""
     nodata = -1.0
 
-
-    floral_raster_temp_uri = pygeoprocessing.geoprocessing.temporary_filename()
-
-    LOGGER.debug('Mapping floral attributes to landcover, writing to %s',
-        floral_raster_temp_uri)
-    map_attribute(landuse, lu_attr, guild, floral_fields,
-        floral_raster_temp_uri, sum)
     map_attribute(landuse, lu_attr, guild, nesting_fields, uris['nesting'], max)
 
-    # Now that the per-pixel nesting and floral resources have been
-    # calculated, the floral resources still need to factor in
-    # neighborhoods.
     lulc_ds = gdal.Open(landuse)
     pixel_size = abs(lulc_ds.GetGeoTransform()[1])
     lulc_ds = None
-    expected_distance = guild['alpha'] / pixel_size
-    kernel_uri = pygeoprocessing.geoprocessing.temporary_filename()
-    make_exponential_decay_kernel_uri(expected_distance, kernel_uri)
-    LOGGER.debug('expected distance: %s ', expected_distance)
-
-    # Fetch the floral resources raster and matrix from the args dictionary
-    # apply an exponential convolution filter and save the floral resources raster to the
-    # dataset.
-    LOGGER.debug('Applying neighborhood mappings to floral resources')
-    pygeoprocessing.geoprocessing.convolve_2d_uri(floral_raster_temp_uri, kernel_uri, uris['floral'])
-    os.remove(kernel_uri)
+
     # Calculate the pollinator abundance index (using Math! to simplify the
     # equation in the documentation.  We're still waiting on Taylor
     # Rickett's reply to see if this is correct.
@@ -302,14 +335,11 @@ def calculate_farm_abundance(species_abundance, ag_map, alpha, uri, temp_dir):
     species_abundance = gdal.Open(species_abundance_uri)
 
     pixel_size = abs(species_abundance.GetGeoTransform()[1])
-    expected_distance = alpha / pixel_size
-
-    kernel_uri = pygeoprocessing.geoprocessing.temporary_filename()
-    make_exponential_decay_kernel_uri(expected_distance, kernel_uri)
 
     LOGGER.debug('Calculating foraging/farm abundance index')
-    pygeoprocessing.geoprocessing.convolve_2d_uri(species_abundance_uri, kernel_uri, farm_abundance_temp_uri)
-    os.remove(kernel_uri)
+    convolution.convolve_uri(
+        species_abundance_uri, 'exponential', alpha, pixel_size,
+        farm_abundance_temp_uri)
 
     nodata = species_abundance.GetRasterBand(1).GetNoDataValue()
     LOGGER.debug('Using nodata value %s from species abundance raster', nodata)
@@ -453,13 +483,10 @@ def calculate_service(rasters, nodata, alpha, part_wild, out_uris):
         bounding_box_mode='intersection',
         vectorize_op=False)
 
-    expected_distance = alpha / min_pixel_size
-    kernel_uri = pygeoprocessing.geoprocessing.temporary_filename()
-    make_exponential_decay_kernel_uri(expected_distance, kernel_uri)
     LOGGER.debug('Exponetial decay on ratio raster')
-    pygeoprocessing.geoprocessing.convolve_2d_uri(
-        out_uris['species_value'], kernel_uri, out_uris['species_value_blurred'])
-    os.remove(kernel_uri)
+    convolution.convolve_uri(
+        out_uris['species_value'], 'exponential', alpha, min_pixel_size,
+        out_uris['species_value_blurred'])
 
     # Vectorize the ps_vectorized function
     LOGGER.debug('Attributing farm value to the current species')
@@ -607,37 +634,5 @@ def map_attribute(base_raster, attr_table, guild_dict, resource_fields,
 
 
 def make_exponential_decay_kernel_uri(expected_distance, kernel_uri):
-    max_distance = expected_distance * 5
-    kernel_size = int(numpy.round(max_distance * 2 + 1))
-
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_dataset = driver.Create(
-        kernel_uri.encode('utf-8'), kernel_size, kernel_size, 1, gdal.GDT_Float32,
-        options=['BIGTIFF=IF_SAFER'])
-
-    #Make some kind of geotransform, it doesn't matter what but
-    #will make GIS libraries behave better if it's all defined
-    kernel_dataset.SetGeoTransform( [ 444720, 30, 0, 3751320, 0, -30 ] )
-    srs = osr.SpatialReference()
-    srs.SetUTM( 11, 1 )
-    srs.SetWellKnownGeogCS( 'NAD27' )
-    kernel_dataset.SetProjection( srs.ExportToWkt() )
-
-    kernel_band = kernel_dataset.GetRasterBand(1)
-    kernel_band.SetNoDataValue(-9999)
-
-    col_index = numpy.array(xrange(kernel_size))
-    integration = 0.0
-    for row_index in xrange(kernel_size):
-        distance_kernel_row = numpy.sqrt(
-            (row_index - max_distance) ** 2 + (col_index - max_distance) ** 2).reshape(1,kernel_size)
-        kernel = numpy.where(
-            distance_kernel_row > max_distance, 0.0, numpy.exp(-distance_kernel_row / expected_distance))
-        integration += numpy.sum(kernel)
-        kernel_band.WriteArray(kernel, xoff=0, yoff=row_index)
-
-    for row_index in xrange(kernel_size):
-        kernel_row = kernel_band.ReadAsArray(
-            xoff=0, yoff=row_index, win_xsize=kernel_size, win_ysize=1)
-        kernel_row /= integration
-        kernel_band.WriteArray(kernel_row, 0, row_index)
+    convolution.write_kernel_uri(
+        convolution.get_kernel('exponential', expected_distance), kernel_uri)
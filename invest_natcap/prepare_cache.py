@@ -0,0 +1,284 @@
+"""A persistent cache for the LULC independent data that models like SDR and
+NDR build in their `_prepare` functions.  An entry is keyed by an md5 hash of
+the path, size and modification time of every input file the preparation
+reads plus any parameters that change its result, so a later run on the same
+DEM, watersheds, etc. reuses the routed rasters no matter which workspace it
+writes to.  The least recently used entries are deleted once the cache grows
+past a size limit."""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+
+LOGGER = logging.getLogger('invest_natcap.prepare_cache')
+
+#Bump this if the layout of a cache entry changes so stale entries are
+#never picked up.
+CACHE_FORMAT_VERSION = 1
+
+#Environment variable that overrides the default cache directory
+CACHE_DIR_ENV = 'INVEST_PREPARE_CACHE_DIR'
+
+#Name of the index written into each cache entry
+ENTRY_INDEX_FILENAME = 'prepared_data.json'
+
+#The default limit on the bytes of all entries in a cache directory
+DEFAULT_MAX_CACHE_BYTES = 2**34
+
+#The files that make up a shapefile, by extension
+SHAPEFILE_EXTENSIONS = [
+    '.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix', '.sbn', '.sbx']
+
+#Suffixes GDAL appends to a raster's filename for its sidecar files
+RASTER_SIDECAR_SUFFIXES = ['.aux.xml', '.ovr', '.msk']
+
+
+def default_cache_dir():
+    """Returns the directory the cache lives in when a model isn't given one
+        explicitly.  This is the value of the INVEST_PREPARE_CACHE_DIR
+        environment variable if it's set, otherwise a folder in the user's
+        home directory."""
+    if CACHE_DIR_ENV in os.environ:
+        return os.environ[CACHE_DIR_ENV]
+    return os.path.join(
+        os.path.expanduser('~'), '.invest_natcap', 'prepare_cache')
+
+
+def _dataset_file_list(uri):
+    """Returns a sorted list of the files on disk that make up the dataset at
+        `uri`.  For a shapefile this is every file of its stem with an
+        extension in SHAPEFILE_EXTENSIONS, for a raster the file itself plus
+        any RASTER_SIDECAR_SUFFIXES sidecars, and for a directory (ESRI grids)
+        every file below it."""
+    if os.path.isdir(uri):
+        file_list = []
+        for root, _, filenames in os.walk(uri):
+            file_list.extend(
+                [os.path.join(root, filename) for filename in filenames])
+        return sorted(file_list)
+
+    stem, extension = os.path.splitext(os.path.abspath(uri))
+    if extension.lower() == '.shp':
+        candidate_list = [stem + ext for ext in SHAPEFILE_EXTENSIONS]
+    else:
+        candidate_list = [os.path.abspath(uri)] + [
+            os.path.abspath(uri) + suffix for suffix in RASTER_SIDECAR_SUFFIXES]
+    return sorted([
+        file_uri for file_uri in candidate_list if os.path.isfile(file_uri)])
+
+
+def get_cache_key(model_name, uri_list, parameters=None):
+    """Calculates the key of a cache entry.  Only the metadata of the input
+        files is read, so checking the cache costs the same no matter how
+        large the inputs are.
+
+        model_name - a string that identifies the preparation function
+        uri_list - a list of uris to the input datasets the preparation
+            reads; the absolute path, size and modification time of each of
+            their files are hashed
+        parameters - (optional) a json serializable dictionary of any other
+            values that change the prepared result
+
+        returns a hex md5 digest string"""
+
+    md5 = hashlib.md5()
+    md5.update(json.dumps(
+        [CACHE_FORMAT_VERSION, model_name, parameters or {}], sort_keys=True))
+    for uri in uri_list:
+        file_list = _dataset_file_list(uri)
+        if len(file_list) == 0:
+            raise IOError('No files found for dataset %s' % uri)
+        for file_uri in file_list:
+            file_stat = os.stat(file_uri)
+            md5.update(json.dumps(
+                [file_uri, file_stat.st_size, repr(file_stat.st_mtime)]))
+    return md5.hexdigest()
+
+
+def _directory_size(dir_uri):
+    """Returns the bytes of all the files below `dir_uri`"""
+    total_bytes = 0
+    for root, _, filenames in os.walk(dir_uri):
+        for filename in filenames:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                #removed by a concurrent eviction
+                pass
+    return total_bytes
+
+
+def _evict_entries(cache_dir, max_cache_bytes, keep_entry_dir):
+    """Deletes the least recently used entries of every model in `cache_dir`
+        until their total size is at most `max_cache_bytes`.  An entry's last
+        use is the modification time of its index, which `cached_prepare`
+        touches on every hit.
+
+        cache_dir - the root of the cache
+        max_cache_bytes - the limit on the bytes of all entries
+        keep_entry_dir - an entry that's never deleted, the one just used
+
+        returns nothing"""
+    entry_list = []
+    for model_name in os.listdir(cache_dir):
+        model_cache_dir = os.path.join(cache_dir, model_name)
+        if not os.path.isdir(model_cache_dir):
+            continue
+        for entry_name in os.listdir(model_cache_dir):
+            entry_dir = os.path.join(model_cache_dir, entry_name)
+            index_uri = os.path.join(entry_dir, ENTRY_INDEX_FILENAME)
+            if entry_name.endswith('.staging') or not os.path.exists(index_uri):
+                continue
+            entry_list.append((
+                os.path.getmtime(index_uri), entry_dir,
+                _directory_size(entry_dir)))
+
+    total_bytes = sum([entry_bytes for _, _, entry_bytes in entry_list])
+    for _, entry_dir, entry_bytes in sorted(entry_list):
+        if total_bytes <= max_cache_bytes:
+            break
+        if os.path.abspath(entry_dir) == os.path.abspath(keep_entry_dir):
+            continue
+        LOGGER.info('Evicting cache entry %s', entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes -= entry_bytes
+
+
+def _load_entry(entry_dir):
+    """Returns the prepared data dictionary stored in `entry_dir` with its
+        paths made absolute, or None if the entry is missing or incomplete."""
+    index_uri = os.path.join(entry_dir, ENTRY_INDEX_FILENAME)
+    if not os.path.exists(index_uri):
+        return None
+    index_file = open(index_uri, 'r')
+    try:
+        relative_data = json.load(index_file)
+    except ValueError:
+        LOGGER.warn('Ignoring corrupt cache index %s', index_uri)
+        return None
+    finally:
+        index_file.close()
+
+    prepared_data = {}
+    for key, relative_uri in relative_data.iteritems():
+        prepared_data[str(key)] = os.path.join(entry_dir, relative_uri)
+        if not os.path.exists(prepared_data[key]):
+            LOGGER.warn(
+                'Ignoring cache entry %s because %s is missing', entry_dir,
+                prepared_data[key])
+            return None
+    return prepared_data
+
+
+def cached_prepare(
+        model_name, prepare_function, args, uri_keys, parameter_keys=None,
+        cache_dir=None, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """Returns the result of `prepare_function(**args)`, loading it from the
+        cache if the same inputs were prepared before and calculating and
+        storing it otherwise.
+
+        model_name - a string that identifies the preparation, used to
+            namespace the entries in the cache
+        prepare_function - a function taking the same keyword arguments as
+            the model's execute that writes its rasters under
+            args['workspace_dir'] and returns a dictionary of uris
+        args - the model's args dictionary
+        uri_keys - the keys in `args` of the input datasets that
+            `prepare_function` reads
+        parameter_keys - (optional) the keys in `args` of any other values
+            that change what `prepare_function` produces
+        cache_dir - (optional) the root of the cache, defaults to
+            `default_cache_dir()`
+        max_cache_bytes - (optional) once the entries of all models in
+            `cache_dir` take more than this many bytes the least recently
+            used are deleted, defaults to DEFAULT_MAX_CACHE_BYTES
+
+        returns the dictionary `prepare_function` returns, with uris that
+            point into the cache"""
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    model_cache_dir = os.path.join(cache_dir, model_name)
+    if not os.path.exists(model_cache_dir):
+        try:
+            os.makedirs(model_cache_dir)
+        except OSError:
+            #another process may have made it in the meantime
+            if not os.path.isdir(model_cache_dir):
+                raise
+
+    parameters = dict(
+        [(key, args[key]) for key in (parameter_keys or []) if key in args])
+    cache_key = get_cache_key(
+        model_name, [args[key] for key in uri_keys], parameters)
+    entry_dir = os.path.join(model_cache_dir, cache_key)
+
+    prepared_data = _load_entry(entry_dir)
+    if prepared_data is not None:
+        LOGGER.info('Using cached prepared data %s', entry_dir)
+        #mark the entry as recently used
+        os.utime(os.path.join(entry_dir, ENTRY_INDEX_FILENAME), None)
+        return prepared_data
+
+    if os.path.exists(entry_dir):
+        LOGGER.info('Replacing incomplete cache entry %s', entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    #prepare into a private staging directory and move it into place once
+    #it's complete so concurrent runs never see a partial entry
+    staging_dir = tempfile.mkdtemp(
+        prefix=cache_key + '_', suffix='.staging', dir=model_cache_dir)
+    LOGGER.info('Preparing data for cache entry %s', entry_dir)
+    try:
+        staged_args = args.copy()
+        staged_args['workspace_dir'] = staging_dir
+        staged_data = prepare_function(**staged_args)
+
+        relative_data = {}
+        for key, uri in staged_data.iteritems():
+            relative_uri = os.path.relpath(uri, staging_dir)
+            if relative_uri.startswith(os.pardir):
+                raise ValueError(
+                    '%s returned %s for %s which is outside its workspace '
+                    'and cannot be cached' % (model_name, uri, key))
+            relative_data[key] = relative_uri
+        index_file = open(
+            os.path.join(staging_dir, ENTRY_INDEX_FILENAME), 'w')
+        json.dump(relative_data, index_file, indent=4, sort_keys=True)
+        index_file.close()
+    except:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(staging_dir, entry_dir)
+    except OSError:
+        #another process finished the same entry first, use that one
+        LOGGER.info('Cache entry %s was created concurrently', entry_dir)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    prepared_data = _load_entry(entry_dir)
+    if prepared_data is None:
+        raise IOError('Unable to load cache entry %s' % entry_dir)
+    _evict_entries(cache_dir, max_cache_bytes, entry_dir)
+    return prepared_data
+
+
+def clear_cache(model_name=None, cache_dir=None):
+    """Deletes entries from the prepared data cache.
+
+        model_name - (optional) if given only this model's entries are
+            removed, otherwise the whole cache is
+        cache_dir - (optional) the root of the cache, defaults to
+            `default_cache_dir()`
+
+        returns nothing"""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if model_name is not None:
+        cache_dir = os.path.join(cache_dir, model_name)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
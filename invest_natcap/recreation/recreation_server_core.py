@@ -6,6 +6,7 @@ import os
 import math
 from urllib2 import urlopen
 import logging
+import StringIO
 
 from osgeo import ogr, osr, gdal
 
@@ -16,6 +17,9 @@ logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 
 LOGGER = logging.getLogger('invest_natcap.recreation.server_core')
 
+#the number of features loaded into the database with each COPY
+COPY_CHUNK_SIZE = 10000
+
 
 class NoQuotes(object):
     def __init__(self, string):
@@ -431,6 +435,156 @@ def calculate_grid(origin_x, origin_y, column, row, cell_size):
                           origin_y + ((row + 1) * cell_size))])
 
 
+def grid_sql(in_table_name, in_column_name, out_table_name, out_column_name, min_x, min_y, columns, rows, cell_size, srid):
+    """
+    Constructs an SQL statement that inserts the cells of a square grid that
+    are covered by the AOI. The cells are generated in the database, so the
+    whole grid is one statement. Their corners are truncated to integers, as
+    in format_polygon_sql.
+
+    Args:
+        in_table_name (string): the PostGIS table name of the AOI
+        in_column_name (string): the geometry column of the AOI
+        out_table_name (string): the PostGIS table name of the grid
+        out_column_name (string): the geometry column of the grid
+        min_x (float): the lower left X coordinate of the origin of the grid
+        min_y (float): the lower left Y coordinate of the origin of the grid
+        columns (int): the number of columns in the grid
+        rows (int): the number of rows in the grid
+        cell_size (float): the size of a grid cell in map units
+        srid (int): the srid value
+
+    Returns:
+        sql (string): an sql statement
+    """
+
+    sql = ("INSERT INTO %(out_table)s SELECT cell.%(out_column)s, cell.id "
+           "FROM (SELECT ST_MakeEnvelope("
+           "trunc(%(min_x)s + (i * %(cell_size)s)), "
+           "trunc(%(min_y)s + (j * %(cell_size)s)), "
+           "trunc(%(min_x)s + ((i + 1) * %(cell_size)s)), "
+           "trunc(%(min_y)s + ((j + 1) * %(cell_size)s)), %(srid)i) "
+           "AS %(out_column)s, (i * %(rows)i) + j AS id "
+           "FROM generate_series(0, %(columns)i - 1) AS i, "
+           "generate_series(0, %(rows)i - 1) AS j) AS cell, %(in_table)s "
+           "WHERE ST_Covers(%(in_table)s.%(in_column)s, cell.%(out_column)s)")
+    sql = sql % {"out_table": out_table_name,
+                 "out_column": out_column_name,
+                 "in_table": in_table_name,
+                 "in_column": in_column_name,
+                 "min_x": format_double_sql(min_x),
+                 "min_y": format_double_sql(min_y),
+                 "cell_size": format_double_sql(cell_size),
+                 "columns": columns,
+                 "rows": rows,
+                 "srid": srid}
+
+    return sql
+
+
+def hex_grid_sql(in_table_name, in_column_name, out_table_name, out_column_name, min_x, min_y, columns, rows, cell_size, srid):
+    """
+    Constructs an SQL statement that inserts the cells of a hexagonal grid
+    that are covered by the AOI. The cells are generated in the database, so
+    the whole grid is one statement. Their vertices are truncated to integers,
+    as in format_polygon_sql.
+
+    Args:
+        in_table_name (string): the PostGIS table name of the AOI
+        in_column_name (string): the geometry column of the AOI
+        out_table_name (string): the PostGIS table name of the grid
+        out_column_name (string): the geometry column of the grid
+        min_x (float): the lower left X coordinate of the origin of the grid
+        min_y (float): the lower left Y coordinate of the origin of the grid
+        columns (int): the number of columns in the grid
+        rows (int): the number of rows in the grid
+        cell_size (float): the width of a hexagon in map units
+        srid (int): the srid value
+
+    Returns:
+        sql (string): an sql statement
+    """
+
+    #calculate offsets for cell
+    delta_short_x = cell_size * 0.25
+    delta_long_x = cell_size * 0.5
+    delta_y = cell_size * 0.25 * (3 ** 0.5)
+
+    #odd rows are shifted right by half a hexagon
+    vertex_sql = "ST_MakePoint(trunc(x %s %s), trunc(y %s %s))"
+    hexagon_sql = ", ".join(
+        [vertex_sql % (x_sign, x_delta, y_sign, y_delta)
+         for x_sign, x_delta, y_sign, y_delta
+         in [("-", "%(long_x)s", "+", "0"),
+             ("-", "%(short_x)s", "+", "%(delta_y)s"),
+             ("+", "%(short_x)s", "+", "%(delta_y)s"),
+             ("+", "%(long_x)s", "+", "0"),
+             ("+", "%(short_x)s", "-", "%(delta_y)s"),
+             ("-", "%(short_x)s", "-", "%(delta_y)s"),
+             ("-", "%(long_x)s", "+", "0")]])
+
+    sql = ("INSERT INTO %(out_table)s SELECT cell.%(out_column)s, cell.id "
+           "FROM (SELECT ST_SetSRID(ST_MakePolygon(ST_MakeLine(ARRAY["
+           + hexagon_sql +
+           "])), %(srid)i) AS %(out_column)s, (j * %(rows)i) + i AS id "
+           "FROM (SELECT i, j, "
+           "%(min_x)s + (%(long_x)s * (CASE WHEN (i + 1) %% 2 = 1 "
+           "THEN 1 + (3 * j) ELSE %(half_offset)s + (3 * j) END)) AS x, "
+           "%(min_y)s + (%(delta_y)s * (i + 1)) AS y "
+           "FROM generate_series(0, %(columns)i - 1) AS j, "
+           "generate_series(0, %(rows)i - 1) AS i) AS centroid) AS cell, "
+           "%(in_table)s "
+           "WHERE ST_Covers(%(in_table)s.%(in_column)s, cell.%(out_column)s)")
+    sql = sql % {"out_table": out_table_name,
+                 "out_column": out_column_name,
+                 "in_table": in_table_name,
+                 "in_column": in_column_name,
+                 "min_x": format_double_sql(min_x),
+                 "min_y": format_double_sql(min_y),
+                 "short_x": format_double_sql(delta_short_x),
+                 "long_x": format_double_sql(delta_long_x),
+                 "delta_y": format_double_sql(delta_y),
+                 "half_offset": format_double_sql(2.5),
+                 "columns": columns,
+                 "rows": rows,
+                 "srid": srid}
+
+    return sql
+
+
+def format_double_sql(value):
+    """
+    Returns a number as a double precision SQL literal. Unlike a numeric
+    literal, arithmetic on it rounds the same way as Python floats.
+
+    Args:
+        value (float): a number
+
+    Returns:
+        sql (string): an sql fragment
+    """
+
+    return "%r::double precision" % float(value)
+
+
+def format_copy_value(value):
+    """
+    Returns a value in the text format of the COPY command
+
+    Args:
+        value (string): a value or None for NULL
+
+    Returns:
+        copy_value (string): the escaped value
+    """
+
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace(
+        "\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
 ###OGR calls###
 def create_polygon_feature_ogr(layer, points, results):
     """
@@ -543,7 +697,7 @@ def category_builder_osm():
     return sql
 
 
-def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0):
+def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0, chunk_size=COPY_CHUNK_SIZE):
     """
     Loads the shapefile into a PostGIS table
 
@@ -555,6 +709,7 @@ def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0)
     Keyword Args:
         attributes (boolean): boolean to include attribute table
         srid (int): the srid value
+        chunk_size (int): the number of features loaded with each COPY
 
     Returns:
         srid (int): the srid value
@@ -604,7 +759,9 @@ def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0)
 
     #build field definitions
     fields = []
-    casts = []
+    field_names = []
+    #unset numbers are loaded as NULL and unset text as an empty string
+    nullable_fields = []
     if lyr.GetFeatureCount() < 1:
         LOGGER.warn("Empty shapefile.")
     elif attributes:
@@ -616,13 +773,10 @@ def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0)
 
             if field_defn.GetType() == ogr.OFTInteger:
                 field_type = "integer"
-                casts.append(lambda s: "%s" % (s))
             elif field_defn.GetType() == ogr.OFTReal:
                 field_type = "double precision"
-                casts.append(lambda s: "%s" % (s))
             elif field_defn.GetType() == ogr.OFTString:
                 field_type = "text"
-                casts.append(lambda s: "\'%s\'" % (s))
             elif field_defn.GetType() == ogr.OFTBinary:
                 raise ValueError("Unknown sql Conversion")
             elif field_defn.GetType() == ogr.OFTDate:
@@ -631,6 +785,8 @@ def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0)
                 raise ValueError("Unknown Type")
 
             fields.append("%s %s" % (field_name, field_type))
+            field_names.append(field_name)
+            nullable_fields.append(field_type != "text")
 
     LOGGER.debug("Found the following attribute columns: %s",
                  str(fields).replace(",", "|"))
@@ -643,25 +799,40 @@ def temp_shapefile_db(cur, shapefile_name, table_name, attributes=False, srid=0)
         "Executing SQL: %s." % sql.replace(".", "||").replace(",", "|"))
     cur.execute(sql)
 
-    #insert features
+    #copy features in chunks
+    copy_sql = "COPY %s (%s) FROM STDIN"
+    copy_sql = copy_sql % (table_name, ", ".join(field_names + ["way"]))
+    LOGGER.debug(
+        "Executing SQL: %s." % copy_sql.replace(".", "||").replace(",", "|"))
+
+    copy_buffer = StringIO.StringIO()
+    buffered_count = 0
     for id_number, feat in enumerate(lyr):
         geom = feat.GetGeometryRef()
         if not geom is None:
-            if attributes:
-                attrb = []
-                for i, cast in enumerate(casts):
-                    attrb.append(cast(feat.GetFieldAsString(i)))
-
-                sql = "INSERT INTO %s VALUES(%s, ST_GeomFromText(\'%s\',%s))"
-                sql = sql % (table_name, ", ".join(attrb),
-                             geom.ExportToWkt(), str(srid))
-            else:
-                sql = "INSERT INTO %s VALUES(ST_GeomFromText(\'%s\',%s))"
-                sql = sql % (table_name, geom.ExportToWkt(), str(srid))
-            LOGGER.debug("Inserting feature %i", id_number)
-            LOGGER.debug(
-                "Executing SQL: %s." % sql.replace(".", "||").replace(",", "|"))
-            cur.execute(sql)
+            row = []
+            for i, nullable in enumerate(nullable_fields):
+                if nullable and not feat.IsFieldSet(i):
+                    row.append(None)
+                else:
+                    row.append(feat.GetFieldAsString(i))
+            row.append("SRID=%s;%s" % (str(srid), geom.ExportToWkt()))
+            copy_buffer.write(
+                "\t".join([format_copy_value(value) for value in row]) + "\n")
+            buffered_count += 1
+
+        if buffered_count == chunk_size:
+            LOGGER.debug("Inserting %i features up to feature %i",
+                         buffered_count, id_number)
+            copy_buffer.seek(0)
+            cur.copy_expert(copy_sql, copy_buffer)
+            copy_buffer = StringIO.StringIO()
+            buffered_count = 0
+
+    if buffered_count > 0:
+        LOGGER.debug("Inserting %i features", buffered_count)
+        copy_buffer.seek(0)
+        cur.copy_expert(copy_sql, copy_buffer)
 
     return int(srid)
 
@@ -715,23 +886,13 @@ def temp_grid_db(cur, in_table_name, in_column_name, out_table_name, out_column_
     cur.execute(sql)
 
     #insert grid cells if covered by AOI
-    for i in range(columns):
-        for j in range(rows):
-            box = calculate_grid(min_x, min_y, i, j, cell_size)
-            boxsql = format_polygon_sql(box, srid)
-
-            sql = "INSERT INTO %s SELECT %s, %i as id FROM %s as %s,"% \
-                (out_table_name, out_column_name, (i * rows) + j, boxsql,
-                 out_column_name)
-            sql = sql + " %s WHERE ST_Covers(%s.%s,%s)" % \
-                (in_table_name, in_table_name, in_column_name,
-                 out_column_name)
-
-            # LOGGER.debug("Executing SQL: %s",
-            #              sql.replace(",", "|").replace(".", "||"))
-            LOGGER.debug(
-                "Checking if extent grid cell %i in AOI." % ((i * rows) + j))
-            cur.execute(sql)
+    sql = grid_sql(in_table_name, in_column_name, out_table_name,
+                   out_column_name, min_x, min_y, columns, rows, cell_size,
+                   srid)
+    LOGGER.debug("Checking which of %i extent grid cells are in AOI.",
+                 columns * rows)
+    LOGGER.debug("Executing SQL: %s", sql.replace(",", "|").replace(".", "||"))
+    cur.execute(sql)
 
     sort_grid(cur, out_table_name, out_column_name)
 
@@ -766,7 +927,6 @@ def hex_grid(cur, in_table_name, in_column_name, out_table_name, out_column_name
     width, height = abs(max_x - min_x), abs(max_y - min_y)
 
     #calculate offsets for cell
-    delta_short_x = cell_size * 0.25
     delta_long_x = cell_size * 0.5
     delta_y = cell_size * 0.25 * (3 ** 0.5)
 
@@ -788,35 +948,13 @@ def hex_grid(cur, in_table_name, in_column_name, out_table_name, out_column_name
     cur.execute(sql)
 
     #insert grid cells if covered by AOI
-    for j in range(columns):
-        for i in range(rows):
-            if (i + 1) % 2:
-                centroid = (min_x + (delta_long_x * (1 + (3 * j))),
-                            min_y + (delta_y * (i + 1)))
-            else:
-                centroid = (min_x + (delta_long_x * (2.5 + (3 * j))),
-                            min_y + (delta_y * (i + 1)))
-
-            x_coordinate, y_coordinate = centroid
-            hexagon = [(x_coordinate - delta_long_x, y_coordinate),
-                       (x_coordinate - delta_short_x, y_coordinate + delta_y),
-                       (x_coordinate + delta_short_x, y_coordinate + delta_y),
-                       (x_coordinate + delta_long_x, y_coordinate),
-                       (x_coordinate + delta_short_x, y_coordinate - delta_y),
-                       (x_coordinate - delta_short_x, y_coordinate - delta_y),
-                       (x_coordinate - delta_long_x, y_coordinate)]
-            hexagonsql = format_polygon_sql(hexagon, srid)
-
-            sql = "INSERT INTO %s SELECT %s, %i as id FROM %s as %s," % \
-                (out_table_name, out_column_name,
-                    (j * rows) + i, hexagonsql, out_column_name)
-            sql = sql + " %s WHERE ST_Covers(%s.%s,%s)" % \
-                (in_table_name, in_table_name, in_column_name, out_column_name)
-            # LOGGER.debug("Executing SQL: %s",
-            #              sql.replace(",", "|").replace(".", "||"))
-            LOGGER.debug(
-                "Checking if extent grid cell %i in AOI." % ((i * rows) + j))
-            cur.execute(sql)
+    sql = hex_grid_sql(in_table_name, in_column_name, out_table_name,
+                       out_column_name, min_x, min_y, columns, rows,
+                       cell_size, srid)
+    LOGGER.debug("Checking which of %i extent grid cells are in AOI.",
+                 columns * rows)
+    LOGGER.debug("Executing SQL: %s", sql.replace(",", "|").replace(".", "||"))
+    cur.execute(sql)
 
     sort_grid(cur, out_table_name, out_column_name)
 
@@ -833,27 +971,23 @@ def sort_grid(cur, out_table_name, out_column_name):
     Returns:
         None
     """
-    sql = ("SELECT %s, "
-           "row_number() OVER (ORDER BY ST_YMin(box2d(%s)), "
-           "ST_XMin(box2d(%s)) ASC) FROM %s")
-    sql = sql % ("id", out_column_name, out_column_name, out_table_name)
+    sql = "ALTER TABLE %s ADD new_id integer"
+    sql = sql % (out_table_name)
     LOGGER.debug(
         "Executing SQL: %s." % sql.replace(".", "||").replace(",", "|"))
     cur.execute(sql)
-    renumber = cur.fetchall()
 
-    sql = "ALTER TABLE %s ADD new_id integer"
-    sql = sql % (out_table_name)
+    sql = ("UPDATE %s SET new_id = renumber.new_id "
+           "FROM (SELECT %s AS old_id, "
+           "row_number() OVER (ORDER BY ST_YMin(box2d(%s)), "
+           "ST_XMin(box2d(%s)) ASC) AS new_id FROM %s) AS renumber "
+           "WHERE %s.%s = renumber.old_id")
+    sql = sql % (out_table_name, "id", out_column_name, out_column_name,
+                 out_table_name, out_table_name, "id")
     LOGGER.debug(
         "Executing SQL: %s." % sql.replace(".", "||").replace(",", "|"))
     cur.execute(sql)
 
-    sql = "UPDATE %s SET new_id = %i WHERE id = %i"
-    for old_id, new_id in renumber:
-        #LOGGER.debug("Executing SQL: %s." % (sql % (out_table_name, new_id, old_id)).replace(".", "||").replace(",", "|"))
-        LOGGER.debug("Renumbering cell %i to %i." % (old_id, new_id))
-        cur.execute(sql % (out_table_name, new_id, old_id))
-
     sql = "ALTER TABLE %s DROP COLUMN %s"
     sql = sql % (out_table_name, "id")
     LOGGER.debug(
@@ -2,13 +2,15 @@
 functionality."""
 
 import os
+import csv
 import logging
 import codecs
 import re
 from types import StringType
 
+from osgeo import ogr
+
 import invest_natcap
-import pygeoprocessing.geoprocessing
 import table_generator
 
 LOGGER = logging.getLogger('invest_natcap.reporting')
@@ -79,7 +81,10 @@ def generate_report(reporting_args):
                     'data_type' is 'shapefile' or 'csv' (required). If a
                     list of dictionaries, each dictionary should have
                     keys that represent the columns, where each dictionary
-                    is a row (list could be empty)
+                    is a row (list could be empty). Any other iterable of
+                    dictionaries, such as iter_csv_rows or
+                    iter_datasource_rows, may be used in place of the list,
+                    in which case the rows are written as they are read
                     How the rows are ordered are defined by their
                     index in the list. Formatted example:
                     [{col_name_1: value, col_name_2: value, ...},
@@ -203,8 +208,9 @@ def generate_report(reporting_args):
         section = element.pop('section')
 
         # Process the element by calling it's specific function handler which
-        # will return a string. Append this to html dictionary to be written
-        # in write_html
+        # will return a string, or for tables a generator of strings that is
+        # only run when the page is written. Append this to html dictionary to
+        # be written in write_html
         html_obj[section].append(report[fun_type](element))
 
     # Write the html page to 'out_uri'
@@ -213,11 +219,13 @@ def generate_report(reporting_args):
 
 def write_html(html_obj, out_uri):
     """Write an html file to 'out_uri' from html element represented as strings
-        in 'html_obj'
+        in 'html_obj'. Each piece is written to the file as soon as it is
+        available so the page is never held in memory as a whole.
 
         html_obj - a dictionary with two keys, 'head' and 'body', that point to
             lists. The list for each key is a list of the htmls elements as
-            strings (required)
+            strings, or as iterables of strings such as the generators returned
+            by build_table (required)
             example: {'head':['elem_1', 'elem_2',...],
                       'body':['elem_1', 'elem_2',...]}
 
@@ -227,45 +235,46 @@ def write_html(html_obj, out_uri):
 
     LOGGER.debug('Writing HTML page')
 
-    # Start the string that will be written as the html file
-    html_str = u('<html>')
-
-    for section in ['head', 'body']:
-        # Ensure the browser interprets the html file as utf-8
-        if section == 'head':
-            html_str += '<meta charset="UTF-8">'
-
-        # Write the tag for the section
-        html_str += '<%s>' % u(section)
-        # Get the list of html string elements for this section
-        sect_elements = html_obj[section]
+    # If the URI for the html output file exists remove it
+    if os.path.isfile(out_uri):
+        os.remove(out_uri)
 
-        for element in sect_elements:
-            # Add each element to the html string
-            if type(element) is StringType:
-                element = u(element)
-            html_str += element
+    # Open the file and write the page to it as it is generated
+    html_file = codecs.open(out_uri, 'wb', 'utf-8')
+    try:
+        html_file.write(u('<html>'))
 
-        # Add the closing tag for the section
-        html_str += '</%s>' % section
+        for section in ['head', 'body']:
+            # Ensure the browser interprets the html file as utf-8
+            if section == 'head':
+                html_file.write(u('<meta charset="UTF-8">'))
 
-    # Finish the html tag
-    html_str += '</html>'
+            # Write the tag for the section
+            html_file.write(u('<%s>' % section))
+            # Get the list of html string elements for this section
+            sect_elements = html_obj[section]
 
-    #LOGGER.debug('HTML Complete String : %s', html_str)
+            for element in sect_elements:
+                # Write each element, a piece at a time if it is not a string
+                if isinstance(element, basestring):
+                    element = [element]
+                for piece in element:
+                    if type(piece) is StringType:
+                        piece = u(piece)
+                    html_file.write(piece)
 
-    # If the URI for the html output file exists remove it
-    if os.path.isfile(out_uri):
-        os.remove(out_uri)
+            # Add the closing tag for the section
+            html_file.write(u('</%s>' % section))
 
-    # Open the file, write the string and close the file
-    html_file = codecs.open(out_uri, 'wb', 'utf-8')
-    html_file.write(html_str)
-    html_file.close()
+        # Finish the html tag
+        html_file.write(u('</html>'))
+    finally:
+        html_file.close()
 
 
 def build_table(param_args):
-    """Generates a string representing a table in html format.
+    """Generates a table in html format. Nothing is read from 'data' until
+        the returned generator is run, and then only a row at a time.
 
         param_args - a dictionary that has the parameters for building up the
             html table. The dictionary includes the following:
@@ -282,9 +291,9 @@ def build_table(param_args):
                 build the table from. Either 'shapefile', 'csv', or 'dictionary'
                 (required)
 
-            param_args['data'] - a URI to a csv or shapefile OR a list of
-                dictionaries. If a list of dictionaries the data should be
-                represented in the following format: (required)
+            param_args['data'] - a URI to a csv or shapefile OR a list or
+                other iterable of dictionaries. If dictionaries the data should
+                be represented in the following format: (required)
                     [{col_name_1: value, col_name_2: value, ...},
                      {col_name_1: value, col_name_2: value, ...},
                      ...]
@@ -314,13 +323,10 @@ def build_table(param_args):
                 total row will be placed at the bottom of the table that sums
                 the columns (required)
 
-        returns - a string that represents an html table
+        returns - a generator of strings that together represent an html
+            table, see table_generator.iter_table
     """
     LOGGER.debug('Building Table Structure')
-    # Initialize an intermediate dictionary which will hold the physical data
-    # elements of the table
-    data_dict = {}
-
     # Initialize the final dictionary which will have the data of the table as
     # well as parameters needed to build up the html table
     table_dict = {}
@@ -333,27 +339,17 @@ def build_table(param_args):
     # shapefile / csv file or a list of dictionaries
     input_data = param_args['data']
 
-    # Depending on the type of input being passed in, pre-process it
-    # accordingly
+    # Depending on the type of input being passed in, set up a reader of
+    # its rows ordered by their key
     if data_type == 'shapefile':
         key = param_args['key']
-        data_dict = pygeoprocessing.geoprocessing.extract_datasource_table_by_key(
-            input_data, key)
-        # Convert the data_dict to a list of dictionaries where each dictionary
-        # in the list represents a row of the table
-        data_list = data_dict_to_list(data_dict)
+        data_list = iter_datasource_rows(input_data, key)
     elif data_type == 'csv':
         key = param_args['key']
-        data_dict = pygeoprocessing.geoprocessing.get_lookup_from_csv(input_data, key)
-        # Convert the data_dict to a list of dictionaries where each dictionary
-        # in the list represents a row of the table
-        data_list = data_dict_to_list(data_dict)
+        data_list = iter_csv_rows(input_data, key)
     else:
         data_list = input_data
 
-    #LOGGER.debug('Data Collected from Input Source: %s', data_list)
-    LOGGER.debug('Data Collected from Input Source')
-
     # Add the columns data to the final dictionary that is to be passed
     # off to the table generator
     table_dict['cols'] = param_args['columns']
@@ -390,9 +386,9 @@ def build_table(param_args):
             table_dict['checkbox_pos'] = param_args['checkbox_pos']
 
     LOGGER.debug('Calling table_generator')
-    # Call generate table passing in the final dictionary and attribute
-    # dictionary. Return the generate string
-    return table_generator.generate_table(table_dict)
+    # Call iter table passing in the final dictionary. Return the generator
+    # of the table strings
+    return table_generator.iter_table(table_dict)
 
 
 def data_dict_to_list(data_dict):
@@ -415,6 +411,110 @@ def data_dict_to_list(data_dict):
     return data_list
 
 
+def iter_csv_rows(csv_uri, key=None):
+    """Read the rows of a CSV table one at a time as dictionaries. Values
+        are cast to ints or floats where possible.
+
+        csv_uri - a URI to a CSV file whose first row is the column names
+            (required)
+
+        key - a column name to order the rows by. Only the key value and file
+            position of each row are held in memory to do so. If a key value
+            is repeated the last row with it is used. If None the rows are
+            read in the order of the file (optional)
+
+        returns - a generator of dictionaries mapping the column names to the
+            values of a row"""
+
+    csv_file = open(csv_uri, 'rb')
+    try:
+        # Read with readline so the file position is known between rows
+        line_iter = iter(csv_file.readline, '')
+        csv_reader = csv.reader(line_iter)
+        header_row = [u(name) for name in csv_reader.next()]
+
+        if key is None:
+            for line in csv_reader:
+                yield _csv_row_dict(header_row, line)
+            return
+
+        key_index = header_row.index(key)
+        key_positions = {}
+        position = csv_file.tell()
+        for line in csv_reader:
+            key_positions[_smart_cast(line[key_index])] = position
+            position = csv_file.tell()
+
+        for key_value in sorted(key_positions):
+            csv_file.seek(key_positions[key_value])
+            line = csv.reader(iter(csv_file.readline, '')).next()
+            yield _csv_row_dict(header_row, line)
+    finally:
+        csv_file.close()
+
+
+def iter_datasource_rows(datasource_uri, key=None):
+    """Read the attribute table of the first layer of an OGR datasource one
+        feature at a time as dictionaries.
+
+        datasource_uri - a URI to an OGR datasource (required)
+
+        key - a field name to order the rows by. Only the key value and FID
+            of each feature are held in memory to do so. If a key value is
+            repeated the last feature with it is used. If None the rows are
+            read in the order of the layer (optional)
+
+        returns - a generator of dictionaries mapping the field names to the
+            values of a feature"""
+
+    datasource = ogr.Open(datasource_uri)
+    layer = datasource.GetLayer()
+    layer_def = layer.GetLayerDefn()
+    field_names = [
+        layer_def.GetFieldDefn(field_index).GetName()
+        for field_index in xrange(layer_def.GetFieldCount())]
+
+    def feature_dict(feature):
+        """Map the field names to the values of 'feature'"""
+        return dict(
+            (field_name, feature.GetField(field_name))
+            for field_name in field_names)
+
+    layer.ResetReading()
+    if key is None:
+        for feature in layer:
+            yield feature_dict(feature)
+        return
+
+    key_fids = {}
+    for feature in layer:
+        key_fids[feature.GetField(key)] = feature.GetFID()
+
+    for key_value in sorted(key_fids):
+        yield feature_dict(layer.GetFeature(key_fids[key_value]))
+
+
+def _csv_row_dict(header_row, line):
+    """Map the column names in 'header_row' to the values in 'line'"""
+    return dict(
+        (header, _smart_cast(value)) for header, value in zip(header_row, line))
+
+
+def _smart_cast(value):
+    """Cast a string to an int or a float, or decode it if it's neither"""
+    for cast_function in [int, float]:
+        try:
+            return cast_function(value)
+        except ValueError:
+            pass
+    for encoding in ['ascii', 'utf-8', 'latin-1']:
+        try:
+            return value.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return value
+
+
 def add_text_element(param_args):
     """Generates a string that represents a html text block. The input string
         should be wrapped in proper html tags
@@ -4,9 +4,24 @@ from types import StringType
 
 LOGGER = logging.getLogger('invest_natcap.reporting.table_generator')
 
+# The value of each row in a checkbox column
+CHECKBOX_INPUT = '<input type=checkbox name=cb value=1>'
+
 def generate_table(table_dict, attributes=None):
     """Takes in a dictionary representation of a table and generates a String of
-        the the table in the form of hmtl
+        the the table in the form of hmtl. See iter_table for the arguments.
+
+        returns - a string representing an html table
+    """
+
+    LOGGER.info('Generating HTML Table String')
+
+    return u''.join(iter_table(table_dict, attributes))
+
+def iter_table(table_dict, attributes=None):
+    """Takes in a dictionary representation of a table and yields the table
+        in the form of html a piece at a time, so a table can be written out
+        without holding all of its rows in memory
 
         table_dict - a dictionary with the following arguments:
             'cols'- a list of dictionaries that defines the column
@@ -25,9 +40,10 @@ def generate_table(table_dict, attributes=None):
                             table data tag under the column will have a class
                             attribute assigned to 'td_class' value (optional)
 
-            'rows' - a list of dictionaries that represent the rows. Each
-                dictionaries keys should match the column names found in
-                'cols' (possibly empty list) (required) Example:
+            'rows' - a list or any other iterable of dictionaries that
+                represent the rows, for example a generator reading them from
+                a file. Each dictionaries keys should match the column names
+                found in 'cols' (possibly empty) (required) Example:
                 [{col_name_1: value, col_name_2: value, ...},
                  {col_name_1: value, col_name_2: value, ...},
                  ...]
@@ -50,17 +66,17 @@ def generate_table(table_dict, attributes=None):
                     (optional)
                     Example: {'class': 'sorttable', 'id': 'parcel_table'}
 
-            returns - a string representing an html table
+            returns - a generator of strings representing an html table: the
+                table header and footer followed by one string for each row
     """
 
-    LOGGER.info('Generating HTML Table String')
-
     def u(string):
         if type(string) is StringType:
             return unicode(string, 'utf-8')
         return string
 
-    # Initialize the string that will store the html representation of the table
+    # Initialize the string that will store the html representation of the
+    # table up to its body
     table_string = u('')
 
     if 'attributes' in table_dict:
@@ -80,14 +96,12 @@ def generate_table(table_dict, attributes=None):
             # If user specified checkbox position, update here
             checkbox_pos = table_dict['checkbox_pos']
 
-        # Get a copy of the column and row lists of dictionaries
-        # to pass into checkbox function
+        # Get a copy of the column list of dictionaries to pass into
+        # checkbox function. The rows get their checkbox value as they are
+        # read so that they never all have to be in memory at once
         cols_copy = list(table_dict['cols'])
-        rows_copy = list(table_dict['rows'])
-        # Get the updated column and row data after adding a
-        # checkbox column
-        table_cols, table_rows = add_checkbox_column(
-            cols_copy, rows_copy, checkbox_pos)
+        table_cols, _ = add_checkbox_column(cols_copy, [], checkbox_pos)
+        table_rows = iter_checkbox_rows(table_dict['rows'])
         add_checkbox_total = True
     else:
         # The column and row lists of dictionaries need to update,
@@ -164,8 +178,8 @@ def generate_table(table_dict, attributes=None):
     # Add the closing tag for the table header
     table_string += '</tr></thead>'
 
-    # Get the row data as 2D list
-    row_data = get_row_data(table_rows, col_headers)
+    # Get the row data as a generator of lists
+    row_data = iter_row_data(table_rows, col_headers)
 
     footer_string = ''
 
@@ -181,13 +195,15 @@ def generate_table(table_dict, attributes=None):
     if not footer_string == '':
         table_string += '<tfoot>%s</tfoot>' % u(footer_string)
 
-    # Add the start tag for the table body
+    # Add the start tag for the table body and hand off everything before the
+    # rows
     table_string += '<tbody>'
+    yield table_string
 
     LOGGER.debug('Construct html string for table body')
-    # For each data row add a row in the html table and fill in the data
+    # For each data row yield a row in the html table with the data filled in
     for row in row_data:
-        table_string += '<tr>'
+        row_string_list = ['<tr>']
         # Iterate over each row data, where the index indicates the column
         # index as well
         for row_index in range(len(row)):
@@ -196,22 +212,21 @@ def generate_table(table_dict, attributes=None):
                 if tdata_tuples[row_index][0]:
                     class_str += u(tdata_tuples[row_index][1])
                 # Add row data
-                table_string += ('<td class="%s">%s</td>' %
+                row_string_list.append('<td class="%s">%s</td>' %
                                     (class_str, row[row_index]))
             else:
                 if tdata_tuples[row_index][0]:
                     class_str = tdata_tuples[row_index][1]
-                    table_string += ('<td class="%s">%s</td>' %
+                    row_string_list.append('<td class="%s">%s</td>' %
                                         (u(class_str), u(row[row_index])))
                 else:
-                    table_string += '<td>%s</td>' % u(row[row_index])
+                    row_string_list.append('<td>%s</td>' % u(row[row_index]))
 
-        table_string += '</tr>'
+        row_string_list.append('</tr>')
+        yield u('').join(row_string_list)
 
     # Add the closing tag for the table body and table
-    table_string += '</tbody></table>'
-
-    return table_string
+    yield u('</tbody></table>')
 
 def add_totals_row(col_headers, total_list, total_name, checkbox_total,
                     tdata_tuples):
@@ -347,12 +362,25 @@ def add_checkbox_column(col_list, row_list, checkbox_pos=1):
     # For each dictionary in the row list add a 'Select' key which
     # refers to the new column and set the value as a checkbox
     for val in row_list:
-        val['Select'] = '<input type=checkbox name=cb value=1>'
+        val['Select'] = CHECKBOX_INPUT
 
     # Return a tuple of the updated / modified column and row list of
     # dictionaries
     return (col_list, row_list)
 
+def iter_checkbox_rows(row_iter):
+    """Add the checkbox column value to each row dictionary as it is read,
+        see add_checkbox_column
+
+        row_iter - an iterable of dictionaries that represent the rows
+            (required)
+
+        returns - a generator of the updated row dictionaries"""
+
+    for val in row_iter:
+        val['Select'] = CHECKBOX_INPUT
+        yield val
+
 def get_row_data(row_list, col_headers):
     """Construct the rows in a 2D List from the list of dictionaries,
         using col_headers to properly order the row data.
@@ -373,16 +401,24 @@ def get_row_data(row_list, col_headers):
 
         return - a 2D list with each inner list representing a row"""
     LOGGER.debug('Compile and return row data as a 2D list')
-    # Initialize a list to hold output rows represented as lists
-    row_data = []
+    return list(iter_row_data(row_list, col_headers))
+
+def iter_row_data(row_iter, col_headers):
+    """Generate the rows as lists from an iterable of dictionaries, using
+        col_headers to properly order the row data. See get_row_data.
 
-    # Iterate over each dictionary in the row_list and append the values to a
-    # list in the order the keys are found in 'col_headers'. Add each generated
-    # list to 'row_data'
-    for row_dict in row_list:
+        row_iter - an iterable of dictionaries that represent the rows. Each
+            dictionaries keys should match the column names found in
+            'col_headers' (required)
+
+        col_headers - a List of the names of the column headers in order
+
+        return - a generator of lists, each list representing a row"""
+
+    # Iterate over each dictionary in row_iter and yield the values as a
+    # list in the order the keys are found in 'col_headers'
+    for row_dict in row_iter:
         row = []
         for col in col_headers:
             row.append(row_dict[col])
-        row_data.append(row)
-
-    return row_data
+        yield row
@@ -0,0 +1,240 @@
+"""Batch runner that evaluates many LULC scenarios against one set of static
+inputs for the SDR, NDR and annual water yield models.  The LULC independent
+preparation (alignment, slope, flow direction, flow accumulation and LS) is
+done once and each scenario then only runs its LULC dependent stages, in
+parallel worker processes, before the per-watershed results of every scenario
+are collected into one table."""
+
+import os
+import csv
+import logging
+import multiprocessing
+import traceback
+
+from osgeo import gdal
+from osgeo import ogr
+
+import pygeoprocessing.geoprocessing
+
+LOGGER = logging.getLogger('invest_natcap.scenario_batch')
+
+#model name -> (module, watershed results shapefile basename).  The module
+#is imported lazily so a batch of one model doesn't need the others' cython
+#extensions.
+MODEL_TABLE = {
+    'sdr': ('invest_natcap.sdr.sdr', 'watershed_results_sdr.shp'),
+    'ndr': ('invest_natcap.ndr.ndr', 'watershed_results_ndr.shp'),
+    'hydropower_water_yield': (
+        'invest_natcap.hydropower.hydropower_water_yield',
+        'watershed_results_wyield.shp'),
+}
+
+#The key field every model's watershed results are reported by
+WATERSHED_ID_FIELD = 'ws_id'
+
+
+def execute(args):
+    """Runs one of the watershed models once per LULC scenario.
+
+        args - a python dictionary with the same entries the chosen model's
+            execute takes, except 'lulc_uri' and 'results_suffix', plus:
+        args['model_name'] - one of 'sdr', 'ndr' or 'hydropower_water_yield'
+        args['workspace_dir'] - a uri to the directory that will hold the
+            shared prepared data, one workspace per scenario and the
+            consolidated results table. (required)
+        args['lulc_uri_list'] - a list of uris to the scenario LULC rasters
+            (required if 'lulc_dir' is not given)
+        args['lulc_dir'] - a uri to a directory whose GDAL readable rasters
+            are each a scenario LULC (required if 'lulc_uri_list' is not
+            given)
+        args['n_workers'] - (optional) the number of worker processes,
+            defaults to the number of CPUs.  1 runs the scenarios in this
+            process.
+
+        Scenarios that raise an exception or have no watersheds in their
+        results are logged and left out of the results table rather than
+        stopping the batch.
+
+        returns a uri to the consolidated results csv, which has one row per
+            scenario and watershed."""
+
+    model_name = args['model_name']
+    if model_name not in MODEL_TABLE:
+        raise ValueError(
+            'Unknown model %s, expected one of %s' % (
+                model_name, sorted(MODEL_TABLE.keys())))
+    model_module = _import_model(model_name)
+
+    if 'lulc_uri_list' in args:
+        lulc_uri_list = list(args['lulc_uri_list'])
+    else:
+        lulc_uri_list = list_rasters(args['lulc_dir'])
+    if len(lulc_uri_list) == 0:
+        raise ValueError('No scenario LULC rasters were given')
+
+    workspace_dir = args['workspace_dir']
+    pygeoprocessing.geoprocessing.create_directories([workspace_dir])
+
+    model_args = args.copy()
+    for key in ['model_name', 'lulc_uri_list', 'lulc_dir', 'n_workers']:
+        model_args.pop(key, None)
+    model_args['results_suffix'] = ''
+
+    #hydropower has no LULC independent stage to share
+    if hasattr(model_module, '_prepare') and '_prepare' not in model_args:
+        LOGGER.info('Preparing the static %s inputs', model_name)
+        prepare_args = model_args.copy()
+        prepare_args['workspace_dir'] = os.path.join(workspace_dir, 'shared')
+        model_args['_prepare'] = model_module._prepare(**prepare_args)
+
+    scenario_list = []
+    for scenario_name, lulc_uri in zip(
+            scenario_names(lulc_uri_list), lulc_uri_list):
+        scenario_args = model_args.copy()
+        scenario_args['lulc_uri'] = lulc_uri
+        scenario_args['workspace_dir'] = os.path.join(
+            workspace_dir, 'scenarios', scenario_name)
+        scenario_list.append((model_name, scenario_name, scenario_args))
+
+    n_workers = int(args.get('n_workers', multiprocessing.cpu_count()))
+    LOGGER.info(
+        'Running %d %s scenarios on %d workers', len(scenario_list),
+        model_name, n_workers)
+    if n_workers > 1:
+        worker_pool = multiprocessing.Pool(n_workers)
+        result_iterator = worker_pool.imap(_run_scenario, scenario_list)
+    else:
+        worker_pool = None
+        result_iterator = (
+            _run_scenario(scenario) for scenario in scenario_list)
+
+    results_table_uri = os.path.join(workspace_dir, 'batch_results.csv')
+    field_list = None
+    results_table_file = open(results_table_uri, 'wb')
+    results_writer = csv.writer(results_table_file)
+    failed_scenario_list = []
+    for scenario_index, (scenario_name, watershed_results, error) in (
+            enumerate(result_iterator)):
+        LOGGER.info(
+            'Finished scenario %s (%d of %d)', scenario_name,
+            scenario_index + 1, len(scenario_list))
+        if error is not None:
+            LOGGER.error('Scenario %s failed:\n%s', scenario_name, error)
+            failed_scenario_list.append(scenario_name)
+            continue
+        if len(watershed_results) == 0:
+            LOGGER.warn('Scenario %s has no watershed results', scenario_name)
+            continue
+        if field_list is None:
+            field_list = sorted(
+                watershed_results.itervalues().next().keys())
+            results_writer.writerow(
+                ['scenario', WATERSHED_ID_FIELD] + field_list)
+        for ws_id in sorted(watershed_results):
+            results_writer.writerow(
+                [scenario_name, ws_id] +
+                [watershed_results[ws_id].get(field) for field in field_list])
+        results_table_file.flush()
+    if field_list is None:
+        #no scenario had any results, leave a table with just the header
+        results_writer.writerow(['scenario', WATERSHED_ID_FIELD])
+    results_table_file.close()
+
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+
+    if len(failed_scenario_list) > 0:
+        LOGGER.warn(
+            '%d scenarios failed: %s', len(failed_scenario_list),
+            ', '.join(failed_scenario_list))
+    return results_table_uri
+
+
+def list_rasters(directory_uri):
+    """Returns a sorted list of uris to the GDAL readable rasters directly
+        inside `directory_uri`."""
+    raster_uri_list = []
+    gdal.PushErrorHandler('CPLQuietErrorHandler')
+    try:
+        for filename in sorted(os.listdir(directory_uri)):
+            uri = os.path.join(directory_uri, filename)
+            if filename.endswith('.aux.xml'):
+                continue
+            dataset = gdal.Open(uri)
+            if dataset is not None and dataset.RasterCount > 0:
+                raster_uri_list.append(uri)
+            dataset = None
+    finally:
+        gdal.PopErrorHandler()
+    return raster_uri_list
+
+
+def scenario_names(lulc_uri_list):
+    """Returns a list of unique scenario names, one per uri in
+        `lulc_uri_list`, made from the raster basenames."""
+    name_list = []
+    for lulc_uri in lulc_uri_list:
+        base_name = os.path.splitext(
+            os.path.basename(os.path.normpath(lulc_uri)))[0]
+        name = base_name
+        duplicate_index = 1
+        while name in name_list:
+            name = '%s_%d' % (base_name, duplicate_index)
+            duplicate_index += 1
+        name_list.append(name)
+    return name_list
+
+
+def _import_model(model_name):
+    """Imports and returns the module of `model_name` in MODEL_TABLE."""
+    module_name = MODEL_TABLE[model_name][0]
+    return __import__(module_name, fromlist=[module_name.split('.')[-1]])
+
+
+def _run_scenario(scenario):
+    """Worker function that runs a model on one scenario.
+
+        scenario - a (model name, scenario name, args dictionary) tuple
+
+        returns a (scenario name, watershed results, error) tuple where
+            watershed results is a dictionary mapping ws_id to a dictionary
+            of the numeric fields of the model's watershed results shapefile
+            and error is None or the traceback of a failed run"""
+    model_name, scenario_name, scenario_args = scenario
+    try:
+        _import_model(model_name).execute(scenario_args)
+        results_uri = os.path.join(
+            scenario_args['workspace_dir'], 'output',
+            MODEL_TABLE[model_name][1])
+        return scenario_name, read_watershed_results(results_uri), None
+    except Exception:
+        return scenario_name, None, traceback.format_exc()
+
+
+def read_watershed_results(results_uri):
+    """Reads the numeric fields of a watershed results shapefile.
+
+        results_uri - a uri to a shapefile with a WATERSHED_ID_FIELD field
+
+        returns a dictionary mapping each watershed id to a dictionary of
+            field name to value"""
+    numeric_types = [ogr.OFTInteger, ogr.OFTReal]
+    datasource = ogr.Open(results_uri)
+    layer = datasource.GetLayer()
+    layer_defn = layer.GetLayerDefn()
+    field_name_list = [
+        layer_defn.GetFieldDefn(field_index).GetNameRef()
+        for field_index in xrange(layer_defn.GetFieldCount())
+        if layer_defn.GetFieldDefn(field_index).GetType() in numeric_types]
+
+    watershed_results = {}
+    for feature in layer:
+        ws_id = feature.GetFieldAsInteger(WATERSHED_ID_FIELD)
+        watershed_results[ws_id] = dict(
+            [(field_name, feature.GetField(field_name))
+             for field_name in field_name_list
+             if field_name != WATERSHED_ID_FIELD])
+    layer = None
+    datasource = None
+    return watershed_results
@@ -1,10 +1,22 @@
 import tempfile
-import struct
-import heapq
+import itertools
 
 from osgeo import gdal
 import numpy
 
+#The number of pixels sorted in memory into one run on disk
+RUN_PIXELS = 2**22
+
+#The number of bytes of the runs that are buffered in memory while merging
+MERGE_BUFFER_BYTES = 2**27
+
+#The smallest number of keys read from a run at once while merging
+MIN_RUN_READ_SIZE = 2**12
+
+#Rasters with at least this many pixels don't fit their flat index in the
+#low word of a packed uint64 key
+MAX_PACKED_PIXELS = 2**32
+
 
 def sort_to_disk(dataset_uri, dataset_index):
     """Sorts the non-nodata pixels in the dataset on disk and returns
@@ -18,13 +30,26 @@ def sort_to_disk(dataset_uri, dataset_index):
         returns an iterable that returns (-value, flat_index, dataset_index)
            in decreasing sorted order by -value"""
 
-    def _read_score_index_from_disk(f):
-        while True:
-            #TODO: better buffering here
-            packed_score = f.read(8)
-            if not packed_score:
-                break
-            yield struct.unpack('fi', packed_score) + (dataset_index,)
+    return (
+        (score, flat_index, dataset_index)
+        for scores, flat_indexes in sort_to_disk_blocks(dataset_uri)
+        for score, flat_index in itertools.izip(
+            scores.tolist(), flat_indexes.tolist()))
+
+
+def sort_to_disk_blocks(dataset_uri):
+    """Sorts the non-nodata pixels in the dataset on disk and returns
+        an iterable of blocks in sorted order.  The raster is read in
+        stripes that are sorted in memory and written to disk as runs, which
+        are then merged a buffer at a time.  Keys are packed into one uint64
+        per pixel unless the raster has MAX_PACKED_PIXELS pixels or more, in
+        which case the score and the flat index each get their own uint64.
+
+        dataset_uri - a uri to a GDAL dataset
+
+        returns an iterable that returns (-values, flat_indexes) numpy array
+           pairs whose concatenation is in increasing sorted order by
+           -value, then flat index"""
 
     dataset = gdal.Open(dataset_uri)
     band = dataset.GetRasterBand(1)
@@ -32,13 +57,14 @@ def sort_to_disk(dataset_uri, dataset_index):
 
     n_rows = band.YSize
     n_cols = band.XSize
+    wide_keys = n_rows * n_cols >= MAX_PACKED_PIXELS
+
+    #This will be a list of files with a sorted run in each
+    run_files = []
 
-    #This will be a list of file iterators we'll pass to heap.merge
-    iters = []
+    #Set the row strides so a stripe is about RUN_PIXELS pixels
+    row_strides = max(RUN_PIXELS / n_cols, 1)
 
-    #Set the row strides to be something reasonable, like 1MB blocks
-    row_strides = max(int(2**20 / (4 * n_cols)), 1)
-    
     for row_index in xrange(0, n_rows, row_strides):
 
         #It's possible we're on the last set of rows and the stride is too big
@@ -46,36 +72,139 @@ def sort_to_disk(dataset_uri, dataset_index):
         if row_index + row_strides >= n_rows:
             row_strides = n_rows - row_index
 
-        #Extract scores make them negative, calculate flat indexes, and sort
-        scores = -band.ReadAsArray(0,row_index,n_cols,row_strides).flatten()
-
-        col_indexes = numpy.tile(numpy.arange(n_cols), (row_strides, 1))
-        row_offsets = numpy.arange(row_index, row_index+row_strides) * n_cols
-        row_offsets.resize((row_strides, 1))
-
-        flat_indexes = (col_indexes + row_offsets).flatten()
-
-        sort_index = scores.argsort()
-        sorted_scores = scores[sort_index]
-        sorted_indexes = flat_indexes[sort_index]
-
-        #Determine where the nodata values are so we can splice them out
-        left_index = numpy.searchsorted(sorted_scores,-nodata,side='left')
-        right_index = numpy.searchsorted(sorted_scores,-nodata,side='right')
-
-        #Splice out the nodata values and order the array in descreasing order
-        sorted_scores = numpy.concatenate(
-            (sorted_scores[0:left_index], sorted_scores[right_index::]))
-        sorted_indexes = numpy.concatenate(
-            (sorted_indexes[0:left_index], sorted_indexes[right_index::]))
-        
-        #Dump all the scores and indexes to disk
-        f = tempfile.TemporaryFile()
-        for score, index in zip(sorted_scores, sorted_indexes):
-            f.write(struct.pack('fi', score, index))
-
-        #Reset the file pointer and add an iterator for it to the list
-        f.seek(0)
-        iters.append(_read_score_index_from_disk(f))
-
-    return heapq.merge(*iters)
+        #Extract scores make them negative and calculate flat indexes
+        scores = -band.ReadAsArray(
+            0, row_index, n_cols, row_strides).astype(numpy.float32).ravel()
+        flat_indexes = numpy.arange(
+            row_index * n_cols, (row_index + row_strides) * n_cols,
+            dtype=numpy.uint64)
+
+        #Splice out the nodata values
+        if nodata is not None:
+            valid_mask = scores != numpy.float32(-nodata)
+            scores = scores[valid_mask]
+            flat_indexes = flat_indexes[valid_mask]
+
+        #Dump the sorted keys to disk and reset the file pointer for merging
+        run_file = tempfile.TemporaryFile()
+        _sort_keys(_encode_keys(scores, flat_indexes, wide_keys)).tofile(
+            run_file)
+        run_file.seek(0)
+        run_files.append(run_file)
+
+    band = None
+    dataset = None
+
+    return itertools.imap(_decode_keys, _merge_runs(run_files, wide_keys))
+
+
+def _encode_keys(scores, flat_indexes, wide_keys=False):
+    """Packs float32 scores and flat indexes into uint64 keys that sort in
+        the same order as (score, flat_index) tuples.  The score's bits are
+        flipped so they order as unsigned ints and go in the high word.
+
+        If wide_keys is True the keys are an (n, 2) array of the flipped
+        score bits and the flat indexes instead, for flat indexes that don't
+        fit in 32 bits."""
+    #adding 0.0 turns -0.0 into 0.0 so the two zeros sort as equal
+    bits = (scores + numpy.float32(0.0)).view(numpy.uint32)
+    negative = (bits & numpy.uint32(0x80000000)) != 0
+    ordered_bits = numpy.where(
+        negative, ~bits, bits | numpy.uint32(0x80000000))
+    if wide_keys:
+        return numpy.column_stack((
+            ordered_bits.astype(numpy.uint64),
+            flat_indexes.astype(numpy.uint64)))
+    return (
+        (ordered_bits.astype(numpy.uint64) << numpy.uint64(32)) |
+        flat_indexes.astype(numpy.uint64))
+
+
+def _decode_keys(keys):
+    """Inverse of _encode_keys, returns a (scores, flat_indexes) tuple."""
+    if keys.ndim == 2:
+        ordered_bits = keys[:, 0].astype(numpy.uint32)
+        flat_indexes = keys[:, 1].astype(numpy.int64)
+    else:
+        ordered_bits = (keys >> numpy.uint64(32)).astype(numpy.uint32)
+        flat_indexes = (keys & numpy.uint64(0xffffffff)).astype(numpy.int64)
+    negative = (ordered_bits & numpy.uint32(0x80000000)) == 0
+    bits = numpy.where(
+        negative, ~ordered_bits, ordered_bits & numpy.uint32(0x7fffffff))
+    return bits.view(numpy.float32), flat_indexes
+
+
+def _sort_keys(keys):
+    """Sorts packed keys, or the rows of wide keys by their first then
+        second column."""
+    if keys.ndim == 2:
+        return keys[numpy.lexsort((keys[:, 1], keys[:, 0]))]
+    return numpy.sort(keys)
+
+
+def _split_index(keys, threshold):
+    """Returns the number of sorted keys that are no bigger than threshold,
+        a key of the same kind as the rows of keys."""
+    if keys.ndim == 2:
+        #the keys with the same score as threshold are ordered by flat index
+        start_index, end_index = numpy.searchsorted(
+            keys[:, 0], threshold[0], side='left'), numpy.searchsorted(
+                keys[:, 0], threshold[0], side='right')
+        return start_index + numpy.searchsorted(
+            keys[start_index:end_index, 1], threshold[1], side='right')
+    return numpy.searchsorted(keys, threshold, side='right')
+
+
+def _read_keys(run_file, read_size, wide_keys):
+    """Reads up to read_size keys from run_file."""
+    if wide_keys:
+        return numpy.fromfile(
+            run_file, dtype=numpy.uint64, count=2 * read_size).reshape(
+                (-1, 2))
+    return numpy.fromfile(run_file, dtype=numpy.uint64, count=read_size)
+
+
+def _merge_runs(run_files, wide_keys=False):
+    """Merges the sorted uint64 keys in `run_files` a block at a time.
+
+        Each run is read a buffer at a time.  Every key no bigger than the
+        smallest last key of the buffers can't be preceded by a key that
+        hasn't been read yet, so those keys are emitted as one sorted block
+        and the buffers that emptied are refilled.
+
+        returns an iterable of sorted uint64 arrays, (n, 2) arrays if
+            wide_keys is True"""
+
+    if len(run_files) == 0:
+        return
+    key_bytes = 16 if wide_keys else 8
+    read_size = max(
+        MERGE_BUFFER_BYTES / (key_bytes * len(run_files)), MIN_RUN_READ_SIZE)
+    buffers = [
+        _read_keys(run_file, read_size, wide_keys) for run_file in run_files]
+
+    while True:
+        active_runs = [
+            run_index for run_index, run_buffer in enumerate(buffers)
+            if run_buffer.size > 0]
+        if len(active_runs) == 0:
+            break
+        if wide_keys:
+            threshold = min([
+                tuple(buffers[run_index][-1]) for run_index in active_runs])
+        else:
+            threshold = min([
+                buffers[run_index][-1] for run_index in active_runs])
+
+        block_list = []
+        for run_index in active_runs:
+            split_index = _split_index(buffers[run_index], threshold)
+            block_list.append(buffers[run_index][:split_index])
+            buffers[run_index] = buffers[run_index][split_index:]
+            if buffers[run_index].size == 0:
+                buffers[run_index] = _read_keys(
+                    run_files[run_index], read_size, wide_keys)
+        yield _sort_keys(numpy.concatenate(block_list))
+
+    for run_file in run_files:
+        run_file.close()
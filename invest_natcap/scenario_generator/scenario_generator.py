@@ -12,6 +12,8 @@ from fractions import Fraction
 import numpy
 from scipy.linalg import eig
 import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 import cProfile
 import pstats
 
@@ -26,6 +28,9 @@ logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 
 LOGGER = logging.getLogger('invest_natcap.scenario_generator.scenario_generator')
 
+#The number of pixels read from a raster at once while allocating pixels
+ALLOCATION_BLOCK_PIXELS = 2**20
+
 
 def calculate_weights(arr, rounding=4):
 
@@ -451,6 +456,383 @@ def filter_fragments(input_uri, size, output_uri):
 
     dst_band.WriteArray(dst_array)
 
+def suitability_level_order(suitability_uri, order_uri):
+    """Groups the flat indexes of the pixels of a suitability raster by
+        suitability level with two passes over the raster a strip at a time.
+
+    :param suitability_uri: The uri for a suitability raster, 0 is unsuitable.
+    :type suitability_uri: str
+    :param order_uri: The uri for a file to memory map the grouped indexes to.
+    :type order_uri: str
+
+    :return: A tuple (level_list, level_offsets, order) where level_list is
+        the suitability levels other than 0 in decreasing order, order is a
+        memory mapped int64 array, and the flat indexes of the pixels at
+        level_list[i] are order[level_offsets[i]:level_offsets[i+1]] in
+        increasing order.
+    :rtype: tuple
+    """
+    dataset = gdal.Open(suitability_uri)
+    band = dataset.GetRasterBand(1)
+    n_rows = band.YSize
+    n_cols = band.XSize
+    strip_rows = max(1, ALLOCATION_BLOCK_PIXELS / n_cols)
+
+    #count the pixels at each level
+    level_counts = {}
+    for row_index in xrange(0, n_rows, strip_rows):
+        strip_array = band.ReadAsArray(
+            0, row_index, n_cols, min(strip_rows, n_rows - row_index)).ravel()
+        values, value_inverse = numpy.unique(strip_array, return_inverse=True)
+        for value, value_count in zip(
+                values.tolist(), numpy.bincount(value_inverse).tolist()):
+            level_counts[value] = level_counts.get(value, 0) + value_count
+    level_counts.pop(0, None)
+    level_list = sorted(level_counts, reverse=True)
+    level_offsets = numpy.cumsum(
+        [0] + [level_counts[level] for level in level_list])
+    level_index_dict = dict(
+        [(level, level_index) for level_index, level in enumerate(level_list)])
+
+    #fill each level's slice of the order in increasing flat index
+    order = numpy.memmap(
+        order_uri, dtype=numpy.int64, mode='w+',
+        shape=(max(level_offsets[-1], 1),))
+    fill_offsets = level_offsets[:-1].copy()
+    for row_index in xrange(0, n_rows, strip_rows):
+        strip_array = band.ReadAsArray(
+            0, row_index, n_cols, min(strip_rows, n_rows - row_index)).ravel()
+        flat_indexes = numpy.flatnonzero(strip_array != 0)
+        if flat_indexes.size == 0:
+            continue
+        values = strip_array[flat_indexes]
+        sort_index = numpy.argsort(-values, kind='mergesort')
+        values = values[sort_index]
+        flat_indexes = flat_indexes[sort_index] + row_index * n_cols
+        group_starts = numpy.concatenate(
+            [[0], numpy.flatnonzero(values[1:] != values[:-1]) + 1,
+             [values.size]])
+        for group_start, group_end in zip(group_starts[:-1], group_starts[1:]):
+            level_index = level_index_dict[values[group_start]]
+            fill_offset = fill_offsets[level_index]
+            order[fill_offset:fill_offset + group_end - group_start] = (
+                flat_indexes[group_start:group_end])
+            fill_offsets[level_index] += group_end - group_start
+
+    return level_list, level_offsets, order
+
+
+def _strip_patch_labels(level_indexes, conversion_array, strip_starts,
+                        row_end, strip_rows):
+    """Labels the patches of the pixels of a suitability level that haven't
+        been converted, a strip of rows at a time.
+
+    :param level_indexes: The flat indexes of the level's pixels in
+        increasing order.
+    :type level_indexes: numpy.ndarray
+    :param conversion_array: The mask of converted pixels, 0 where a pixel
+        hasn't been converted.
+    :type conversion_array: numpy.ndarray
+    :param strip_starts: The first row of each strip to label.
+    :type strip_starts: list
+    :param row_end: The row after the last one of the level.
+    :type row_end: int
+    :param strip_rows: The number of rows in a strip.
+    :type strip_rows: int
+
+    :return: An iterator of (row_index, strip_labels, n_labels) tuples where
+        strip_labels is the scipy.ndimage.label of the strip at row_index.
+    :rtype: iterator
+    """
+    n_cols = conversion_array.shape[1]
+    for row_index in strip_starts:
+        n_strip_rows = min(strip_rows, row_end - row_index)
+        index_range = numpy.searchsorted(
+            level_indexes,
+            [row_index * n_cols, (row_index + n_strip_rows) * n_cols])
+        mask = numpy.zeros((n_strip_rows, n_cols), dtype=numpy.bool)
+        mask.flat[numpy.array(
+            level_indexes[index_range[0]:index_range[1]]) -
+                  row_index * n_cols] = True
+        mask &= conversion_array[row_index:row_index + n_strip_rows] == 0
+        strip_labels, n_labels = scipy.ndimage.label(mask)
+        yield row_index, strip_labels, n_labels
+
+
+def _level_patches(level_indexes, conversion_array, strip_rows):
+    """Finds the patches of the pixels of a suitability level that haven't
+        been converted.  Each strip of rows is labelled on its own and the
+        labels that touch across a strip edge are joined into one patch.
+
+    :param level_indexes: The flat indexes of the level's pixels in
+        increasing order.
+    :type level_indexes: numpy.ndarray
+    :param conversion_array: The mask of converted pixels, 0 where a pixel
+        hasn't been converted.
+    :type conversion_array: numpy.ndarray
+    :param strip_rows: The number of rows in a strip.
+    :type strip_rows: int
+
+    :return: A tuple (strip_starts, row_end, label_offsets,
+        strip_label_patches, patch_sizes, patch_bboxes).  The patch of label
+        l of the strip at row_index is
+        strip_label_patches[label_offsets[row_index] + l - 1].  Patches are
+        numbered in the row major order of their first pixel, the same order
+        scipy.ndimage.label numbers them in on the whole raster.
+        patch_bboxes is an array of the first row, last row + 1, first
+        column and last column + 1 of each patch.
+    :rtype: tuple
+    """
+    n_cols = conversion_array.shape[1]
+    row_start = int(level_indexes[0] / n_cols)
+    row_end = int(level_indexes[-1] / n_cols) + 1
+    strip_starts = range(row_start, row_end, strip_rows)
+
+    label_offsets = {}
+    size_list = []
+    bbox_list = []
+    edge_list = []
+    n_strip_labels = 0
+    previous_edge = None
+    for row_index, strip_labels, n_labels in _strip_patch_labels(
+            level_indexes, conversion_array, strip_starts, row_end,
+            strip_rows):
+        label_offsets[row_index] = n_strip_labels
+        size_list.append(numpy.bincount(
+            strip_labels.ravel(), minlength=n_labels + 1)[1:])
+        strip_bboxes = numpy.array([
+            (location[0].start, location[0].stop, location[1].start,
+             location[1].stop) for location in
+            scipy.ndimage.find_objects(strip_labels, n_labels)],
+            dtype=numpy.int64).reshape((-1, 4))
+        strip_bboxes[:, :2] += row_index
+        bbox_list.append(strip_bboxes)
+
+        #labels above and below a strip edge are the same patch
+        if previous_edge is not None:
+            touching = (previous_edge > 0) & (strip_labels[0] > 0)
+            edge_list.append((
+                previous_edge[touching] - 1,
+                strip_labels[0][touching] + n_strip_labels - 1))
+        previous_edge = numpy.where(
+            strip_labels[-1] > 0, strip_labels[-1] + n_strip_labels, 0)
+        n_strip_labels += n_labels
+
+    if n_strip_labels == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (strip_starts, row_end, label_offsets, empty, empty,
+                numpy.zeros((0, 4), dtype=numpy.int64))
+
+    edge_from = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int64)] + [edge[0] for edge in edge_list])
+    edge_to = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int64)] + [edge[1] for edge in edge_list])
+    label_graph = scipy.sparse.coo_matrix(
+        (numpy.ones(edge_from.size), (edge_from, edge_to)),
+        shape=(n_strip_labels, n_strip_labels))
+    n_patches, strip_label_components = (
+        scipy.sparse.csgraph.connected_components(
+            label_graph, directed=False))
+
+    #labels are numbered by strip, then by first pixel, so the first label
+    #of a patch holds its first pixel
+    _, first_labels = numpy.unique(strip_label_components, return_index=True)
+    component_patches = numpy.empty(n_patches, dtype=numpy.int64)
+    component_patches[numpy.argsort(first_labels)] = numpy.arange(n_patches)
+    strip_label_patches = component_patches[strip_label_components]
+
+    patch_sizes = numpy.bincount(
+        strip_label_patches, weights=numpy.concatenate(size_list),
+        minlength=n_patches).astype(numpy.int64)
+    label_order = numpy.argsort(strip_label_patches, kind='mergesort')
+    patch_starts = numpy.searchsorted(
+        strip_label_patches[label_order], numpy.arange(n_patches))
+    strip_bboxes = numpy.concatenate(bbox_list)[label_order]
+    patch_bboxes = numpy.column_stack((
+        numpy.minimum.reduceat(strip_bboxes[:, 0], patch_starts),
+        numpy.maximum.reduceat(strip_bboxes[:, 1], patch_starts),
+        numpy.minimum.reduceat(strip_bboxes[:, 2], patch_starts),
+        numpy.maximum.reduceat(strip_bboxes[:, 3], patch_starts)))
+
+    return (strip_starts, row_end, label_offsets, strip_label_patches,
+            patch_sizes, patch_bboxes)
+
+
+def allocate_pixels(scenario_uri, change_list, suitability_dict):
+    """Converts pixels of the scenario raster to the covers in change_list
+        in order.  The pixels of each suitability level are converted a patch
+        at a time in random order, and a patch that would overshoot the count
+        is converted from its interior out.  A single mask of converted
+        pixels keeps later covers from converting them again.
+
+        The rasters, the mask and the patch labels are only held a strip of
+        ALLOCATION_BLOCK_PIXELS pixels at a time, and the mask is memory
+        mapped.  On top of that memory grows with a few integers per patch
+        of the level being converted, and with the bounding box of the one
+        patch per cover that is converted from its interior out.
+
+    :param scenario_uri: The uri for the scenario raster, updated in place.
+    :type scenario_uri: str
+    :param change_list: A list of (priority, cover_id, count) tuples in the
+        order to convert them.
+    :type change_list: list
+    :param suitability_dict: A dictionary of the uri for the suitability
+        raster of each cover_id.
+    :type suitability_dict: dict
+
+    :return: A dictionary of the number of pixels that couldn't be converted
+        for each cover_id that ran out of suitable pixels.
+    :rtype: dict
+    """
+    scenario_ds = gdal.Open(scenario_uri, 1)
+    scenario_band = scenario_ds.GetRasterBand(1)
+    n_rows = scenario_band.YSize
+    n_cols = scenario_band.XSize
+    strip_rows = max(1, ALLOCATION_BLOCK_PIXELS / n_cols)
+
+    #0 for pixels that haven't been converted, otherwise 1 + the index in
+    #change_list of the cover they were converted to
+    conversion_dtype = numpy.uint8
+    if len(change_list) >= 2**8:
+        conversion_dtype = numpy.uint16
+    conversion_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    conversion_array = numpy.memmap(
+        conversion_uri, dtype=conversion_dtype, mode='w+',
+        shape=(n_rows, n_cols))
+
+    unconverted_pixels = {}
+    for index, (priority, cover_id, count) in enumerate(change_list):
+        LOGGER.debug("Increasing cover %i by %i pixels.", cover_id, count)
+
+        order_uri = pygeoprocessing.geoprocessing.temporary_filename()
+        level_list, level_offsets, order = suitability_level_order(
+            suitability_dict[cover_id], order_uri)
+
+        pixels_changed = 0
+        for level_index, suitability_score in enumerate(level_list):
+            # Check if suitsbility is between 0 and 100 inclusive
+            assert abs(suitability_score - 50) <= 50, \
+                'Invalid suitability score ' + str(suitability_score)
+            if pixels_changed == count:
+                LOGGER.debug("All necessay pixels converted.")
+                break
+
+            #label the patches of the pixels at this level that a higher
+            #priority cover hasn't converted
+            level_indexes = order[
+                level_offsets[level_index]:level_offsets[level_index+1]]
+            (strip_starts, row_end, label_offsets, strip_label_patches,
+             patch_sizes, patch_bboxes) = _level_patches(
+                 level_indexes, conversion_array, strip_rows)
+            if patch_sizes.size == 0:
+                continue
+
+            LOGGER.debug("Checking pixels with suitability of %i.", suitability_score)
+
+            #randomize patch order
+            patch_labels = numpy.array(range(1, patch_sizes.size + 1))
+            numpy.random.shuffle(patch_labels)
+
+            #whole patches are converted while they fit in the count, the
+            #patch after them is converted from its interior out
+            cumulative_sizes = numpy.cumsum(patch_sizes[patch_labels - 1])
+            n_whole_patches = numpy.searchsorted(
+                cumulative_sizes, count - pixels_changed, side='right')
+            converted_patches = numpy.zeros(
+                patch_sizes.size, dtype=numpy.bool)
+            converted_patches[patch_labels[:n_whole_patches] - 1] = True
+            if n_whole_patches > 0:
+                pixels_changed += cumulative_sizes[n_whole_patches - 1]
+            partial_patch = -1
+            n_selected_patches = n_whole_patches
+            if pixels_changed < count and n_whole_patches < patch_labels.size:
+                partial_patch = patch_labels[n_whole_patches] - 1
+                n_selected_patches += 1
+
+            #only relabel the strips the selected patches are in
+            selected_bboxes = patch_bboxes[
+                patch_labels[:n_selected_patches] - 1]
+            first_row = selected_bboxes[:, 0].min()
+            last_row = selected_bboxes[:, 1].max()
+            converted_strip_starts = [
+                row_index for row_index in strip_starts
+                if row_index + strip_rows > first_row and
+                row_index < last_row]
+
+            partial_rows = []
+            partial_cols = []
+            for row_index, strip_labels, n_labels in _strip_patch_labels(
+                    level_indexes, conversion_array, converted_strip_starts,
+                    row_end, strip_rows):
+                label_offset = label_offsets[row_index]
+                strip_patches = numpy.concatenate([[-1], strip_label_patches[
+                    label_offset:label_offset + n_labels]])[strip_labels]
+                if partial_patch >= 0:
+                    rows, cols = numpy.nonzero(strip_patches == partial_patch)
+                    partial_rows.append(rows + row_index)
+                    partial_cols.append(cols)
+
+                #change the pixels in the scenario, which also keeps lower
+                #priority covers from converting them
+                converted_mask = strip_patches >= 0
+                converted_mask[converted_mask] = converted_patches[
+                    strip_patches[converted_mask]]
+                conversion_array[
+                    row_index:row_index + strip_labels.shape[0]][
+                        converted_mask] = index + 1
+
+            if partial_patch >= 0:
+                #calculate the distance to exit the patch over its extent
+                row_offset, _, col_offset, _ = patch_bboxes[partial_patch]
+                pixels_to_change = (
+                    numpy.concatenate(partial_rows) - row_offset,
+                    numpy.concatenate(partial_cols) - col_offset)
+                patch_mask = numpy.zeros(
+                    (patch_bboxes[partial_patch, 1] - row_offset,
+                     patch_bboxes[partial_patch, 3] - col_offset),
+                    dtype=numpy.int8)
+                patch_mask[pixels_to_change] = 1
+                tmp_array = scipy.ndimage.morphology.distance_transform_edt(
+                    patch_mask)[pixels_to_change]
+
+                #select the number of pixels that need to be converted
+                tmp_index = numpy.argsort(tmp_array)
+                tmp_index = tmp_index[:count - pixels_changed]
+                conversion_array[
+                    row_offset + pixels_to_change[0][tmp_index],
+                    col_offset + pixels_to_change[1][tmp_index]] = index + 1
+                pixels_changed = count
+
+        order = None
+        os.remove(order_uri)
+
+        #report and record unchanged pixels
+        if pixels_changed < count:
+            LOGGER.warn("Not all pixels converted.")
+            unconverted_pixels[cover_id] = count - pixels_changed
+
+    #write the converted pixels to the scenario a strip at a time
+    cover_id_array = numpy.array(
+        [0] + [cover_id for _, cover_id, _ in change_list])
+    for row_index in xrange(0, n_rows, strip_rows):
+        n_strip_rows = min(strip_rows, n_rows - row_index)
+        conversion_strip = conversion_array[
+            row_index:row_index + n_strip_rows]
+        converted_mask = conversion_strip != 0
+        if not converted_mask.any():
+            continue
+        scenario_array = scenario_band.ReadAsArray(
+            0, row_index, n_cols, n_strip_rows)
+        scenario_array[converted_mask] = cover_id_array[
+            conversion_strip[converted_mask]]
+        scenario_band.WriteArray(scenario_array, 0, row_index)
+
+    conversion_array = None
+    scenario_band = None
+    scenario_ds = None
+    return unconverted_pixels
+
+
 def sum_uri(dataset_uri, datasource_uri):
     """Wrapper call to pygeoprocessing.geoprocessing.aggregate_raster_values_uri to extract total
 
@@ -1132,138 +1514,8 @@ def execute(args):
     change_list.sort(reverse=True)
 
     #change pixels
-    scenario_ds = gdal.Open(scenario_uri, 1)
-    scenario_band = scenario_ds.GetRasterBand(1)
-    scenario_array = scenario_band.ReadAsArray()
-
-    unconverted_pixels = {}
-    for index, (priority, cover_id, count) in enumerate(change_list):
-        LOGGER.debug("Increasing cover %i by %i pixels.", cover_id, count)
-
-        #open all lower priority suitability rasters and assign changed pixels value of 0
-        update_ds = {}
-        update_bands = {}
-        update_arrays = {}
-        for _, update_id, _ in change_list[index+1:]:
-            update_ds[update_id] = gdal.Open(suitability_dict[update_id], 1)
-            update_bands[update_id] = update_ds[update_id].GetRasterBand(1)
-            update_arrays[update_id] = update_bands[update_id].ReadAsArray()
-
-        ##select pixels
-        #open suitability raster
-        src_ds = gdal.Open(suitability_dict[cover_id], 1)
-        src_band = src_ds.GetRasterBand(1)
-        src_array = src_band.ReadAsArray()
-
-        pixels_changed = 0
-        suitability_values = list(numpy.unique(src_array))
-        suitability_values.sort(reverse=True)
-        if suitability_values[-1]==0:
-            suitability_values.pop(-1)
-        for suitability_score in suitability_values:
-            # Check if suitsbility is between 0 and 100 inclusive
-            if abs(suitability_score - 50) > 50:
-                print('suitability_values:', suitability_dict[cover_id])
-                for v in suitability_values:
-                    print v, ' ',
-
-            assert abs(suitability_score - 50) <= 50, \
-                'Invalid suitability score ' + str(suitability_score)
-            if pixels_changed == count:
-                LOGGER.debug("All necessay pixels converted.")
-                break
-
-            LOGGER.debug("Checking pixels with suitability of %i.", suitability_score)
-
-            #mask out everything except the current suitability score
-            mask = src_array == suitability_score
-
-            #label patches
-            label_im, nb_labels = scipy.ndimage.label(mask)
-
-            #get patch sizes
-            patch_sizes = scipy.ndimage.sum(mask, label_im, range(1, nb_labels + 1))
-            patch_labels = numpy.array(range(1, nb_labels + 1))
-            patch_locations = scipy.ndimage.find_objects(label_im, nb_labels)
-
-            #randomize patch order
-            numpy.random.shuffle(patch_labels)
-
-            #check patches for conversion
-            patch_label_count = patch_labels.size
-            for l in range(patch_label_count):
-                label = patch_labels[l]
-                source = label_im[patch_locations[label-1]]
-                target = scenario_array[patch_locations[label-1]]
-                pixels_to_change = numpy.where(source == label)
-                assert pixels_to_change[0].size == patch_sizes[label-1]
-
-                if patch_sizes[label-1] + pixels_changed > count:
-
-                    #mask out everything except the current patch
-                    #patch = numpy.where(label_im == label)
-                    #patch_mask = numpy.zeros_like(scenario_array)
-                    patch_mask = numpy.zeros_like(target)
-                    #patch_mask[patch] = 1
-                    patch_mask[pixels_to_change] = 1
-
-                    #calculate the distance to exit the patch
-                    #tmp_array = scipy.ndimage.morphology.distance_transform_edt(patch_mask)
-                    tmp_array = scipy.ndimage.morphology.distance_transform_edt(patch_mask)
-                    #tmp_array = tmp_array[patch]
-                    tmp_array = tmp_array[pixels_to_change]
-
-                    #select the number of pixels that need to be converted
-                    tmp_index = numpy.argsort(tmp_array)
-                    tmp_index = tmp_index[:count - pixels_changed]
-
-                    #convert the selected pixels into coordinates
-                    #pixels_to_change = numpy.array(zip(patch[0], patch[1]))
-                    pixels_to_change = numpy.array(zip(pixels_to_change[0], pixels_to_change[1]))
-                    pixels_to_change = pixels_to_change[tmp_index]
-                    pixels_to_change = apply(zip, pixels_to_change)
-
-                    #change the pixels in the scenario
-                    #scenario_array[pixels_to_change] = cover_id
-                    target[pixels_to_change] = cover_id
-
-                    pixels_changed = count
-
-                    #alter other suitability rasters to prevent double conversion
-                    for _, update_id, _ in change_list[index+1:]:
-                        #update_arrays[update_id][pixels_to_change] = 0
-                        target = update_arrays[update_id][patch_locations[label-1]]
-                        target[pixels_to_change] = 0
-
-                    break
-
-                else:
-                    #convert patch, increase count of changes
-                    target[pixels_to_change] = cover_id
-                    pixels_changed += patch_sizes[label-1]
-
-                    #alter other suitability rasters to prevent double conversion
-                    for _, update_id, _ in change_list[index+1:]:
-                        target = update_arrays[update_id][patch_locations[label-1]]
-                        target[pixels_to_change] = 0
-
-        #report and record unchanged pixels
-        if pixels_changed < count:
-            LOGGER.warn("Not all pixels converted.")
-            unconverted_pixels[cover_id] = count - pixels_changed
-
-
-        #write new suitability arrays
-        for _, update_id, _ in change_list[index+1:]:
-            update_bands[update_id].WriteArray(update_arrays[update_id])
-            update_arrays[update_id] = None
-            update_bands[update_id] = None
-            update_ds[update_id] = None
-
-    scenario_band.WriteArray(scenario_array)
-    scenario_array = None
-    scenario_band = None
-    scenario_ds = None
+    unconverted_pixels = allocate_pixels(
+        scenario_uri, change_list, suitability_dict)
 
     #apply override
     if args["override_layer"]:
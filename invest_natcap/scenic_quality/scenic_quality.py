@@ -1,6 +1,7 @@
 import os
 import sys
 import math
+import multiprocessing
 
 import numpy as np
 import scipy.stats
@@ -150,61 +151,35 @@ def compute_viewshed_uri(in_dem_uri, out_viewshed_uri, in_structure_uri,
         -refraction: refraction index between 0 (max effect) and 1 (no effect).
         Default is 0.13."""
 
-    # Extract cell size from input DEM
-    cell_size = geoprocessing.get_cell_size_from_uri(in_dem_uri)
+    # Create the accumulator raster the viewpoints are summed into
+    geoprocessing.new_raster_from_base_uri(in_dem_uri, out_viewshed_uri, \
+        'GTiff', -1., gdal.GDT_Float64, fill_value = 0.)
 
-    # Extract nodata
-    nodata = geoprocessing.get_nodata_from_uri(in_dem_uri)
+    compute_viewshed(in_dem_uri, out_viewshed_uri, in_structure_uri, \
+    curvature_correction, refr_coeff, args)
 
-    ## Build I and J arrays, and save them to disk
-    rows, cols = geoprocessing.get_row_col_from_uri(in_dem_uri)
-    I, J = np.meshgrid(range(rows), range(cols), indexing = 'ij')
-    # Base path uri
-    base_uri = os.path.split(out_viewshed_uri)[0]
-    I_uri = os.path.join(base_uri, 'I.tif')
-    J_uri = os.path.join(base_uri, 'J.tif')
-    #I_uri = geoprocessing.temporary_filename()
-    #J_uri = geoprocessing.temporary_filename()
-    geoprocessing.new_raster_from_base_uri(in_dem_uri, I_uri, 'GTiff', \
-        -32768., gdal.GDT_Float32, fill_value = -32768.)
-    I_raster = gdal.Open(I_uri, gdal.GA_Update)
-    I_band = I_raster.GetRasterBand(1)
-    I_band.WriteArray(I)
-    I_band = None
-    I_raster = None
-    geoprocessing.new_raster_from_base_uri(in_dem_uri, J_uri, 'GTiff', \
-        -32768., gdal.GDT_Float32, fill_value = -32768.)
-    J_raster = gdal.Open(J_uri, gdal.GA_Update)
-    J_band = J_raster.GetRasterBand(1)
-    J_band.WriteArray(J)
-    J_band = None
-    J_raster = None
-    # Extract the input raster geotransform
-    GT = geoprocessing.get_geotransform_uri(in_dem_uri)
 
-    # Open the input URI and extract the numpy array
-    input_raster = gdal.Open(in_dem_uri)
-    input_array = input_raster.GetRasterBand(1).ReadAsArray()
-    input_raster = None
-
-    # Create a raster from base before passing it to viewshed
-    visibility_uri = out_viewshed_uri #geoprocessing.temporary_filename()
-    geoprocessing.new_raster_from_base_uri(in_dem_uri, visibility_uri, 'GTiff', \
-        255, gdal.GDT_Byte, fill_value = 255)
-
-    # Call the non-uri version of viewshed.
-    #compute_viewshed(in_dem_uri, visibility_uri, in_structure_uri,
-    compute_viewshed(input_array, visibility_uri, in_structure_uri,
-    cell_size, rows, cols, nodata, GT, I_uri, J_uri, curvature_correction,
-    refr_coeff, args)
-
-
-#def compute_viewshed(in_dem_uri, visibility_uri, in_structure_uri, \
-def compute_viewshed(input_array, visibility_uri, in_structure_uri, \
-    cell_size, rows, cols, nodata, GT, I_uri, J_uri, curvature_correction, \
-    refr_coeff, args):
-    """ array-based function that computes the viewshed as is defined in ArcGIS
-    """
+def compute_viewshed(in_dem_uri, visibility_uri, in_structure_uri, \
+    curvature_correction, refr_coeff, args):
+    """ Computes the valued viewshed of every viewpoint in in_structure_uri
+    and adds it into visibility_uri.
+
+        -in_dem_uri: URI to input surface raster
+        -visibility_uri: URI to an existing raster aligned with in_dem_uri
+        that accumulates the viewsheds
+        -in_structure_uri: URI to a point shapefile of the viewpoints
+        -curvature_correction: not used yet
+        -refr_coeff: refraction coefficient (0.0-1.0)
+        -args: the model's arguments, reads the valuation function and its
+        coefficients, and 'n_workers', the number of processes computing
+        viewsheds in parallel, which defaults to the number of CPUs
+
+        Each viewpoint's viewshed is computed in memory over only the window
+        its radius covers and added into visibility_uri in viewpoint order,
+        so no per viewpoint rasters are written and the totals are the same
+        from one run to the next.
+
+        Returns nothing"""
     # default parameter values that are not passed to this function but that
     # scenic_quality_core.viewshed needs
     obs_elev = 1.0 # Observator's elevation in meters
@@ -213,72 +188,17 @@ def compute_viewshed(input_array, visibility_uri, in_structure_uri, \
     coefficient = 1.0 # Used to weight the importance of individual viewsheds
     height = 0.0 # Per viewpoint height offset--updated as we read file info
 
-    #input_raster = gdal.Open(in_dem_uri)
-    #input_band = input_raster.GetRasterBand(1)
-    #input_array = input_band.ReadAsArray()
-    #input_band = None
-    #input_raster = None
-
-    # Compute the distance for each point
-    def compute_distance(vi, vj, cell_size):
-        def compute(i, j, v):
-            if v == 1:
-                return ((vi - i)**2 + (vj - j)**2)**.5 * cell_size
-            else:
-                return -1.
-        return compute
-
-    # Apply the valuation functions to the distance
-    def polynomial(a, b, c, d, max_valuation_radius):
-        def compute(x, v):
-            if v==1:
-                if x < 1000:
-                    return a + b*1000 + c*1000**2 + d*1000**3 - \
-                        (b + 2*c*1000 + 3*d*1000**2)*(1000-x)
-                elif x <= max_valuation_radius:
-                    return a + b*x + c*x**2 + d*x**3
-                else:
-                    return 0.
-            else:
-                return 0.
-        return compute
-
-    def logarithmic(a, b, max_valuation_radius):
-        def compute(x, v):
-            if v==1:
-                if x < 1000:
-                    return a + b*math.log(1000) - (b/1000)*(1000-x)
-                elif x <= max_valuation_radius:
-                    return a + b*math.log(x)
-                else:
-                    return 0.
-            else:
-                return 0.
-        return compute
-
-    # Multiply a value by a constant
-    def multiply(c):
-        def compute(x):
-            return x*c
-        return compute
-
+    cell_size = geoprocessing.get_cell_size_from_uri(in_dem_uri)
+    nodata = geoprocessing.get_nodata_from_uri(in_dem_uri)
+    rows, cols = geoprocessing.get_row_col_from_uri(in_dem_uri)
+    GT = geoprocessing.get_geotransform_uri(in_dem_uri)
 
     # Setup valuation function
-    a = args["a_coefficient"]
-    b = args["b_coefficient"]
-    c = args["c_coefficient"]
-    d = args["d_coefficient"]
-
-    valuation_function = None
+    valuation_args = dict([(key, args[key]) for key in [ \
+        'valuation_function', 'a_coefficient', 'b_coefficient', \
+        'c_coefficient', 'd_coefficient', 'max_valuation_radius']])
+    valuation_function = get_valuation_function(valuation_args)
     max_valuation_radius = args['max_valuation_radius']
-    if "polynomial" in args["valuation_function"]:
-        print("Polynomial")
-        valuation_function = polynomial(a, b, c, d, max_valuation_radius)
-    elif "logarithmic" in args['valuation_function']:
-        print("logarithmic")
-        valuation_function = logarithmic(a, b, max_valuation_radius)
-
-    assert valuation_function is not None
 
     # Make sure the values don't become too small at max_valuation_radius:
     edge_value = valuation_function(max_valuation_radius, 1)
@@ -286,26 +206,16 @@ def compute_viewshed(input_array, visibility_uri, in_structure_uri, \
     str(max_valuation_radius) + " meters (value is " + str(edge_value) + ")"
     assert edge_value >= 0., message
 
-    # Base path uri
-    base_uri = os.path.split(visibility_uri)[0]
-
-    # Temporary files that will be used
-    distance_uri = geoprocessing.temporary_filename()
-    viewshed_uri = geoprocessing.temporary_filename()
-
-
     # The model extracts each viewpoint from the shapefile
-    point_list = []
+    viewpoint_list = []
     shapefile = ogr.Open(in_structure_uri)
     assert shapefile is not None
     layer = shapefile.GetLayer(0)
     assert layer is not None
     iGT = gdal.InvGeoTransform(GT)[1]
     feature_count = layer.GetFeatureCount()
-    viewshed_uri_list = []
-    print('Number of viewpoints: ' + str(feature_count))
+    LOGGER.info('Number of viewpoints: %d', feature_count)
     for f in range(feature_count):
-        print("feature " + str(f))
         feature = layer.GetFeature(f)
         field_count = feature.GetFieldCount()
         # Check for feature information (radius, coeff, height)
@@ -343,56 +253,217 @@ def compute_viewshed(input_array, visibility_uri, in_structure_uri, \
         y = geometry.GetY()
         j = int((iGT[0] + x*iGT[1] + y*iGT[2]))
         i = int((iGT[3] + x*iGT[4] + y*iGT[5]))
+        if i < 0 or i >= rows or j < 0 or j >= cols:
+            LOGGER.warning('Skipping viewpoint %d outside of the DEM', f)
+            continue
 
-        array_shape = (rows, cols)
-
-        #tmp_visibility_uri = geoprocessing.temporary_filename()
-        tmp_visibility_uri = os.path.join(base_uri, 'visibility_' + str(f) + '.tif')
-        geoprocessing.new_raster_from_base_uri( \
-            visibility_uri, tmp_visibility_uri, 'GTiff', \
-            255, gdal.GDT_Float64, fill_value=255)
-        scenic_quality_core.viewshed(input_array, cell_size, \
-        array_shape, nodata, tmp_visibility_uri, (i,j), obs_elev, tgt_elev, \
-        max_dist, refr_coeff)
-
-        # Compute the distance
-        #tmp_distance_uri = geoprocessing.temporary_filename()
-        tmp_distance_uri = os.path.join(base_uri, 'distance_' + str(f) + '.tif')
-        geoprocessing.new_raster_from_base_uri(visibility_uri, \
-        tmp_distance_uri, 'GTiff', \
-        255, gdal.GDT_Byte, fill_value = 255)
-        distance_fn = compute_distance(i,j, cell_size)
-        geoprocessing.vectorize_datasets([I_uri, J_uri, tmp_visibility_uri], \
-        distance_fn, tmp_distance_uri, gdal.GDT_Float64, -1., cell_size, "union")
-        # Apply the valuation function
-        #tmp_viewshed_uri = geoprocessing.temporary_filename()
-        tmp_viewshed_uri = os.path.join(base_uri, 'viewshed_' + str(f) + '.tif')
-
-        geoprocessing.vectorize_datasets(
-            [tmp_distance_uri, tmp_visibility_uri],
-            valuation_function, tmp_viewshed_uri, gdal.GDT_Float64, -9999.0, cell_size,
-            "union")
-
-
-        # Multiply the viewshed by its coefficient
-        scaled_viewshed_uri = geoprocessing.temporary_filename()
-        #os.path.join(base_uri, 'vshed_' + str(f) + '.tif') #geoprocessing.temporary_filename()
-        apply_coefficient = multiply(coefficient)
-        geoprocessing.vectorize_datasets([tmp_viewshed_uri], apply_coefficient, \
-        scaled_viewshed_uri, gdal.GDT_Float64, 0., cell_size, "union")
-        viewshed_uri_list.append(scaled_viewshed_uri)
+        viewpoint_list.append((in_dem_uri, nodata, cell_size, (i, j), \
+            obs_elev, tgt_elev, max_dist, refr_coeff, coefficient, \
+            valuation_args))
 
     layer = None
     shapefile = None
-    # Accumulate result to combined raster
-    def sum_rasters(*x):
-        return np.sum(x, axis = 0)
-    LOGGER.debug('Summing up everything using vectorize_datasets...')
-    LOGGER.debug('visibility_uri' + visibility_uri)
-    LOGGER.debug('viewshed_uri_list: ' + str(viewshed_uri_list))
-    geoprocessing.vectorize_datasets( \
-        viewshed_uri_list, sum_rasters, \
-        visibility_uri, gdal.GDT_Float64, -1., cell_size, "union", vectorize_op=False)
+
+    n_workers = int(args.get('n_workers', multiprocessing.cpu_count()))
+    LOGGER.info('Computing %d viewsheds on %d workers', \
+        len(viewpoint_list), n_workers)
+    if n_workers > 1:
+        # Workers started by spawn re-import this module and only see the
+        # built in valuation functions, so register the others in each one
+        worker_pool = multiprocessing.Pool(n_workers, \
+            _register_valuation_functions, (valuation_function_paths(),))
+        # imap keeps the viewpoint order so the floating point sums don't
+        # depend on which worker finishes first
+        viewshed_iterator = \
+            worker_pool.imap(_valued_viewshed, viewpoint_list)
+    else:
+        worker_pool = None
+        viewshed_iterator = ( \
+            _valued_viewshed(viewpoint) for viewpoint in viewpoint_list)
+
+    # Accumulate each viewshed's window into the combined raster in viewpoint
+    # order
+    visibility_raster = gdal.Open(visibility_uri, gdal.GA_Update)
+    visibility_band = visibility_raster.GetRasterBand(1)
+    for viewpoint_index, (row_offset, col_offset, valued_viewshed) in \
+        enumerate(viewshed_iterator):
+        (window_rows, window_cols) = valued_viewshed.shape
+        accumulator = visibility_band.ReadAsArray( \
+            col_offset, row_offset, window_cols, window_rows)
+        visibility_band.WriteArray( \
+            accumulator + valued_viewshed, xoff=col_offset, yoff=row_offset)
+        if (viewpoint_index + 1) % 100 == 0:
+            LOGGER.info('%d of %d viewsheds done', viewpoint_index + 1, \
+                len(viewpoint_list))
+    visibility_band.FlushCache()
+    visibility_band = None
+    visibility_raster = None
+
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+
+def viewshed_window(array_shape, viewpoint, max_dist):
+    """ Compute the window of the raster a viewpoint can see. This is the
+    same bounding box scenic_quality_core.get_perimeter_cells uses.
+
+        -array_shape: tuple (rows, cols) of the raster size
+        -viewpoint: tuple (row, col) of the observer
+        -max_dist: maximum visibility distance in pixels, negative values
+        mean infinite
+
+        Returns a tuple (row_min, row_max, col_min, col_max) where the max
+        values are exclusive"""
+    if max_dist < 0:
+        return (0, array_shape[0], 0, array_shape[1])
+    return (max(viewpoint[0] - max_dist, 0), \
+        min(viewpoint[0] + max_dist, array_shape[0]), \
+        max(viewpoint[1] - max_dist, 0), \
+        min(viewpoint[1] + max_dist, array_shape[1]))
+
+def _valued_viewshed(viewpoint_task):
+    """ Worker function that computes a single viewpoint's valued viewshed
+    over the window its radius covers.
+
+        -viewpoint_task: a tuple (dem_uri, nodata, cell_size, (i, j),
+        obs_elev, tgt_elev, max_dist, refr_coeff, coefficient,
+        valuation_args)
+
+        Returns a tuple (row_offset, col_offset, valued_viewshed) where
+        valued_viewshed is the coefficient times the valuation of the
+        distance to every visible pixel of the window, 0 elsewhere"""
+    (dem_uri, nodata, cell_size, (i, j), obs_elev, tgt_elev, max_dist, \
+        refr_coeff, coefficient, valuation_args) = viewpoint_task
+
+    dem_raster = gdal.Open(dem_uri)
+    dem_band = dem_raster.GetRasterBand(1)
+    (row_min, row_max, col_min, col_max) = viewshed_window( \
+        (dem_band.YSize, dem_band.XSize), (i, j), max_dist)
+    input_array = dem_band.ReadAsArray( \
+        col_min, row_min, col_max - col_min, row_max - row_min)
+    dem_band = None
+    dem_raster = None
+
+    visibility = scenic_quality_core.compute_viewshed(input_array, nodata, \
+        (i - row_min, j - col_min), obs_elev, tgt_elev, max_dist, cell_size, \
+        refr_coeff, 'cython')
+
+    # Compute the distance for each pixel
+    I, J = np.meshgrid(np.arange(row_min, row_max), \
+        np.arange(col_min, col_max), indexing = 'ij')
+    distance = ((i - I)**2 + (j - J)**2)**.5 * cell_size
+
+    # Apply the valuation function to the distance and scale it
+    valuation_function = get_valuation_function(valuation_args)
+    valued_viewshed = valuation_function(distance, visibility) * coefficient
+
+    return (row_min, col_min, valued_viewshed)
+
+def polynomial_valuation(distance, visible, valuation_args):
+    """ Value pixels with a + b*x + c*x**2 + d*x**3 of their distance x,
+    extended linearly below 1000 meters.
+
+        -distance: numpy array of distances to the viewpoint in meters
+        -visible: numpy array the same shape as distance, 1 where visible
+        -valuation_args: dictionary with the a, b, c and d coefficients and
+        'max_valuation_radius'
+
+        Returns a numpy array of values, 0 where not visible or beyond
+        max_valuation_radius"""
+    a = valuation_args["a_coefficient"]
+    b = valuation_args["b_coefficient"]
+    c = valuation_args["c_coefficient"]
+    d = valuation_args["d_coefficient"]
+    x = np.asarray(distance, dtype = np.float64)
+    near = a + b*1000 + c*1000**2 + d*1000**3 - \
+        (b + 2*c*1000 + 3*d*1000**2)*(1000-x)
+    far = a + b*x + c*x**2 + d*x**3
+    value = np.where(x < 1000, near, \
+        np.where(x <= valuation_args['max_valuation_radius'], far, 0.))
+    return np.where(np.asarray(visible) == 1, value, 0.)
+
+def logarithmic_valuation(distance, visible, valuation_args):
+    """ Value pixels with a + b*log(x) of their distance x, extended
+    linearly below 1000 meters.
+
+        -distance: numpy array of distances to the viewpoint in meters
+        -visible: numpy array the same shape as distance, 1 where visible
+        -valuation_args: dictionary with the a and b coefficients and
+        'max_valuation_radius'
+
+        Returns a numpy array of values, 0 where not visible or beyond
+        max_valuation_radius"""
+    a = valuation_args["a_coefficient"]
+    b = valuation_args["b_coefficient"]
+    x = np.asarray(distance, dtype = np.float64)
+    near = a + b*math.log(1000) - (b/1000)*(1000-x)
+    # log is only taken where it's used to avoid log(0) warnings
+    far = a + b*np.log(np.maximum(x, 1000))
+    value = np.where(x < 1000, near, \
+        np.where(x <= valuation_args['max_valuation_radius'], far, 0.))
+    return np.where(np.asarray(visible) == 1, value, 0.)
+
+# Valuation functions by the name args['valuation_function'] has to contain.
+# Each one takes (distance, visible, valuation_args) numpy arrays and the
+# valuation arguments and returns a numpy array of pixel values.
+VALUATION_FUNCTIONS = {
+    'polynomial': polynomial_valuation,
+    'logarithmic': logarithmic_valuation,
+}
+
+def register_valuation_function(name, valuation_function):
+    """ Add a valuation function the model can use.
+
+        -name: the name args['valuation_function'] selects it by
+        -valuation_function: a function of (distance, visible,
+        valuation_args) that operates on whole numpy arrays, like
+        polynomial_valuation. It has to be a module level function so
+        worker processes can import it by its module and name
+
+        Returns nothing"""
+    VALUATION_FUNCTIONS[name] = valuation_function
+
+def valuation_function_paths():
+    """ List the import path of every registered valuation function.
+
+        Returns a list of (name, module_name, function_name) tuples that
+        _register_valuation_functions can register in another process"""
+    return [(name, VALUATION_FUNCTIONS[name].__module__, \
+        VALUATION_FUNCTIONS[name].__name__) \
+        for name in sorted(VALUATION_FUNCTIONS)]
+
+def _register_valuation_functions(function_path_list):
+    """ Worker initializer that imports and registers valuation functions.
+
+        -function_path_list: a list of (name, module_name, function_name)
+        tuples as returned by valuation_function_paths
+
+        Returns nothing"""
+    for name, module_name, function_name in function_path_list:
+        if name in VALUATION_FUNCTIONS:
+            continue
+        module = __import__(module_name, fromlist=[function_name])
+        register_valuation_function(name, getattr(module, function_name))
+
+def get_valuation_function(valuation_args):
+    """ Build the function that values pixels from their distance to the
+    viewpoint.
+
+        -valuation_args: a dictionary with the keys 'valuation_function',
+        'a_coefficient', 'b_coefficient', 'c_coefficient', 'd_coefficient'
+        and 'max_valuation_radius' as in the model's arguments
+
+        Returns a function of (distance, visible) numpy arrays that returns
+        the value of every pixel, 0 where it's not visible"""
+    for name in sorted(VALUATION_FUNCTIONS):
+        if name in valuation_args['valuation_function']:
+            valuation_function = VALUATION_FUNCTIONS[name]
+            def compute(distance, visible):
+                return valuation_function(distance, visible, valuation_args)
+            return compute
+
+    raise ValueError("Unknown valuation function %s, expected one of %s" % \
+        (valuation_args['valuation_function'], sorted(VALUATION_FUNCTIONS)))
 
 def add_field_feature_set_uri(fs_uri, field_name, field_type):
     shapefile = ogr.Open(fs_uri, 1)
@@ -3,6 +3,7 @@
 import os
 import csv
 import logging
+import math
 
 from osgeo import gdal
 from osgeo import ogr
@@ -12,6 +13,8 @@ import pygeoprocessing.geoprocessing
 import pygeoprocessing.routing
 import pygeoprocessing.routing.routing_core
 
+from invest_natcap import prepare_cache
+
 logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 
@@ -56,6 +59,17 @@ def execute(args):
             sdr._prepare call.  This argument could be used in cases where the
             call to this function is scripted and can save a significant amount
             of runtime.
+        args['use_prepare_cache'] - (optional) if False the prepared data is
+            recalculated in the workspace rather than loaded from or saved to
+            the cache in invest_natcap.prepare_cache.  Defaults to True.
+        args['prepare_cache_dir'] - (optional) a uri to the directory holding
+            the prepared data cache.  Defaults to
+            prepare_cache.default_cache_dir().
+        args['fused_local_ops'] - (optional) if True, the per-pixel local
+            operations are evaluated in two block-wise passes around the
+            routing steps and only the rasters needed by routing and the
+            model outputs are written to disk.  Otherwise each intermediate
+            raster is written to the intermediate directory.
 
         returns nothing."""
 
@@ -98,6 +112,11 @@ def execute(args):
     #check if we've already prepared the DEM
     if '_prepare' in args:
         preprocessed_data = args['_prepare']
+    elif args.get('use_prepare_cache', True):
+        preprocessed_data = prepare_cache.cached_prepare(
+            'sdr', _prepare, args,
+            ['dem_uri', 'erosivity_uri', 'erodibility_uri', 'watersheds_uri'],
+            cache_dir=args.get('prepare_cache_dir', None))
     else:
         preprocessed_data = _prepare(**args)
 
@@ -132,6 +151,8 @@ def execute(args):
 
     dem_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(args['dem_uri'])
 
+    fused_local_ops = args.get('fused_local_ops', False)
+
     if 'drainage_uri' in args and args['drainage_uri'] != '':
         def add_drainage(stream, drainage):
             return numpy.where(drainage == 1, 1, stream)
@@ -140,12 +161,36 @@ def execute(args):
         #add additional drainage to the stream
         drainage_uri = os.path.join(output_dir, 'drainage%s.tif' % file_suffix)
 
+        input_drainage_uri = args['drainage_uri']
+        if fused_local_ops:
+            #the fused passes need every raster on the same grid, so the
+            #drainage mask can't be allowed to shrink the stream extent
+            input_drainage_uri = os.path.join(
+                intermediate_dir, 'aligned_drainage%s.tif' % file_suffix)
+            tmp_dem_uri = pygeoprocessing.geoprocessing.temporary_filename()
+            pygeoprocessing.geoprocessing.align_dataset_list(
+                [aligned_dem_uri, args['drainage_uri']],
+                [tmp_dem_uri, input_drainage_uri], ['nearest'] * 2,
+                out_pixel_size, 'dataset', 0, dataset_to_bound_index=0)
+            os.remove(tmp_dem_uri)
+
         pygeoprocessing.geoprocessing.vectorize_datasets(
-            [stream_uri, args['drainage_uri']], add_drainage, drainage_uri,
+            [stream_uri, input_drainage_uri], add_drainage, drainage_uri,
             gdal.GDT_Byte, stream_nodata, out_pixel_size, "intersection",
             dataset_to_align_index=0, vectorize_op=False)
         stream_uri = drainage_uri
 
+    if fused_local_ops:
+        usle_uri, sed_export_uri, sed_retention_bare_soil_uri = (
+            _execute_fused_local_ops(
+                args, preprocessed_data, biophysical_table, aligned_lulc_uri,
+                stream_uri, intermediate_dir, output_dir, file_suffix))
+        LOGGER.info('generating report')
+        _generate_report(
+            usle_uri, sed_export_uri, sed_retention_bare_soil_uri,
+            args['watersheds_uri'], output_dir, file_suffix)
+        return
+
     #Calculate the W factor
     LOGGER.info('calculate per pixel W')
     original_w_factor_uri = os.path.join(
@@ -427,15 +472,43 @@ def execute(args):
 
 
     LOGGER.info('generating report')
+    _generate_report(
+        usle_uri, sed_export_uri, sed_retention_bare_soil_uri,
+        args['watersheds_uri'], output_dir, file_suffix)
+
+    for ds_uri in [zero_absorption_source_uri, loss_uri]:
+        try:
+            os.remove(ds_uri)
+        except OSError as e:
+            LOGGER.warn("couldn't remove %s because it's still open", ds_uri)
+            LOGGER.warn(e)
+
+
+def _generate_report(
+        usle_uri, sed_export_uri, sed_retention_uri, watersheds_uri,
+        output_dir, file_suffix):
+    """Aggregates the USLE, sediment export and sediment retention rasters
+        over the watersheds and writes them to a copy of the watershed
+        shapefile in the output directory.
+
+        usle_uri - a uri to the per pixel USLE raster
+        sed_export_uri - a uri to the per pixel sediment export raster
+        sed_retention_uri - a uri to the per pixel sediment retention raster
+        watersheds_uri - a uri to the watershed shapefile with a 'ws_id' field
+        output_dir - the directory to write watershed_results_sdr.shp to
+        file_suffix - a string to append to the output shapefile name
+
+        returns nothing"""
+
     esri_driver = ogr.GetDriverByName('ESRI Shapefile')
 
     field_summaries = {
-        'usle_tot': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(usle_uri, args['watersheds_uri'], 'ws_id').total,
-        'sed_export': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(sed_export_uri, args['watersheds_uri'], 'ws_id').total,
-        'sed_retent': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(sed_retention_bare_soil_uri, args['watersheds_uri'], 'ws_id').total,
+        'usle_tot': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(usle_uri, watersheds_uri, 'ws_id').total,
+        'sed_export': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(sed_export_uri, watersheds_uri, 'ws_id').total,
+        'sed_retent': pygeoprocessing.geoprocessing.aggregate_raster_values_uri(sed_retention_uri, watersheds_uri, 'ws_id').total,
         }
 
-    original_datasource = ogr.Open(args['watersheds_uri'])
+    original_datasource = ogr.Open(watersheds_uri)
     watershed_output_datasource_uri = os.path.join(output_dir, 'watershed_results_sdr%s.shp' % file_suffix)
     #If there is already an existing shapefile with the same name and path, delete it
     #Copy the input shapefile into the designated output folder
@@ -464,13 +537,348 @@ def execute(args):
     original_datasource.Destroy()
     datasource_copy.Destroy()
 
-    for ds_uri in [zero_absorption_source_uri, loss_uri]:
+
+def _execute_fused_local_ops(
+        args, preprocessed_data, biophysical_table, aligned_lulc_uri,
+        stream_uri, intermediate_dir, output_dir, file_suffix):
+    """Calculates the SDR outputs with the per-pixel local operations fused
+        into one block-wise pass before and one after the routing steps.
+        Only the rasters the routing functions consume and the model outputs
+        are written to disk, the other intermediate rasters of `execute` are
+        only ever held one block at a time in memory.
+
+        args - the args dictionary passed to `execute`
+        preprocessed_data - the dictionary returned by `_prepare`
+        biophysical_table - a dictionary mapping lulc codes to rows of the
+            biophysical table
+        aligned_lulc_uri - a uri to the lulc raster aligned with the prepared
+            dem
+        stream_uri - a uri to the stream raster aligned with the prepared dem
+        intermediate_dir - directory to write the rasters needed by routing
+        output_dir - directory to write the model output rasters
+        file_suffix - a string to append to each output file name
+
+        returns a tuple of uris to the (usle, sediment export, sediment
+            retention) rasters"""
+
+    aligned_dem_uri = preprocessed_data['aligned_dem_uri']
+    flow_accumulation_uri = preprocessed_data['flow_accumulation_uri']
+    flow_direction_uri = preprocessed_data['flow_direction_uri']
+    thresholded_slope_uri = preprocessed_data['thresholded_slope_uri']
+
+    out_pixel_size = pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+        aligned_dem_uri)
+    cell_area = out_pixel_size ** 2
+    cell_area_ha = cell_area / 10000.0
+
+    lulc_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        aligned_lulc_uri)
+    ls_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        preprocessed_data['ls_uri'])
+    erosivity_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        preprocessed_data['aligned_erosivity_uri'])
+    erodibility_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        preprocessed_data['aligned_erodibility_uri'])
+    stream_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        stream_uri)
+    slope_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        thresholded_slope_uri)
+    flow_accumulation_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        flow_accumulation_uri)
+
+    lucodes = numpy.array(sorted(biophysical_table), dtype=numpy.int64)
+    usle_c = numpy.array(
+        [float(biophysical_table[lucode]['usle_c']) for lucode in lucodes])
+    usle_cp = numpy.array(
+        [float(biophysical_table[lucode]['usle_c']) *
+         float(biophysical_table[lucode]['usle_p']) for lucode in lucodes])
+
+    w_nodata = -1.0
+    cp_nodata = -1.0
+    inverse_nodata = -1.0
+    rkls_nodata = -1.0
+    usle_nodata = -1.0
+
+    #the watershed mask stands in for the aoi_uri argument that masks USLE
+    #in the unfused path
+    aoi_mask_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+        aligned_dem_uri, aoi_mask_uri, 'GTiff', 255, gdal.GDT_Byte,
+        fill_value=0)
+    pygeoprocessing.geoprocessing.rasterize_layer_uri(
+        aoi_mask_uri, args['watersheds_uri'], burn_values=[1])
+
+    def pre_routing_op(lulc, ls_factor, erosivity, erodibility, stream,
+                       slope, aoi_mask):
+        """Calculates the thresholded W factor, the inverse WS and S factors
+            needed by distance_to_stream, RKLS and USLE for a block"""
+        lulc_nodata_mask = lulc == lulc_nodata
+        w_factor = _reclassify_block(
+            lulc, lulc_nodata_mask, lucodes, usle_c, w_nodata)
+        w_factor[(w_factor < 0.001) & ~lulc_nodata_mask] = 0.001
+        cp_factor = _reclassify_block(
+            lulc, lulc_nodata_mask, lucodes, usle_cp, cp_nodata)
+
+        slope_valid_mask = slope != slope_nodata
+        ws_inverse = numpy.where(
+            (w_factor != w_nodata) & slope_valid_mask,
+            1.0 / (w_factor * slope), inverse_nodata)
+        s_inverse = numpy.where(
+            slope_valid_mask, 1.0 / slope, inverse_nodata)
+
+        rkls = numpy.where(
+            stream == 1, 0.0,
+            ls_factor * erosivity * erodibility * cell_area_ha)
+        rkls = numpy.where(
+            (ls_factor == ls_nodata) | (erosivity == erosivity_nodata) |
+            (erodibility == erodibility_nodata) | (stream == stream_nodata),
+            rkls_nodata, rkls).astype(numpy.float32)
+
+        usle = numpy.where(
+            (rkls == rkls_nodata) | (cp_factor == cp_nodata) |
+            (aoi_mask != 1), usle_nodata, rkls * cp_factor * (1 - stream))
+        return w_factor, ws_inverse, s_inverse, rkls, usle
+
+    thresholded_w_factor_uri = os.path.join(
+        intermediate_dir, 'thresholded_w_factor%s.tif' % file_suffix)
+    ws_factor_inverse_uri = os.path.join(
+        intermediate_dir, 'ws_factor_inverse%s.tif' % file_suffix)
+    s_factor_inverse_uri = os.path.join(
+        intermediate_dir, 's_factor_inverse%s.tif' % file_suffix)
+    rkls_uri = os.path.join(output_dir, 'rkls%s.tif' % file_suffix)
+    usle_uri = os.path.join(output_dir, 'usle%s.tif' % file_suffix)
+
+    LOGGER.info('calculating W, inverse WS and S, RKLS, and USLE')
+    _fused_vectorize_datasets(
+        [aligned_lulc_uri, preprocessed_data['ls_uri'],
+         preprocessed_data['aligned_erosivity_uri'],
+         preprocessed_data['aligned_erodibility_uri'], stream_uri,
+         thresholded_slope_uri, aoi_mask_uri],
+        pre_routing_op,
+        [(thresholded_w_factor_uri, gdal.GDT_Float64, w_nodata),
+         (ws_factor_inverse_uri, gdal.GDT_Float32, inverse_nodata),
+         (s_factor_inverse_uri, gdal.GDT_Float32, inverse_nodata),
+         (rkls_uri, gdal.GDT_Float32, rkls_nodata),
+         (usle_uri, gdal.GDT_Float64, usle_nodata)])
+
+    zero_absorption_source_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    loss_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    pygeoprocessing.geoprocessing.make_constant_raster_from_base_uri(
+        aligned_dem_uri, 0.0, zero_absorption_source_uri)
+
+    w_accumulation_uri = os.path.join(
+        intermediate_dir, 'w_accumulation%s.tif' % file_suffix)
+    s_accumulation_uri = os.path.join(
+        intermediate_dir, 's_accumulation%s.tif' % file_suffix)
+    for factor_uri, accumulation_uri in [
+            (thresholded_w_factor_uri, w_accumulation_uri),
+            (thresholded_slope_uri, s_accumulation_uri)]:
+        LOGGER.info("calculating %s", accumulation_uri)
+        pygeoprocessing.routing.route_flux(
+            flow_direction_uri, aligned_dem_uri, factor_uri,
+            zero_absorption_source_uri, loss_uri, accumulation_uri,
+            'flux_only', aoi_uri=args['watersheds_uri'])
+
+    LOGGER.info('calculating d_dn')
+    d_dn_uri = os.path.join(intermediate_dir, 'd_dn%s.tif' % file_suffix)
+    pygeoprocessing.routing.routing_core.distance_to_stream(
+        flow_direction_uri, stream_uri, d_dn_uri,
+        factor_uri=ws_factor_inverse_uri)
+    d_dn_bare_soil_uri = os.path.join(
+        intermediate_dir, 'd_dn_bare_soil%s.tif' % file_suffix)
+    pygeoprocessing.routing.routing_core.distance_to_stream(
+        flow_direction_uri, stream_uri, d_dn_bare_soil_uri,
+        factor_uri=s_factor_inverse_uri)
+
+    w_bar_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        w_accumulation_uri)
+    s_bar_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+        s_accumulation_uri)
+    d_dn_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(d_dn_uri)
+    d_up_nodata = -1.0
+    ic_nodata = -9999.0
+    sdr_nodata = -9999.0
+    sed_export_nodata = -1.0
+    nodata_sed_retention_index = -1
+    nodata_sediment_retention = -1
+
+    k = float(args['k_param'])
+    ic_0 = float(args['ic_0_param'])
+    sdr_max = float(args['sdr_max'])
+
+    def sdr_from_d_up_d_dn(d_up, d_dn, stream):
+        """Calculates the SDR factor from d_up and d_dn, the intermediate
+            IC factor is rounded to Float32 as it is in the unfused path"""
+        ic_factor = numpy.where(
+            (d_up == d_up_nodata) | (d_dn == d_dn_nodata), ic_nodata,
+            numpy.log10(d_up / d_dn)).astype(numpy.float32)
+        sdr_factor = numpy.where(
+            ic_factor == ic_nodata, sdr_nodata,
+            sdr_max / (1 + numpy.exp((ic_0 - ic_factor) / k)))
+        return numpy.where(stream == 1, 0.0, sdr_factor).astype(numpy.float32)
+
+    def post_routing_op(w_accumulation, s_accumulation, flow_accumulation,
+                        d_dn, d_dn_bare_soil, stream, rkls, usle):
+        """Calculates sediment export, the sediment retention index and
+            sediment retention for a block"""
+        flow_accumulation_mask = flow_accumulation != flow_accumulation_nodata
+        w_bar = numpy.where(
+            (w_accumulation != w_bar_nodata) & flow_accumulation_mask,
+            w_accumulation / flow_accumulation,
+            w_bar_nodata).astype(numpy.float32)
+        s_bar = numpy.where(
+            (s_accumulation != s_bar_nodata) & flow_accumulation_mask,
+            s_accumulation / flow_accumulation,
+            s_bar_nodata).astype(numpy.float32)
+        upstream_area = numpy.sqrt(flow_accumulation * cell_area)
+
+        d_up = numpy.where(
+            (w_bar != w_bar_nodata) & (s_bar != s_bar_nodata) &
+            flow_accumulation_mask, w_bar * s_bar * upstream_area,
+            d_up_nodata).astype(numpy.float32)
+        sdr_factor = sdr_from_d_up_d_dn(d_up, d_dn, stream)
+
+        d_up_bare_soil = numpy.where(
+            (s_bar != s_bar_nodata) & flow_accumulation_mask,
+            s_bar * upstream_area, d_up_nodata).astype(numpy.float32)
+        sdr_factor_bare_soil = sdr_from_d_up_d_dn(
+            d_up_bare_soil, d_dn_bare_soil, stream)
+
+        usle_rkls_nodata_mask = (usle == usle_nodata) | (rkls == rkls_nodata)
+        sed_export = numpy.where(
+            (usle == usle_nodata) | (sdr_factor == sdr_nodata),
+            sed_export_nodata, usle * sdr_factor)
+        sed_retention_index = numpy.where(
+            usle_rkls_nodata_mask | (sdr_factor == sdr_nodata),
+            nodata_sed_retention_index,
+            (rkls - usle) * sdr_factor / sdr_max)
+        sed_retention = numpy.where(
+            usle_rkls_nodata_mask | (stream == stream_nodata) |
+            (sdr_factor == sdr_nodata) | (sdr_factor_bare_soil == sdr_nodata),
+            nodata_sediment_retention,
+            (rkls * sdr_factor_bare_soil - usle * sdr_factor) * (1 - stream))
+        return sed_export, sed_retention_index, sed_retention
+
+    sed_export_uri = os.path.join(output_dir, 'sed_export%s.tif' % file_suffix)
+    sed_retention_index_uri = os.path.join(
+        output_dir, 'sed_retention_index%s.tif' % file_suffix)
+    sed_retention_uri = os.path.join(
+        intermediate_dir, 'sed_retention%s.tif' % file_suffix)
+
+    LOGGER.info('calculating sediment export and retention')
+    _fused_vectorize_datasets(
+        [w_accumulation_uri, s_accumulation_uri, flow_accumulation_uri,
+         d_dn_uri, d_dn_bare_soil_uri, stream_uri, rkls_uri, usle_uri],
+        post_routing_op,
+        [(sed_export_uri, gdal.GDT_Float32, sed_export_nodata),
+         (sed_retention_index_uri, gdal.GDT_Float32,
+          nodata_sed_retention_index),
+         (sed_retention_uri, gdal.GDT_Float32, nodata_sediment_retention)])
+
+    for ds_uri in [zero_absorption_source_uri, loss_uri, aoi_mask_uri]:
         try:
             os.remove(ds_uri)
         except OSError as e:
             LOGGER.warn("couldn't remove %s because it's still open", ds_uri)
             LOGGER.warn(e)
 
+    return usle_uri, sed_export_uri, sed_retention_uri
+
+
+def _reclassify_block(
+        lulc_block, lulc_nodata_mask, lucode_array, value_array, out_nodata):
+    """Maps the lulc codes in a block to values in the same way
+        reclassify_dataset_uri does with exception_flag='values_required'.
+
+        lulc_block - an integer array of lulc codes
+        lulc_nodata_mask - a boolean array that's True where lulc_block is
+            nodata
+        lucode_array - sorted array of the lulc codes in the table
+        value_array - array of the values that correspond to lucode_array
+        out_nodata - the value to write where lulc_block is nodata
+
+        returns a float64 array the same shape as lulc_block"""
+
+    result = numpy.empty(lulc_block.shape, dtype=numpy.float64)
+    result[lulc_nodata_mask] = out_nodata
+    valid_lulc = lulc_block[~lulc_nodata_mask]
+    lucode_index = numpy.searchsorted(lucode_array, valid_lulc)
+    lucode_index[lucode_index == lucode_array.size] = 0
+    missing_mask = lucode_array[lucode_index] != valid_lulc
+    if missing_mask.any():
+        raise ValueError(
+            'The following lulc codes were found in the lulc raster but not '
+            'in the biophysical table: %s' % str(
+                numpy.unique(valid_lulc[missing_mask])))
+    result[~lulc_nodata_mask] = value_array[lucode_index]
+    return result
+
+
+def _fused_vectorize_datasets(base_uri_list, block_op, target_list):
+    """Evaluates `block_op` on aligned blocks of the base rasters and writes
+        each array it returns into its own target raster.  Unlike
+        vectorize_datasets, several outputs come from a single read of the
+        inputs and no intermediate result touches the disk.
+
+        base_uri_list - a list of uris to single band rasters that all have
+            the same dimensions; the first one defines the block size and
+            the geotransform and projection of the targets
+        block_op - a function that takes one array per raster in
+            base_uri_list and returns a tuple with one array per target
+        target_list - a list of (uri, gdal datatype, nodata) tuples that
+            describe the rasters to create
+
+        returns nothing"""
+
+    base_dataset_list = [gdal.Open(uri) for uri in base_uri_list]
+    n_rows = base_dataset_list[0].RasterYSize
+    n_cols = base_dataset_list[0].RasterXSize
+    for uri, dataset in zip(base_uri_list, base_dataset_list):
+        if (dataset.RasterYSize, dataset.RasterXSize) != (n_rows, n_cols):
+            raise ValueError(
+                '%s has dimensions %d x %d but the fused pass expects %d x '
+                '%d' % (uri, dataset.RasterYSize, dataset.RasterXSize, n_rows,
+                        n_cols))
+    base_band_list = [
+        dataset.GetRasterBand(1) for dataset in base_dataset_list]
+
+    target_dataset_list = []
+    for target_uri, datatype, nodata in target_list:
+        pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+            base_uri_list[0], target_uri, 'GTiff', nodata, datatype)
+        target_dataset_list.append(gdal.Open(target_uri, gdal.GA_Update))
+    target_band_list = [
+        dataset.GetRasterBand(1) for dataset in target_dataset_list]
+
+    cols_per_block, rows_per_block = base_band_list[0].GetBlockSize()
+    n_col_blocks = int(math.ceil(n_cols / float(cols_per_block)))
+    n_row_blocks = int(math.ceil(n_rows / float(rows_per_block)))
+
+    for row_block_index in xrange(n_row_blocks):
+        row_offset = row_block_index * rows_per_block
+        row_block_width = min(n_rows - row_offset, rows_per_block)
+
+        for col_block_index in xrange(n_col_blocks):
+            col_offset = col_block_index * cols_per_block
+            col_block_width = min(n_cols - col_offset, cols_per_block)
+
+            block_list = [
+                band.ReadAsArray(
+                    xoff=col_offset, yoff=row_offset,
+                    win_xsize=col_block_width, win_ysize=row_block_width)
+                for band in base_band_list]
+            result_list = block_op(*block_list)
+            for target_band, result in zip(target_band_list, result_list):
+                target_band.WriteArray(
+                    result, xoff=col_offset, yoff=row_offset)
+
+    for target_band in target_band_list:
+        target_band.FlushCache()
+    base_band_list = None
+    base_dataset_list = None
+    target_band_list = None
+    target_dataset_list = None
+
 
 def calculate_ls_factor(
     flow_accumulation_uri, slope_uri, aspect_uri, ls_factor_uri, ls_nodata):
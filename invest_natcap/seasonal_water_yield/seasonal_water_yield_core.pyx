@@ -29,6 +29,9 @@ cdef extern from "time.h" nogil:
 
 import pygeoprocessing
 
+import invest_natcap.block_cache
+from invest_natcap.block_cache cimport BlockCache
+
 logging.basicConfig(format='%(asctime)s %(name)-18s %(levelname)-8s \
     %(message)s', lnevel=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 
@@ -38,147 +41,8 @@ cdef int N_MONTHS = 12
 
 cdef double PI = 3.141592653589793238462643383279502884
 cdef double INF = numpy.inf
-cdef int N_BLOCK_ROWS = 6
-cdef int N_BLOCK_COLS = 6
-
-cdef class BlockCache_SWY:
-    cdef numpy.int32_t[:,:] row_tag_cache
-    cdef numpy.int32_t[:,:] col_tag_cache
-    cdef numpy.int8_t[:,:] cache_dirty
-    cdef int n_block_rows
-    cdef int n_block_cols
-    cdef int block_col_size
-    cdef int block_row_size
-    cdef int n_rows
-    cdef int n_cols
-    band_list = []
-    block_list = []
-    update_list = []
-
-    def __cinit__(
-            self, int n_block_rows, int n_block_cols, int n_rows, int n_cols,
-            int block_row_size, int block_col_size, band_list, block_list,
-            update_list, numpy.int8_t[:,:] cache_dirty):
-        self.n_block_rows = n_block_rows
-        self.n_block_cols = n_block_cols
-        self.block_col_size = block_col_size
-        self.block_row_size = block_row_size
-        self.n_rows = n_rows
-        self.n_cols = n_cols
-        self.row_tag_cache = numpy.zeros((n_block_rows, n_block_cols), dtype=numpy.int32)
-        self.col_tag_cache = numpy.zeros((n_block_rows, n_block_cols), dtype=numpy.int32)
-        self.cache_dirty = cache_dirty
-        self.row_tag_cache[:] = -1
-        self.col_tag_cache[:] = -1
-        self.band_list[:] = band_list
-        self.block_list[:] = block_list
-        self.update_list[:] = update_list
-        list_lengths = [len(x) for x in [band_list, block_list, update_list]]
-        if len(set(list_lengths)) > 1:
-            raise ValueError(
-                "lengths of band_list, block_list, update_list should be equal."
-                " instead they are %s", list_lengths)
-        raster_dimensions_list = [(b.YSize, b.XSize) for b in band_list]
-        for raster_n_rows, raster_n_cols in raster_dimensions_list:
-            if raster_n_rows != n_rows or raster_n_cols != n_cols:
-                raise ValueError(
-                    "a band was passed in that has a different dimension than"
-                    "the memory block was specified as")
-
-        for band in band_list:
-            block_col_size, block_row_size = band.GetBlockSize()
-            if block_col_size == 1 or block_row_size == 1:
-                LOGGER.warn(
-                    'a band in BlockCache is not memory blocked, this might '
-                    'make the runtime slow for other algorithms. %s',
-                    band.GetDescription())
-
-    def __dealloc__(self):
-        self.band_list[:] = []
-        self.block_list[:] = []
-        self.update_list[:] = []
-
-    #@cython.boundscheck(False)
-    @cython.wraparound(False)
-    #@cython.cdivision(True)
-    cdef void update_cache(self, int global_row, int global_col, int *row_index, int *col_index, int *row_block_offset, int *col_block_offset):
-        cdef int cache_row_size, cache_col_size
-        cdef int global_row_offset, global_col_offset
-        cdef int row_tag, col_tag
-
-        row_block_offset[0] = global_row % self.block_row_size
-        row_index[0] = (global_row // self.block_row_size) % self.n_block_rows
-        row_tag = (global_row // self.block_row_size) // self.n_block_rows
-
-        col_block_offset[0] = global_col % self.block_col_size
-        col_index[0] = (global_col // self.block_col_size) % self.n_block_cols
-        col_tag = (global_col // self.block_col_size) // self.n_block_cols
-
-        cdef int current_row_tag = self.row_tag_cache[row_index[0], col_index[0]]
-        cdef int current_col_tag = self.col_tag_cache[row_index[0], col_index[0]]
-
-        if current_row_tag != row_tag or current_col_tag != col_tag:
-            if self.cache_dirty[row_index[0], col_index[0]]:
-                global_col_offset = (current_col_tag * self.n_block_cols + col_index[0]) * self.block_col_size
-                cache_col_size = self.n_cols - global_col_offset
-                if cache_col_size > self.block_col_size:
-                    cache_col_size = self.block_col_size
-
-                global_row_offset = (current_row_tag * self.n_block_rows + row_index[0]) * self.block_row_size
-                cache_row_size = self.n_rows - global_row_offset
-                if cache_row_size > self.block_row_size:
-                    cache_row_size = self.block_row_size
-
-                for band, block, update in zip(self.band_list, self.block_list, self.update_list):
-                    if update:
-                        band.WriteArray(block[row_index[0], col_index[0], 0:cache_row_size, 0:cache_col_size],
-                            yoff=global_row_offset, xoff=global_col_offset)
-                self.cache_dirty[row_index[0], col_index[0]] = 0
-            self.row_tag_cache[row_index[0], col_index[0]] = row_tag
-            self.col_tag_cache[row_index[0], col_index[0]] = col_tag
-
-            global_col_offset = (col_tag * self.n_block_cols + col_index[0]) * self.block_col_size
-            global_row_offset = (row_tag * self.n_block_rows + row_index[0]) * self.block_row_size
-
-            cache_col_size = self.n_cols - global_col_offset
-            if cache_col_size > self.block_col_size:
-                cache_col_size = self.block_col_size
-            cache_row_size = self.n_rows - global_row_offset
-            if cache_row_size > self.block_row_size:
-                cache_row_size = self.block_row_size
-
-            for band_index, (band, block) in enumerate(zip(self.band_list, self.block_list)):
-                band.ReadAsArray(
-                    xoff=global_col_offset, yoff=global_row_offset,
-                    win_xsize=cache_col_size, win_ysize=cache_row_size,
-                    buf_obj=block[row_index[0], col_index[0], 0:cache_row_size, 0:cache_col_size])
-
-    cdef void flush_cache(self):
-        cdef int global_row_offset, global_col_offset
-        cdef int cache_row_size, cache_col_size
-        cdef int row_index, col_index
-        for row_index in xrange(self.n_block_rows):
-            for col_index in xrange(self.n_block_cols):
-                row_tag = self.row_tag_cache[row_index, col_index]
-                col_tag = self.col_tag_cache[row_index, col_index]
-
-                if self.cache_dirty[row_index, col_index]:
-                    global_col_offset = (col_tag * self.n_block_cols + col_index) * self.block_col_size
-                    cache_col_size = self.n_cols - global_col_offset
-                    if cache_col_size > self.block_col_size:
-                        cache_col_size = self.block_col_size
-
-                    global_row_offset = (row_tag * self.n_block_rows + row_index) * self.block_row_size
-                    cache_row_size = self.n_rows - global_row_offset
-                    if cache_row_size > self.block_row_size:
-                        cache_row_size = self.block_row_size
-
-                    for band, block, update in zip(self.band_list, self.block_list, self.update_list):
-                        if update:
-                            band.WriteArray(block[row_index, col_index, 0:cache_row_size, 0:cache_col_size],
-                                yoff=global_row_offset, xoff=global_col_offset)
-        for band in self.band_list:
-            band.FlushCache()
+#number of blocks cached per raster unless a block_cache memory budget is set
+cdef int N_CACHE_SLOTS = 36
 
 #@cython.boundscheck(False)
 @cython.wraparound(False)
@@ -212,36 +76,42 @@ cdef route_recharge(
     cdef int neighbor_row_index, neighbor_col_index #neighbor cache index
     cdef int neighbor_row_block_offset, neighbor_col_block_offset #index into the neighbor cache block
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int8, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.float32] +
+        [numpy.float32, numpy.float32, numpy.float32] * N_MONTHS)
+
     #define all the single caches
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] kc_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] recharge_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] recharge_avail_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_sum_avail_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] aet_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] stream_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
 
 
     #these are 12 band blocks
     cdef numpy.ndarray[numpy.npy_float32, ndim=5] precip_block_list = numpy.zeros(
-        (N_MONTHS, N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (N_MONTHS, n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=5] et0_block_list = numpy.zeros(
-        (N_MONTHS, N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (N_MONTHS, n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=5] qfi_block_list = numpy.zeros(
-        (N_MONTHS, N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (N_MONTHS, n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
 
     cdef numpy.ndarray[numpy.npy_int8, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways), dtype=numpy.int8)
 
     cdef int outflow_direction_nodata = pygeoprocessing.get_nodata_from_uri(
         outflow_direction_uri)
@@ -332,8 +202,8 @@ cdef route_recharge(
 
     cache_dirty[:] = 0
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols,
         block_row_size, block_col_size,
         band_list, block_list, update_list, cache_dirty)
 
@@ -526,8 +396,13 @@ def calculate_flow_weights(
     cdef int block_col_size, block_row_size
     block_col_size, block_row_size = flow_direction_band.GetBlockSize()
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.int8, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] flow_direction_block = numpy.empty(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
 
     #This is the array that's used to keep track of the connections of the
     #current cell to those *inflowing* to the cell, thus the 8 directions
@@ -541,7 +416,7 @@ def calculate_flow_weights(
     outflow_direction_dataset = gdal.Open(outflow_direction_uri, gdal.GA_Update)
     outflow_direction_band = outflow_direction_dataset.GetRasterBand(1)
     cdef numpy.ndarray[numpy.npy_byte, ndim=4] outflow_direction_block = (
-        numpy.empty((N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8))
+        numpy.empty((n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8))
 
     cdef double outflow_weights_nodata = -1.0
     pygeoprocessing.new_raster_from_base_uri(
@@ -550,7 +425,7 @@ def calculate_flow_weights(
     outflow_weights_dataset = gdal.Open(outflow_weights_uri, gdal.GA_Update)
     outflow_weights_band = outflow_weights_dataset.GetRasterBand(1)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = (
-        numpy.empty((N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32))
+        numpy.empty((n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32))
 
     #center point of global index
     cdef int global_row, global_col, global_block_row, global_block_col #index into the overall raster
@@ -564,15 +439,15 @@ def calculate_flow_weights(
 
     #define all the caches
     cdef numpy.ndarray[numpy.npy_int8, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways), dtype=numpy.int8)
 
     cache_dirty[:] = 0
     band_list = [flow_direction_band, outflow_direction_band, outflow_weights_band]
     block_list = [flow_direction_block, outflow_direction_block, outflow_weights_block]
     update_list = [False, True, True]
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
 
 
     #The number of diagonal offsets defines the neighbors, angle between them
@@ -819,22 +694,27 @@ def flow_direction_inf(dem_uri, flow_direction_uri):
     cdef int neighbor_row_index, neighbor_col_index #neighbor cache index
     cdef int neighbor_row_block_offset, neighbor_col_block_offset #index into the neighbor cache block
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.float64])
+
     #define all the caches
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] flow_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     #DEM block is a 64 bit float so it can capture the resolution of small DEM offsets
     #from the plateau resolution algorithm.
     cdef numpy.ndarray[numpy.npy_float64, ndim=4] dem_block = numpy.zeros(
-      (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float64)
+      (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float64)
 
-    #the BlockCache_SWY object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
+    #the BlockCache object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
     band_list = [dem_band, flow_band]
     block_list = [dem_block, flow_block]
     update_list = [False, True]
-    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int row_offset, col_offset
 
@@ -1026,23 +906,28 @@ def distance_to_stream(
     cdef int n_global_block_rows = int(ceil(float(n_rows) / block_row_size))
     cdef int n_global_block_cols = int(ceil(float(n_cols) / block_col_size))
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.int8, numpy.float32, numpy.float32, numpy.int8, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] stream_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int8))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.float32))
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] distance_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] processed_cell_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int8))
 
     band_list = [stream_band, outflow_direction_band, outflow_weights_band,
@@ -1055,7 +940,7 @@ def distance_to_stream(
     cdef int factor_exists = (factor_uri != None)
     if factor_exists:
         factor_block = numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.float32)
         factor_ds = gdal.Open(factor_uri)
         factor_band = factor_ds.GetRasterBand(1)
@@ -1064,10 +949,10 @@ def distance_to_stream(
         update_list.append(False)
 
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = (
-        numpy.zeros((N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte))
+        numpy.zeros((n_cache_sets, n_cache_ways), dtype=numpy.byte))
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     #center point of global index
@@ -1398,26 +1283,31 @@ def percent_to_sink(
 
     #define all the caches
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int32, numpy.float32, numpy.int8, numpy.float32, numpy.float32, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] sink_pixels_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] export_rate_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] out_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] effect_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
-    #the BlockCache_SWY object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
+    #the BlockCache object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
     block_list = [sink_pixels_block, export_rate_block, outflow_direction_block, outflow_weights_block, effect_block]
     band_list = [sink_pixels_band, export_rate_band, outflow_direction_band, outflow_weights_band, effect_band]
     update_list = [False, False, False, False, True]
-    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef float outflow_weight, neighbor_outflow_weight
     cdef int neighbor_outflow_direction
@@ -1554,23 +1444,28 @@ cdef flat_edges(
     cdef int n_rows = dem_ds.RasterYSize
     cdef int n_cols = dem_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] flow_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] dem_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
 
     band_list = [dem_band, flow_band]
     block_list = [dem_block, flow_block]
     update_list = [False, False]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
     block_col_size, block_row_size = dem_band.GetBlockSize()
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int n_global_block_rows = int(ceil(float(n_rows) / block_row_size))
@@ -1705,23 +1600,28 @@ cdef label_flats(dem_uri, deque[int] &low_edges, labels_uri):
     cdef int n_rows = dem_ds.RasterYSize
     cdef int n_cols = dem_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] labels_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] dem_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
 
     band_list = [dem_band, labels_band]
     block_list = [dem_block, labels_block]
     update_list = [False, True]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
     block_col_size, block_row_size = dem_band.GetBlockSize()
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int n_global_block_rows = int(ceil(float(n_rows) / block_row_size))
@@ -1851,18 +1751,23 @@ cdef clean_high_edges(labels_uri, deque[int] &high_edges):
     cdef int n_rows = labels_ds.RasterYSize
     cdef int n_cols = labels_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int32])
+
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] labels_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.int32)
 
     band_list = [labels_band]
     block_list = [labels_block]
     update_list = [False]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int labels_nodata = pygeoprocessing.get_nodata_from_uri(
@@ -1998,25 +1903,30 @@ cdef away_from_higher(
     cdef int n_rows = labels_ds.RasterYSize
     cdef int n_cols = labels_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int32, numpy.int32, numpy.int32])
+
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] labels_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] flat_mask_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] flow_direction_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int32))
 
     band_list = [labels_band, flat_mask_band, flow_direction_band]
     block_list = [labels_block, flat_mask_block, flow_direction_block]
     update_list = [False, True, False]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int cell_row_index, cell_col_index
@@ -2170,25 +2080,30 @@ cdef towards_lower(
     cdef int n_rows = labels_ds.RasterYSize
     cdef int n_cols = labels_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int32, numpy.int32, numpy.int32])
+
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] labels_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] flat_mask_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] flow_direction_block = (
         numpy.zeros(
-            (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+            (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
             dtype=numpy.int32))
 
     band_list = [labels_band, flat_mask_band, flow_direction_band]
     block_list = [labels_block, flat_mask_block, flow_direction_block]
     update_list = [False, True, False]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int cell_row_index, cell_col_index
@@ -2402,24 +2317,29 @@ def flow_direction_inf_masked_flow_dirs(
     cdef int neighbor_row_index, neighbor_col_index #neighbor cache index
     cdef int neighbor_row_block_offset, neighbor_col_block_offset #index into the neighbor cache block
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.int32, numpy.int32])
+
     #define all the caches
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] flow_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     #flat_mask block is a 64 bit float so it can capture the resolution of small flat_mask offsets
     #from the plateau resolution algorithm.
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] flat_mask_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int32)
     cdef numpy.ndarray[numpy.npy_int32, ndim=4] label_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int32)
 
-    #the BlockCache_SWY object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
+    #the BlockCache object needs parallel lists of bands, blocks, and boolean tags to indicate which ones are updated
     band_list = [flat_mask_band, flow_band, label_band]
     block_list = [flat_mask_block, flow_block, label_block]
     update_list = [False, True, False]
-    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+    cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros((n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size, block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef int row_offset, col_offset
 
@@ -2589,21 +2509,26 @@ cdef find_outlets(dem_uri, flow_direction_uri, deque[int] &outlet_deque):
     cdef int n_rows = dem_ds.RasterYSize
     cdef int n_cols = dem_ds.RasterXSize
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.float32, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] dem_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] flow_direction_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size),
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size),
         dtype=numpy.float32)
 
     band_list = [dem_band, flow_direction_band]
     block_list = [dem_block, flow_direction_block]
     update_list = [False, False]
     cdef numpy.ndarray[numpy.npy_byte, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.byte)
+        (n_cache_sets, n_cache_ways), dtype=numpy.byte)
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols, block_row_size,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols, block_row_size,
         block_col_size, band_list, block_list, update_list, cache_dirty)
 
     cdef float dem_nodata = pygeoprocessing.get_nodata_from_uri(dem_uri)
@@ -2734,17 +2659,22 @@ def calculate_r_sum_avail_pour(
     n_global_block_rows = int(numpy.ceil(float(n_rows) / block_row_size))
     n_global_block_cols = int(numpy.ceil(float(n_cols) / block_col_size))
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int8, numpy.float32, numpy.float32, numpy.float32])
+
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_sum_avail_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_sum_avail_pour_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
 
     cdef numpy.ndarray[numpy.npy_int8, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways), dtype=numpy.int8)
 
     outflow_direction_dataset = gdal.Open(outflow_direction_uri)
     outflow_direction_band = outflow_direction_dataset.GetRasterBand(1)
@@ -2766,8 +2696,8 @@ def calculate_r_sum_avail_pour(
     update_list = [False, False, False, True]
     cache_dirty[:] = 0
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols,
         block_row_size, block_col_size,
         band_list, block_list, update_list, cache_dirty)
 
@@ -2884,26 +2814,31 @@ def route_sf(
     cdef int neighbor_row_index, neighbor_col_index #neighbor cache index
     cdef int neighbor_row_block_offset, neighbor_col_block_offset #index into the neighbor cache block
 
+    cdef int n_cache_sets, n_cache_ways
+    n_cache_sets, n_cache_ways = invest_natcap.block_cache.cache_geometry(
+        N_CACHE_SLOTS, block_row_size, block_col_size,
+        [numpy.int8, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.float32, numpy.int8])
+
     #define all the single caches
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] outflow_direction_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] outflow_weights_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_avail_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_sum_avail_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] r_sum_avail_pour_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] sf_down_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_float32, ndim=4] sf_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.float32)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.float32)
     cdef numpy.ndarray[numpy.npy_int8, ndim=4] stream_block = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS, block_row_size, block_col_size), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways, block_row_size, block_col_size), dtype=numpy.int8)
 
     cdef numpy.ndarray[numpy.npy_int8, ndim=2] cache_dirty = numpy.zeros(
-        (N_BLOCK_ROWS, N_BLOCK_COLS), dtype=numpy.int8)
+        (n_cache_sets, n_cache_ways), dtype=numpy.int8)
 
     cdef int outflow_direction_nodata = pygeoprocessing.get_nodata_from_uri(
         outflow_direction_uri)
@@ -2951,8 +2886,8 @@ def route_sf(
     update_list = [False] * 6 + [True] * 2
     cache_dirty[:] = 0
 
-    cdef BlockCache_SWY block_cache = BlockCache_SWY(
-        N_BLOCK_ROWS, N_BLOCK_COLS, n_rows, n_cols,
+    cdef BlockCache block_cache = BlockCache(
+        n_cache_sets, n_cache_ways, n_rows, n_cols,
         block_row_size, block_col_size,
         band_list, block_list, update_list, cache_dirty)
 
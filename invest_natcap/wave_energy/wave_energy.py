@@ -20,6 +20,10 @@ logging.basicConfig(format='%(asctime)s %(name)-20s %(levelname)-8s \
 %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 LOGGER = logging.getLogger('invest_natcap.wave_energy.wave_energy')
 
+# Number of wave points whose seastate bins are read from the memory mapped
+# WW3 data at once when computing the captured wave energy
+WAVE_POINT_BLOCK_SIZE = 2**12
+
 def execute(args):
     """
     Executes both the biophysical and valuation parts of the
@@ -188,7 +192,7 @@ def execute(args):
     analysis_area_uri = args['analysis_area_uri']
     # Use the analysis area String to get the uri's to the wave seastate data,
     # the wave point shapefile, and the polygon extract shapefile
-    wave_seastate_bins = load_binary_wave_data(
+    wave_seastate_bins = load_binary_wave_tensor(
             analysis_dict[analysis_area_uri]['ww3_uri'])
     analysis_area_points_uri = analysis_dict[analysis_area_uri]['point_shape']
     analysis_area_extract_uri = \
@@ -400,8 +404,11 @@ def execute(args):
 
     # Create a dictionary with the wave energy capacity sums from each location
     LOGGER.info('Calculating Captured Wave Energy.')
-    energy_cap = compute_wave_energy_capacity(
-        wave_seastate_bins, energy_interp, machine_param_dict)
+    energy_cap_array = compute_wave_energy_capacity_batch(
+        wave_seastate_bins, [energy_interp], [machine_param_dict])[0]
+    energy_cap = dict(zip(
+        [tuple(point) for point in wave_seastate_bins['points'].tolist()],
+        energy_cap_array.tolist()))
 
     # Add the sum as a field to the shapefile for the corresponding points
     LOGGER.debug('Adding the wave energy sums to the WaveData shapefile')
@@ -840,56 +847,73 @@ def load_binary_wave_data(wave_file_uri):
                }
     """
     LOGGER.debug('Extrapolating wave data from text to a dictionary')
-    wave_file = open(wave_file_uri, 'rb')
+    wave_tensor = load_binary_wave_tensor(wave_file_uri)
     wave_dict = {}
-    # Create a key that hosts another dictionary where the matrix representation
-    # of the seastate bins will be saved
     wave_dict['bin_matrix'] = {}
-    wave_array = None
-    wave_periods = []
-    wave_heights = []
-    key = None
-
-    # get rows,cols
-    row_col_bin = wave_file.read(8)
-    n_cols, n_rows = struct.unpack('ii', row_col_bin)
+    for point, bin_matrix in itertools.izip(
+            wave_tensor['points'].tolist(), wave_tensor['bin_tensor']):
+        wave_dict['bin_matrix'][tuple(point)] = np.array(
+            bin_matrix, dtype=np.float64)
 
-    # get the periods and heights
-    line = wave_file.read(n_cols * 4)
-
-    wave_periods = list(struct.unpack('f' * n_cols, line))
-    line = wave_file.read(n_rows * 4)
-    wave_heights = list(struct.unpack('f' * n_rows, line))
+    # Add row/col header to dictionary
+    LOGGER.debug('WaveData col %s', wave_tensor['periods'])
+    wave_dict['periods'] = wave_tensor['periods']
+    LOGGER.debug('WaveData row %s', wave_tensor['heights'])
+    wave_dict['heights'] = wave_tensor['heights']
+    LOGGER.debug('Finished extrapolating wave data to dictionary')
+    return wave_dict
 
-    key = None
-    while True:
-        line = wave_file.read(8)
-        if len(line) == 0:
-            # end of file
-            wave_dict['bin_matrix'][key] = np.array(wave_array)
-            break
 
-        if key != None:
-            wave_dict['bin_matrix'][key] = np.array(wave_array)
+def load_binary_wave_tensor(wave_file_uri):
+    """Memory maps the seastate bins of a binary WW3 file as a single
+        (points, heights, periods) array.  The file starts with the number
+        of periods and heights as two ints, then the periods and heights as
+        floats, followed by a record per point of its (I,J) as two ints and
+        its heights x periods matrix of hours as floats.
 
-        # Clear out array
-        wave_array = []
+        wave_file_uri - The path to a pickled binary WW3 file.
 
-        key = struct.unpack('ii', line)
+        returns - A dictionary with the following structure:
+               {'periods': [1,2,3,4,...],
+                'heights': [.5,1.0,1.5,...],
+                'points': an (n_points, 2) int array of the (I,J) of each
+                    point,
+                'bin_tensor': an (n_points, n_heights, n_periods) float32
+                    array, memory mapped from wave_file_uri, of the hours
+                    each seastate occurs at each point
+               }
+    """
+    wave_file = open(wave_file_uri, 'rb')
+    # get rows,cols
+    n_cols, n_rows = struct.unpack('ii', wave_file.read(8))
+    # get the periods and heights
+    wave_periods = np.array(
+        struct.unpack('f' * n_cols, wave_file.read(n_cols * 4)), dtype='f')
+    wave_heights = np.array(
+        struct.unpack('f' * n_rows, wave_file.read(n_rows * 4)), dtype='f')
+    wave_file.close()
 
-        for _ in itertools.repeat(None, n_rows):
-            line = wave_file.read(n_cols * 4)
-            array = list(struct.unpack('f' * n_cols, line))
-            wave_array.append(array)
+    header_size = 8 + (n_cols + n_rows) * 4
+    record_dtype = np.dtype([
+        ('point', 'i4', (2,)), ('bins', 'f4', (n_rows, n_cols))])
+    n_points = (
+        (os.path.getsize(wave_file_uri) - header_size) /
+        record_dtype.itemsize)
+    LOGGER.debug('%d wave points in %s', n_points, wave_file_uri)
+
+    if n_points > 0:
+        records = np.memmap(
+            wave_file_uri, dtype=record_dtype, mode='r', offset=header_size,
+            shape=(n_points,))
+    else:
+        records = np.zeros(0, dtype=record_dtype)
 
-    wave_file.close()
-    # Add row/col header to dictionary
-    LOGGER.debug('WaveData col %s', wave_periods)
-    wave_dict['periods'] = np.array(wave_periods, dtype='f')
-    LOGGER.debug('WaveData row %s', wave_heights)
-    wave_dict['heights'] = np.array(wave_heights, dtype='f')
-    LOGGER.debug('Finished extrapolating wave data to dictionary')
-    return wave_dict
+    return {
+        'periods': wave_periods,
+        'heights': wave_heights,
+        'points': np.array(records['point']),
+        'bin_tensor': records['bins'],
+        }
 
 
 def pixel_size_helper(shape_path, coord_trans, coord_trans_opposite, ds_uri):
@@ -1340,70 +1364,90 @@ def compute_wave_energy_capacity(wave_data, interp_z, machine_param):
     returns - A dictionary representing the wave energy capacity at
               each wave point"""
 
-    energy_cap = {}
-
-    # Get the row,col headers (ranges) for the wave watch data
-    # row is wave period label
-    # col is wave height label
-    wave_periods = wave_data['periods']
-    wave_heights = wave_data['heights']
-
-    # Get the machine parameter restriction values
-    cap_max = float(machine_param['capmax'])
-    period_max = float(machine_param['tpmax'])
-    height_max = float(machine_param['hsmax'])
-
-    # It seems that the capacity max is already set to it's limit in
-    # the machine performance table. However, if it needed to be
-    # restricted the following line will do it
-    interp_z = np.array(interp_z)
-    interp_z[interp_z > cap_max] = cap_max
-
-    # Set position variables to use as a check and as an end
-    # point for rows/cols if restrictions limit the ranges
-    period_max_index = -1
-    height_max_index = -1
-
-    # Using the restrictions find the max position (index) for period and height
-    # in the wave_periods/wave_heights ranges
-
-    for index_pos, value in enumerate(wave_periods):
-        if (value > period_max):
-            period_max_index = index_pos
-            break
-
-    for index_pos, value in enumerate(wave_heights):
-        if (value > height_max):
-            height_max_index = index_pos
-            break
-
-    LOGGER.debug('Position of max period : %f', period_max_index)
-    LOGGER.debug('Position of max height : %f', height_max_index)
-
-    # For all the wave watch points, multiply the occurence matrix by the
-    # interpolated machine performance matrix to get the captured wave energy
-    for key, val in wave_data['bin_matrix'].iteritems():
-        # Convert all values to type float
-        temp_matrix = np.array(val, dtype='f')
-        mult_matrix = np.multiply(temp_matrix, interp_z)
+    point_list = wave_data['bin_matrix'].keys()
+    wave_tensor = {
+        'periods': wave_data['periods'],
+        'heights': wave_data['heights'],
+        'bin_tensor': np.array(
+            [wave_data['bin_matrix'][point] for point in point_list],
+            dtype='f'),
+        }
+    energy_cap = compute_wave_energy_capacity_batch(
+        wave_tensor, [interp_z], [machine_param])[0]
+    return dict(zip(point_list, energy_cap.tolist()))
+
+
+def compute_wave_energy_capacity_batch(
+        wave_tensor, interp_z_list, machine_param_list):
+    """Computes the wave energy capacity of every point for several machines
+        at once.  The occurence tensor is streamed through in blocks of
+        points, and each block is contracted against all of the machines'
+        performance matrices in a single tensordot.
+
+        wave_tensor - A dictionary as returned by load_binary_wave_tensor,
+            only the 'periods', 'heights' and 'bin_tensor' keys are used
+        interp_z_list - A list of 2D arrays of the interpolated values of
+            each machine's performance table, see wave_energy_interp
+        machine_param_list - A list of dictionaries containing the
+            restrictions (CapMax, TpMax, HsMax) of each machine, parallel to
+            interp_z_list
+
+    returns - An (n_machines, n_points) array of the captured wave energy in
+              mega watts"""
+
+    wave_periods = wave_tensor['periods']
+    wave_heights = wave_tensor['heights']
+    bin_tensor = wave_tensor['bin_tensor']
+
+    machine_z_list = []
+    for interp_z, machine_param in zip(interp_z_list, machine_param_list):
+        # Get the machine parameter restriction values
+        cap_max = float(machine_param['capmax'])
+        period_max = float(machine_param['tpmax'])
+        height_max = float(machine_param['hsmax'])
+
+        # It seems that the capacity max is already set to it's limit in
+        # the machine performance table. However, if it needed to be
+        # restricted the following line will do it
+        machine_z = np.array(interp_z, dtype=np.float64)
+        machine_z[machine_z > cap_max] = cap_max
+
         # Set any value that is outside the restricting ranges provided by
-        # machine parameters to zero
-        if period_max_index != -1:
-            mult_matrix[:, period_max_index:] = 0
-        if height_max_index != -1:
-            mult_matrix[height_max_index:, :] = 0
-
-        # Since we are doing a cubic interpolation there is a possibility we
-        # will have negative values where they should be zero. So here
-        # we drive any negative values to zero.
-        mult_matrix[mult_matrix < 0] = 0
-
-        # Sum all of the values from the matrix to get the total
-        # captured wave energy and convert into mega watts
-        sum_we = (mult_matrix.sum() / 1000)
-        energy_cap[key] = sum_we
-
-    return energy_cap
+        # machine parameters to zero, the ranges end at the first period and
+        # height above the machine's maximums
+        period_max_index = np.flatnonzero(wave_periods > period_max)
+        if period_max_index.size > 0:
+            machine_z[:, period_max_index[0]:] = 0
+        height_max_index = np.flatnonzero(wave_heights > height_max)
+        if height_max_index.size > 0:
+            machine_z[height_max_index[0]:, :] = 0
+        machine_z_list.append(machine_z)
+
+    # Since we are doing a cubic interpolation there is a possibility we
+    # will have negative products where they should be zero. max(b*z, 0) is
+    # max(b,0)*max(z,0) + min(b,0)*min(z,0), so negatives are driven to zero
+    # by contracting the positive and negative parts separately.
+    machine_z_tensor = np.array(machine_z_list)
+    positive_z = np.maximum(machine_z_tensor, 0)
+    negative_z = np.minimum(machine_z_tensor, 0)
+    has_negative_z = np.any(negative_z < 0)
+
+    n_points = bin_tensor.shape[0]
+    energy_cap = np.zeros((len(machine_z_list), n_points))
+    for block_start in xrange(0, n_points, WAVE_POINT_BLOCK_SIZE):
+        block_end = min(block_start + WAVE_POINT_BLOCK_SIZE, n_points)
+        bin_block = np.asarray(
+            bin_tensor[block_start:block_end], dtype=np.float64)
+        energy_block = np.tensordot(
+            positive_z, np.maximum(bin_block, 0), axes=([1, 2], [1, 2]))
+        if has_negative_z:
+            energy_block += np.tensordot(
+                negative_z, np.minimum(bin_block, 0), axes=([1, 2], [1, 2]))
+        energy_cap[:, block_start:block_end] = energy_block
+
+    # Sum all of the values from the matrix to get the total captured wave
+    # energy and convert into mega watts
+    return energy_cap / 1000
 
 def captured_wave_energy_to_shape(energy_cap, wave_shape_uri):
     """Adds each captured wave energy value from the dictionary
@@ -11,11 +11,13 @@ from osgeo import ogr
 from osgeo import osr
 
 import numpy as np
-from scipy import integrate
+from scipy import special
+from scipy import spatial
 #required for py2exe to build
 from scipy.sparse.csgraph import _validation
 import shapely.wkt
-import shapely.ops
+import shapely.geometry
+import shapely.prepared
 from shapely import speedups
 
 import pygeoprocessing.geoprocessing
@@ -27,6 +29,17 @@ LOGGER = logging.getLogger('invest_natcap.wind_energy.wind_energy')
 
 speedups.enable()
 
+# This is the expected column header list for the binary wind energy file.
+# The data is expected to be in this order so it can be unpacked properly
+WIND_DATA_FIELDS = [
+        "LONG","LATI","Ram-010m","Ram-020m","Ram-030m","Ram-040m",
+        "Ram-050m","Ram-060m","Ram-070m","Ram-080m","Ram-090m","Ram-100m",
+        "Ram-110m","Ram-120m","Ram-130m","Ram-140m","Ram-150m","K-010m"]
+
+# Degrees the AOI's lat/long bounding box is grown by before it's used to
+# filter the wind data points, so points on its edge are never dropped
+AOI_BOUNDING_BOX_MARGIN = 0.1
+
 
 class HubHeightError(Exception):
     """A custom error message for a hub height that is not supported in
@@ -223,16 +236,17 @@ def execute(args):
     # Define a list of the fields that are of interest in the wind data file
     wind_data_field_list = ['LATI', 'LONG', scale_key, 'K-010m']
 
-    # Read the wind energy data into a dictionary
-    LOGGER.info('Reading in Wind Data')
-    wind_data = read_binary_wind_data(
-            args['wind_data_uri'], wind_data_field_list)
-
     if 'aoi_uri' in args:
         LOGGER.info('AOI Provided')
 
         aoi_uri = args['aoi_uri']
 
+        # Only the wind data points around the AOI are read in
+        LOGGER.info('Reading in Wind Data')
+        wind_data = read_binary_wind_array(
+                args['wind_data_uri'], wind_data_field_list,
+                get_lat_long_bounding_box(aoi_uri))
+
         # Since an AOI was provided the wind energy points shapefile will need
         # to be clipped and projected. Thus save the construction of the
         # shapefile from dictionary in the intermediate directory. The final
@@ -242,7 +256,7 @@ def execute(args):
 
         # Create point shapefile from wind data
         LOGGER.info('Create point shapefile from wind data')
-        wind_data_to_point_shape(wind_data, 'wind_data', wind_point_shape_uri)
+        wind_array_to_point_shape(wind_data, 'wind_data', wind_point_shape_uri)
 
         # Define the uri for projecting the wind energy data points to that of
         # the AOI
@@ -344,9 +358,13 @@ def execute(args):
         wind_point_shape_uri = os.path.join(
                 out_dir, 'wind_energy_points%s.shp' % suffix)
 
-        # Create point shapefile from wind data dictionary
+        LOGGER.info('Reading in Wind Data')
+        wind_data = read_binary_wind_array(
+                args['wind_data_uri'], wind_data_field_list)
+
+        # Create point shapefile from wind data
         LOGGER.debug('Create point shapefile from wind data')
-        wind_data_to_point_shape(wind_data, 'wind_data', wind_point_shape_uri)
+        wind_array_to_point_shape(wind_data, 'wind_data', wind_point_shape_uri)
 
         # Set the bathymetry and points URI to use in the rest of the model. In
         # this case these URIs refer to the unprojected files. This may not be
@@ -397,45 +415,6 @@ def execute(args):
     # text file given by CK. I guess we could search for the 'K' if needed.
     shape_key = 'K-010m'
 
-    # Weibull probability function to integrate over
-    def weibull_probability(v_speed, k_shape, l_scale):
-        """Calculate the weibull probability function of variable v_speed
-
-            v_speed - a number representing wind speed
-            k_shape - a float for the shape parameter
-            l_scale - a float for the scale parameter of the distribution
-
-            returns - a float"""
-        return ((k_shape / l_scale) * (v_speed / l_scale)**(k_shape - 1) *
-                (math.exp(-1 * (v_speed/l_scale)**k_shape)))
-
-    # Density wind energy function to integrate over
-    def density_wind_energy_fun(v_speed, k_shape, l_scale):
-        """Calculate the probability density function of a weibull variable
-            v_speed
-
-            v_speed - a number representing wind speed
-            k_shape - a float for the shape parameter
-            l_scale - a float for the scale parameter of the distribution
-
-            returns - a float"""
-        return ((k_shape / l_scale) * (v_speed / l_scale)**(k_shape - 1) *
-                (math.exp(-1 * (v_speed/l_scale)**k_shape))) * v_speed**3
-
-    # Harvested wind energy function to integrate over
-    def harvested_wind_energy_fun(v_speed, k_shape, l_scale):
-        """Calculate the harvested wind energy
-
-            v_speed - a number representing wind speed
-            k_shape - a float for the shape parameter
-            l_scale - a float for the scale parameter of the distribution
-
-            returns - a float"""
-        fract = ((v_speed**exp_pwr_curve - v_in**exp_pwr_curve) /
-            (v_rate**exp_pwr_curve - v_in**exp_pwr_curve))
-
-        return fract * weibull_probability(v_speed, k_shape, l_scale)
-
     # The harvested energy is on a per year basis
     num_days = 365
 
@@ -499,57 +478,52 @@ def execute(args):
             new_field = ogr.FieldDefn(new_field_name, ogr.OFTReal)
             wind_points_layer.CreateField(new_field)
 
-        LOGGER.debug('Entering Density and Harvest Calculations for each point')
-        # For all the locations compute the weibull density and
-        # harvested wind energy. Save in a field of the feature
+        # Read the shape and scale values of all the points so the integrals
+        # can be computed for every point at once
+        shape_list = []
+        scale_list = []
         for feat in wind_points_layer:
-            # Get the scale and shape values
-            scale_value = feat.GetField(scale_index)
-            shape_value = feat.GetField(shape_index)
-
-            # Integrate over the probability density function. 0 and 50 are hard
-            # coded values set in CKs documentation
-            density_results = integrate.quad(
-                    density_wind_energy_fun, 0, 50, (shape_value, scale_value))
-
-            # Compute the final wind power density value
-            density_results = 0.5 * mean_air_density * density_results[0]
-
-            # Integrate over the harvested wind energy function
-            harv_results = integrate.quad(
-                    harvested_wind_energy_fun, v_in, v_rate,
-                    (shape_value, scale_value))
-
-            # Integrate over the weibull probability function
-            weibull_results = integrate.quad(weibull_probability, v_rate, v_out,
-                    (shape_value, scale_value))
-
-            # Compute the final harvested wind energy value
-            harvested_wind_energy = (
-                    scalar * (harv_results[0] + weibull_results[0]))
-
-            # Convert harvested energy from Whr/yr to MWhr/yr by dividing by
-            # 1,000,000
-            harvested_wind_energy = harvested_wind_energy / 1000000.00
-
-            # Now factor in the percent losses due to turbine
-            # downtime (mechanical failure, storm damage, etc.)
-            # and due to electrical resistance in the cables
-            harvested_wind_energy = (1 - losses) * harvested_wind_energy
-
-            # Finally, multiply the harvested wind energy by the number of
-            # turbines to get the amount of energy generated for the entire farm
-            harvested_wind_energy = harvested_wind_energy * number_of_turbines
-
-            # Save the results to their respective fields
-            for field_name, result_value in [
-                    (density_field_name, density_results),
-                    (harvest_field_name, harvested_wind_energy)]:
-                out_index = feat.GetFieldIndex(field_name)
-                feat.SetField(out_index, result_value)
-
-            # Save the feature and set to None to clean up
+            scale_list.append(feat.GetField(scale_index))
+            shape_list.append(feat.GetField(shape_index))
+
+        LOGGER.debug(
+                'Computing Density and Harvest for %d points', len(shape_list))
+        density_integral, harvested_integral = weibull_energy_integrals(
+                np.array(shape_list, dtype=np.float64),
+                np.array(scale_list, dtype=np.float64), v_in, v_rate, v_out,
+                exp_pwr_curve)
+
+        # Compute the final wind power density value
+        density_results = 0.5 * mean_air_density * density_integral
+
+        # Compute the final harvested wind energy value and convert it from
+        # Whr/yr to MWhr/yr by dividing by 1,000,000
+        harvested_wind_energy = scalar * harvested_integral / 1000000.00
+
+        # Now factor in the percent losses due to turbine
+        # downtime (mechanical failure, storm damage, etc.)
+        # and due to electrical resistance in the cables
+        harvested_wind_energy = (1 - losses) * harvested_wind_energy
+
+        # Finally, multiply the harvested wind energy by the number of
+        # turbines to get the amount of energy generated for the entire farm
+        harvested_wind_energy = harvested_wind_energy * number_of_turbines
+
+        # Save the results to their respective fields in one pass over the
+        # features
+        layer_defn = wind_points_layer.GetLayerDefn()
+        density_index = layer_defn.GetFieldIndex(density_field_name)
+        harvest_index = layer_defn.GetFieldIndex(harvest_field_name)
+        density_list = density_results.tolist()
+        harvest_list = harvested_wind_energy.tolist()
+        wind_points_layer.ResetReading()
+        wind_points_layer.StartTransaction()
+        for index, feat in enumerate(wind_points_layer):
+            feat.SetField(density_index, density_list[index])
+            feat.SetField(harvest_index, harvest_list[index])
             wind_points_layer.SetFeature(feat)
+        wind_points_layer.CommitTransaction()
+        wind_points_layer.SyncToDisk()
 
         wind_points = None
 
@@ -1142,6 +1116,59 @@ def execute(args):
                 vectorize_op=False)
     LOGGER.info('Wind Energy Valuation Model Complete')
 
+def weibull_energy_integrals(
+        shape_array, scale_array, v_in, v_rate, v_out, exp_pwr_curve):
+    """Integrate the wind energy density and the harvested wind energy over
+        the Weibull distributions of many points at once. The integrals have
+        closed forms in terms of the regularized lower incomplete gamma
+        function P(a, x), since the integral of v**p times the Weibull
+        probability from 0 to v is
+        scale**p * gamma(1 + p / shape) * P(1 + p / shape, (v / scale)**shape)
+
+        shape_array - a numpy array of the Weibull shape parameters (k)
+        scale_array - a numpy array of the Weibull scale parameters (lambda),
+            parallel to shape_array
+        v_in - a float for the cut in wind speed of the turbine
+        v_rate - a float for the rated wind speed of the turbine
+        v_out - a float for the cut out wind speed of the turbine
+        exp_pwr_curve - a number for the exponent of the power curve between
+            v_in and v_rate
+
+        returns - a tuple of numpy arrays parallel to shape_array. The first is
+            the integral of v**3 times the Weibull probability from 0 to 50,
+            0 and 50 being hard coded values set in CKs documentation. The
+            second is the integral of the fraction of rated power produced
+            times the Weibull probability from v_in to v_out"""
+    shape_array = np.asarray(shape_array, dtype=np.float64)
+    scale_array = np.asarray(scale_array, dtype=np.float64)
+
+    def moment_to(v_speed, power):
+        """Integral of v**power times the Weibull probability from 0 to
+            v_speed"""
+        gamma_a = 1.0 + power / shape_array
+        return (scale_array**power * special.gamma(gamma_a) *
+                special.gammainc(gamma_a, (v_speed / scale_array)**shape_array))
+
+    def probability_to(v_speed):
+        """The Weibull cumulative probability at v_speed"""
+        return -np.expm1(-(v_speed / scale_array)**shape_array)
+
+    density_integral = moment_to(50.0, 3.0)
+
+    # Between v_in and v_rate the turbine produces a fraction
+    # (v**p - v_in**p) / (v_rate**p - v_in**p) of its rated power, and
+    # between v_rate and v_out it produces all of it
+    v_in_pwr = float(v_in)**exp_pwr_curve
+    rate_pwr_range = float(v_rate)**exp_pwr_curve - v_in_pwr
+    cdf_in = probability_to(v_in)
+    cdf_rate = probability_to(v_rate)
+    harvested_integral = (
+        (moment_to(v_rate, exp_pwr_curve) - moment_to(v_in, exp_pwr_curve) -
+         v_in_pwr * (cdf_rate - cdf_in)) / rate_pwr_range +
+        probability_to(v_out) - cdf_rate)
+
+    return density_integral, harvested_integral
+
 def get_shapefile_feature_count(shape_uri):
     """Get the feature count for a shapefile
 
@@ -1255,6 +1282,11 @@ def point_to_polygon_distance(poly_ds_uri, point_ds_uri):
         nearest polygon from a polygon shapefile. Both datasources must be
         projected in meters
 
+        The polygon boundaries are broken into line segments whose midpoints
+        are indexed in a KD-tree, so the nearest segment to every point is
+        found with batched queries instead of measuring each point against
+        the union of all the polygons. Points inside a polygon are 0 away.
+
         poly_ds_uri - a URI to an OGR polygon geometry datasource projected in
             meters
         point_ds_uri - a URI to an OGR point geometry datasource projected in
@@ -1265,52 +1297,174 @@ def point_to_polygon_distance(poly_ds_uri, point_ds_uri):
     point_ds = ogr.Open(point_ds_uri)
 
     poly_layer = poly_ds.GetLayer()
-    # List to store the polygons geometries as shapely objects
-    poly_list = []
+    # List to store the segments of the polygons boundaries as numpy arrays
+    segment_list = []
+    # List to store the areal polygons and their bounding boxes for the
+    # point in polygon tests
+    area_poly_list = []
+    area_bounds_list = []
 
     LOGGER.debug('Loading the polygons into Shapely')
     for poly_feat in poly_layer:
         # Get the geometry of the polygon in WKT format
         poly_wkt = poly_feat.GetGeometryRef().ExportToWkt()
-        # Load the geometry into shapely making it a shapely object
-        shapely_polygon = shapely.wkt.loads(poly_wkt)
-        # Add the shapely polygon geometry to a list, but first simplify the
-        # geometry which smooths the edges making operations a lot faster
-        poly_list.append(
-                shapely_polygon.simplify(0.01, preserve_topology=False))
-
-    # Take the union over the list of polygons to get one defined polygon object
-    LOGGER.debug('Get the collection of polygon geometries by taking the union')
-    polygon_collection = shapely.ops.unary_union(poly_list)
+        # Load the geometry into shapely making it a shapely object, but first
+        # simplify the geometry which smooths the edges making operations a
+        # lot faster
+        shapely_polygon = shapely.wkt.loads(poly_wkt).simplify(
+                0.01, preserve_topology=False)
+        if shapely_polygon.is_empty:
+            continue
+        segment_list.extend(_geometry_segments(shapely_polygon))
+        if shapely_polygon.area > 0:
+            area_poly_list.append(shapely.prepared.prep(shapely_polygon))
+            area_bounds_list.append(shapely_polygon.bounds)
 
     point_layer = point_ds.GetLayer()
-    # List to store the shapely point objects
-    point_list = []
-
-    LOGGER.debug('Loading the points into shapely')
-    for point_feat in point_layer:
-        # Get the geometry of the point in WKT format
-        point_wkt = point_feat.GetGeometryRef().ExportToWkt()
-        # Load the geometry into shapely making it a shapely object
-        shapely_point = shapely.wkt.loads(point_wkt)
-        # Add the point to a list to iterate through
-        point_list.append(shapely_point)
-
-    LOGGER.debug('find distances')
-    distances = []
-    for point in point_list:
-        # Get the distance in meters and convert to km
-        point_dist = point.distance(polygon_collection) / 1000.0
-        # Add the distances to a list
-        distances.append(point_dist)
+    # Array to store the point coordinates
+    points = np.zeros((point_layer.GetFeatureCount(), 2))
 
-    LOGGER.debug('Distance List Length : %s', len(distances))
+    LOGGER.debug('Loading the points')
+    for index, point_feat in enumerate(point_layer):
+        point_geom = point_feat.GetGeometryRef()
+        points[index] = [point_geom.GetX(), point_geom.GetY()]
 
     point_ds = None
     poly_ds = None
 
+    if len(segment_list) == 0:
+        raise ValueError('There are no geometries in %s' % poly_ds_uri)
+
+    LOGGER.debug('find distances')
+    distances = nearest_segment_distance(
+            points, np.concatenate(segment_list))
+
+    # Points inside a polygon are on it. Only the points in a polygons
+    # bounding box are tested, found by searching the points sorted by x
+    x_order = np.argsort(points[:, 0])
+    sorted_x = points[x_order, 0]
+    for prepared_polygon, (min_x, min_y, max_x, max_y) in zip(
+            area_poly_list, area_bounds_list):
+        candidates = x_order[np.searchsorted(sorted_x, min_x, side='left'):
+                             np.searchsorted(sorted_x, max_x, side='right')]
+        candidates = candidates[
+                (points[candidates, 1] >= min_y) &
+                (points[candidates, 1] <= max_y) & (distances[candidates] > 0)]
+        for point_index in candidates:
+            if prepared_polygon.contains(shapely.geometry.Point(
+                    points[point_index])):
+                distances[point_index] = 0.0
+
+    LOGGER.debug('Distance List Length : %s', len(distances))
+
+    # Convert the distances in meters to km
+    return (distances / 1000.0).tolist()
+
+def _geometry_segments(geometry):
+    """Breaks the boundary of a shapely geometry into line segments
+
+        geometry - a shapely Point, LineString, LinearRing, Polygon or a
+            collection of them
+
+        returns - a list of numpy arrays of (x0, y0, x1, y1) segments, a point
+            is a segment of length 0"""
+    if geometry.is_empty:
+        return []
+    if (geometry.geom_type.startswith('Multi') or
+            geometry.geom_type == 'GeometryCollection'):
+        segment_list = []
+        for sub_geometry in geometry.geoms:
+            segment_list.extend(_geometry_segments(sub_geometry))
+        return segment_list
+    if geometry.geom_type == 'Polygon':
+        return _geometry_segments(geometry.exterior) + [
+            segments for interior in geometry.interiors
+            for segments in _geometry_segments(interior)]
+
+    coords = np.array(geometry.coords)[:, :2]
+    if len(coords) == 1:
+        return [np.hstack((coords, coords))]
+    return [np.hstack((coords[:-1], coords[1:]))]
+
+def nearest_segment_distance(points, segments, batch_size=2**14):
+    """Calculates the distance from each point to the nearest of a set of
+        line segments
+
+        Long segments are split so that none is much longer than a typical
+        one, then the segment midpoints go in a KD-tree. The exact distance to
+        the segment with the nearest midpoint bounds the distance to the
+        nearest segment, so only segments whose midpoints are within that
+        bound plus half the longest segment length are measured.
+
+        points - a numpy array of (x, y) rows
+        segments - a numpy array of (x0, y0, x1, y1) rows
+        batch_size - the number of points queried at once
+
+        returns - a numpy array of distances parallel to points"""
+    lengths = np.hypot(
+            segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    max_length = 4.0 * np.median(lengths)
+    if max_length > 0:
+        n_pieces = np.maximum(np.ceil(lengths / max_length), 1).astype(int)
+        if (n_pieces > 1).any():
+            segment_index = np.repeat(np.arange(len(segments)), n_pieces)
+            piece_index = np.arange(len(segment_index)) - np.repeat(
+                    np.cumsum(n_pieces) - n_pieces, n_pieces)
+            start = (piece_index / n_pieces[segment_index].astype(float))
+            end = ((piece_index + 1) /
+                   n_pieces[segment_index].astype(float))
+            long_segments = segments[segment_index]
+            delta = long_segments[:, 2:] - long_segments[:, :2]
+            segments = np.hstack((
+                long_segments[:, :2] + start[:, np.newaxis] * delta,
+                long_segments[:, :2] + end[:, np.newaxis] * delta))
+            lengths = lengths[segment_index] / n_pieces[segment_index]
+    search_margin = lengths.max() / 2.0
+
+    midpoint_tree = spatial.cKDTree(
+            (segments[:, :2] + segments[:, 2:]) / 2.0)
+    distances = np.empty(len(points))
+    for batch_start in xrange(0, len(points), batch_size):
+        batch_points = points[batch_start:batch_start + batch_size]
+        _, nearest_midpoint = midpoint_tree.query(batch_points)
+        upper_bound = _point_segment_distance(
+                batch_points, segments[nearest_midpoint])
+
+        # Every segment that could be nearer has its midpoint within the
+        # upper bound plus half its length of the point
+        candidate_lists = midpoint_tree.query_ball_point(
+                batch_points, (upper_bound + search_margin) * (1 + 1e-9) +
+                1e-9)
+        counts = np.array([len(candidates) for candidates in candidate_lists])
+        candidates = np.fromiter(
+                (index for candidate_list in candidate_lists
+                 for index in candidate_list), dtype=int, count=counts.sum())
+        candidate_distances = _point_segment_distance(
+                np.repeat(batch_points, counts, axis=0),
+                segments[candidates])
+        distances[batch_start:batch_start + len(batch_points)] = (
+                np.minimum.reduceat(
+                    candidate_distances, np.cumsum(counts) - counts))
     return distances
 
+def _point_segment_distance(points, segments):
+    """Calculates the distances between points and segments row by row
+
+        points - a numpy array of (x, y) rows
+        segments - a numpy array of (x0, y0, x1, y1) rows parallel to points
+
+        returns - a numpy array of distances"""
+    delta = segments[:, 2:] - segments[:, :2]
+    offset = points - segments[:, :2]
+    length_sq = np.sum(delta**2, axis=1)
+    # The position of the closest point along the segment, clamped to it
+    position = np.clip(
+            np.sum(offset * delta, axis=1) / np.where(
+                length_sq > 0, length_sq, 1.0), 0.0, 1.0)
+    return np.hypot(
+            offset[:, 0] - position * delta[:, 0],
+            offset[:, 1] - position * delta[:, 1])
+
 def read_csv_wind_parameters(csv_uri, parameter_list):
     """Construct a dictionary from a csv file given a list of keys in
         'parameter_list'. The list of keys corresponds to the parameters names
@@ -1522,59 +1676,114 @@ def read_binary_wind_data(wind_data_uri, field_list):
 
     LOGGER.debug('Entering read_wind_data')
 
+    wind_array = read_binary_wind_array(wind_data_uri, field_list)
+
     wind_dict = {}
+    for values in wind_array.tolist():
+        point_dict = dict(zip(wind_array.dtype.names, values))
+        # The key of the output dictionary will be a tuple of the latitude,
+        # longitude
+        wind_dict[(point_dict['LATI'], point_dict['LONG'])] = point_dict
 
-    # This is the expected column header list for the binary wind energy file.
-    # It is expected that the data will be in this order so that we can properly
-    # unpack the information into a dictionary
-    param_list = [
-            "LONG","LATI","Ram-010m","Ram-020m","Ram-030m","Ram-040m",
-            "Ram-050m","Ram-060m","Ram-070m","Ram-080m","Ram-090m","Ram-100m",
-            "Ram-110m","Ram-120m","Ram-130m","Ram-140m","Ram-150m","K-010m"]
+    LOGGER.debug('Leaving read_wind_data')
+    return wind_dict
+
+def read_binary_wind_array(wind_data_uri, field_list, bounding_box=None):
+    """Read the columns of interest of the binary wind data into a numpy
+        structured array. The file is memory mapped and only the points that
+        fall in the bounding box are copied out of it. See
+        read_binary_wind_data for the layout of the file.
+
+        wind_data_uri - a uri for the binary wind data file
+
+        field_list - a list of strings referring to the column headers that
+            are to be included in the array. ['LONG', 'LATI', scale_key,
+            'K-010m']
+
+        bounding_box - (optional) a list of [min_long, min_lat, max_long,
+            max_lat] in WGS84 degrees; points outside of it are left out.
+            Longitudes below -180 are shifted by 360 before the test, as
+            they are when the points are written to a shapefile.
+
+        returns - a numpy structured array with a float32 column per field in
+            field_list, in the order of field_list"""
 
     # Get the scale key from the field list to verify that the hub height given
     # is indeed a valid height handled in the wind energy point data
     scale_key = field_list[2]
 
-    if scale_key not in param_list:
+    if scale_key not in WIND_DATA_FIELDS:
         raise HubHeightError('The Hub Height is not supported by the current '
                 'wind point data. Please make sure the hub height lies '
                 'between 10 and 150 meters')
 
-    # Open the file in reading and binary mode
-    wind_file = open(wind_data_uri, 'rb')
-
-    # Get the length of the expected parameter list to use in unpacking
-    param_list_length = len(param_list)
-
-    # For every line in the file, unpack
-    while True:
-        # Read in line by line where each piece of data is 4 bytes
-        line = wind_file.read(4*param_list_length)
+    # Unpack the data. We are assuming the binary data was packed using the
+    # big indian ordering '<' and that the values are floats.
+    record_dtype = np.dtype(
+        [(field, '<f4') for field in WIND_DATA_FIELDS])
+    n_records = os.path.getsize(wind_data_uri) / record_dtype.itemsize
+    if n_records == 0:
+        return np.empty(0, dtype=[(field, '<f4') for field in field_list])
+    wind_records = np.memmap(
+        wind_data_uri, dtype=record_dtype, mode='r', shape=(n_records,))
+
+    if bounding_box is not None:
+        longitude = wind_records['LONG']
+        longitude = np.where(longitude < -180, longitude + 360, longitude)
+        latitude = wind_records['LATI']
+        in_box = np.flatnonzero(
+            (longitude >= bounding_box[0]) & (latitude >= bounding_box[1]) &
+            (longitude <= bounding_box[2]) & (latitude <= bounding_box[3]))
+        n_points = in_box.size
+        LOGGER.debug(
+            '%d of %d wind points in the bounding box', n_points, n_records)
+    else:
+        in_box = slice(None)
+        n_points = n_records
 
-        # If we have reached the end of the file, quit
-        if len(line) == 0:
-            break
+    wind_array = np.empty(
+        n_points, dtype=[(field, '<f4') for field in field_list])
+    for field in field_list:
+        wind_array[field] = wind_records[field][in_box]
 
-        # Unpack the data. We are assuming the binary data was packed using the
-        # big indian ordering '<' and that the values are floats.
-        values_list = struct.unpack('<'+'f'*param_list_length, line)
+    wind_records = None
+    return wind_array
 
-        # The key of the output dictionary will be a tuple of the latitude,
-        # longitude
-        key = (values_list[1], values_list[0])
-        wind_dict[key] = {}
+def get_lat_long_bounding_box(aoi_uri, margin=AOI_BOUNDING_BOX_MARGIN):
+    """Calculate the bounding box of a datasource in WGS84 lat/long. The
+        edges of the datasource's extent are sampled before they are
+        transformed, so the box covers the extent even when the projection
+        bends them.
 
-        for index in range(param_list_length):
-            # Only add the field and values we are interested in using
-            if param_list[index] in field_list:
-                # Build up the dictionary with values
-                wind_dict[key][param_list[index]] = values_list[index]
+        aoi_uri - a URI to an OGR datasource with a spatial reference
 
-    wind_file.close()
+        margin - degrees the bounding box is grown by on every side
 
-    LOGGER.debug('Leaving read_wind_data')
-    return wind_dict
+        returns - a list of [min_long, min_lat, max_long, max_lat]"""
+    aoi_ds = ogr.Open(aoi_uri)
+    aoi_layer = aoi_ds.GetLayer()
+    aoi_sr = aoi_layer.GetSpatialRef()
+    min_x, max_x, min_y, max_y = aoi_layer.GetExtent()
+
+    wgs84_sr = osr.SpatialReference()
+    wgs84_sr.SetWellKnownGeogCS("WGS84")
+    coord_trans = osr.CoordinateTransformation(aoi_sr, wgs84_sr)
+
+    steps = np.linspace(0.0, 1.0, 21)
+    x_list = min_x + (max_x - min_x) * steps
+    y_list = min_y + (max_y - min_y) * steps
+    edge_points = (
+        [(x, min_y) for x in x_list] + [(x, max_y) for x in x_list] +
+        [(min_x, y) for y in y_list] + [(max_x, y) for y in y_list])
+    lat_long_points = np.array(coord_trans.TransformPoints(edge_points))
+
+    aoi_layer = None
+    aoi_ds = None
+    return [
+        np.min(lat_long_points[:, 0]) - margin,
+        np.min(lat_long_points[:, 1]) - margin,
+        np.max(lat_long_points[:, 0]) + margin,
+        np.max(lat_long_points[:, 1]) + margin]
 
 def wind_data_to_point_shape(dict_data, layer_name, output_uri):
     """Given a dictionary of the wind data create a point shapefile that
@@ -1646,6 +1855,67 @@ def wind_data_to_point_shape(dict_data, layer_name, output_uri):
     LOGGER.debug('Leaving wind_data_to_point_shape')
     output_datasource = None
 
+def wind_array_to_point_shape(wind_array, layer_name, output_uri):
+    """Create a point shapefile from a structured array of wind data as
+        returned by read_binary_wind_array, with a field per column.
+
+        wind_array - a numpy structured array that has at least the 'LATI'
+            and 'LONG' columns
+
+        layer_name - a python string for the name of the layer
+
+        output_uri - a uri for the output destination of the shapefile
+
+        return - nothing"""
+
+    LOGGER.debug('Entering wind_array_to_point_shape')
+
+    # If the output_uri exists delete it
+    if os.path.isfile(output_uri):
+        os.remove(output_uri)
+
+    output_driver = ogr.GetDriverByName('ESRI Shapefile')
+    output_datasource = output_driver.CreateDataSource(output_uri)
+
+    # Set the spatial reference to WGS84 (lat/long)
+    source_sr = osr.SpatialReference()
+    source_sr.SetWellKnownGeogCS("WGS84")
+
+    output_layer = output_datasource.CreateLayer(
+            layer_name, source_sr, ogr.wkbPoint)
+
+    field_list = list(wind_array.dtype.names)
+    for field in field_list:
+        output_field = ogr.FieldDefn(field, ogr.OFTReal)
+        output_layer.CreateField(output_field)
+
+    # When projecting to WGS84, extents -180 to 180 are used for
+    # longitude. In case input longitude is from -360 to 0 convert
+    longitude = wind_array['LONG'].astype(np.float64)
+    longitude = np.where(longitude < -180, longitude + 360, longitude)
+    latitude = wind_array['LATI'].astype(np.float64)
+
+    # Pull the columns out as python lists once rather than indexing numpy
+    # scalars per feature
+    column_list = [wind_array[field].tolist() for field in field_list]
+    layer_defn = output_layer.GetLayerDefn()
+    field_index_list = [layer_defn.GetFieldIndex(field) for field in field_list]
+
+    for point_index, (point_long, point_lat) in enumerate(
+            zip(longitude.tolist(), latitude.tolist())):
+        geom = ogr.Geometry(ogr.wkbPoint)
+        geom.AddPoint_2D(point_long, point_lat)
+
+        output_feature = ogr.Feature(layer_defn)
+        for field_index, column in zip(field_index_list, column_list):
+            output_feature.SetField(field_index, column[point_index])
+        output_feature.SetGeometryDirectly(geom)
+        output_layer.CreateFeature(output_feature)
+        output_feature = None
+
+    LOGGER.debug('Leaving wind_array_to_point_shape')
+    output_datasource = None
+
 def clip_and_reproject_raster(raster_uri, aoi_uri, projected_uri):
     """Clip and project a Dataset to an area of interest
 
@@ -1837,6 +2107,12 @@ def calculate_distances_land_grid(land_shape_uri, harvested_masked_uri, tmp_dist
         of each point feature in 'land_shape_uri' and each features
         'L2G' field.
 
+        Each pixel gets the distance to the nearest point feature plus that
+        features 'L2G' distance. Rather than a distance transform per feature,
+        the pixel centers are queried against a KD-tree of the pixels the
+        points fall in, which gives both the distance and the nearest feature
+        in one pass over the raster.
+
         land_shape_uri - a URI to an OGR shapefile that has the desired
             features to get the distance from (required)
 
@@ -1848,130 +2124,115 @@ def calculate_distances_land_grid(land_shape_uri, harvested_masked_uri, tmp_dist
 
         returns - Nothing
     """
-    # Open the point shapefile and get the layer
-    land_points = ogr.Open(land_shape_uri)
-    land_pts_layer = land_points.GetLayer()
-    # A list to hold the land to grid distances in order for each point
-    # features 'L2G' field
-    l2g_dist = []
-    # A list to hold the individual distance transform URI's in order
-    uri_list = []
-
     # Get nodata value from biophsyical output raster
     out_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(harvested_masked_uri)
     # Get pixel size
     pixel_size = pygeoprocessing.geoprocessing.get_cell_size_from_uri(harvested_masked_uri)
 
+    pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+        harvested_masked_uri, tmp_dist_final_uri, 'GTiff', out_nodata,
+        gdal.GDT_Float32, fill_value=0.0)
+    dist_ds = gdal.Open(tmp_dist_final_uri, gdal.GA_Update)
+    dist_band = dist_ds.GetRasterBand(1)
+    geotransform = dist_ds.GetGeoTransform()
+    n_rows, n_cols = dist_band.YSize, dist_band.XSize
+
+    # Find the pixel each point feature falls in along with its land to grid
+    # distance. Features outside the raster or in a pixel that an earlier
+    # feature already claimed are never the nearest, so they are dropped
+    land_points = ogr.Open(land_shape_uri)
+    land_pts_layer = land_points.GetLayer()
+    l2g_dist = []
+    feature_pixels = []
+    claimed_pixels = set()
     for feat in land_pts_layer:
-        # Get the point features land to grid value and add it to the list
+        geom = feat.GetGeometryRef()
+        col = int(math.floor(
+            (geom.GetX() - geotransform[0]) / geotransform[1]))
+        row = int(math.floor(
+            (geom.GetY() - geotransform[3]) / geotransform[5]))
+        if (row < 0 or row >= n_rows or col < 0 or col >= n_cols or
+                (row, col) in claimed_pixels):
+            continue
+        claimed_pixels.add((row, col))
+        feature_pixels.append((row, col))
         field_index = feat.GetFieldIndex("L2G")
         l2g_dist.append(float(feat.GetField(field_index)))
-
-        # Create a new shapefile with only one feature to burn onto a raster
-        # in order to get the distance transform based on that one feature
-        output_driver = ogr.GetDriverByName('ESRI Shapefile')
-        tmp_uri = pygeoprocessing.geoprocessing.temporary_folder()
-        output_datasource = output_driver.CreateDataSource(tmp_uri)
-
-        # Get the original_layer definition which holds needed attribute values
-        original_layer_dfn = land_pts_layer.GetLayerDefn()
-
-        # Create the new layer for output_datasource using same name and
-        # geometry type from original_datasource as well as spatial reference
-        output_layer = output_datasource.CreateLayer(
-                original_layer_dfn.GetName(), land_pts_layer.GetSpatialRef(),
-                original_layer_dfn.GetGeomType())
-
-        # Get the number of fields in original_layer
-        original_field_count = original_layer_dfn.GetFieldCount()
-
-        # For every field, create a duplicate field and add it to the new
-        # shapefiles layer
-        for fld_index in range(original_field_count):
-            original_field = original_layer_dfn.GetFieldDefn(fld_index)
-            output_field = ogr.FieldDefn(
-                    original_field.GetName(), original_field.GetType())
-            # NOT setting the WIDTH or PRECISION because that seems to be
-            # unneeded and causes interesting OGR conflicts
-            output_layer.CreateField(output_field)
-
-        # Copy original_datasource's feature and set as new shapes feature
-        output_feature = ogr.Feature(
-                feature_def=output_layer.GetLayerDefn())
-
-        # Since the original feature is of interest add it's fields and
-        # Values to the new feature from the intersecting geometries
-        # The False in SetFrom() signifies that the fields must match
-        # exactly
-        output_feature.SetFrom(feat, False)
-        output_layer.CreateFeature(output_feature)
-
-        output_feature = None
-        output_layer = None
-        output_datasource = None
-
-        land_pts_rasterized_uri = pygeoprocessing.geoprocessing.temporary_filename('.tif')
-        # Create a new raster based on a biophysical output and fill with 0's
-        # to set up for distance transform
-        pygeoprocessing.geoprocessing.new_raster_from_base_uri(
-            harvested_masked_uri, land_pts_rasterized_uri, 'GTiff',
-            out_nodata, gdal.GDT_Float32, fill_value=0.0)
-        # Burn single feature onto the raster with value of 1 to set up for
-        # distance transform
-        pygeoprocessing.geoprocessing.rasterize_layer_uri(
-            land_pts_rasterized_uri, tmp_uri, burn_values=[1.0],
-            option_list=["ALL_TOUCHED=TRUE"])
-
-        dist_uri = pygeoprocessing.geoprocessing.temporary_filename('.tif')
-        pygeoprocessing.geoprocessing.distance_transform_edt(
-            land_pts_rasterized_uri, dist_uri, process_pool=None)
-        # Add each features distance transform result to list
-        uri_list.append(dist_uri)
-
-    def land_ocean_dist(*rasters):
-        """vectorize_dataset operation to aggregate each features distance
-            transform output and create one distance output that has the
-            shortest distances combined with each features land to grid
-            distance
-
-            *rasters - a numpy array of numpy nd arrays
-
-            returns - a nd numpy array of the shortest distances
-        """
-        # Get the shape of the incoming numpy arrays
-        shape = rasters[0].shape
-        # Create a numpy array of 1's with proper shape
-        land_grid = np.ones(shape)
-        # Initialize numpy array with land to grid distances from the first
-        # array
-        land_grid = land_grid * l2g_dist[0]
-        # Initialize final minimum distances array to first rasters
-        distances = rasters[0]
-        # Get the length of rasters lists to use in iteration and
-        # indexing
-        size = len(rasters)
-
-        for index in range(1, size):
-            raster = rasters[index]
-            # Get the land to grid distances corresponding to current
-            # indexed raster
-            new_dist = np.ones(shape)
-            new_dist = new_dist * l2g_dist[index]
-            # Create a mask to indicate minimum distances
-            mask = raster < distances
-            # Replace distance values with minimum
-            distances = np.where(mask, raster, distances)
-            # Replace land to grid distances based on mask
-            land_grid = np.where(mask, new_dist, land_grid)
-
-        # Convert to meters from number of pixels
-        distances = distances * pixel_size
-        # Return and add land to grid distances to final distances
-        return distances + land_grid
-
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-                uri_list, land_ocean_dist, tmp_dist_final_uri, gdal.GDT_Float32,
-                out_nodata, pixel_size, 'intersection', vectorize_op=False)
+    land_points = None
+
+    if len(feature_pixels) == 0:
+        raise ValueError(
+            'None of the points in %s are within the extent of %s' % (
+                land_shape_uri, harvested_masked_uri))
+
+    feature_array = np.array(feature_pixels, dtype=np.float64)
+    feature_tree = spatial.cKDTree(feature_array)
+    l2g_dist = np.array(l2g_dist)
+    n_neighbors = min(2, len(l2g_dist))
+
+    # Process the raster in stripes of about a million pixels
+    rows_per_block = max(1, 2**20 / n_cols)
+    col_index = np.arange(n_cols)
+    for row_offset in xrange(0, n_rows, rows_per_block):
+        block_rows = min(rows_per_block, n_rows - row_offset)
+        pixel_rows, pixel_cols = np.meshgrid(
+            np.arange(row_offset, row_offset + block_rows), col_index,
+            indexing='ij')
+        pixel_points = np.column_stack(
+            (pixel_rows.ravel(), pixel_cols.ravel()))
+        distances, nearest_index = feature_tree.query(
+            pixel_points, k=n_neighbors)
+        if n_neighbors > 1:
+            # Pixels on a grid are often equally far from several features,
+            # in which case the first feature is the nearest one.  Any
+            # number of features may tie, so those pixels look up every
+            # feature at their nearest distance
+            tied_pixels = np.flatnonzero(distances[:, 1] == distances[:, 0])
+            distances = distances[:, 0]
+            nearest_index = nearest_index[:, 0]
+            if tied_pixels.size > 0:
+                nearest_index[tied_pixels] = _first_nearest_features(
+                    feature_tree, feature_array, pixel_points[tied_pixels],
+                    distances[tied_pixels])
+        # Convert to meters from number of pixels and add the land to grid
+        # distance of the nearest feature
+        distances = distances * pixel_size + l2g_dist[nearest_index]
+        dist_band.WriteArray(
+            distances.reshape((block_rows, n_cols)), 0, row_offset)
+
+    dist_band.FlushCache()
+    dist_band = None
+    dist_ds = None
+
+def _first_nearest_features(feature_tree, feature_array, points, distances):
+    """Finds the lowest index of the features nearest to each point when
+        several are equally near
+
+        feature_tree - a cKDTree of 'feature_array'
+
+        feature_array - a numpy array of the (row, col) pixel of each feature
+
+        points - a numpy array of (row, col) pixels
+
+        distances - a numpy array of the distance from each point to its
+            nearest feature
+
+        returns - a numpy array of the index in 'feature_array' of the first
+            of the nearest features to each point"""
+    first_index = np.empty(len(points), dtype=np.int64)
+    for distance in np.unique(distances):
+        point_index = np.flatnonzero(distances == distance)
+        # Pad the radius so rounding can't leave out a tied feature, the
+        # exact squared pixel distances then pick out the nearest ones
+        candidate_lists = feature_tree.query_ball_point(
+            points[point_index], distance * (1 + 1e-9))
+        for index, candidates in zip(point_index, candidate_lists):
+            candidates = np.array(candidates)
+            squared_distances = np.sum(
+                (feature_array[candidates] - points[index]) ** 2, axis=1)
+            first_index[index] = candidates[
+                squared_distances == squared_distances.min()].min()
+    return first_index
 
 def calculate_distances_grid(land_shape_uri, harvested_masked_uri, tmp_dist_final_uri):
     """Creates a distance transform raster from an OGR shapefile. The function
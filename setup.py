@@ -15,6 +15,8 @@ import platform
 import os
 import sys
 import glob
+import shutil
+import tempfile
 import matplotlib
 import zipfile
 import scipy
@@ -67,12 +69,67 @@ class ZipCommand(Command):
                 zip.write(fullpath, fullpath, zipfile.ZIP_DEFLATED)
         zip.close()
 
+#Extensions that use cython.parallel and are built with OpenMP when the
+#compiler supports it, otherwise their prange loops run serially
+OPENMP_EXTENSIONS = ['ndr_core']
+
+#compiler type -> (compile args, link args) that enable OpenMP
+OPENMP_FLAGS = {
+    'msvc': (['/openmp'], []),
+    'unix': (['-fopenmp'], ['-fopenmp']),
+    'mingw32': (['-fopenmp'], ['-fopenmp']),
+    'cygwin': (['-fopenmp'], ['-fopenmp']),
+}
+
+class OpenMPBuildExt(build_ext):
+    """Cython's build_ext that adds the OpenMP flags of the compiler in use
+    to the extensions in OPENMP_EXTENSIONS.  If the compiler has no OpenMP
+    support (e.g. Apple's clang) the extensions are built without it."""
+
+    def build_extensions(self):
+        compile_args, link_args = self._openmp_flags()
+        for extension in self.extensions:
+            if extension.name in OPENMP_EXTENSIONS:
+                extension.extra_compile_args += compile_args
+                extension.extra_link_args += link_args
+        build_ext.build_extensions(self)
+
+    def _openmp_flags(self):
+        """Returns the (compile args, link args) that enable OpenMP, or two
+        empty lists if this compiler can't build an OpenMP program."""
+        compiler_type = self.compiler.compiler_type
+        if compiler_type not in OPENMP_FLAGS:
+            print 'No OpenMP flags known for %s, building without OpenMP' % (
+                compiler_type)
+            return [], []
+        compile_args, link_args = OPENMP_FLAGS[compiler_type]
+        test_dir = tempfile.mkdtemp()
+        try:
+            test_uri = os.path.join(test_dir, 'openmp_test.c')
+            test_file = open(test_uri, 'w')
+            test_file.write(
+                '#include <omp.h>\n'
+                'int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n')
+            test_file.close()
+            object_list = self.compiler.compile(
+                [test_uri], output_dir=test_dir, extra_postargs=compile_args)
+            self.compiler.link_executable(
+                object_list, 'openmp_test', output_dir=test_dir,
+                extra_postargs=link_args)
+        except Exception:
+            print '%s compiler has no OpenMP support, building without it' % (
+                compiler_type)
+            return [], []
+        finally:
+            shutil.rmtree(test_dir, ignore_errors=True)
+        return compile_args, link_args
+
 console = []
 py2exe_args = {}
 data_files = []
 lib_path = ''
 CMD_CLASSES = {
-    'build_ext': build_ext,
+    'build_ext': OpenMPBuildExt,
     'zip': ZipCommand,
 }
 
@@ -306,6 +363,9 @@ setup(name='invest_natcap',
       data_files=data_files,
       include_package_data=True,
       ext_modules=cythonize([
+        Extension(
+          name="invest_natcap.block_cache",
+          sources=['invest_natcap/block_cache.pyx']),
         Extension(
           name="scenic_quality_cython_core",
           sources=[
@@ -318,7 +378,7 @@ setup(name='invest_natcap',
           name="seasonal_water_yield_core",
           sources=['invest_natcap/seasonal_water_yield/seasonal_water_yield_core.pyx'],
           language="c++"),
-        ]),
+        ], include_path=['.']),
       **py2exe_args)
 
 # Since we wrote the invest version module to a file that needed to be taken
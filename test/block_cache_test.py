@@ -0,0 +1,113 @@
+"""Tests for the set associative LRU block cache of the Cython cores"""
+
+import unittest
+
+from osgeo import gdal
+import numpy
+
+from invest_natcap import block_cache
+
+
+class TestBlockCache(unittest.TestCase):
+    def setUp(self):
+        #a 4 x 8 raster of 2 x 2 blocks, 2 block rows by 4 block columns
+        self.n_rows, self.n_cols = 4, 8
+        self.block_size = 2
+        self.value_array = numpy.arange(
+            self.n_rows * self.n_cols, dtype=numpy.float32).reshape(
+                (self.n_rows, self.n_cols))
+        self.dataset_list = []
+        self.band_list = []
+        for _ in xrange(2):
+            dataset = gdal.GetDriverByName('MEM').Create(
+                '', self.n_cols, self.n_rows, 1, gdal.GDT_Float32)
+            band = dataset.GetRasterBand(1)
+            band.WriteArray(self.value_array)
+            self.dataset_list.append(dataset)
+            self.band_list.append(band)
+
+    def tearDown(self):
+        self.band_list = None
+        self.dataset_list = None
+
+    def _make_cache(self, n_sets, n_ways, update_list):
+        self.block_list = [
+            numpy.zeros(
+                (n_sets, n_ways, self.block_size, self.block_size),
+                dtype=numpy.float32) for _ in self.band_list]
+        self.cache_dirty = numpy.zeros((n_sets, n_ways), dtype=numpy.int8)
+        return block_cache.BlockCache(
+            n_sets, n_ways, self.n_rows, self.n_cols, self.block_size,
+            self.block_size, self.band_list, self.block_list, update_list,
+            self.cache_dirty)
+
+    def test_lookup_reads_block(self):
+        """A pixel's value is at the slot and offsets lookup returns"""
+        cache = self._make_cache(2, 4, [False, False])
+        for global_row, global_col in [(0, 0), (3, 7), (2, 5), (1, 2)]:
+            set_index, way_index, row_offset, col_offset = cache.lookup(
+                global_row, global_col)
+            self.assertEqual(
+                self.block_list[0][
+                    set_index, way_index, row_offset, col_offset],
+                self.value_array[global_row, global_col])
+
+    def test_lru_eviction_order(self):
+        """A full set replaces the way that was used longest ago"""
+        cache = self._make_cache(1, 4, [False, False])
+        #blocks at columns 0, 2, 4 and 6 of the first block row fill the set
+        way_list = [cache.lookup(0, col)[1] for col in [0, 2, 4, 6]]
+        self.assertEqual(sorted(way_list), [0, 1, 2, 3])
+        #touch the first block, so the second is now the least recently used
+        self.assertEqual(cache.lookup(1, 1)[1], way_list[0])
+        self.assertEqual(cache.lookup(2, 0)[1], way_list[1])
+        #the first block is still cached, the second was evicted
+        self.assertEqual(cache.lookup(0, 0)[1], way_list[0])
+        self.assertEqual(cache.stats(), {
+            'hits': 2, 'misses': 5, 'write_backs': 0})
+        cache.lookup(0, 2)
+        self.assertEqual(cache.stats()['misses'], 6)
+
+    def test_write_back_on_eviction_and_flush(self):
+        """Dirty slots are written to the updated bands only, when evicted
+            and when the cache is flushed"""
+        cache = self._make_cache(1, 4, [True, False])
+        for col in [0, 2, 4, 6]:
+            set_index, way_index, row_offset, col_offset = cache.lookup(
+                0, col)
+            for block in self.block_list:
+                block[set_index, way_index, row_offset, col_offset] = -1
+            self.cache_dirty[set_index, way_index] = 1
+
+        #a fifth block evicts the block at column 0
+        cache.lookup(2, 0)
+        self.assertEqual(cache.stats()['write_backs'], 1)
+        expected_array = self.value_array.copy()
+        expected_array[0, 0] = -1
+        numpy.testing.assert_array_equal(
+            self.band_list[0].ReadAsArray(), expected_array)
+
+        cache.flush()
+        self.assertEqual(cache.stats()['write_backs'], 4)
+        expected_array[0, [2, 4, 6]] = -1
+        numpy.testing.assert_array_equal(
+            self.band_list[0].ReadAsArray(), expected_array)
+        numpy.testing.assert_array_equal(
+            self.band_list[1].ReadAsArray(), self.value_array)
+        self.assertFalse(self.cache_dirty.any())
+
+    def test_cache_geometry(self):
+        """A memory budget sets the slot count, never below MIN_WAYS"""
+        self.assertEqual(
+            block_cache.cache_geometry(64, 2, 2, [numpy.float32]), (16, 4))
+        original_budget = block_cache.get_memory_budget()
+        try:
+            block_cache.set_memory_budget(2 * 2 * 8 * 32)
+            self.assertEqual(
+                block_cache.cache_geometry(
+                    64, 2, 2, [numpy.float32, numpy.float32]), (8, 4))
+            block_cache.set_memory_budget(1)
+            self.assertEqual(
+                block_cache.cache_geometry(64, 2, 2, [numpy.float32]), (1, 4))
+        finally:
+            block_cache.set_memory_budget(original_budget)
@@ -0,0 +1,75 @@
+"""Tests for the block-wise zonal sums of the blue carbon model"""
+
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+
+from invest_natcap.blue_carbon import blue_carbon
+
+import invest_test_core
+
+
+class TestZonalSums(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.block_pixels = blue_carbon.ZONAL_BLOCK_PIXELS
+        #strips of 2 rows so the sums run over several blocks
+        blue_carbon.ZONAL_BLOCK_PIXELS = 8
+
+        category_array = numpy.array([
+            [1, 1, 2, 2],
+            [1, 3, 3, 2],
+            [-1, 3, 1, 1],
+            [2, 2, -1, 3],
+            [5, 1, 2, 3]], dtype=numpy.int32)
+        self.category_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'category.tif', category_array,
+            gdal.GDT_Int32, -1)
+        self.value_a_array = numpy.array([
+            [1.0, 2.0, 3.0, 4.0],
+            [5.0, 6.0, -9.0, 8.0],
+            [9.0, 10.0, 11.0, 12.0],
+            [13.0, 14.0, 15.0, 16.0],
+            [17.0, 18.0, 19.0, -9.0]], dtype=numpy.float32)
+        self.value_a_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'value_a.tif', self.value_a_array,
+            gdal.GDT_Float32, -9.0)
+        self.value_b_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'value_b.tif',
+            numpy.full((5, 4), 0.5, dtype=numpy.float32), gdal.GDT_Float32,
+            -9.0)
+
+    def tearDown(self):
+        blue_carbon.ZONAL_BLOCK_PIXELS = self.block_pixels
+        shutil.rmtree(self.workspace_dir)
+
+    def test_totals(self):
+        """Without a category raster each raster is summed without nodata"""
+        totals = blue_carbon.zonal_sums_uri(
+            [self.value_a_uri, self.value_b_uri])
+        self.assertAlmostEqual(totals[0], 210.0 - 7.0 - 20.0)
+        self.assertAlmostEqual(totals[1], 10.0)
+
+    def test_category_sums(self):
+        """Values are summed per category, nodata categories and values are
+            left out"""
+        sum_list = blue_carbon.zonal_sums_uri(
+            [self.value_a_uri, self.value_b_uri], self.category_uri)
+        self.assertEqual(
+            sum_list[0],
+            {1: 1.0 + 2.0 + 5.0 + 11.0 + 12.0 + 18.0,
+             2: 3.0 + 4.0 + 8.0 + 13.0 + 14.0 + 19.0,
+             3: 6.0 + 10.0 + 16.0,
+             5: 17.0})
+        self.assertEqual(sum_list[1], {1: 3.0, 2: 3.0, 3: 2.5, 5: 0.5})
+
+    def test_selected_categories(self):
+        """Only the categories asked for are summed, including ones that
+            aren't in the raster"""
+        self.assertEqual(
+            blue_carbon.sum_by_category_uri(
+                self.category_uri, self.value_a_uri, categories=[3, 5, 7]),
+            {3: 32.0, 5: 17.0, 7: 0})
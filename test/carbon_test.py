@@ -2,12 +2,18 @@
 
 import os
 import sys
+import math
 import unittest
 import logging
 import re
 
 import numpy.random
+import numpy.testing
+from osgeo import gdal
+from scipy.stats import norm
+import pygeoprocessing.geoprocessing
 
+from invest_natcap.carbon import carbon_biophysical
 from invest_natcap.carbon import carbon_combined
 from invest_natcap.carbon import carbon_utils
 import invest_test_core
@@ -285,6 +291,118 @@ class TestCarbonBiophysical(unittest.TestCase):
         self.check()
 
 
+    def test_biophysical_uncertainty_seed(self):
+        """Test that seeded Monte Carlo runs and percentile maps repeat and
+        match a run by run simulation with the same seed."""
+        args = {
+            'workspace_dir': self.workspace_dir,
+            'do_uncertainty': True,
+            'lulc_cur_uri': (
+                './invest-data/test/data/base_data/terrestrial/lulc_samp_cur'),
+            'lulc_fut_uri': (
+                './invest-data/test/data/base_data/terrestrial/lulc_samp_fut'),
+            'carbon_pools_uncertain_uri': (
+                './invest-data/test/data/carbon/input/'
+                'carbon_pools_samp_uncertain.csv'),
+            'monte_carlo_runs': 2000,
+            'monte_carlo_seed': 1,
+        }
+        pools = carbon_biophysical._compute_carbon_pools(args)
+        results = carbon_biophysical._compute_uncertainty_data(args, pools)
+
+        # Split the runs into uneven blocks so the samples are drawn over
+        # several blocks.
+        percentile_uris = {
+            ('fut', 50): os.path.join(self.workspace_dir, 'tot_C_p50.tif'),
+            ('sequest_fut', 5): os.path.join(
+                self.workspace_dir, 'sequest_p5.tif'),
+        }
+        block_runs = carbon_biophysical.MONTE_CARLO_BLOCK_RUNS
+        carbon_biophysical.MONTE_CARLO_BLOCK_RUNS = 300
+        try:
+            repeat_results = carbon_biophysical._compute_uncertainty_data(
+                args, pools, percentile_uris)
+        finally:
+            carbon_biophysical.MONTE_CARLO_BLOCK_RUNS = block_runs
+        self.assertEqual(sorted(results), sorted(repeat_results))
+        for scenario in results:
+            numpy.testing.assert_allclose(
+                results[scenario], repeat_results[scenario], rtol=1e-9)
+
+        # The same draws one run and one lulc type at a time, in the order
+        # of pools.keys(), as the runs were made before they were blocked.
+        random_state = numpy.random.RandomState(args['monte_carlo_seed'])
+        lulc_counts = dict(
+            (scenario, pygeoprocessing.geoprocessing.unique_raster_values_count(
+                args['lulc_%s_uri' % scenario]))
+            for scenario in ['cur', 'fut'])
+        lulc_samples = dict((lulc_id, []) for lulc_id in pools)
+        loop_totals = {'cur': [], 'fut': [], 'sequest_fut': []}
+        for _ in xrange(args['monte_carlo_runs']):
+            run_samples = {}
+            for lulc_id, distribution in pools.items():
+                if not distribution['variance']:
+                    run_samples[lulc_id] = distribution['total']
+                else:
+                    run_samples[lulc_id] = random_state.normal(
+                        distribution['total'],
+                        math.sqrt(distribution['variance']))
+                lulc_samples[lulc_id].append(run_samples[lulc_id])
+            for scenario in ['cur', 'fut']:
+                loop_totals[scenario].append(sum(
+                    count * run_samples[lulc_id]
+                    for lulc_id, count in lulc_counts[scenario].items()))
+            loop_totals['sequest_fut'].append(
+                loop_totals['fut'][-1] - loop_totals['cur'][-1])
+        self.assertEqual(sorted(results), sorted(loop_totals))
+        for scenario, totals in loop_totals.items():
+            numpy.testing.assert_allclose(
+                results[scenario], norm.fit(totals), rtol=1e-9)
+
+        # Each grid cell's percentile is the percentile of the samples of
+        # its lulc types, a nodata cell holds no carbon.
+        nodata_out = -5.0
+        lulc_cur, lulc_fut = [
+            gdal.Open(args['lulc_%s_uri' % scenario]).GetRasterBand(
+                1).ReadAsArray()
+            for scenario in ['cur', 'fut']]
+        cur_nodata, fut_nodata = [
+            pygeoprocessing.geoprocessing.get_nodata_from_uri(
+                args['lulc_%s_uri' % scenario])
+            for scenario in ['cur', 'fut']]
+        zero_samples = numpy.zeros(args['monte_carlo_runs'])
+
+        def cell_samples(lulc_id, lulc_nodata):
+            if lulc_id == lulc_nodata:
+                return zero_samples
+            return numpy.array(lulc_samples[lulc_id])
+
+        expected_storage = numpy.empty(lulc_fut.shape)
+        expected_sequest = numpy.empty(lulc_fut.shape)
+        for cur_id, fut_id in set(zip(lulc_cur.flat, lulc_fut.flat)):
+            mask = (lulc_cur == cur_id) & (lulc_fut == fut_id)
+            if fut_id == fut_nodata:
+                expected_storage[mask] = nodata_out
+            else:
+                expected_storage[mask] = numpy.percentile(
+                    cell_samples(fut_id, fut_nodata), 50)
+            if cur_id == cur_nodata and fut_id == fut_nodata:
+                expected_sequest[mask] = nodata_out
+            else:
+                expected_sequest[mask] = numpy.percentile(
+                    cell_samples(fut_id, fut_nodata) -
+                    cell_samples(cur_id, cur_nodata), 5)
+
+        for percentile_key, expected_array in [
+                (('fut', 50), expected_storage),
+                (('sequest_fut', 5), expected_sequest)]:
+            percentile_array = gdal.Open(
+                percentile_uris[percentile_key]).GetRasterBand(
+                    1).ReadAsArray()
+            numpy.testing.assert_allclose(
+                percentile_array, expected_array.astype(numpy.float32),
+                rtol=1e-5)
+
     def test_carbon_biophysical_uk(self):
         """Test carbon_biophysical function for UK data."""
 
@@ -685,7 +685,31 @@ class TestCoastalVulnerability(unittest.TestCase):
 
         # TODO: Test with regression data
         # TODO: Test distances
-        return True 
+        return True
+
+    def test_cast_fetch_rays(self):
+        """ Test batched rays stop on land and at the raster edge."""
+        land_array = np.zeros((5, 5))
+        land_array[0, 2] = 1
+        bathymetry = np.ones_like(land_array) * -2.
+        bathymetry[1, 2] = -4.
+        rows = np.array([2, 4])
+        cols = np.array([2, 2])
+        # North: the center point hits land after 1 step, the bottom point
+        # after 3
+        (ray_i, ray_j), unit_step_length = \
+            cvc.cast_ray_fast(np.array([-1., 0.]), 10)
+        distances, depths = cvc._cast_fetch_rays(rows, cols, ray_i, ray_j, \
+            unit_step_length, 1., land_array, bathymetry, -1)
+        np.testing.assert_almost_equal(distances, [1.5, 3.5])
+        np.testing.assert_almost_equal(depths, [-3., -2.5])
+        # East: both rays leave the raster after 2 steps
+        (ray_i, ray_j), unit_step_length = \
+            cvc.cast_ray_fast(np.array([0., 1.]), 10)
+        distances, depths = cvc._cast_fetch_rays(rows, cols, ray_i, ray_j, \
+            unit_step_length, 1., land_array, bathymetry, -1)
+        np.testing.assert_almost_equal(distances, [2.5, 2.5])
+        np.testing.assert_almost_equal(depths, [-2., -2.])
 
     def test_fetch_distance_directions(self):
         """ Test the fetch distances with different fetch directions."""
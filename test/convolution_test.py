@@ -0,0 +1,104 @@
+"""Tests for the cached distance decay convolutions"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+import scipy.signal
+
+from invest_natcap import convolution
+
+import invest_test_core
+
+
+class TestConvolution(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        convolution.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+        convolution.clear_cache()
+
+    def test_get_kernel(self):
+        """Kernels are normalized, cached and scaled by the pixel size"""
+        kernel = convolution.get_kernel('exponential', 90.0, 30.0)
+        self.assertEqual(kernel.shape, (31, 31))
+        self.assertAlmostEqual(numpy.sum(kernel), 1.0, places=5)
+        self.assertTrue(
+            kernel is convolution.get_kernel('exponential', 3.0, 1.0))
+        self.assertRaises(ValueError, convolution.get_kernel, 'box', 3.0)
+
+    def test_convolve_kernels_uri(self):
+        """Blockwise convolution matches a direct convolution, with kernels
+            split into tiles and one larger than the raster"""
+        numpy.random.seed(0)
+        signal_array = numpy.random.random((70, 45)).astype(numpy.float32)
+        nodata = -1.0
+        signal_array[numpy.random.random(signal_array.shape) < 0.1] = nodata
+        signal_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'signal.tif', signal_array, gdal.GDT_Float32,
+            nodata)
+
+        kernel_key_list = [
+            ('linear', 4.0, 1.0), ('gaussian', 2.0, 1.0),
+            ('exponential', 12.0, 1.0)]
+        output_uri_list = [
+            os.path.join(self.workspace_dir, 'out_%d.tif' % index)
+            for index in xrange(len(kernel_key_list))]
+
+        original_block_size = convolution.BLOCK_SIZE
+        convolution.BLOCK_SIZE = 16
+        try:
+            convolution.convolve_kernels_uri(
+                signal_uri, kernel_key_list, output_uri_list)
+        finally:
+            convolution.BLOCK_SIZE = original_block_size
+
+        nodata_mask = signal_array == nodata
+        zeroed_signal = numpy.where(nodata_mask, 0.0, signal_array)
+        for kernel_key, output_uri in zip(kernel_key_list, output_uri_list):
+            kernel = convolution.get_kernel(*kernel_key)
+            expected = scipy.signal.convolve2d(
+                zeroed_signal, kernel, mode='same')
+            expected[nodata_mask] = convolution.OUTPUT_NODATA
+            output_dataset = gdal.Open(output_uri)
+            result = output_dataset.GetRasterBand(1).ReadAsArray()
+            output_dataset = None
+            numpy.testing.assert_array_almost_equal(result, expected, 5)
+
+    def test_spectrum_reuse(self):
+        """Each signal block is transformed once for all kernels and kernel
+            spectra are reused by later calls"""
+        numpy.random.seed(0)
+        signal_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'signal.tif',
+            numpy.random.random((40, 30)).astype(numpy.float32),
+            gdal.GDT_Float32, -1.0)
+        output_uri_list = [
+            os.path.join(self.workspace_dir, 'out_%d.tif' % index)
+            for index in xrange(2)]
+
+        original_block_size = convolution.BLOCK_SIZE
+        convolution.BLOCK_SIZE = 16
+        try:
+            #a 9x9 kernel fits in a block, the 25x25 one is 4 tiles
+            convolution.convolve_kernels_uri(
+                signal_uri, [('linear', 4.0, 1.0), ('gaussian', 2.4, 1.0)],
+                output_uri_list)
+            self.assertEqual(
+                convolution.cache_stats(),
+                {'hits': 0, 'misses': 5, 'signal_transforms': 6})
+
+            #the same kernels in other units hit the cache
+            convolution.convolve_kernels_uri(
+                signal_uri, [('linear', 120.0, 30.0), ('gaussian', 72.0, 30.0)],
+                output_uri_list)
+            self.assertEqual(
+                convolution.cache_stats(),
+                {'hits': 5, 'misses': 5, 'signal_transforms': 12})
+        finally:
+            convolution.BLOCK_SIZE = original_block_size
@@ -0,0 +1,48 @@
+'''
+python -m unittest test_crop_production_raster
+'''
+
+import unittest
+
+import gdal
+import numpy as np
+
+from invest_natcap.crop_production.raster import Raster
+import crop_production_data as test_data
+
+
+class TestLazyLocalOps(unittest.TestCase):
+    def setUp(self):
+        self.lulc_raster = test_data.create_lulc_map2(test_data.aoi_dict)
+        self.lulc_array = self.lulc_raster.get_band(1).data
+
+    def test_run1(self):
+        float_raster = self.lulc_raster.set_datatype_and_nodata(
+            gdal.GDT_Float32, test_data.NODATA_FLOAT)
+        product_raster = float_raster * 2.5
+        guess_raster = (product_raster + product_raster) / (
+            float_raster + 1) - float_raster.minimum(2)
+
+        # nothing is computed until a file is needed
+        assert(guess_raster._expression is not None)
+        assert(guess_raster.get_nodata(1) == test_data.NODATA_FLOAT)
+        assert(guess_raster.get_shape() == self.lulc_raster.get_shape())
+        assert(guess_raster._expression is not None)
+
+        check_array = (5.0 * self.lulc_array) / (
+            self.lulc_array + 1) - np.minimum(self.lulc_array, 2)
+        guess_array = guess_raster.get_band(1).data
+        assert(guess_raster._expression is None)
+        assert(np.allclose(guess_array, check_array))
+
+    def test_reclass(self):
+        guess_raster = self.lulc_raster.reclass({1: 10, 2: 20, 3: 30}) - 5
+        check_array = self.lulc_array * 10 - 5
+        assert(np.array_equal(guess_raster.get_band(1).data, check_array))
+
+        missing_raster = self.lulc_raster.reclass({1: 10})
+        self.assertRaises(ValueError, missing_raster.get_band, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
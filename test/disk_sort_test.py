@@ -0,0 +1,87 @@
+"""Tests for the on disk raster sort of the scenario generator"""
+
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+
+from invest_natcap.scenario_generator import disk_sort
+
+import invest_test_core
+
+
+class TestDiskSort(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.constants = (
+            disk_sort.RUN_PIXELS, disk_sort.MERGE_BUFFER_BYTES,
+            disk_sort.MIN_RUN_READ_SIZE, disk_sort.MAX_PACKED_PIXELS)
+        #runs of 2 rows merged 3 keys at a time so blocks end all over
+        disk_sort.RUN_PIXELS = 14
+        disk_sort.MERGE_BUFFER_BYTES = 1
+        disk_sort.MIN_RUN_READ_SIZE = 3
+
+    def tearDown(self):
+        (disk_sort.RUN_PIXELS, disk_sort.MERGE_BUFFER_BYTES,
+         disk_sort.MIN_RUN_READ_SIZE, disk_sort.MAX_PACKED_PIXELS) = (
+             self.constants)
+        shutil.rmtree(self.workspace_dir)
+
+    def _score_array(self):
+        """A 9x7 raster with many tied scores, both zeros and nodata"""
+        numpy.random.seed(0)
+        score_array = numpy.random.randint(-3, 4, (9, 7)).astype(
+            numpy.float32) / 2
+        score_array[0, 0] = -0.0
+        score_array[4, 6] = 0.0
+        score_array[8, 0] = -0.0
+        score_array[2, 3] = -1.0
+        score_array[6, 5] = -1.0
+        score_array[7, 1] = 1e30
+        score_array[3, 2] = -1e30
+        return score_array
+
+    def _check_sort(self, score_array, nodata):
+        score_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'scores.tif', score_array, gdal.GDT_Float32,
+            nodata)
+        expected = sorted([
+            (-float(value), flat_index)
+            for flat_index, value in enumerate(score_array.flat)
+            if value != nodata])
+        result = [
+            (score, flat_index) for score, flat_index, _ in
+            disk_sort.sort_to_disk(score_uri, 0)]
+        self.assertEqual(result, expected)
+
+        block_sizes = [
+            scores.size for scores, _ in
+            disk_sort.sort_to_disk_blocks(score_uri)]
+        self.assertTrue(len(block_sizes) > 1)
+        self.assertEqual(sum(block_sizes), len(expected))
+
+    def test_sort_to_disk(self):
+        """Pixels come out in the order of sorted (-value, flat_index)
+            tuples, with -0.0 and 0.0 tied"""
+        self._check_sort(self._score_array(), -1.0)
+
+    def test_sort_to_disk_wide_keys(self):
+        """Rasters too big to pack their flat index in 32 bits sort in the
+            same order"""
+        disk_sort.MAX_PACKED_PIXELS = 1
+        self._check_sort(self._score_array(), -1.0)
+
+    def test_wide_keys_round_trip(self):
+        """Flat indexes past 2**32 survive wide keys and order after the
+            score"""
+        scores = numpy.array([-2.0, 1.5, -2.0, -0.0], dtype=numpy.float32)
+        flat_indexes = numpy.array(
+            [2**33 + 5, 7, 2**32, 2**40], dtype=numpy.int64)
+        keys = disk_sort._sort_keys(
+            disk_sort._encode_keys(scores, flat_indexes, True))
+        sorted_scores, sorted_indexes = disk_sort._decode_keys(keys)
+        self.assertEqual(sorted_scores.tolist(), [-2.0, -2.0, 0.0, 1.5])
+        self.assertEqual(
+            sorted_indexes.tolist(), [2**32, 2**33 + 5, 2**40, 7])
@@ -185,3 +185,42 @@ class TestFinfishAquacultureCore(unittest.TestCase):
                         self.ff_aqua_args['do_valuation'], self.ff_aqua_args['reg_npv'], 
                         self.ff_aqua_args['reg_value_hist'])
         
+
+    def test_simulate_farm_cycles(self):
+        """The vectorized simulation matches the cycle by cycle functions"""
+        water_temp_dict = dict(
+            (str(day), {'1': str(8 + day % 7), '2': str(9 + day % 5)})
+            for day in range(365))
+        farm_op_dict = {
+            '1': {'start day for growing': '10',
+                  'Length of Fallowing period': '30',
+                  'weight of fish at start (kg)': '0.06',
+                  'target weight of fish at harvest (kg)': '5.4',
+                  'number of fish in farm': '6000'},
+            '2': {'start day for growing': '360',
+                  'Length of Fallowing period': '0',
+                  'weight of fish at start (kg)': '0.06',
+                  'target weight of fish at harvest (kg)': '4.0',
+                  'number of fish in farm': '1500'}}
+        a_samples = [0.038, 0.045, 0.030]
+        b_samples = [0.6667, 0.62, 0.7]
+        farm_arrays = finfish_aquaculture_core._make_farm_arrays(
+            3, water_temp_dict, farm_op_dict)
+        cycles, weight, value = finfish_aquaculture_core.simulate_farm_cycles(
+            farm_arrays, a_samples, b_samples, 0.08, 4.0, 0.85, 0.00014,
+            (2.25, 0.3, 0.000192))
+
+        for run, (a, b) in enumerate(zip(a_samples, b_samples)):
+            cycle_history = finfish_aquaculture_core.calc_farm_cycles(
+                3, a, b, 0.08, water_temp_dict, farm_op_dict, 4.0)
+            sum_hrv_weight, hrv_weight = finfish_aquaculture_core.calc_hrv_weight(
+                farm_op_dict, 0.85, 0.00014, cycle_history)
+            _, farms_npv = finfish_aquaculture_core.valuation(
+                2.25, 0.3, 0.000192, hrv_weight, cycle_history)
+            for farm_index, farm in enumerate(farm_arrays['farm_ids']):
+                self.assertEqual(
+                    cycles[run, farm_index], len(cycle_history[farm]))
+                self.assertAlmostEqual(
+                    weight[run, farm_index], sum_hrv_weight[farm], 4)
+                self.assertAlmostEqual(
+                    value[run, farm_index], farms_npv[farm], 4)
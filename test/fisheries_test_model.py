@@ -1,5 +1,6 @@
 import unittest
 import pprint
+import copy
 
 from numpy import testing
 import numpy as np
@@ -370,6 +371,14 @@ class TestSetCycleFunc(unittest.TestCase):
             'N_tasx': np.ones([10, 2, 2, 2]),  # Index Order: time, class, sex, region
         }
 
+        # Index Order: class, sex, region
+        self.N_prev = np.array([[[1.0, 2.0], [3.0, 4.0]], [[5.0, 6.0], [7.0, 8.0]]])
+        # Migrated class 0: [[1.75, 1.25], [4.25, 2.75]]
+        # Migrated class 1: [[2.5, 8.5], [3.5, 11.5]]
+        self.migration = [
+            np.matrix([[0.75, 0.5], [0.25, 0.5]]),
+            np.matrix([[0.5, 0.0], [0.5, 1.0]])]
+
     def test_stage_based(self):
         vars_dict = self.sample_vars
         rec_func = model.set_recru_func(vars_dict)
@@ -378,11 +387,36 @@ class TestSetCycleFunc(unittest.TestCase):
         N_prev = np.ones([2, 2, 2])
 
         N_cur_guess, spawners = cycle_func(N_prev)
-        # N_cur_check = np.array([])
-        # testing.assert_equal(N_cur_guess, N_cur_check)
+        N_cur_check = np.array([[[1.25, 2.25], [3.25, 4.25]], [[2.0, 2.0], [2.0, 2.0]]])
+        testing.assert_equal(N_cur_guess, N_cur_check)
+
+    def test_stage_based_migration(self):
+        vars_dict = self.sample_vars
+        vars_dict['Migration'] = self.migration
+        vars_dict['G_survtotalfrac'] = np.ones([2, 2, 2]) * 0.5
+        vars_dict['P_survtotalfrac'] = np.ones([2, 2, 2]) * 0.25
+        rec_func = model.set_recru_func(vars_dict)
+        cycle_func = model.set_cycle_func(vars_dict, rec_func)
+
+        N_cur_guess, spawners = cycle_func(self.N_prev)
+        # Recruits of 0.25 plus migrated class 0 times S, then migrated
+        # classes times G and P
+        N_cur_check = np.array([[[2.0, 2.75], [13.0, 11.25]], [[1.5, 2.75], [3.0, 4.25]]])
+        testing.assert_equal(N_cur_guess, N_cur_check)
+        self.assertTrue(spawners is None)
 
     def test_age_based(self):
-        pass
+        vars_dict = self.sample_vars
+        vars_dict['population_type'] = 'Age-Based'
+        vars_dict['Migration'] = self.migration
+        rec_func = model.set_recru_func(vars_dict)
+        cycle_func = model.set_cycle_func(vars_dict, rec_func)
+
+        N_cur_guess, spawners = cycle_func(self.N_prev)
+        # Recruits of 0.25, then the last class gets both migrated classes
+        # times S
+        N_cur_check = np.array([[[0.25, 0.25], [0.25, 0.25]], [[14.25, 53.5], [37.25, 103.0]]])
+        testing.assert_equal(N_cur_guess, N_cur_check)
 
 
 class TestRunPopulationModel(unittest.TestCase):
@@ -434,7 +468,6 @@ class TestRunPopulationModel(unittest.TestCase):
         }
 
     def test_run_population_model(self):
-        ## UNTESTED
         vars_dict = self.sample_vars
         recru_func = model.set_recru_func(vars_dict)
         init_cond_func = model.set_init_cond_func(vars_dict)
@@ -445,7 +478,166 @@ class TestRunPopulationModel(unittest.TestCase):
         vars_dict = model.run_population_model(
             vars_dict, init_cond_func, cycle_func, harvest_func)
 
-        # pp.pprint(vars_dict['N_tasx'])
+        # 25 recruits per sex and region, adults at 25 / 0.5 * 0.5
+        testing.assert_equal(vars_dict['N_tasx'][0], np.ones([2, 2, 2]) * 25.0)
+        # Fixed recruits of 0.5 * 1.0 / 2, adults at (25 + 25) * 0.5
+        testing.assert_equal(vars_dict['N_tasx'][1], np.array([[[0.25, 0.25], [0.25, 0.25]], [[25.0, 25.0], [25.0, 25.0]]]))
+        testing.assert_equal(vars_dict['N_tasx'][2][1], np.ones([2, 2]) * 12.625)
+        # Harvest fractions of 0.25 * 0.5 and 0.5 * 0.5
+        testing.assert_equal(vars_dict['H_tx'][0], np.array([12.5, 25.0]))
+        testing.assert_equal(vars_dict['V_tx'][0], np.array([31.25, 62.5]))
+        self.assertTrue(np.isnan(vars_dict['Spawners_t'][1]))
+        self.assertTrue(vars_dict['equilibrate_timestep'] > 0)
+
+
+
+class TestRunEnsembleModel(unittest.TestCase):
+    def setUp(self):
+        self.sample_vars = {
+            'total_timesteps': 50,
+            'results_suffix': '',
+            'population_type': 'Age-Based',
+            'sexsp': 2,
+            'spawn_units': 'Weight',
+            'total_init_recruits': 100.0,
+            'recruitment_type': 'Beverton-Holt',
+            'alpha': 3.0,
+            'beta': 4.0,
+            'total_recur_recruits': 1.0,
+            'migr_cont': True,
+            'val_cont': True,
+            'harvest_units': 'Individuals',
+            'frac_post_process': 0.5,
+            'unit_price': 5.0,
+
+            # Pop Params
+            'Survnaturalfrac': np.ones([2, 2, 2]) * 0.5,  # Regions, Sexes, Classes
+            'Classes': np.array(['larva', 'adult']),
+            'Vulnfishing': np.array([[0.5, 0.5], [0.5, 0.5]]),
+            'Maturity': np.array([[0.0, 1.0], [0.0, 1.0]]),
+            'Duration': np.array([[2, 3], [2, 3]]),
+            'Weight': np.array([[0.1, 1.0], [0.1, 1.0]]),
+            'Fecundity': np.array([[0.1, 1.0], [0.1, 2.0]]),
+            'Regions': np.array(['r1', 'r2']),
+            'Exploitationfraction': np.array([0.25, 0.5]),
+            'Larvaldispersal': np.array([0.5, 0.5]),
+
+            # Mig Params
+            'Migration': [np.matrix(np.eye(2)), np.matrix(np.eye(2))],
+        }
+
+    def test_run_ensemble_model(self):
+        """Each ensemble member matches a single model run"""
+        alpha_k = np.array([2.0, 3.0, 6.0])
+        migration_k = np.array([
+            [np.eye(2), np.eye(2)],
+            [[[0.75, 0.5], [0.25, 0.5]], [[0.5, 0.0], [0.5, 1.0]]],
+            [[[0.0, 1.0], [1.0, 0.0]], np.eye(2)]])
+        ensemble_vars = model.run_ensemble_model(
+            copy.deepcopy(self.sample_vars),
+            {'alpha': alpha_k, 'Migration': migration_k})
+
+        for k, alpha in enumerate(alpha_k):
+            vars_dict = copy.deepcopy(self.sample_vars)
+            vars_dict['alpha'] = alpha
+            vars_dict['Migration'] = [np.matrix(m) for m in migration_k[k]]
+            vars_dict = model.initialize_vars(vars_dict)
+            recru_func = model.set_recru_func(vars_dict)
+            vars_dict = model.run_population_model(
+                vars_dict, model.set_init_cond_func(vars_dict),
+                model.set_cycle_func(vars_dict, recru_func),
+                model.set_harvest_func(vars_dict))
+
+            testing.assert_array_almost_equal(
+                ensemble_vars['N_ktasx'][k], vars_dict['N_tasx'])
+            testing.assert_array_almost_equal(
+                ensemble_vars['H_ktx'][k], vars_dict['H_tx'])
+            self.assertEqual(
+                ensemble_vars['equilibrate_timestep_k'][k],
+                vars_dict['equilibrate_timestep'])
+
+    def test_stage_based_ricker(self):
+        """First step of a Stage-Based Ricker ensemble with migration"""
+        self.sample_vars.update({
+            'population_type': 'Stage-Based',
+            'recruitment_type': 'Ricker',
+            'spawn_units': 'Individuals',
+            'sexsp': 1,
+            'beta': 0.5,
+            'Survnaturalfrac': np.ones([2, 1, 2]) * 0.5,
+            'Vulnfishing': np.array([[0.0, 0.0]]),
+            'Maturity': np.array([[0.0, 1.0]]),
+            'Duration': np.array([[2, 2]]),
+            'Weight': np.array([[1.0, 1.0]]),
+            'Fecundity': np.array([[0.0, 1.0]]),
+        })
+        migration = [[0.75, 0.5], [0.25, 0.5]]
+        ensemble_vars = model.run_ensemble_model(
+            self.sample_vars, {
+                'alpha': np.array([3.0, 6.0]),
+                'Migration': np.array([
+                    [np.eye(2), np.eye(2)], [migration, migration]])})
+
+        # 50 recruits per region and 1 adult, so 2 spawners
+        testing.assert_equal(
+            ensemble_vars['N_ktasx'][:, 0],
+            np.array([[[[50.0, 50.0]], [[1.0, 1.0]]]] * 2))
+        testing.assert_equal(ensemble_vars['Spawners_kt'][:, 1], [2.0, 2.0])
+        # S = 0.5, G = 0.25 * 0.5 / 0.75 and P = 0.5 * 0.5 / 0.75
+        G = 1.0 / 6
+        P = 1.0 / 3
+        recruits = 0.5 * 2.0 * np.e ** -1.0
+        testing.assert_array_almost_equal(
+            ensemble_vars['N_ktasx'][:, 1],
+            np.array([
+                [[[3.0 * recruits + 25.0] * 2],
+                 [[50.0 * G + P] * 2]],
+                [[[6.0 * recruits + 31.25, 6.0 * recruits + 18.75]],
+                 [[62.5 * G + 1.25 * P, 37.5 * G + 0.75 * P]]]]))
+
+    def test_age_based_fecundity(self):
+        """First step of an Age-Based Fecundity ensemble with more regions
+        than sexes and migration"""
+        self.sample_vars.update({
+            'recruitment_type': 'Fecundity',
+            'Survnaturalfrac': np.ones([3, 2, 2]) * 0.5,
+            'Vulnfishing': np.array([[0.0, 0.0], [0.0, 0.0]]),
+            'Fecundity': np.array([[0.0, 2.0], [0.0, 4.0]]),
+            'Regions': np.array(['r1', 'r2', 'r3']),
+            'Exploitationfraction': np.array([0.0, 0.0, 0.0]),
+            'Larvaldispersal': np.array([0.5, 0.25, 0.25]),
+            'Migration': [np.matrix([[0.5, 0.0, 0.0], [0.5, 1.0, 0.0], [0.0, 0.0, 1.0]])] * 2,
+        })
+        ensemble_vars = model.run_ensemble_model(
+            self.sample_vars,
+            {'total_init_recruits': np.array([100.0, 200.0])})
+
+        for k, scale in enumerate([1.0, 2.0]):
+            # Both classes start at [25, 12.5, 12.5] per sex
+            testing.assert_equal(
+                ensemble_vars['N_ktasx'][k, 0],
+                np.array([[[25.0, 12.5, 12.5]] * 2] * 2) * scale)
+            # 50 adults of each sex lay 2 and 4 eggs: 300 eggs
+            testing.assert_equal(
+                ensemble_vars['N_ktasx'][k, 1, 0],
+                np.array([[75.0, 37.5, 37.5]] * 2) * scale)
+            # Half of region 1 moves to region 2 before surviving
+            testing.assert_equal(
+                ensemble_vars['N_ktasx'][k, 1, 1],
+                np.array([[12.5, 25.0, 12.5]] * 2) * scale)
+
+    def test_stop_at_equilibrium(self):
+        """Equilibrated members hold their values"""
+        self.sample_vars['recruitment_type'] = 'Fixed'
+        ensemble_vars = model.run_ensemble_model(
+            self.sample_vars, {'total_recur_recruits': np.array([1.0, 10.0])},
+            stop_at_equilibrium=True)
+        for k, timestep in enumerate(ensemble_vars['equilibrate_timestep_k']):
+            self.assertTrue(timestep > 0)
+            testing.assert_array_equal(
+                ensemble_vars['H_ktx'][k, timestep:],
+                np.tile(ensemble_vars['H_ktx'][k, timestep],
+                        (50 - timestep, 1)))
 
 
 if __name__ == '__main__':
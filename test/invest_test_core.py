@@ -333,6 +333,31 @@ def make_sample_dem(cols, rows, height_points, roughness, nodata, out_uri):
 
     return dataset
 
+def make_raster(workspace_dir, name, array, datatype, nodata=None):
+    """Write a 2D array to a single band GeoTIFF with the same geotransform
+       as the random rasters above.
+
+       workspace_dir - the directory to write the raster to
+       name - the filename of the raster in workspace_dir
+       array - a 2D numpy array of the pixel values
+       datatype - the GDAL datatype of the band such as gdal.GDT_Float32
+       nodata - the nodata value of the band, left unset if None
+
+       returns the uri of the new raster"""
+
+    raster_uri = os.path.join(workspace_dir, name)
+    driver = gdal.GetDriverByName('GTiff')
+    raster_dataset = driver.Create(
+        raster_uri, array.shape[1], array.shape[0], 1, datatype)
+    raster_dataset.SetGeoTransform([444720, 30, 0, 3751320, 0, -30])
+    raster_band = raster_dataset.GetRasterBand(1)
+    if nodata is not None:
+        raster_band.SetNoDataValue(nodata)
+    raster_band.WriteArray(array)
+    raster_band = None
+    raster_dataset = None
+    return raster_uri
+
 def assertTwoDatasets(unit, firstDS, secondDS, checkEqual, dict=None):
     firstDSBand = firstDS.GetRasterBand(1)
     secondDSBand = secondDS.GetRasterBand(1)
@@ -9,6 +9,7 @@ from nose.plugins.skip import SkipTest
 import numpy as np
 
 from invest_natcap.marine_water_quality import marine_water_quality_biophysical
+from invest_natcap.marine_water_quality import marine_water_quality_core
 import invest_test_core
 
 LOGGER = logging.getLogger('marine_water_quality_test')
@@ -37,3 +38,37 @@ class TestMWQBiophysical(unittest.TestCase):
             os.mkdir(output_base)
         
         marine_water_quality_biophysical.execute(args)
+
+
+class TestMWQCore(unittest.TestCase):
+    """Tests for the advection diffusion solver"""
+    def test_diffusion_advection_solvers(self):
+        """Every linear solver should give the same concentrations on a
+            small grid with a land cell and a source point."""
+        nodata = -1.0
+        in_water_array = np.ones((8, 9), dtype=np.bool)
+        in_water_array[3, 4] = False
+        tide_e_array = np.ones((8, 9)) * 50.0
+        adv_u_array = np.ones((8, 9)) * 0.1
+        adv_v_array = np.zeros((8, 9))
+        source_point_data = {0: {'point': [5, 2], 'WPS': 100.0}}
+
+        direct_result = marine_water_quality_core.diffusion_advection_solver(
+            dict((k, v.copy()) for k, v in source_point_data.iteritems()),
+            0.001, in_water_array, tide_e_array, adv_u_array, adv_v_array,
+            nodata, 10.0, 1.0, solver='direct')
+        self.assertEqual(direct_result[3, 4], nodata)
+        self.assertTrue(direct_result[5, 2] > 0)
+
+        for solver in ['amg', 'lgmres', 'gmres', 'bicgstab']:
+            result = marine_water_quality_core.diffusion_advection_solver(
+                dict((k, v.copy()) for k, v in source_point_data.iteritems()),
+                0.001, in_water_array, tide_e_array, adv_u_array,
+                adv_v_array, nodata, 10.0, 1.0, solver=solver,
+                tolerance=1e-10)
+            np.testing.assert_allclose(result, direct_result, rtol=1e-5)
+
+        self.assertRaises(
+            ValueError, marine_water_quality_core.diffusion_advection_solver,
+            source_point_data, 0.001, in_water_array, tide_e_array,
+            adv_u_array, adv_v_array, nodata, 10.0, 1.0, solver='unknown')
@@ -0,0 +1,78 @@
+"""Tests for the serial and basin parallel NDR effective retention"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+import pygeoprocessing.routing
+
+import ndr_core
+import invest_test_core
+
+
+class TestNDREffectiveRetention(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def _read_raster(self, raster_uri):
+        raster_dataset = gdal.Open(raster_uri)
+        array = raster_dataset.GetRasterBand(1).ReadAsArray()
+        raster_dataset = None
+        return array
+
+    def test_parallel_matches_serial(self):
+        """Routing by basin gives the serial result bit for bit, both for
+            basins that fit in a strip and for taller ones"""
+        numpy.random.seed(0)
+        n_rows, n_cols = 60, 45
+        #valleys running down to a stream along the top and one across the
+        #middle, with noise so flow splits between neighbors
+        dem_array = (
+            numpy.arange(n_rows)[:, numpy.newaxis] * 0.3 +
+            numpy.abs(numpy.arange(n_cols) - n_cols / 2.0)[numpy.newaxis, :] *
+            0.2 + numpy.sin(numpy.arange(n_cols) / 3.0)[numpy.newaxis, :] * 2 +
+            numpy.random.random((n_rows, n_cols)) * 5).astype(numpy.float32)
+        dem_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'dem.tif', dem_array, gdal.GDT_Float32, -1.0)
+        flow_direction_uri = os.path.join(
+            self.workspace_dir, 'flow_direction.tif')
+        pygeoprocessing.routing.flow_direction_d_inf(
+            dem_uri, flow_direction_uri)
+
+        stream_array = numpy.zeros((n_rows, n_cols), dtype=numpy.byte)
+        stream_array[0, :] = 1
+        stream_array[n_rows / 2, ::7] = 1
+        stream_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'stream.tif', stream_array, gdal.GDT_Byte, 255)
+        retention_eff_lulc_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'eff.tif', numpy.random.uniform(
+                0.1, 0.9, (n_rows, n_cols)).astype(numpy.float32),
+            gdal.GDT_Float32, -1.0)
+        crit_len_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'crit_len.tif', numpy.random.uniform(
+                20, 200, (n_rows, n_cols)).astype(numpy.float32),
+            gdal.GDT_Float32, -1.0)
+
+        serial_uri = os.path.join(self.workspace_dir, 'serial.tif')
+        ndr_core.ndr_eff_calculation(
+            flow_direction_uri, stream_uri, retention_eff_lulc_uri,
+            crit_len_uri, serial_uri)
+        serial_array = self._read_raster(serial_uri)
+
+        #the whole raster in one strip, then strips of 4 rows so most basins
+        #are routed on their own window
+        for max_strip_pixels in [2**24, 4 * n_cols]:
+            parallel_uri = os.path.join(
+                self.workspace_dir, 'parallel_%d.tif' % max_strip_pixels)
+            ndr_core.ndr_eff_calculation_parallel(
+                flow_direction_uri, stream_uri, retention_eff_lulc_uri,
+                crit_len_uri, parallel_uri, 2,
+                max_strip_pixels=max_strip_pixels)
+            numpy.testing.assert_array_equal(
+                self._read_raster(parallel_uri), serial_array)
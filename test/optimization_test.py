@@ -0,0 +1,131 @@
+"""Tests for the streamed top-k pixel selection of the optimization module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+from osgeo import ogr
+import numpy
+import scipy.ndimage.filters
+
+from invest_natcap.optimization import optimization
+
+import invest_test_core
+
+GEOTRANSFORM = [444720, 30, 0, 3751320, 0, -30]
+
+
+class TestStaticMaxMarginalGain(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.block_pixels = optimization.BLOCK_PIXELS
+
+    def tearDown(self):
+        optimization.BLOCK_PIXELS = self.block_pixels
+        shutil.rmtree(self.workspace_dir)
+
+    def _make_aoi(self, name, n_rows, n_aoi_cols):
+        """Writes a polygon shapefile covering the first n_aoi_cols columns
+            of every row and returns its uri"""
+        aoi_uri = os.path.join(self.workspace_dir, name)
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        datasource = driver.CreateDataSource(aoi_uri)
+        layer = datasource.CreateLayer('aoi', geom_type=ogr.wkbPolygon)
+        min_x = GEOTRANSFORM[0] - 10
+        max_x = GEOTRANSFORM[0] + n_aoi_cols * GEOTRANSFORM[1]
+        max_y = GEOTRANSFORM[3] + 10
+        min_y = GEOTRANSFORM[3] + n_rows * GEOTRANSFORM[5] - 10
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in [(min_x, min_y), (min_x, max_y), (max_x, max_y),
+                     (max_x, min_y), (min_x, min_y)]:
+            ring.AddPoint(x, y)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+        feature = None
+        layer = None
+        datasource = None
+        return aoi_uri
+
+    def _read_raster(self, raster_uri):
+        raster_dataset = gdal.Open(raster_uri)
+        array = raster_dataset.GetRasterBand(1).ReadAsArray()
+        raster_dataset = None
+        return array
+
+    def _reference_selection(self, scores, valid_mask, budget):
+        """Selects the best `budget` valid pixels of the whole array with a
+            single sort, ties going to the lower flat index"""
+        flat_scores = scores.flatten()
+        flat_valid = valid_mask.flatten()
+        order = numpy.argsort(-flat_scores, kind='mergesort')
+        order = order[flat_valid[order]]
+        selection = numpy.where(flat_valid, 0, 255).astype(numpy.ubyte)
+        selection[order[:budget]] = 1
+        return selection.reshape(scores.shape)
+
+    def _run_selection(self, score_array, budget_list, sigma, aoi_uri):
+        score_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'score.tif', score_array, gdal.GDT_Float32,
+            -1.0)
+        output_uri_list = [
+            os.path.join(self.workspace_dir, 'selection_%d.tif' % budget)
+            for budget in budget_list]
+        optimization.static_max_marginal_gain(
+            score_uri, budget_list, output_uri_list, sigma=sigma,
+            aoi_uri=aoi_uri)
+        return [self._read_raster(uri) for uri in output_uri_list]
+
+    def test_matches_full_sort(self):
+        """Selections streamed in strips match a sort of the whole raster,
+            with ties, nodata, nan, an aoi and several budgets"""
+        numpy.random.seed(0)
+        n_rows, n_cols, n_aoi_cols = 11, 9, 6
+        #few distinct values so many pixels tie, also across strips
+        score_array = numpy.random.randint(0, 4, (n_rows, n_cols)).astype(
+            numpy.float32)
+        score_array[2, 1] = -1.0
+        score_array[7, 3] = numpy.nan
+        valid_mask = ~numpy.isnan(score_array) & (score_array != -1.0)
+        valid_mask[:, n_aoi_cols:] = False
+        aoi_uri = self._make_aoi('aoi.shp', n_rows, n_aoi_cols)
+        n_valid = numpy.count_nonzero(valid_mask)
+
+        #strips of 3 rows, the small budgets are trimmed to while streaming
+        #with ties at the smallest kept value
+        optimization.BLOCK_PIXELS = 3 * n_cols
+        for budget_list in [[0, 1, 5, 17, 40, n_valid + 10], [3], [5, 9]]:
+            selection_list = self._run_selection(
+                score_array, budget_list, 0.0, aoi_uri)
+            for budget, selection in zip(budget_list, selection_list):
+                numpy.testing.assert_array_equal(
+                    selection,
+                    self._reference_selection(
+                        score_array, valid_mask, budget))
+
+    def test_matches_full_sort_smoothed(self):
+        """Gaussian smoothing strips with a halo selects the same pixels as
+            smoothing the whole raster"""
+        numpy.random.seed(1)
+        n_rows, n_cols = 20, 7
+        score_array = numpy.random.random((n_rows, n_cols)).astype(
+            numpy.float32)
+        score_array[5, 2] = -1.0
+        valid_mask = score_array != -1.0
+        sigma = 1.5
+        smoothed_array = scipy.ndimage.filters.gaussian_filter(
+            numpy.where(valid_mask, score_array, 0.0).astype(numpy.float32),
+            sigma, mode='constant', cval=0.0)
+
+        budget_list = [4, 30]
+        optimization.BLOCK_PIXELS = 2 * n_cols
+        selection_list = self._run_selection(
+            score_array, budget_list, sigma, None)
+        for budget, selection in zip(budget_list, selection_list):
+            numpy.testing.assert_array_equal(
+                selection,
+                self._reference_selection(smoothed_array, valid_mask, budget))
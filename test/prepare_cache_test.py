@@ -0,0 +1,102 @@
+"""Tests for the prepared data cache shared by SDR and NDR"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from invest_natcap import prepare_cache
+
+
+class TestPrepareCache(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workspace_dir, 'cache')
+        self.dem_uri = os.path.join(self.workspace_dir, 'dem.tif')
+        dem_file = open(self.dem_uri, 'wb')
+        dem_file.write('dem bytes')
+        dem_file.close()
+        self.n_prepare_calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def _prepare(self, **args):
+        """Stand in for a model's _prepare that counts its calls"""
+        self.n_prepare_calls += 1
+        intermediate_dir = os.path.join(args['workspace_dir'], 'prepared_data')
+        os.makedirs(intermediate_dir)
+        flow_uri = os.path.join(intermediate_dir, 'flow_direction.tif')
+        flow_file = open(flow_uri, 'w')
+        flow_file.write(open(args['dem_uri'], 'rb').read())
+        flow_file.close()
+        return {'flow_direction_uri': flow_uri}
+
+    def _cached_prepare(self, **kwargs):
+        args = {
+            'workspace_dir': os.path.join(self.workspace_dir, 'run'),
+            'dem_uri': self.dem_uri,
+        }
+        return prepare_cache.cached_prepare(
+            'test', self._prepare, args, ['dem_uri'],
+            cache_dir=self.cache_dir, **kwargs)
+
+    def _write_file(self, uri, contents):
+        out_file = open(uri, 'wb')
+        out_file.write(contents)
+        out_file.close()
+
+    def test_cache_hit(self):
+        """A second run on the same inputs should not call _prepare"""
+        first_data = self._cached_prepare()
+        second_data = self._cached_prepare()
+        self.assertEqual(self.n_prepare_calls, 1)
+        self.assertEqual(first_data, second_data)
+        self.assertEqual(
+            open(first_data['flow_direction_uri']).read(), 'dem bytes')
+
+    def test_cache_miss_on_changed_input(self):
+        """Changing the contents of an input should prepare a new entry"""
+        first_data = self._cached_prepare()
+        dem_file = open(self.dem_uri, 'wb')
+        dem_file.write('other dem bytes')
+        dem_file.close()
+        second_data = self._cached_prepare()
+        self.assertEqual(self.n_prepare_calls, 2)
+        self.assertNotEqual(
+            first_data['flow_direction_uri'],
+            second_data['flow_direction_uri'])
+
+    def test_incomplete_entry_is_replaced(self):
+        """An entry with a missing raster should be recalculated"""
+        first_data = self._cached_prepare()
+        os.remove(first_data['flow_direction_uri'])
+        second_data = self._cached_prepare()
+        self.assertEqual(self.n_prepare_calls, 2)
+        self.assertTrue(os.path.exists(second_data['flow_direction_uri']))
+
+    def test_clear_cache(self):
+        """clear_cache should remove every entry of a model"""
+        self._cached_prepare()
+        prepare_cache.clear_cache('test', cache_dir=self.cache_dir)
+        self._cached_prepare()
+        self.assertEqual(self.n_prepare_calls, 2)
+
+    def test_unrelated_file_with_same_stem(self):
+        """Only a dataset's own sidecars should change its key"""
+        first_key = prepare_cache.get_cache_key('test', [self.dem_uri])
+        self._write_file(
+            os.path.join(self.workspace_dir, 'dem.shp'), 'shapefile bytes')
+        self.assertEqual(
+            first_key, prepare_cache.get_cache_key('test', [self.dem_uri]))
+        self._write_file(self.dem_uri + '.aux.xml', '<PAMDataset/>')
+        self.assertNotEqual(
+            first_key, prepare_cache.get_cache_key('test', [self.dem_uri]))
+
+    def test_evict_least_recently_used(self):
+        """Entries past the size limit are deleted oldest use first"""
+        first_data = self._cached_prepare()
+        self._write_file(self.dem_uri, 'other dem bytes')
+        second_data = self._cached_prepare(max_cache_bytes=0)
+        self.assertFalse(os.path.exists(first_data['flow_direction_uri']))
+        self.assertTrue(os.path.exists(second_data['flow_direction_uri']))
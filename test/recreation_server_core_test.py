@@ -1,8 +1,20 @@
 """Testing of recreation_server_core
 """
+import math
+import os
+import shutil
+import tempfile
 import unittest
+
+from osgeo import ogr, osr
+import psycopg2
+
 import recreation_server_core
 
+#the environment variable holding a libpq connection string to a PostGIS
+#database the database tests may create temporary tables in
+POSTGIS_ENV = "INVEST_TEST_POSTGIS"
+
 
 class PostgisTest(unittest.TestCase):
     """testing class"""
@@ -53,6 +65,80 @@ class PostgisTest(unittest.TestCase):
 
         self.assertEqual(results, expected_results)
 
+    def test_format_double_sql(self):
+        """format_double_sql test
+        """
+
+        expected_results = "-0.1::double precision"
+
+        results = recreation_server_core.format_double_sql(-0.1)
+
+        self.assertEqual(results, expected_results)
+
+    def test_format_copy_value(self):
+        """format_copy_value test
+        """
+
+        self.assertEqual(recreation_server_core.format_copy_value(None), "\\N")
+        self.assertEqual(
+            recreation_server_core.format_copy_value("a\tb\\c\nd"),
+            "a\\tb\\\\c\\nd")
+
+    def test_grid_sql(self):
+        """grid_sql test
+        """
+
+        expected_results = (
+            "INSERT INTO grid SELECT cell.cell, cell.id "
+            "FROM (SELECT ST_MakeEnvelope("
+            "trunc(0.5::double precision + (i * 10.0::double precision)), "
+            "trunc(-1.0::double precision + (j * 10.0::double precision)), "
+            "trunc(0.5::double precision + "
+            "((i + 1) * 10.0::double precision)), "
+            "trunc(-1.0::double precision + "
+            "((j + 1) * 10.0::double precision)), 3857) "
+            "AS cell, (i * 2) + j AS id "
+            "FROM generate_series(0, 3 - 1) AS i, "
+            "generate_series(0, 2 - 1) AS j) AS cell, aoi "
+            "WHERE ST_Covers(aoi.way, cell.cell)")
+
+        results = recreation_server_core.grid_sql(
+            "aoi", "way", "grid", "cell", 0.5, -1.0, 3, 2, 10.0, 3857)
+
+        self.assertEqual(results, expected_results)
+
+    def test_hex_grid_sql(self):
+        """hex_grid_sql test
+        """
+
+        long_x = "5.0::double precision"
+        short_x = "2.5::double precision"
+        delta_y = "4.330127018922193::double precision"
+        expected_results = (
+            "INSERT INTO grid SELECT cell.cell, cell.id "
+            "FROM (SELECT ST_SetSRID(ST_MakePolygon(ST_MakeLine(ARRAY["
+            "ST_MakePoint(trunc(x - %(long_x)s), trunc(y + 0)), "
+            "ST_MakePoint(trunc(x - %(short_x)s), trunc(y + %(delta_y)s)), "
+            "ST_MakePoint(trunc(x + %(short_x)s), trunc(y + %(delta_y)s)), "
+            "ST_MakePoint(trunc(x + %(long_x)s), trunc(y + 0)), "
+            "ST_MakePoint(trunc(x + %(short_x)s), trunc(y - %(delta_y)s)), "
+            "ST_MakePoint(trunc(x - %(short_x)s), trunc(y - %(delta_y)s)), "
+            "ST_MakePoint(trunc(x - %(long_x)s), trunc(y + 0))])), 3857) "
+            "AS cell, (j * 2) + i AS id "
+            "FROM (SELECT i, j, 0.5::double precision + (%(long_x)s * "
+            "(CASE WHEN (i + 1) %% 2 = 1 THEN 1 + (3 * j) "
+            "ELSE 2.5::double precision + (3 * j) END)) AS x, "
+            "-1.0::double precision + (%(delta_y)s * (i + 1)) AS y "
+            "FROM generate_series(0, 3 - 1) AS j, "
+            "generate_series(0, 2 - 1) AS i) AS centroid) AS cell, aoi "
+            "WHERE ST_Covers(aoi.way, cell.cell)") % {
+                "long_x": long_x, "short_x": short_x, "delta_y": delta_y}
+
+        results = recreation_server_core.hex_grid_sql(
+            "aoi", "way", "grid", "cell", 0.5, -1.0, 3, 2, 10.0, 3857)
+
+        self.assertEqual(results, expected_results)
+
     def test_format_feature_sql(self):
         feature = "tag_value"
         expected_results = "osm.tag = \'value\'"
@@ -76,7 +162,218 @@ class PostgisTest(unittest.TestCase):
     def category_dict(self):
         pass
 
-    
-        
+
+def _aoi_bounds(cur, in_table_name, in_column_name):
+    """Returns the (min_x, min_y, max_x, max_y, srid) of an AOI table"""
+    cur.execute("SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), "
+                "ST_YMax(extent) FROM (SELECT Box2D(ST_Union(%s)) AS extent "
+                "FROM %s) AS bbox" % (in_column_name, in_table_name))
+    min_x, min_y, max_x, max_y = cur.fetchone()
+    cur.execute("SELECT ST_srid(%s) FROM %s LIMIT 1" % (
+        in_column_name, in_table_name))
+    srid, = cur.fetchone()
+    return min_x, min_y, max_x, max_y, srid
+
+
+def _cell_loop_insert(cur, in_table_name, in_column_name, out_table_name,
+                      out_column_name, cell_id, points, srid):
+    """Inserts one grid cell if the AOI covers it, the statement the grids
+    used to run for every cell"""
+    sql = "INSERT INTO %s SELECT %s, %i as id FROM %s as %s," % (
+        out_table_name, out_column_name, cell_id,
+        recreation_server_core.format_polygon_sql(points, srid),
+        out_column_name)
+    sql = sql + " %s WHERE ST_Covers(%s.%s,%s)" % (
+        in_table_name, in_table_name, in_column_name, out_column_name)
+    cur.execute(sql)
+
+
+def _row_update_sort_grid(cur, out_table_name, out_column_name):
+    """The per row renumbering sort_grid used to run"""
+    cur.execute("SELECT id, row_number() OVER (ORDER BY ST_YMin(box2d(%s)), "
+                "ST_XMin(box2d(%s)) ASC) FROM %s" % (
+                    out_column_name, out_column_name, out_table_name))
+    renumber = cur.fetchall()
+    cur.execute("ALTER TABLE %s ADD new_id integer" % out_table_name)
+    for old_id, new_id in renumber:
+        cur.execute("UPDATE %s SET new_id = %i WHERE id = %i" % (
+            out_table_name, new_id, old_id))
+    cur.execute("ALTER TABLE %s DROP COLUMN id" % out_table_name)
+    cur.execute("ALTER TABLE %s RENAME COLUMN new_id to id" % out_table_name)
+
+
+def cell_loop_grid(cur, in_table_name, in_column_name, out_table_name,
+                   out_column_name, cell_size):
+    """The square grid built one calculate_grid cell at a time, kept as a
+    reference"""
+    min_x, min_y, max_x, max_y, srid = _aoi_bounds(
+        cur, in_table_name, in_column_name)
+    columns = int(math.floor(abs(max_x - min_x) / cell_size))
+    rows = int(math.floor(abs(max_y - min_y) / cell_size))
+    cur.execute("CREATE TEMPORARY TABLE %s (%s geometry, id integer)" % (
+        out_table_name, out_column_name))
+    for i in range(columns):
+        for j in range(rows):
+            _cell_loop_insert(
+                cur, in_table_name, in_column_name, out_table_name,
+                out_column_name, (i * rows) + j,
+                recreation_server_core.calculate_grid(
+                    min_x, min_y, i, j, cell_size), srid)
+    _row_update_sort_grid(cur, out_table_name, out_column_name)
+
+
+def cell_loop_hex_grid(cur, in_table_name, in_column_name, out_table_name,
+                       out_column_name, cell_size):
+    """The hexagonal grid built one hexagon at a time, kept as a reference"""
+    min_x, min_y, max_x, max_y, srid = _aoi_bounds(
+        cur, in_table_name, in_column_name)
+    delta_short_x = cell_size * 0.25
+    delta_long_x = cell_size * 0.5
+    delta_y = cell_size * 0.25 * (3 ** 0.5)
+    columns = int(math.floor(abs(max_x - min_x) / (3 * delta_long_x)) + 1)
+    rows = int(math.floor(abs(max_y - min_y) / delta_y) + 1)
+    cur.execute("CREATE TEMPORARY TABLE %s (%s geometry, id INTEGER)" % (
+        out_table_name, out_column_name))
+    for j in range(columns):
+        for i in range(rows):
+            if (i + 1) % 2:
+                x = min_x + (delta_long_x * (1 + (3 * j)))
+            else:
+                x = min_x + (delta_long_x * (2.5 + (3 * j)))
+            y = min_y + (delta_y * (i + 1))
+            hexagon = [(x - delta_long_x, y),
+                       (x - delta_short_x, y + delta_y),
+                       (x + delta_short_x, y + delta_y),
+                       (x + delta_long_x, y),
+                       (x + delta_short_x, y - delta_y),
+                       (x - delta_short_x, y - delta_y),
+                       (x - delta_long_x, y)]
+            _cell_loop_insert(
+                cur, in_table_name, in_column_name, out_table_name,
+                out_column_name, (j * rows) + i, hexagon, srid)
+    _row_update_sort_grid(cur, out_table_name, out_column_name)
+
+
+class PostgisDatabaseTest(unittest.TestCase):
+    """Tests against the PostGIS database given by the libpq connection
+    string in the INVEST_TEST_POSTGIS environment variable, skipped without
+    one"""
+
+    def setUp(self):
+        if POSTGIS_ENV not in os.environ:
+            raise unittest.SkipTest("%s is not set" % POSTGIS_ENV)
+        try:
+            self.database = psycopg2.connect(os.environ[POSTGIS_ENV])
+        except psycopg2.Error as error:
+            raise unittest.SkipTest("No PostGIS database: %s" % error)
+        self.cur = self.database.cursor()
+        self.workspace_dir = tempfile.mkdtemp()
+
+        #an L shaped AOI whose corners aren't on whole map units
+        self.cur.execute(
+            "CREATE TEMPORARY TABLE aoi (way geometry)")
+        self.cur.execute(
+            "INSERT INTO aoi VALUES (ST_GeomFromText('POLYGON(("
+            "0.5 0.25, 1000.5 0.25, 1000.5 700.75, 400.5 700.75, "
+            "400.5 300.25, 0.5 300.25, 0.5 0.25))', 3857))")
+
+    def tearDown(self):
+        #temporary tables go with the connection
+        self.database.rollback()
+        self.database.close()
+        shutil.rmtree(self.workspace_dir)
+
+    def _grid_rows(self, table_name):
+        self.cur.execute(
+            "SELECT id, ST_AsEWKT(way) FROM %s ORDER BY id" % table_name)
+        return self.cur.fetchall()
+
+    def test_temp_grid_db(self):
+        """temp_grid_db makes the same cells and ids as the cell loop
+        """
+
+        recreation_server_core.temp_grid_db(
+            self.cur, "aoi", "way", "grid", "way", 97.5)
+        cell_loop_grid(self.cur, "aoi", "way", "loop_grid", "way", 97.5)
+
+        results = self._grid_rows("grid")
+        #some cells are outside of the L
+        self.assertTrue(0 < len(results) < 10 * 7)
+        self.assertEqual(results, self._grid_rows("loop_grid"))
+
+    def test_hex_grid(self):
+        """hex_grid makes the same cells and ids as the hexagon loop
+        """
+
+        recreation_server_core.hex_grid(
+            self.cur, "aoi", "way", "grid", "way", 120.0)
+        cell_loop_hex_grid(self.cur, "aoi", "way", "loop_grid", "way", 120.0)
+
+        results = self._grid_rows("grid")
+        self.assertTrue(len(results) > 0)
+        self.assertEqual(results, self._grid_rows("loop_grid"))
+
+    def test_temp_shapefile_db(self):
+        """temp_shapefile_db COPYs values that need escaping, NULLs and
+        several chunks
+        """
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3857)
+        shapefile_name = os.path.join(self.workspace_dir, "points.shp")
+        datasource = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(
+            shapefile_name)
+        layer = datasource.CreateLayer("points", srs, ogr.wkbPoint)
+        layer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
+        layer.CreateField(ogr.FieldDefn("value", ogr.OFTReal))
+        layer.CreateField(ogr.FieldDefn("name", ogr.OFTString))
+        feature_list = [
+            (1, 2.5, "plain", "POINT(1.5 2.25)"),
+            (2, None, "tab\there back\\slash 'quote'", "POINT(-3 4)"),
+            (3, -0.125, None, "POINT(5 -6.5)"),
+            (4, 7.0, "line\nbreak", None),
+            (5, 0.0, "", "POINT(0 0)")]
+        for id_number, value, name, wkt in feature_list:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField("id", id_number)
+            if value is not None:
+                feature.SetField("value", value)
+            if name is not None:
+                feature.SetField("name", name)
+            if wkt is not None:
+                feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            layer.CreateFeature(feature)
+            feature = None
+        layer = None
+        datasource = None
+
+        #map the prj to its srid the way the server does
+        prj_file = open(shapefile_name[:-3] + "prj", "r")
+        wkt = prj_file.read()
+        prj_file.close()
+        self.cur.execute(
+            "CREATE TEMPORARY TABLE prj_srid "
+            "(wkt text, auth_srid integer, source text)")
+        self.cur.execute(
+            "INSERT INTO prj_srid VALUES (%s, 3857, 'test')", (wkt,))
+
+        srid = recreation_server_core.temp_shapefile_db(
+            self.cur, shapefile_name, "points", attributes=True,
+            chunk_size=2)
+
+        self.assertEqual(srid, 3857)
+        self.cur.execute("SELECT id, value, name, ST_SRID(way), "
+                         "ST_AsText(way) FROM points ORDER BY id")
+        #the feature without a geometry is skipped, an unset number is NULL
+        #and unset text is empty
+        expected_results = [
+            (1, 2.5, "plain", 3857, "POINT(1.5 2.25)"),
+            (2, None, "tab\there back\\slash 'quote'", 3857,
+             "POINT(-3 4)"),
+            (3, -0.125, "", 3857, "POINT(5 -6.5)"),
+            (5, 0.0, "", 3857, "POINT(0 0)")]
+        self.assertEqual(self.cur.fetchall(), expected_results)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,14 @@
 """Unit Tests For Reporting Package"""
 
 import os, sys
+import codecs
+import copy
+import shutil
+import tempfile
 from osgeo import gdal
 from osgeo import ogr
 import unittest
+import pygeoprocessing.geoprocessing
 from nose.plugins.skip import SkipTest
 import invest_natcap.testing as testing
 
@@ -995,3 +1000,145 @@ class TestReportingPackage(testing.GISTest):
         reporting.generate_report(report_args)
 
         self.assertFiles(output_uri, reg_uri)
+
+
+class TestReportingRowReaders(unittest.TestCase):
+    """Tests that the streaming CSV and datasource row readers give the rows
+        the lookup dictionaries used to"""
+
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        # Keys out of order, a repeated key and quoted fields with a comma
+        # and a line break
+        self.csv_uri = os.path.join(self.workspace_dir, 'table.csv')
+        csv_file = open(self.csv_uri, 'wb')
+        csv_file.write(
+            'ws_id,name,value\n'
+            '3,"multi\nline",1.5\n'
+            '1,plain,2\n'
+            '2,"comma, inside",3\n'
+            '1,replaced,4\n')
+        csv_file.close()
+        self.columns = [
+            {'name': 'ws_id', 'total': False},
+            {'name': 'name', 'total': False},
+            {'name': 'value', 'total': True}]
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def test_iter_csv_rows(self):
+        """iter_csv_rows sorts by key, keeps the last row of a repeated key
+            and reads quoted line breaks"""
+        expected_rows = [
+            {'ws_id': 1, 'name': 'replaced', 'value': 4},
+            {'ws_id': 2, 'name': 'comma, inside', 'value': 3},
+            {'ws_id': 3, 'name': 'multi\nline', 'value': 1.5}]
+        self.assertEqual(
+            list(reporting.iter_csv_rows(self.csv_uri, 'ws_id')),
+            expected_rows)
+
+        file_order_ids = [
+            (row['ws_id'], row['name'])
+            for row in reporting.iter_csv_rows(self.csv_uri)]
+        self.assertEqual(file_order_ids, [
+            (3, 'multi\nline'), (1, 'plain'), (2, 'comma, inside'),
+            (1, 'replaced')])
+
+    def test_iter_csv_rows_lookup(self):
+        """iter_csv_rows gives the rows of the csv lookup dictionary in key
+            order"""
+        lookup_rows = reporting.data_dict_to_list(
+            pygeoprocessing.geoprocessing.get_lookup_from_csv(
+                self.csv_uri, 'ws_id'))
+        self.assertEqual(
+            list(reporting.iter_csv_rows(self.csv_uri, 'ws_id')),
+            lookup_rows)
+
+    def test_iter_datasource_rows(self):
+        """iter_datasource_rows gives the rows of the datasource table by
+            key in key order"""
+        shape_uri = os.path.join(self.workspace_dir, 'parcels.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        datasource = driver.CreateDataSource(shape_uri)
+        layer = datasource.CreateLayer('parcels', geom_type=ogr.wkbPoint)
+        for field_name, field_type in [
+                ('parcel_id', ogr.OFTInteger), ('owner', ogr.OFTString),
+                ('area', ogr.OFTReal)]:
+            layer.CreateField(ogr.FieldDefn(field_name, field_type))
+        for parcel_id, owner, area in [
+                (7, 'north', 2.5), (2, 'east', 10.0), (5, 'south', 0.25),
+                (2, 'west', 4.0)]:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('parcel_id', parcel_id)
+            feature.SetField('owner', owner)
+            feature.SetField('area', area)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                'POINT(%d %d)' % (parcel_id, parcel_id)))
+            layer.CreateFeature(feature)
+            feature = None
+        layer = None
+        datasource = None
+
+        datasource_rows = list(
+            reporting.iter_datasource_rows(shape_uri, 'parcel_id'))
+        self.assertEqual(
+            [(row['parcel_id'], row['owner']) for row in datasource_rows],
+            [(2, 'west'), (5, 'south'), (7, 'north')])
+        self.assertEqual(
+            datasource_rows, reporting.data_dict_to_list(
+                pygeoprocessing.geoprocessing.extract_datasource_table_by_key(
+                    shape_uri, 'parcel_id')))
+
+    def test_generate_report_csv(self):
+        """A 'csv' table is written to the same html page as when the whole
+            table was read into a lookup first"""
+        output_uri = os.path.join(self.workspace_dir, 'report.html')
+        report_args = {
+            'title': 'Test Title',
+            'elements': [{
+                'type': 'table',
+                'section': 'body',
+                'sortable': True,
+                'checkbox': False,
+                'total': True,
+                'data_type': 'csv',
+                'columns': copy.deepcopy(self.columns),
+                'key': 'ws_id',
+                'data': self.csv_uri}],
+            'out_uri': output_uri}
+        reporting.generate_report(report_args)
+
+        # The table as the string built html page wrote it
+        expected_table = (
+            '<table class="sortable"><thead><tr><th>ws_id</th><th>name</th>'
+            '<th>value</th></tr></thead><tfoot><tr class="totalColumn">'
+            '<td>Total</td><td>--</td><td class="totalCol">--</td></tr>'
+            '</tfoot><tbody>'
+            '<tr><td>1</td><td>replaced</td>'
+            '<td class="rowDataSd ">4</td></tr>'
+            '<tr><td>2</td><td>comma, inside</td>'
+            '<td class="rowDataSd ">3</td></tr>'
+            '<tr><td>3</td><td>multi\nline</td>'
+            '<td class="rowDataSd ">1.5</td></tr>'
+            '</tbody></table>')
+        lookup_table = table_generator.generate_table({
+            'cols': copy.deepcopy(self.columns),
+            'rows': reporting.data_dict_to_list(
+                pygeoprocessing.geoprocessing.get_lookup_from_csv(
+                    self.csv_uri, 'ws_id')),
+            'total': True,
+            'attributes': {'class': 'sortable'}})
+        self.assertEqual(lookup_table, expected_table)
+
+        jquery_element = reporting.add_head_element({
+            'format': 'script', 'data_src': reporting.JQUERY_URI,
+            'input_type': 'File'})
+        expected_html = (
+            u'<html><meta charset="UTF-8"><head><title>Test Title</title>' +
+            jquery_element + u'</head><body>' + expected_table +
+            u'</body></html>')
+        html_file = codecs.open(output_uri, 'rb', 'utf-8')
+        html = html_file.read()
+        html_file.close()
+        self.assertEqual(html, expected_html)
@@ -0,0 +1,107 @@
+"""Tests for the batch LULC scenario runner"""
+
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+from osgeo import ogr
+
+from invest_natcap import scenario_batch
+
+#scenario name -> (ws_id, value) rows this module's execute writes
+SCENARIO_RESULTS = {
+    'forest': [(2, 0.5), (1, 1.5)],
+    'urban': [(1, 3.0), (2, 4.0)],
+    'empty': [],
+}
+
+
+def execute(args):
+    """Stand in for a model's execute that writes a watershed results
+        shapefile with the rows in SCENARIO_RESULTS"""
+    scenario_name = os.path.splitext(os.path.basename(args['lulc_uri']))[0]
+    if scenario_name == 'broken':
+        raise ValueError('broken scenario')
+    output_dir = os.path.join(args['workspace_dir'], 'output')
+    os.makedirs(output_dir)
+    write_watershed_results(
+        os.path.join(output_dir, 'watershed_results_test.shp'),
+        SCENARIO_RESULTS[scenario_name])
+
+
+def write_watershed_results(results_uri, row_list):
+    """Writes a shapefile with a ws_id and value field per row"""
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    datasource = driver.CreateDataSource(results_uri)
+    layer = datasource.CreateLayer('watershed_results', geom_type=ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn('ws_id', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    for ws_id, value in row_list:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('ws_id', ws_id)
+        feature.SetField('value', value)
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint(float(ws_id), 0.0)
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+        feature = None
+    layer = None
+    datasource = None
+
+
+class TestScenarioBatch(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        scenario_batch.MODEL_TABLE['test'] = (
+            __name__, 'watershed_results_test.shp')
+
+    def tearDown(self):
+        del scenario_batch.MODEL_TABLE['test']
+        shutil.rmtree(self.workspace_dir)
+
+    def _run_batch(self, scenario_list):
+        args = {
+            'model_name': 'test',
+            'workspace_dir': self.workspace_dir,
+            'lulc_uri_list': [
+                os.path.join('lulc', '%s.tif' % name)
+                for name in scenario_list],
+            'n_workers': 1,
+        }
+        results_table_file = open(scenario_batch.execute(args), 'rb')
+        row_list = list(csv.reader(results_table_file))
+        results_table_file.close()
+        return row_list
+
+    def test_scenario_names(self):
+        """Duplicate basenames get a numbered suffix"""
+        self.assertEqual(
+            scenario_batch.scenario_names(
+                ['a/lulc.tif', 'b/lulc.tif', 'c/other.tif']),
+            ['lulc', 'lulc_1', 'other'])
+
+    def test_read_watershed_results(self):
+        """Numeric fields other than ws_id are read per watershed"""
+        results_uri = os.path.join(self.workspace_dir, 'results.shp')
+        write_watershed_results(results_uri, [(3, 2.5), (4, 1.0)])
+        self.assertEqual(
+            scenario_batch.read_watershed_results(results_uri),
+            {3: {'value': 2.5}, 4: {'value': 1.0}})
+
+    def test_execute(self):
+        """Every scenario's watersheds land in one table, failed and empty
+            scenarios are left out"""
+        row_list = self._run_batch(['empty', 'forest', 'broken', 'urban'])
+        self.assertEqual(row_list, [
+            ['scenario', 'ws_id', 'value'],
+            ['forest', '1', '1.5'],
+            ['forest', '2', '0.5'],
+            ['urban', '1', '3.0'],
+            ['urban', '2', '4.0']])
+
+    def test_execute_no_results(self):
+        """A batch with only empty results writes just the header"""
+        row_list = self._run_batch(['empty'])
+        self.assertEqual(row_list, [['scenario', 'ws_id']])
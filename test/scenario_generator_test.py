@@ -0,0 +1,147 @@
+"""Tests for the pixel allocation of the scenario generator"""
+
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+import scipy.ndimage
+
+from invest_natcap.scenario_generator import scenario_generator
+
+import invest_test_core
+
+
+def whole_raster_allocate_pixels(
+        scenario_array, change_list, suitability_arrays):
+    """The patch loop the scenario generator used to run on whole arrays,
+        kept as a reference.  Converts scenario_array in place and returns
+        the unconverted pixel counts."""
+    suitability_arrays = dict([
+        (cover_id, array.copy())
+        for cover_id, array in suitability_arrays.items()])
+    unconverted_pixels = {}
+    for index, (priority, cover_id, count) in enumerate(change_list):
+        src_array = suitability_arrays[cover_id]
+        pixels_changed = 0
+        suitability_values = list(numpy.unique(src_array))
+        suitability_values.sort(reverse=True)
+        if suitability_values[-1] == 0:
+            suitability_values.pop(-1)
+        for suitability_score in suitability_values:
+            if pixels_changed == count:
+                break
+
+            #mask out everything except the current suitability score
+            mask = src_array == suitability_score
+
+            #label patches
+            label_im, nb_labels = scipy.ndimage.label(mask)
+
+            #get patch sizes
+            patch_sizes = scipy.ndimage.sum(
+                mask, label_im, range(1, nb_labels + 1))
+            patch_labels = numpy.array(range(1, nb_labels + 1))
+            patch_locations = scipy.ndimage.find_objects(label_im, nb_labels)
+
+            #randomize patch order
+            numpy.random.shuffle(patch_labels)
+
+            #check patches for conversion
+            for label in patch_labels:
+                source = label_im[patch_locations[label-1]]
+                target = scenario_array[patch_locations[label-1]]
+                pixels_to_change = numpy.where(source == label)
+
+                if patch_sizes[label-1] + pixels_changed > count:
+                    #calculate the distance to exit the patch
+                    patch_mask = numpy.zeros_like(target)
+                    patch_mask[pixels_to_change] = 1
+                    tmp_array = scipy.ndimage.morphology.distance_transform_edt(
+                        patch_mask)[pixels_to_change]
+
+                    #select the number of pixels that need to be converted
+                    tmp_index = numpy.argsort(tmp_array)
+                    tmp_index = tmp_index[:int(count - pixels_changed)]
+                    pixels_to_change = (
+                        pixels_to_change[0][tmp_index],
+                        pixels_to_change[1][tmp_index])
+                    target[pixels_to_change] = cover_id
+                    pixels_changed = count
+                else:
+                    #convert patch, increase count of changes
+                    target[pixels_to_change] = cover_id
+                    pixels_changed += patch_sizes[label-1]
+
+                #alter other suitability rasters to prevent double conversion
+                for _, update_id, _ in change_list[index+1:]:
+                    update_target = suitability_arrays[update_id][
+                        patch_locations[label-1]]
+                    update_target[pixels_to_change] = 0
+
+                if pixels_changed == count:
+                    break
+
+        if pixels_changed < count:
+            unconverted_pixels[cover_id] = count - pixels_changed
+
+    return unconverted_pixels
+
+
+class TestAllocatePixels(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+        self.block_pixels = scenario_generator.ALLOCATION_BLOCK_PIXELS
+
+    def tearDown(self):
+        scenario_generator.ALLOCATION_BLOCK_PIXELS = self.block_pixels
+        shutil.rmtree(self.workspace_dir)
+
+    def test_matches_whole_raster_allocation(self):
+        """Strip by strip allocation converts the same pixels as the patch
+            loop over whole arrays for the same seed"""
+        numpy.random.seed(0)
+        n_rows, n_cols = 23, 17
+        scenario_array = numpy.random.randint(1, 4, (n_rows, n_cols))
+        suitability_arrays = {}
+        for cover_id in [10, 11, 12]:
+            #smoothed noise so the levels form patches of many shapes, a lot
+            #of them crossing strip edges
+            noise = scipy.ndimage.gaussian_filter(
+                numpy.random.random((n_rows, n_cols)), 1.5)
+            levels = numpy.digitize(
+                noise, numpy.percentile(noise, [30, 60, 85]))
+            suitability_arrays[cover_id] = numpy.array(
+                [0, 20, 60, 100], dtype=numpy.uint8)[levels]
+        #the last cover asks for more than it can get
+        change_list = [(3, 10, 70), (2, 11, 95), (1, 12, 300)]
+
+        for block_rows in [n_rows, 4, 1]:
+            scenario_generator.ALLOCATION_BLOCK_PIXELS = block_rows * n_cols
+            scenario_uri = invest_test_core.make_raster(
+                self.workspace_dir, 'scenario_%d.tif' % block_rows,
+                scenario_array, gdal.GDT_Int32)
+            suitability_dict = dict([
+                (cover_id, invest_test_core.make_raster(
+                    self.workspace_dir,
+                    'suitability_%d_%d.tif' % (cover_id, block_rows), array,
+                    gdal.GDT_Byte))
+                for cover_id, array in suitability_arrays.items()])
+
+            numpy.random.seed(1)
+            unconverted_pixels = scenario_generator.allocate_pixels(
+                scenario_uri, change_list, suitability_dict)
+
+            numpy.random.seed(1)
+            expected_array = scenario_array.copy()
+            expected_unconverted = whole_raster_allocate_pixels(
+                expected_array, change_list, suitability_arrays)
+
+            scenario_dataset = gdal.Open(scenario_uri)
+            numpy.testing.assert_array_equal(
+                scenario_dataset.GetRasterBand(1).ReadAsArray(),
+                expected_array)
+            scenario_dataset = None
+            self.assertEqual(unconverted_pixels, expected_unconverted)
+            self.assertTrue(12 in unconverted_pixels)
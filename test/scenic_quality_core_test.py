@@ -30,6 +30,11 @@ LOGGER = logging.getLogger('scenic_quality_test')
 logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s \
     %(message)s', level=logging.DEBUG, datefmt='%m/%d/%Y %H:%M:%S ')
 
+def constant_valuation(distance, visible, valuation_args):
+    """Valuation function registered by the tests: a everywhere visible"""
+    return np.where(np.asarray(visible) == 1, \
+        valuation_args['a_coefficient'], 0.)
+
 class TestScenicQuality(unittest.TestCase):
     """Main testing class for the scenic quality tests"""
     
@@ -592,6 +597,70 @@ class TestScenicQuality(unittest.TestCase):
         elevation[viewpoint[0], viewpoint[1]] = 2
         #print(elevation)
 
+    def test_viewshed_window(self):
+        """The window a viewshed is computed over should be the bounding box
+            of its perimeter cells."""
+        array_shape = (9, 12)
+        for viewpoint in [(4, 5), (0, 0), (8, 11), (2, 10)]:
+            for max_dist in [-1, 2, 3, 20]:
+                perimeter = sqc.get_perimeter_cells( \
+                    array_shape, viewpoint, max_dist)
+                window = sq.viewshed_window(array_shape, viewpoint, max_dist)
+                self.assertEqual(window, (np.amin(perimeter[0]), \
+                    np.amax(perimeter[0]) + 1, np.amin(perimeter[1]), \
+                    np.amax(perimeter[1]) + 1))
+
+    def test_valuation_functions(self):
+        """The array valuation functions should match their formulas on both
+            sides of 1000 meters, beyond the valuation radius and where
+            pixels aren't visible."""
+        valuation_args = {
+            'valuation_function': 'polynomial: a + bx + cx^2 + dx^3',
+            'a_coefficient': 1.,
+            'b_coefficient': 2.,
+            'c_coefficient': 0.001,
+            'd_coefficient': 0.,
+            'max_valuation_radius': 5000.,
+        }
+        distance = np.array([[500., 2000.], [6000., 2000.]])
+        visible = np.array([[1, 1], [1, 0]])
+        polynomial = sq.get_valuation_function(valuation_args)
+        np.testing.assert_almost_equal(polynomial(distance, visible), \
+            [[1. + 2000. + 1000. - 4. * 500., 1. + 4000. + 4000.], [0., 0.]])
+
+        valuation_args['valuation_function'] = 'logarithmic: a + b ln(x)'
+        logarithmic = sq.get_valuation_function(valuation_args)
+        np.testing.assert_almost_equal(logarithmic(distance, visible), \
+            [[1. + 2. * math.log(1000) - 0.002 * 500., \
+            1. + 2. * math.log(2000)], [0., 0.]])
+
+        valuation_args['valuation_function'] = 'exponential'
+        self.assertRaises( \
+            ValueError, sq.get_valuation_function, valuation_args)
+
+    def test_register_valuation_function_in_worker(self):
+        """A registered valuation function should be found again from its
+            import path, as a spawned worker's initializer does."""
+        sq.register_valuation_function('constant', constant_valuation)
+        try:
+            function_path_list = sq.valuation_function_paths()
+            self.assertTrue(('constant', constant_valuation.__module__, \
+                'constant_valuation') in function_path_list)
+
+            # a fresh worker only knows the built in functions
+            del sq.VALUATION_FUNCTIONS['constant']
+            sq._register_valuation_functions(function_path_list)
+            valuation_args = {
+                'valuation_function': 'constant',
+                'a_coefficient': 3.,
+                'max_valuation_radius': 5000.,
+            }
+            constant = sq.get_valuation_function(valuation_args)
+            np.testing.assert_almost_equal(constant( \
+                np.array([10., 20.]), np.array([1, 0])), [3., 0.])
+        finally:
+            sq.VALUATION_FUNCTIONS.pop('constant', None)
+
     def cell_row(self, cell_id, col_count):
         """Compute the row index from a cell ID"""
         return float(cell_id / col_count)
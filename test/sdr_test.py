@@ -0,0 +1,90 @@
+"""Tests for the fused block-wise local operations of the SDR model"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy
+
+from invest_natcap.sdr import sdr
+
+import invest_test_core
+
+
+class TestFusedLocalOps(unittest.TestCase):
+    def setUp(self):
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace_dir)
+
+    def test_reclassify_block(self):
+        """Lulc codes map to table values and nodata to the output nodata"""
+        lulc_block = numpy.array([[1, 3, 255], [3, 7, 1]])
+        lulc_nodata_mask = lulc_block == 255
+        lucode_array = numpy.array([1, 3, 7])
+        value_array = numpy.array([0.5, 0.25, 2.0])
+
+        result = sdr._reclassify_block(
+            lulc_block, lulc_nodata_mask, lucode_array, value_array, -1.0)
+
+        expected = numpy.array([[0.5, 0.25, -1.0], [0.25, 2.0, 0.5]])
+        numpy.testing.assert_array_equal(result, expected)
+
+        lulc_block[1, 1] = 4
+        self.assertRaises(
+            ValueError, sdr._reclassify_block, lulc_block, lulc_nodata_mask,
+            lucode_array, value_array, -1.0)
+
+    def test_fused_vectorize_datasets(self):
+        """Every output of the block op lands in its own target raster"""
+        a_array = numpy.arange(35, dtype=numpy.float32).reshape((7, 5))
+        b_array = numpy.ones((7, 5), dtype=numpy.int16)
+        b_array[2, 3] = -1
+        a_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'a.tif', a_array, gdal.GDT_Float32, -1.0)
+        b_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'b.tif', b_array, gdal.GDT_Int16, -1)
+        sum_uri = os.path.join(self.workspace_dir, 'sum.tif')
+        mask_uri = os.path.join(self.workspace_dir, 'mask.tif')
+
+        def block_op(a_block, b_block):
+            """sums the blocks and flags where b is nodata"""
+            return (
+                numpy.where(b_block == -1, -1.0, a_block + b_block),
+                (b_block == -1).astype(numpy.byte))
+
+        sdr._fused_vectorize_datasets(
+            [a_uri, b_uri], block_op,
+            [(sum_uri, gdal.GDT_Float32, -1.0),
+             (mask_uri, gdal.GDT_Byte, 255)])
+
+        expected_sum = a_array + 1
+        expected_sum[2, 3] = -1.0
+        expected_mask = numpy.zeros((7, 5), dtype=numpy.byte)
+        expected_mask[2, 3] = 1
+        for target_uri, expected, nodata in [
+                (sum_uri, expected_sum, -1.0), (mask_uri, expected_mask, 255)]:
+            target_dataset = gdal.Open(target_uri)
+            target_band = target_dataset.GetRasterBand(1)
+            self.assertEqual(target_band.GetNoDataValue(), nodata)
+            numpy.testing.assert_array_equal(
+                target_band.ReadAsArray(), expected)
+            target_band = None
+            target_dataset = None
+
+    def test_fused_vectorize_datasets_size_mismatch(self):
+        """Rasters on different grids are rejected"""
+        a_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'a.tif', numpy.zeros((3, 3)), gdal.GDT_Float32,
+            -1.0)
+        b_uri = invest_test_core.make_raster(
+            self.workspace_dir, 'b.tif', numpy.zeros((3, 4)), gdal.GDT_Float32,
+            -1.0)
+        self.assertRaises(
+            ValueError, sdr._fused_vectorize_datasets, [a_uri, b_uri],
+            lambda a_block, b_block: (a_block,),
+            [(os.path.join(self.workspace_dir, 'out.tif'), gdal.GDT_Float32,
+              -1.0)])
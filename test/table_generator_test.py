@@ -271,3 +271,30 @@ class TestTableGenerator(unittest.TestCase):
         table_string = table_generator.generate_table(sample_dict, attributes)
 
         self.assertEqual(expected_result, table_string)
+
+    def test_iter_table_row_generator(self):
+        """Unit test for creating a table a row at a time from a generator
+            of row dictionaries"""
+
+        def row_generator():
+            for product, date in [('chips', '9/13'), ('peanuts', '3/13')]:
+                yield {'product':product, 'date':date}
+
+        sample_dict = {
+                'cols':[{'name':'product', 'total':False},
+                        {'name':'date', 'total':False}],
+                'rows':row_generator(),
+                'checkbox':False,
+                'total':False
+                }
+
+        expected_result = [
+                "<table><thead><tr><th>product</th><th>date</th></tr></thead>"
+                "<tbody>",
+                "<tr><td>chips</td><td>9/13</td></tr>",
+                "<tr><td>peanuts</td><td>3/13</td></tr>",
+                "</tbody></table>"]
+
+        table_pieces = list(table_generator.iter_table(sample_dict))
+
+        self.assertEqual(expected_result, table_pieces)
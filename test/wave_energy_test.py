@@ -705,6 +705,49 @@ class TestWaveEnergy(unittest.TestCase):
             else:
                 self.assertEqual(0, 1, 'The keys do not match')
 
+    def test_wave_energy_compute_wave_energy_capacity_batch(self):
+        """Test compute_wave_energy_capacity_batch on two machines at once
+            using hand generated values and results."""
+
+        bin_matrix = {(520, 490):[[0, 2, 2.6, 1.8, 1.4],
+                                  [1.6, 3, 3.4, 2.6, .6],
+                                  [0, .6, 2.2, 1.8, 1.4],
+                                  [2.2, 3.4, 4.6, 3.8, 2.4]],
+                      (521, 491):[[-.2, 1.3, 2.66, 1.8, 1.4],
+                                  [-1.6, -1, 34, 2.6, 0],
+                                  [.4, .6, 2.3, 1.8, 1.45],
+                                  [2.2, 3.4, 4.6, 3.8, 2.4]]}
+        point_list = [(520, 490), (521, 491)]
+        wave_tensor = {
+            'periods':np.array([1, 2, 3, 4, 5]),
+            'heights':np.array([1, 2, 3, 4]),
+            'bin_tensor':np.array(
+                [bin_matrix[point] for point in point_list], dtype='f')}
+
+        interp_z_list = [[[0, 0, 1, 3, 8], [0, 3, 5, 9, 7],
+                          [1, 4, 5, 3, 0], [0, 0, 0, 0, 0]],
+                         [[-1, 0, 2, 3, 8], [0, 3, -5, 9, 7],
+                          [1, 4, 5, 30, 0], [2, 0, 1, 0, 4]]]
+        #The first machine cuts off periods above 4 and heights above 3, the
+        #second only caps interp_z at 6
+        machine_param_list = [{'capmax':20, 'tpmax':4, 'hsmax':3},
+                              {'capmax':6, 'tpmax':10, 'hsmax':10}]
+        #Hand calculated results, one row per machine. For the second machine
+        #the rows of the clipped products sum to 19 + 28.2 + 24.2 + 18.6 at
+        #the first point and 19.32 + 15.6 + 25.1 + 18.6 at the second, with
+        #negative products dropped
+        result = [[0.0762, 0.22116], [0.09, 0.07862]]
+
+        energy_cap = wave_energy.compute_wave_energy_capacity_batch(
+            wave_tensor, interp_z_list, machine_param_list)
+        self.assertEqual(energy_cap.shape, (2, 2))
+
+        for machine_index in range(2):
+            for point_index in range(2):
+                self.assertAlmostEqual(
+                    result[machine_index][point_index],
+                    energy_cap[machine_index, point_index], 8)
+
     def test_wave_energy_wave_energy_interp(self):
         """Test wave_energy_interp by using hand calculations and hand
             calculated results based on the given inputs.
@@ -7,6 +7,7 @@ import random
 import logging
 import csv
 import pickle
+import struct
 
 from osgeo import ogr
 from osgeo import gdal
@@ -128,6 +129,32 @@ class TestWindEnergyFunctionUnit(testing.GISTest):
         for exp, res in zip(expected_list, result):
             self.assertAlmostEqual(exp, res, 4)
     
+    def test_wind_energy_nearest_segment_distance(self):
+        """A unit test comparing the indexed nearest segment distances to
+            measuring every segment"""
+        np.random.seed(0)
+        angles = np.linspace(0, 2 * np.pi, 500)
+        radii = 1000 + 100 * np.sin(12 * angles)
+        ring = np.column_stack((radii * np.cos(angles), radii * np.sin(angles)))
+        # A ring, one very long segment and a point
+        segments = np.vstack((
+                np.hstack((ring[:-1], ring[1:])),
+                [[-5000, -5000, 5000, -5000], [3000, 3000, 3000, 3000]]))
+        points = np.random.uniform(-6000, 6000, (300, 2))
+
+        result = wind_energy.nearest_segment_distance(
+                points, segments, batch_size=64)
+
+        for point, distance in zip(points, result):
+            delta = segments[:, 2:] - segments[:, :2]
+            position = np.clip(
+                    np.sum((point - segments[:, :2]) * delta, axis=1) /
+                    np.maximum(np.sum(delta**2, axis=1), 1e-12), 0, 1)
+            nearest = segments[:, :2] + position[:, np.newaxis] * delta
+            expected = np.min(np.hypot(
+                    nearest[:, 0] - point[0], nearest[:, 1] - point[1]))
+            self.assertAlmostEqual(expected, distance, 6)
+
     def test_wind_energy_get_points_geometries(self):
         """A unit test for properly reading coordinates into a list from a
             point shapefile """
@@ -145,6 +172,173 @@ class TestWindEnergyFunctionUnit(testing.GISTest):
 
         self.assertTrue((expected_list == result).all())
 
+    def test_wind_energy_weibull_energy_integrals(self):
+        """A unit test comparing the closed form Weibull integrals to
+            numerical integration"""
+        from scipy import integrate
+
+        shape_array = np.array([0.9, 1.7, 2.0, 3.5])
+        scale_array = np.array([4.5, 8.2, 10.0, 12.7])
+        v_in, v_rate, v_out, exp_pwr_curve = 4.0, 12.0, 25.0, 2
+
+        density, harvested = wind_energy.weibull_energy_integrals(
+                shape_array, scale_array, v_in, v_rate, v_out, exp_pwr_curve)
+
+        def weibull_probability(v_speed, k_shape, l_scale):
+            return ((k_shape / l_scale) * (v_speed / l_scale)**(k_shape - 1) *
+                    (math.exp(-1 * (v_speed/l_scale)**k_shape)))
+
+        def fraction_probability(v_speed, k_shape, l_scale):
+            fract = ((v_speed**exp_pwr_curve - v_in**exp_pwr_curve) /
+                (v_rate**exp_pwr_curve - v_in**exp_pwr_curve))
+            return fract * weibull_probability(v_speed, k_shape, l_scale)
+
+        for index in xrange(len(shape_array)):
+            params = (shape_array[index], scale_array[index])
+            expected_density = integrate.quad(
+                    lambda v, k, l: weibull_probability(v, k, l) * v**3,
+                    0, 50, params)[0]
+            expected_harvested = (
+                    integrate.quad(
+                        fraction_probability, v_in, v_rate, params)[0] +
+                    integrate.quad(
+                        weibull_probability, v_rate, v_out, params)[0])
+            self.assertAlmostEqual(
+                    density[index] / expected_density, 1.0, 6)
+            self.assertAlmostEqual(harvested[index], expected_harvested, 6)
+
+    def test_wind_energy_calculate_distances_land_grid(self):
+        """A unit test for the distance to the nearest land point plus its
+            land to grid distance"""
+        output_dir = os.path.join(
+                TEST_DIR, 'wind_energy/valuation/calculate_distances_land_grid')
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        base_uri = os.path.join(output_dir, 'harvested_by_hand.tif')
+        land_uri = os.path.join(output_dir, 'land_points_by_hand.shp')
+        out_uri = os.path.join(output_dir, 'land_grid_dist.tif')
+
+        srs = osr.SpatialReference()
+        srs.SetUTM( 11, 1 )
+        srs.SetWellKnownGeogCS( 'NAD27' )
+
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(base_uri, 5, 3, 1, gdal.GDT_Float32)
+        dataset.SetProjection( srs.ExportToWkt() )
+        dataset.SetGeoTransform( [444720, 30, 0, 3751320, 0, -30 ] )
+        dataset.GetRasterBand(1).SetNoDataValue(-1.0)
+        dataset.GetRasterBand(1).Fill(1.0)
+        dataset = None
+
+        if os.path.isfile(land_uri):
+            os.remove(land_uri)
+        shape_driver = ogr.GetDriverByName('ESRI Shapefile')
+        datasource = shape_driver.CreateDataSource(land_uri)
+        layer = datasource.CreateLayer('land_points', srs, ogr.wkbPoint)
+        layer.CreateField(ogr.FieldDefn('L2G', ogr.OFTReal))
+        # Points in the centers of pixels (0, 0) and (2, 4) with land to grid
+        # distances of 1000 and 10
+        for x_pos, y_pos, l2g in [
+                (444735, 3751305, 1000.0), (444855, 3751245, 10.0)]:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(x_pos, y_pos)
+            feature.SetGeometry(point)
+            feature.SetField('L2G', l2g)
+            layer.CreateFeature(feature)
+            feature = None
+        layer = None
+        datasource = None
+
+        wind_energy.calculate_distances_land_grid(land_uri, base_uri, out_uri)
+
+        rows, cols = np.mgrid[0:3, 0:5]
+        dist_first = np.sqrt(rows**2 + cols**2) * 30 + 1000.0
+        dist_second = np.sqrt((rows - 2)**2 + (cols - 4)**2) * 30 + 10.0
+        # Pixels equally far from both points take the first point
+        expected_results = np.where(
+                np.sqrt((rows - 2)**2 + (cols - 4)**2) <
+                np.sqrt(rows**2 + cols**2), dist_second, dist_first)
+
+        result_ds = gdal.Open(out_uri)
+        result_array = result_ds.GetRasterBand(1).ReadAsArray()
+        result_ds = None
+
+        np.testing.assert_array_almost_equal(
+                result_array, expected_results, 3)
+
+    def test_wind_energy_calculate_distances_land_grid_ties(self):
+        """A unit test for pixels equally far from more than a few land
+            points, which take the first of them"""
+        output_dir = os.path.join(
+                TEST_DIR, 'wind_energy/valuation/calculate_distances_land_grid')
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        base_uri = os.path.join(output_dir, 'harvested_ties.tif')
+        land_uri = os.path.join(output_dir, 'land_points_ties.shp')
+        out_uri = os.path.join(output_dir, 'land_grid_dist_ties.tif')
+
+        srs = osr.SpatialReference()
+        srs.SetUTM( 11, 1 )
+        srs.SetWellKnownGeogCS( 'NAD27' )
+
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(base_uri, 11, 11, 1, gdal.GDT_Float32)
+        dataset.SetProjection( srs.ExportToWkt() )
+        dataset.SetGeoTransform( [444720, 30, 0, 3751320, 0, -30 ] )
+        dataset.GetRasterBand(1).SetNoDataValue(-1.0)
+        dataset.GetRasterBand(1).Fill(1.0)
+        dataset = None
+
+        # The twelve pixels 5 pixels from the center pixel (5, 5), with land
+        # to grid distances that shrink with the feature order
+        offsets = [
+                (3, 4), (4, 3), (-3, 4), (-4, 3), (3, -4), (4, -3),
+                (-3, -4), (-4, -3), (5, 0), (0, 5), (-5, 0), (0, -5)]
+        point_rows = np.array([5 + row_offset for row_offset, _ in offsets])
+        point_cols = np.array([5 + col_offset for _, col_offset in offsets])
+        l2g_dist = 200.0 - 10.0 * np.arange(len(offsets))
+
+        if os.path.isfile(land_uri):
+            os.remove(land_uri)
+        shape_driver = ogr.GetDriverByName('ESRI Shapefile')
+        datasource = shape_driver.CreateDataSource(land_uri)
+        layer = datasource.CreateLayer('land_points', srs, ogr.wkbPoint)
+        layer.CreateField(ogr.FieldDefn('L2G', ogr.OFTReal))
+        for row, col, l2g in zip(point_rows, point_cols, l2g_dist):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(444735 + 30 * col, 3751305 - 30 * row)
+            feature.SetGeometry(point)
+            feature.SetField('L2G', l2g)
+            layer.CreateFeature(feature)
+            feature = None
+        layer = None
+        datasource = None
+
+        wind_energy.calculate_distances_land_grid(land_uri, base_uri, out_uri)
+
+        # argmin takes the first of the nearest points
+        rows, cols = np.mgrid[0:11, 0:11]
+        squared_dist = (
+                (rows[..., np.newaxis] - point_rows) ** 2 +
+                (cols[..., np.newaxis] - point_cols) ** 2)
+        nearest = np.argmin(squared_dist, axis=2)
+        expected_results = (
+                np.sqrt(squared_dist.min(axis=2)) * 30 + l2g_dist[nearest])
+        self.assertAlmostEqual(expected_results[5, 5], 5 * 30 + 200.0)
+
+        result_ds = gdal.Open(out_uri)
+        result_array = result_ds.GetRasterBand(1).ReadAsArray()
+        result_ds = None
+
+        np.testing.assert_array_almost_equal(
+                result_array, expected_results, 3)
+
     def test_wind_energy_get_dictionary_from_shape(self):
         """A unit test for building a dictionary from a shapefile"""
         #raise SkipTest
@@ -206,6 +400,41 @@ class TestWindEnergyFunctionUnit(testing.GISTest):
         self.assertRaises(
                wind_energy.HubHeightError, wind_energy.read_binary_wind_data, 
                wind_data_uri, field_list) 
+
+    def test_wind_energy_read_binary_wind_array(self):
+        """Unit test that only the requested columns of the points in the
+            bounding box are read"""
+        #raise SkipTest
+
+        output_dir = os.path.join(
+                TEST_DIR, 'wind_energy/biophysical/read_binary_wind_array')
+
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        wind_data_uri = os.path.join(output_dir, 'wind_data.bin')
+        wind_file = open(wind_data_uri, 'wb')
+        # LONG, LATI and then every hub height column set to the point index
+        for point_index, (longitude, latitude) in enumerate(
+                [(-70.0, 40.0), (-250.0, 41.0), (-71.5, 45.0), (-69.0, 40.5)]):
+            wind_file.write(struct.pack(
+                '<' + 'f' * 18, longitude, latitude, *([point_index] * 16)))
+        wind_file.close()
+
+        field_list = ['LATI', 'LONG', 'Ram-050m', 'K-010m']
+        bounding_box = [-72.0, 39.0, -69.5, 42.0]
+
+        wind_array = wind_energy.read_binary_wind_array(
+                wind_data_uri, field_list, bounding_box)
+
+        self.assertEqual(list(wind_array.dtype.names), field_list)
+        # The second point's longitude is -250 which is -250 + 360 = 110
+        np.testing.assert_array_equal(wind_array['LATI'], [40.0])
+        np.testing.assert_array_equal(wind_array['Ram-050m'], [0.0])
+
+        wind_array = wind_energy.read_binary_wind_array(
+                wind_data_uri, field_list)
+        np.testing.assert_array_equal(wind_array['K-010m'], [0, 1, 2, 3])
    
 
 class TestWindEnergyFunctionRegression(testing.GISTest):